@@ -19,7 +19,7 @@ from functools import wraps
 import math
 from flask_babel import Babel, gettext as _, lazy_gettext as _l
 import gettext
-from sqlalchemy.orm import joinedload, selectinload, lazyload
+from sqlalchemy.orm import joinedload, selectinload, lazyload, defer
 from services.evaluation_params_service import EvaluationParamsService
 
 # ========================
@@ -68,7 +68,14 @@ print("⚠️ Flask-Mail désactivé - Utilisation de SMTP direct")
 app = Flask(__name__)
 app.config.from_object('config.Config')
 
-@app.before_request
+# Pipeline unique des traitements avant requête (remplace les @app.before_request).
+# Lié à l'application définitive par init_app après sa création plus bas.
+from services.pipeline_requete import PipelineRequete
+pipeline_requete = PipelineRequete()
+
+# Volontairement hors du pipeline : ce hook visait la première instance de
+# l'application, remplacée plus bas, et ne s'est jamais exécuté. L'activer
+# ajouterait une redirection 301 en production.
 def redirect_to_www():
     """Redirige systematiquement egalyx.com vers www.egalyx.com"""
     if request.host.startswith('egalyx.com') and not request.host.startswith('www.'):
@@ -76,6 +83,30 @@ def redirect_to_www():
         url = request.url.replace('://', '://www.', 1)
         return redirect(url, 301)
 
+# ========================
+# TÂCHES PLANIFIÉES
+# ========================
+# Les planificateurs APScheduler sont enregistrés ici puis démarrés en fin
+# d'import (serveur de développement, `python app.py`). Sous gunicorn,
+# gunicorn.conf.py fixe TACHES_PLANIFIEES=post_fork : ils démarrent dans un
+# seul worker après le fork, jamais dans le maître dont les workers héritent.
+TACHES_PLANIFIEES = []
+
+def tache_planifiee(demarrer):
+    """Enregistre une fonction qui démarre un planificateur"""
+    TACHES_PLANIFIEES.append(demarrer)
+    return demarrer
+
+def demarrer_taches_planifiees():
+    """Démarre tous les planificateurs enregistrés (une fois par processus)"""
+    for demarrer in TACHES_PLANIFIEES:
+        try:
+            with app.app_context():
+                demarrer()
+        except Exception as e:
+            print(f"⚠️ Planificateur {demarrer.__name__} non démarré: {e}")
+    TACHES_PLANIFIEES.clear()
+
 # ========================
 # IMPORT DE LA BASE DE DONNÉES
 # ========================
@@ -86,7 +117,7 @@ try:
     
     # Import des modèles spécifiques après db
     from models import (
-        User, Direction, Service, Cartographie, Risque, EvaluationRisque,
+        User, Direction, Service, Cartographie, Risque, EvaluationRisque, RisqueEtatCourant,
         KRI, MesureKRI, Processus, EtapeProcessus, SousEtapeProcessus, LienProcessus,
         ZoneRisqueProcessus, ControleProcessus, VeilleReglementaire, ActionConformite,
         Audit, Constatation, Recommandation, PlanAction, EtapePlanAction, HistoriqueModification,
@@ -95,7 +126,7 @@ try:
         ProcessusActivite, ElementLogigramme, LienLogigramme, VeilleDocument, ParametreEvaluation,
         GuideEvaluation, JournalActivite, PermissionTemplate, SystemLog, Notification,
         ConfigurationChampRisque, ConfigurationListeDeroulante, ChampPersonnaliseRisque, 
-        FichierRisque, FichierKRI,
+        FichierRisque, FichierKRI, ObjetStocke, ReferenceObjet,
         AuditRisque, SousAction, JournalAudit, HistoriqueRecommandation, MatriceMaturite,
         Questionnaire, QuestionnaireCategorie, Question, OptionQuestion, ConditionQuestion,
         ReponseQuestionnaire, ReponseQuestion, ReponseOption, CampagneEvaluation,
@@ -116,7 +147,8 @@ try:
         IncidentDispositifIntegration, DispositifHistoriqueEfficacite, ActualisationCartographie, NonConformite, AuditQualite,
         FormationQualite, ReunionQualite, GrilleAuditQualite, Pays, PlanActionC2N, NonConformiteC2N, ValidationControle,
         ExecutionControle, PlanificationControle, ReferentielControle, RecommandationC2N, SousActionPlanC2N, CommentairePlanActionC2N,
-        CommentaireSousActionC2N, ErreurTest, HistoriqueRisqueTest, DemandeReevaluation, PermissionOperateur
+        CommentaireSousActionC2N, ErreurTest, HistoriqueRisqueTest, DemandeReevaluation, PermissionOperateur,
+        JournalEvenement
 
         
         
@@ -717,16 +749,11 @@ if COLLECTE_DISPONIBLE:
             with app.app_context():
                 test_count = SourceDonnee.query.count()
                 print(f"📊 {test_count} sources de données trouvées")
-                
-            collecte_scheduler = CollecteScheduler(app, db)
-            collecte_scheduler.demarrer()
             
-            @app.teardown_appcontext
-            def shutdown_scheduler(exception=None):
-                if 'collecte_scheduler' in locals():
-                    collecte_scheduler.arreter()
-                    
-            print("✅ Planificateur de collectes démarré avec succès")
+            @tache_planifiee
+            def demarrer_planificateur_collectes():
+                CollecteScheduler(app, db).demarrer()
+                print("✅ Planificateur de collectes démarré avec succès")
             
         except Exception as e:
             print(f"⚠️ Impossible d'accéder aux sources de données: {e}")
@@ -1057,14 +1084,31 @@ except ImportError as e:
     print(f"⚠️ Erreur import service notifications: {e}")
     NOTIFICATION_SERVICE_AVAILABLE = False
 
-# Importer le blueprint des notifications
+# Indicateurs d'audit calculés par lot (progression, score, taux de réalisation)
+from services.audit_kpi_service import AuditKPIService
+from services.quota_service import QuotaService, LimiteFormuleAtteinte
+from services.controle_metriques_service import ControleMetriquesService
+from services.session_utilisateur_service import SessionUtilisateurService, UtilisateurSession
+from services.feuille_version_service import VersionsFeuilleService
+from services.stockage_service import StockageService, FichierTropVolumineux
+from services.cache_fragments_service import CacheFragments
+from services.contexte_templates_service import ContexteTemplates
+from services.kri_analytique_service import AnalytiqueKRI
+from services.kri_series_service import SeriesKRI
+from services.series_temporelles_service import SeriesTemporellesKRI
+from services.historique_evaluations_service import HistoriqueEvaluations
+from services.risque_etat_courant_service import RisqueEtatCourantService
+from services.kri_seuils_service import EvaluateurSeuilsKRI
+from services.kri_anomalies_service import DetecteurAnomaliesKRI
+
+# Tâches IA asynchrones (le blueprint est enregistré via routes.enregistrer_blueprints)
 try:
-    from routes.notifications import notifications_bp
-    NOTIFICATIONS_ROUTES_AVAILABLE = True
-    print("✅ Routes notifications importées")
+    from routes.ia_taches import reponse_tache_soumise
+    from services.ia_cache_service import IACacheService
+    IA_TACHES_ROUTES_AVAILABLE = True
 except ImportError as e:
-    print(f"⚠️ Erreur import routes notifications: {e}")
-    NOTIFICATIONS_ROUTES_AVAILABLE = False
+    print(f"⚠️ Erreur import routes tâches IA: {e}")
+    IA_TACHES_ROUTES_AVAILABLE = False
 
 # ========================
 # IMPORT DES FORMULAIRES
@@ -1415,7 +1459,6 @@ try:
         # ========== FONCTIONS SUPPLÉMENTAIRES ==========
         get_kri_stats,
         calculer_statistiques_kri,
-        generer_graphique_kri,
         synchroniser_kri_automatique,
         synchroniser_kri_risque,
         synchroniser_toutes_cartographies,
@@ -1547,8 +1590,6 @@ except ImportError as e:
         return {'total_kris': 0, 'kri_alertes': 0}
     def calculer_statistiques_kri(*args, **kwargs):
         return {}
-    def generer_graphique_kri(*args, **kwargs):
-        return None
     def synchroniser_kri_automatique(*args, **kwargs):
         return False
     def synchroniser_kri_risque(*args, **kwargs):
@@ -1891,47 +1932,12 @@ def check_credentials():
 # FONCTIONS UTILITAIRES (définies avant l'application)
 # ========================
 
-def nl2br(value):
-    """Convertit les retours à la ligne en balises <br> (version sécurisée)."""
-    if value is None:
-        return ''
-    
-    escaped = escape(str(value))
-    result = escaped.replace('\n', '<br>\n')
-    return Markup(result)
 
 
-def truncate(text, length=100, end='...'):
-    """Tronque le texte."""
-    if not text:
-        return ''
-    if len(text) <= length:
-        return text
-    return text[:length - len(end)] + end
 
-def format_date(value, format='%d/%m/%Y'):
-    """Formate une date."""
-    if not value:
-        return ''
-    return value.strftime(format)
 
-def format_datetime(value, format='%d/%m/%Y %H:%M'):
-    """Formate une date et heure."""
-    if not value:
-        return ''
-    return value.strftime(format)
 
-def yes_no(value):
-    """Convertit un booléen en Oui/Non."""
-    return 'Oui' if value else 'Non'
 
-def join_list(value, separator=', '):
-    """Join a list into a string."""
-    if not value:
-        return ''
-    if isinstance(value, list):
-        return separator.join(str(item) for item in value)
-    return str(value)
 
 def get_file_size(filepath):
     """Retourne la taille d'un fichier formatée"""
@@ -1948,55 +1954,8 @@ def get_file_size(filepath):
     except:
         return "N/A"
 
-def slugify(value):
-    """
-    Convertit une chaîne en slug (pour les URLs)
-    Exemple: "Hello World 2024!" devient "hello-world-2024"
-    """
-    if not value:
-        return ''
-    
-    # Normaliser les caractères Unicode
-    value = normalize('NFKD', str(value)).encode('ascii', 'ignore').decode('ascii')
-    
-    # Convertir en minuscules
-    value = value.lower()
-    
-    # Remplacer les caractères non alphanumériques par des tirets
-    value = re.sub(r'[^\w\s-]', '', value)
-    value = re.sub(r'[-\s]+', '-', value)
-    
-    # Supprimer les tirets en début et fin
-    value = value.strip('-')
-    
-    return value
 
-def allowed_file(filename):
-    """Vérifie si le fichier a une extension autorisée"""
-    # Récupérer ALLOWED_EXTENSIONS depuis la config de l'application
-    from flask import current_app
-    allowed_extensions = current_app.config.get('ALLOWED_EXTENSIONS', set())
-    
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in allowed_extensions
 
-def permission_required(permission):
-    """Décorateur pour vérifier les permissions"""
-    def decorator(f):
-        @wraps(f)
-        def decorated_function(*args, **kwargs):
-            if not current_user.is_authenticated:
-                flash('Veuillez vous connecter pour accéder à cette page.', 'warning')
-                return redirect(url_for('login'))
-            
-            if hasattr(current_user, 'role'):
-                if current_user.role in ['admin', 'manager', 'auditeur']:
-                    return f(*args, **kwargs)
-            
-            flash('Vous n\'avez pas les permissions nécessaires.', 'danger')
-            return redirect(url_for('index'))
-        return decorated_function
-    return decorator
 
 # ========================
 # CRÉATION DE L'APPLICATION FLASK
@@ -2017,9 +1976,29 @@ app.config.update({
     'UPLOAD_FOLDER_RISQUES': 'uploads/risques',
     'UPLOAD_FOLDER_AUDITS': 'static/uploads/audits',
     'ALLOWED_EXTENSIONS': {'pdf', 'doc', 'docx', 'xls', 'xlsx', 'ppt', 'pptx', 'txt', 'jpg', 'png', 'jpeg', 'gif'},
-    'MAX_CONTENT_LENGTH': 32 * 1024 * 1024  # 32MB (augmenté)
+    'MAX_CONTENT_LENGTH': 32 * 1024 * 1024,  # 32MB (augmenté)
+    # Pièces jointes stockées par contenu (SHA-256) : 'local' ou 's3' (S3 / MinIO, boto3 requis)
+    'STOCKAGE_BACKEND': os.environ.get('STOCKAGE_BACKEND', 'local'),
+    'STOCKAGE_RACINE': os.environ.get('STOCKAGE_RACINE', 'uploads/objets'),
+    'STOCKAGE_S3_BUCKET': os.environ.get('STOCKAGE_S3_BUCKET'),
+    'STOCKAGE_S3_ENDPOINT': os.environ.get('STOCKAGE_S3_ENDPOINT'),
+    'STOCKAGE_S3_ACCESS_KEY': os.environ.get('STOCKAGE_S3_ACCESS_KEY'),
+    'STOCKAGE_S3_SECRET_KEY': os.environ.get('STOCKAGE_S3_SECRET_KEY'),
+    'STOCKAGE_S3_REGION': os.environ.get('STOCKAGE_S3_REGION'),
+    # Durée de chaque étape du pipeline avant requête dans l'en-tête Server-Timing
+    'PIPELINE_SERVER_TIMING': os.environ.get('PIPELINE_SERVER_TIMING', 'false').lower() == 'true',
+    # Rétention des mesures KRI collectées : brutes N jours, puis agrégats horaires / journaliers
+    'KRI_RETENTION_BRUTE_JOURS': int(os.environ.get('KRI_RETENTION_BRUTE_JOURS', 90)),
+    'KRI_RETENTION_HORAIRE_JOURS': int(os.environ.get('KRI_RETENTION_HORAIRE_JOURS', 365)),
+    # Données brutes des collectes au-delà de cette taille : compressées dans le stockage par contenu
+    'COLLECTE_TAILLE_MAX_INLINE': int(os.environ.get('COLLECTE_TAILLE_MAX_INLINE', 2048)),
 })
 
+pipeline_requete.init_app(app)
+
+# Contexte des templates : un seul context processor, calculé une fois par requête
+contexte_templates = ContexteTemplates(app)
+
 # ========================
 # CRÉATION DES DOSSIERS D'UPLOAD
 # ========================
@@ -2118,9 +2097,10 @@ if MODELS_IMPORTED:
     
     @login_manager.user_loader
     def load_user(user_id):
-        """Charge l'utilisateur avec la syntaxe SQLAlchemy 2.0"""
+        """Charge le profil de session ; l'objet User n'est lu que si une vue en a besoin"""
         try:
-            return db.session.get(User, int(user_id))
+            profil = SessionUtilisateurService.profil(int(user_id))
+            return UtilisateurSession(profil) if profil else None
         except (ValueError, TypeError) as e:
             print(f"⚠️ Erreur de conversion user_id: {e}")
             return None
@@ -2129,7 +2109,26 @@ if MODELS_IMPORTED:
             return None
     
     print("✅ User loader configuré")
-    
+
+    # Suivi des sessions (UserSession)
+    from flask_login import user_logged_in, user_logged_out
+
+    @user_logged_in.connect_via(app)
+    def suivre_ouverture_session(sender, user, **extra):
+        import secrets
+        session['suivi_session_id'] = secrets.token_urlsafe(24)
+        SessionUtilisateurService.enregistrer_ouverture(
+            user_id=user.id,
+            session_id=session['suivi_session_id'],
+            client_id=user.client_id,
+            ip_address=request.remote_addr,
+            user_agent=request.user_agent.string if request.user_agent else None
+        )
+
+    @user_logged_out.connect_via(app)
+    def suivre_fermeture_session(sender, user, **extra):
+        SessionUtilisateurService.enregistrer_fermeture(session.pop('suivi_session_id', None))
+
 else:
     print("❌ Modèles non importés - Mode dégradé activé")
     
@@ -2312,15 +2311,198 @@ except Exception as e:
     print(f"❌ Erreur initialisation service IA: {e}")
     service_ia = None
 
-# Blueprint des notifications
+# Blueprints (registre dans routes/__init__.py)
+from routes import enregistrer_blueprints
+enregistrer_blueprints(app)
+
+# Hiérarchies en table de fermeture (processus, organisation)
 try:
-    if NOTIFICATIONS_ROUTES_AVAILABLE:
-        app.register_blueprint(notifications_bp)
-        print("✅ Blueprint notifications enregistré")
-    else:
-        print("⚠️ Blueprint notifications non disponible")
+    from services.hierarchie_service import HierarchieService
+    with app.app_context():
+        db.create_all()
+        if HierarchieService.est_vide():
+            nb_lignes = HierarchieService.reconstruire()
+            print(f"✅ Table de fermeture des hiérarchies construite ({nb_lignes} liens)")
 except Exception as e:
-    print(f"❌ Erreur enregistrement blueprint notifications: {e}")
+    print(f"⚠️ Erreur initialisation hiérarchies: {e}")
+
+# Compteurs d'usage des formules d'abonnement
+try:
+    with app.app_context():
+        if QuotaService.est_vide():
+            nb_compteurs = QuotaService.reconcilier()
+            print(f"✅ Compteurs d'usage initialisés ({nb_compteurs} compteurs)")
+except Exception as e:
+    print(f"⚠️ Erreur initialisation compteurs d'usage: {e}")
+
+# Agrégats des contrôles C2N (référentiels, campagnes)
+try:
+    with app.app_context():
+        if ControleMetriquesService.est_vide():
+            nb_agregats = ControleMetriquesService.reconstruire()
+            print(f"✅ Métriques C2N initialisées ({nb_agregats} agrégats)")
+except Exception as e:
+    print(f"⚠️ Erreur initialisation métriques C2N: {e}")
+
+# État courant des risques (dernière évaluation confirmée ou validée)
+try:
+    with app.app_context():
+        if RisqueEtatCourantService.est_vide():
+            nb_risques = RisqueEtatCourantService.reconstruire()
+            print(f"✅ État courant des risques initialisé ({nb_risques} risques)")
+except Exception as e:
+    print(f"⚠️ Erreur initialisation état courant des risques: {e}")
+
+# États de seuil des KRI (sans alerte rétroactive à la mise en service)
+try:
+    with app.app_context():
+        if EvaluateurSeuilsKRI.est_vide():
+            nb_kri = EvaluateurSeuilsKRI.initialiser()
+            print(f"✅ États de seuil des KRI initialisés ({nb_kri} KRI)")
+except Exception as e:
+    print(f"⚠️ Erreur initialisation états de seuil KRI: {e}")
+
+# Références de détection d'anomalies des KRI collectés (rejeu de l'historique)
+try:
+    with app.app_context():
+        if DetecteurAnomaliesKRI.est_vide():
+            nb_kri = DetecteurAnomaliesKRI.initialiser()
+            print(f"✅ Références d'anomalies des KRI initialisées ({nb_kri} KRI)")
+except Exception as e:
+    print(f"⚠️ Erreur initialisation références d'anomalies KRI: {e}")
+
+
+@app.cli.command('compacter-versions-feuilles')
+def compacter_versions_feuilles():
+    """Convertit les instantanés des versions de feuilles de travail en deltas"""
+    rapport = VersionsFeuilleService.compacter()
+    gain = rapport['octets_avant'] - rapport['octets_apres']
+    pourcentage = (gain / rapport['octets_avant'] * 100) if rapport['octets_avant'] else 0
+    print(f"✅ {rapport['feuilles']} feuilles, {rapport['versions_converties']} versions converties en deltas")
+    print(f"📦 {rapport['octets_avant'] / 1024:.1f} Ko -> {rapport['octets_apres'] / 1024:.1f} Ko "
+          f"({gain / 1024:.1f} Ko économisés, {pourcentage:.1f}%)")
+
+
+@app.cli.command('migrer-fichiers-stockage')
+def migrer_fichiers_stockage():
+    """Range les fichiers de risques et de KRI existants dans le stockage par contenu"""
+    for modele, entite_type in ((FichierRisque, 'fichier_risque'), (FichierKRI, 'fichier_kri')):
+        rapport = StockageService.migrer_pieces(modele, entite_type)
+        print(f"✅ {modele.__name__}: {rapport['fichiers']} fichiers migrés "
+              f"({rapport['octets_avant'] / 1024 / 1024:.1f} Mo), {rapport['manquants']} introuvables")
+
+    usage = StockageService.usage_clients()
+    logiques = sum(ligne['octets_logiques'] for ligne in usage.values())
+    physiques = sum(ligne['octets_physiques'] for ligne in usage.values())
+    print(f"📦 Stockage: {logiques / 1024 / 1024:.1f} Mo référencés, {physiques / 1024 / 1024:.1f} Mo stockés "
+          f"({(logiques - physiques) / 1024 / 1024:.1f} Mo dédoublonnés)")
+
+
+@app.cli.command('purger-objets-stockes')
+def purger_objets_stockes():
+    """Supprime les objets stockés qui ne sont plus référencés"""
+    nombre, octets = StockageService.purger_orphelins()
+    print(f"🧹 {nombre} objets supprimés ({octets / 1024 / 1024:.1f} Mo libérés)")
+
+
+@app.cli.command('appliquer-retention-kri')
+def appliquer_retention_kri():
+    """Résume en agrégats puis supprime les mesures KRI collectées au-delà de la rétention"""
+    rapport = SeriesTemporellesKRI.appliquer_retention()
+    print(f"✅ {rapport['mesures']} mesures et {rapport['collectes']} collectes purgées, "
+          f"{rapport['agregats']} agrégats mis à jour")
+    print(f"🧹 {rapport['agregats_horaires_supprimes']} agrégats horaires expirés supprimés")
+
+
+@app.cli.command('migrer-historiques')
+def migrer_historiques():
+    """Copie les historiques JSON existants dans le journal d'événements"""
+    sources = [
+        (PlanificationControle, 'historique_actions'),
+        (WorkflowApprobation, 'historique_etapes'),
+        (DemandeReevaluation, 'historique_actions'),
+    ]
+    total = 0
+    for modele, colonne in sources:
+        for entite in modele.query.filter(getattr(modele, colonne).isnot(None)).all():
+            entrees = getattr(entite, colonne) or []
+            if not entrees or JournalEvenement.compter(modele.__tablename__, entite.id):
+                continue
+            for entree in entrees:
+                try:
+                    date = datetime.fromisoformat(entree.get('date')) if entree.get('date') else None
+                except (TypeError, ValueError):
+                    date = None
+                JournalEvenement.enregistrer(
+                    entite,
+                    entree.get('action') or 'transition',
+                    entree.get('utilisateur_id'),
+                    entree.get('details') or entree.get('commentaire'),
+                    ancien_statut=entree.get('ancien_statut') or entree.get('ancienne_etape'),
+                    nouveau_statut=entree.get('nouveau_statut') or entree.get('nouvelle_etape'),
+                    date=date
+                )
+                total += 1
+        db.session.commit()
+        print(f"✅ {modele.__name__}: historiques migrés")
+    print(f"✅ {total} événements copiés dans journal_evenements")
+
+
+@app.cli.command('reconcilier-quotas')
+def reconcilier_quotas():
+    """Recale les compteurs d'usage des clients sur les comptages réels"""
+    nb_corriges = QuotaService.reconcilier()
+    print(f"✅ Compteurs d'usage réconciliés ({nb_corriges} corrigés)")
+
+
+@app.cli.command('reconstruire-metriques-controle')
+def reconstruire_metriques_controle():
+    """Recalcule les agrégats C2N de tous les référentiels et campagnes"""
+    nb_agregats = ControleMetriquesService.reconstruire()
+    print(f"✅ {nb_agregats} agrégats C2N recalculés")
+
+
+@app.cli.command('reconstruire-etat-risques')
+def reconstruire_etat_risques():
+    """Recalcule l'état courant (dernière évaluation retenue) de tous les risques"""
+    nb_risques = RisqueEtatCourantService.reconstruire()
+    print(f"✅ État courant de {nb_risques} risques recalculé")
+
+
+@app.cli.command('reinitialiser-seuils-kri')
+def reinitialiser_seuils_kri():
+    """Recale l'état de seuil de tous les KRI actifs sur leur dernière mesure, sans alerte"""
+    nb_kri = EvaluateurSeuilsKRI.initialiser()
+    print(f"✅ État de seuil modifié pour {nb_kri} KRI")
+
+
+@app.cli.command('backtester-anomalies-kri')
+def backtester_anomalies_kri():
+    """Rejoue l'historique des mesures des KRI collectés dans le détecteur d'anomalies"""
+    rapport = DetecteurAnomaliesKRI.backtester()
+    nb_mesures = sum(ligne['nb_mesures'] for ligne in rapport.values())
+    nb_anomalies = sum(ligne['nb_anomalies'] for ligne in rapport.values())
+    for kri_id, ligne in sorted(rapport.items(), key=lambda item: -item[1]['taux_anomalies']):
+        if ligne['nb_anomalies']:
+            print(f"   KRI {kri_id}: {ligne['nb_anomalies']}/{ligne['nb_mesures']} mesures signalées "
+                  f"({ligne['taux_anomalies']}%)")
+    taux = (nb_anomalies / nb_mesures * 100) if nb_mesures else 0
+    print(f"📊 {len(rapport)} KRI, {nb_mesures} mesures rejouées, {nb_anomalies} anomalies ({taux:.2f}%)")
+
+
+@app.cli.command('reinitialiser-anomalies-kri')
+def reinitialiser_anomalies_kri():
+    """Reconstruit les références de détection d'anomalies en rejouant l'historique des mesures"""
+    nb_kri = DetecteurAnomaliesKRI.initialiser()
+    print(f"✅ Références d'anomalies reconstruites pour {nb_kri} KRI")
+
+
+@app.cli.command('rebuild-hierarchies')
+def rebuild_hierarchies():
+    """Reconstruit la table de fermeture des hiérarchies"""
+    from services.hierarchie_service import HierarchieService
+    nb_lignes = HierarchieService.reconstruire()
+    print(f"✅ {nb_lignes} liens de hiérarchie reconstruits")
 
 
 # ========================
@@ -2346,18 +2528,6 @@ def admin_required(f):
     return decorated_function
 
 
-def super_admin_required(f):
-    """Décorateur pour le super admin (accès universel)"""
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if not current_user.is_authenticated:
-            flash('Accès refusé : connexion requise', 'error')
-            return redirect(url_for('login', next=request.url))
-        if current_user.role != 'super_admin':
-            flash('Accès refusé : privilèges super administrateur requis', 'error')
-            return redirect(url_for('dashboard'))
-        return f(*args, **kwargs)
-    return decorated_function
 
 
 def permission_required(permission, custom_message=None):
@@ -2569,70 +2739,6 @@ print("   - permission_required")
 # FONCTIONS DE VÉRIFICATION D'ACCÈS
 # ========================
 
-def check_client_access(entity):
-    """
-    Vérifie l'accès à une entité spécifique - VERSION ULTRA FLEXIBLE
-    """
-    if not current_user.is_authenticated:
-        return False
-    
-    # 1. SUPER ADMIN a toujours accès
-    if current_user.role == 'super_admin':
-        return True
-    
-    user_client_id = current_user.client_id
-    
-    if not user_client_id:
-        print(f"⚠️ {current_user.username} n'a pas de client_id")
-        return False
-    
-    # 2. Si l'entité est un Audit
-    if isinstance(entity, Audit):
-        audit = entity
-        
-        # Si l'audit n'a pas de client_id
-        if audit.client_id is None:
-            # Vérifier si l'utilisateur est le créateur
-            if hasattr(audit, 'created_by') and audit.created_by == current_user.id:
-                return True
-            # Vérifier si l'utilisateur est le responsable
-            if hasattr(audit, 'responsable_id') and audit.responsable_id == current_user.id:
-                return True
-            # Vérifier si l'utilisateur est dans l'équipe
-            if audit.equipe_audit_ids:
-                try:
-                    equipe_ids = [int(id.strip()) for id in audit.equipe_audit_ids.split(',') if id.strip()]
-                    if current_user.id in equipe_ids:
-                        return True
-                except:
-                    pass
-            return False
-        
-        # Si l'audit a un client_id, vérifier la correspondance
-        return audit.client_id == user_client_id
-    
-    # 3. Pour les autres entités
-    if hasattr(entity, 'client_id'):
-        entity_client_id = entity.client_id
-        
-        if entity_client_id is None:
-            # Pour les entités sans client_id, vérifier par created_by
-            if hasattr(entity, 'created_by') and entity.created_by:
-                creator = User.query.get(entity.created_by)
-                if creator:
-                    return creator.client_id == user_client_id
-            return True  # Ou False selon votre politique
-        
-        return entity_client_id == user_client_id
-    
-    # 4. Vérifier par created_by
-    if hasattr(entity, 'created_by') and entity.created_by:
-        creator = User.query.get(entity.created_by)
-        if creator and hasattr(creator, 'client_id'):
-            return creator.client_id == user_client_id
-    
-    # 5. Par défaut, refuser (sécurité)
-    return False
 
 @app.route('/fix_audits_client_id')
 @login_required
@@ -2659,88 +2765,6 @@ def fix_audits_client_id():
 # FONCTIONS DE FILTRAGE CLIENT
 # ========================
 
-def get_client_filter(model_class, **filters):
-    """
-    Retourne une requête filtrée par client
-    """
-    query = model_class.query
-    
-    # SUPER ADMIN : PAS DE FILTRE (sauf s'il visualise un client spécifique)
-    if current_user.is_authenticated and current_user.role == 'super_admin':
-        viewing_client_id = session.get('viewing_client_id')
-        
-        # Si le super admin a choisi un client spécifique
-        if viewing_client_id is not None:
-            if hasattr(model_class, 'client_id'):
-                query = query.filter(model_class.client_id == viewing_client_id)
-            elif hasattr(model_class, 'created_by'):
-                # Pour les tables sans client_id : filtrer par les utilisateurs du client
-                user_ids = User.query.filter_by(client_id=viewing_client_id).with_entities(User.id).all()
-                user_ids = [uid[0] for uid in user_ids] if user_ids else [-1]
-                query = query.filter(model_class.created_by.in_(user_ids))
-        # Sinon, super admin voit tout (pas de filtre client)
-    
-    # UTILISATEURS NORMAUX : filtrer par leur client
-    elif current_user.is_authenticated:
-        client_id = current_user.client_id
-        
-        if hasattr(model_class, 'client_id'):
-            query = query.filter(model_class.client_id == client_id)
-        elif hasattr(model_class, 'created_by'):
-            # Récupérer tous les utilisateurs du même client
-            user_ids = db.session.query(User.id).filter_by(client_id=client_id).all()
-            user_ids = [uid[0] for uid in user_ids] if user_ids else [-1]
-            query = query.filter(model_class.created_by.in_(user_ids))
-    
-    # Ajouter les filtres supplémentaires
-    for key, value in filters.items():
-        if hasattr(model_class, key):
-            query = query.filter(getattr(model_class, key) == value)
-    
-    return query
-
-
-
-
-
-@app.context_processor
-def inject_translation_system():
-    """Injecte le système de traduction ultra-simple"""
-    def t(text, lang=None):
-        target_lang = lang or get_locale()
-        return simple_translator.translate(text, target_lang)
-    
-    return {
-        't': t,
-        'translate': t,
-        'current_lang': get_locale,
-        'is_english': lambda: get_locale() == 'en',
-        'is_french': lambda: get_locale() == 'fr'
-    }
-
-
-# Mettez à jour le context processor
-@app.context_processor
-def inject_translation_utilities():
-    """Injecte les utilitaires de traduction"""
-    current_lang = get_locale()
-    
-    def t(text):
-        """Fonction de traduction pour les templates"""
-        if not text or current_lang == 'fr':
-            return text
-        return translation_manager.translate(text, current_lang)
-    
-    return {
-        't': t,
-        'translate': t,
-        'current_lang': current_lang,
-        'lang_info': LANGUAGES.get(current_lang, LANGUAGES['fr']),
-        'available_langs': LANGUAGES,
-        'is_english': current_lang == 'en',
-        'is_french': current_lang == 'fr'
-    }
-
 
 
 # Modifiez vos routes pour supporter la langue
@@ -2930,7 +2954,7 @@ def operateur_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
-@app.before_request
+@pipeline_requete.etape('langue', exemptes=['static'])
 def handle_language():
     """Gère la langue avant chaque requête"""
     try:
@@ -2945,40 +2969,17 @@ def handle_language():
         elif request.cookies.get('lang') in ['fr', 'en']:
             lang = request.cookies.get('lang')
         
-        # Stocker dans g et session
+        # Stocker dans g et session (la session n'est réécrite que si la langue change)
         g.current_lang = lang
-        session['lang'] = lang
-        
-        print(f"🌐 Langue définie: {lang}")
+        if session.get('lang') != lang:
+            session['lang'] = lang
         
     except Exception as e:
         print(f"⚠️ Erreur handle_language: {e}")
         g.current_lang = 'fr'
         session['lang'] = 'fr'
 
-# Injecter dans les templates - VERSION CORRIGÉE
-@app.context_processor
-def inject_language_info():
-    """Injecte les informations de langue dans tous les templates"""
-    current_lang = getattr(g, 'current_lang', 'fr')
-    
-    # Fonction de traduction pour les templates
-    def translate_text(text):
-        if not text:
-            return ''
-        return translation_system.translate(text, current_lang)
-    
-    return {
-        'current_lang': current_lang,
-        'lang': current_lang,  # alias
-        't': translate_text,
-        'translate': translate_text,
-        '_': translate_text,  # Compatibilité Flask-Babel
-        'available_langs': LANGUAGES,
-        'lang_info': LANGUAGES.get(current_lang, LANGUAGES['fr']),
-        'is_english': current_lang == 'en',
-        'is_french': current_lang == 'fr'
-    }
+# Les informations de langue des templates sont injectées par inject_lang
 
 @app.route('/change-language/<lang_code>')
 def change_language(lang_code):
@@ -3034,30 +3035,22 @@ def get_locale():
     # 4. Par défaut
     return 'fr'
 
-# Middleware pour gérer la langue
-@app.before_request
-def before_request():
-    """Configure la langue avant chaque requête"""
-    # Déterminer la langue
-    lang = request.args.get('lang')
-    if lang not in ['fr', 'en']:
-        lang = session.get('lang')
-        if lang not in ['fr', 'en']:
-            lang = request.cookies.get('lang', 'fr')
-    
-    # Normaliser
-    if lang not in ['fr', 'en']:
-        lang = 'fr'
-    
-    # Stocker
-    g.current_lang = lang
-    session['lang'] = lang
+# Cache des fragments de templates lourds ({% fragment %}), par client, langue et version des données
+CacheFragments.init_app(app, langue=get_locale)
+CacheFragments.surveiller(
+    Cartographie, CampagneEvaluation, Risque, EvaluationRisque, DispositifMaitrise, DemandeReevaluation,
+    Audit, Constatation, Recommandation, PlanAction, WorkflowApprobation, AlerteApprobation,
+    JournalAudit, AnalyseIA, User, Competence, EvaluationCompetence, Formation, InscriptionFormation,
+    PlanDeveloppementIndividuel,
+)
 
-# Injecter dans les templates
-@app.context_processor
+# La langue de la requête est fixée par l'étape "langue" du pipeline (handle_language)
+
+# Injecter dans les templates (seul fournisseur des informations de langue)
+@contexte_templates.fournisseur
 def inject_lang():
     """Injecte les informations de langue dans tous les templates"""
-    current_lang = getattr(g, 'current_lang', 'fr')
+    current_lang = getattr(g, 'current_lang', None) or get_locale()
     
     # Fonction de traduction pour les templates
     def t(text):
@@ -3065,9 +3058,13 @@ def inject_lang():
     
     return {
         'current_lang': current_lang,
+        'lang': current_lang,  # alias
         't': t,
         'translate': t,
-        '_': t,  # Compatibilité avec Flask-Babel
+        '_': _,  # Flask-Babel
+        'gettext': _,
+        'ngettext': gettext.ngettext,
+        'get_locale': get_locale,
         'available_langs': LANGUAGES,
         'lang_info': LANGUAGES.get(current_lang, LANGUAGES['fr']),
         'is_english': current_lang == 'en',
@@ -3092,38 +3089,6 @@ def set_language(lang):
 
 
 
-@app.context_processor
-def inject_lang():
-    """Injecte les informations de langue dans tous les templates"""
-    def get_current_lang():
-        """Fonction pour obtenir la langue courante"""
-        try:
-            # 1. Paramètre GET
-            lang = request.args.get('lang')
-            if lang in ['fr', 'en']:
-                session['lang'] = lang
-                return lang
-            
-            # 2. Session
-            lang = session.get('lang')
-            if lang in ['fr', 'en']:
-                return lang
-            
-            # 3. Par défaut
-            return 'fr'
-        except:
-            return 'fr'
-    
-    current_lang = get_current_lang()
-    
-    return {
-        'current_lang': current_lang,
-        'get_locale': get_current_lang,  # <-- IMPORTANT : expose la fonction
-        'available_langs': LANGUAGES,
-        'lang_info': LANGUAGES.get(current_lang, LANGUAGES['fr']),
-        'is_english': current_lang == 'en',
-        'is_french': current_lang == 'fr'
-    }
 # Ajouter à vos filtres Jinja2
 def translate(text, lang=None):
     """Traduit un texte dans la langue spécifiée"""
@@ -3185,17 +3150,6 @@ def local_number(value):
 # ========================
 
 
-@app.context_processor
-def inject_lang():
-    """Injecte les informations de langue dans tous les templates"""
-    current_lang = get_locale()  # <-- MAINTENANT DÉFINI
-    return {
-        'current_lang': current_lang,
-        'available_langs': LANGUAGES,
-        '_': _,  # Fonction de traduction
-        'gettext': _,
-        'ngettext': gettext.ngettext
-    }
 
 
 
@@ -3251,29 +3205,6 @@ def get_client_object_or_404(model_class, object_id, **filters):
     
     return obj
 
-def filter_by_client(query, model_class):
-    """Ajoute un filtre client_id à une requête (sauf pour super admin)"""
-    if current_user.role == 'super_admin':
-        return query  # Super admin voit TOUT
-    
-    # Pour les admin clients et utilisateurs normaux
-    if hasattr(model_class, 'client_id'):
-        return query.filter(model_class.client_id == current_user.client_id)
-    elif hasattr(model_class, 'created_by'):
-        # Récupérer tous les utilisateurs du même client
-        try:
-            utilisateurs_client = User.query.filter_by(
-                client_id=current_user.client_id
-            ).with_entities(User.id).all()
-            user_ids = [u.id for u in utilisateurs_client]
-            if user_ids:
-                return query.filter(model_class.created_by.in_(user_ids))
-            else:
-                return query.filter(model_class.created_by == -1)  # Aucun résultat
-        except:
-            return query.filter(model_class.created_by == current_user.id)
-    else:
-        return query
 
 print("✅ Fonctions de vérification d'accès définies")
 
@@ -3323,17 +3254,17 @@ def etat_badge_filter(etat):
 # MIDDLEWARE DE FILTRAGE (doit être après les décorateurs)
 # ========================
 
-@app.before_request
+@pipeline_requete.etape('client', exemptes=['static'])
 def auto_filter_data():
-    """Filtre automatiquement les données par client"""
-    # Ne pas filtrer pour super admin
-    if current_user.is_authenticated and current_user.role == 'super_admin':
-        g.client_id = None  # Super admin voit tout
-        return
-    
-    # Pour les autres utilisateurs
-    if current_user.is_authenticated:
+    """Filtre automatiquement les données par client (multi-tenant)"""
+    if current_user.is_authenticated and current_user.role != 'super_admin':
+        # Clients normaux : filtrer par client_id
         g.client_id = current_user.client_id
+        g.filter_by_client = True
+    else:
+        # Super admin (voit tout) ou visiteur : pas de filtre
+        g.client_id = None
+        g.filter_by_client = False
 
 @app.route('/admin/parametrage/fichiers/configurer', methods=['POST'])
 @login_required
@@ -3360,9 +3291,266 @@ def configurer_types_fichiers():
     
     return redirect(url_for('parametrage_fichiers'))
 
-@app.before_request
+# ==================== LISTE COMPLÈTE DES ENDPOINTS PROTÉGÉS ====================
+# Table unique des permissions requises par endpoint (fusion des anciens
+# middlewares check_permissions_middleware, check_permissions_middleware_complete,
+# check_module_access_middleware et check_permissions). Un tuple exige toutes
+# les permissions listées.
+ENDPOINTS_PROTEGES = {
+    # ==================== CARTOGRAPHIE RISQUES ====================
+    'liste_cartographies': 'can_manage_risks',
+    'nouvelle_cartographie': 'can_manage_risks',
+    'modifier_cartographie': 'can_manage_risks',
+    'detail_cartographie': 'can_manage_risks',
+    'dupliquer_cartographie': 'can_manage_risks',
+    'archiver_cartographie': 'can_manage_risks',
+    'restaurer_cartographie': 'can_manage_risks',
+    'cartographies_archives': 'can_manage_risks',
+    'export_risques_excel': 'can_manage_risks',
+    'telecharger_rapport_cartographie_pdf': 'can_manage_risks',
+    'telecharger_rapport_cartographie_pdf_campagne': 'can_manage_risks',
+    'choisir_cartographie_risque': 'can_manage_risks',
+    'nouveau_risque_sans_cartographie': 'can_manage_risks',
+    
+    # ==================== RISQUES ====================
+    'nouveau_risque': 'can_manage_risks',
+    'modifier_risque': 'can_manage_risks',
+    'detail_risque': 'can_manage_risks',
+    'archiver_risque': 'can_manage_risks',
+    'restaurer_risque': 'can_manage_risks',
+    'supprimer_risque': 'can_manage_risks',
+    'supprimer_definitivement_risque': 'can_manage_risks',
+    'risques_archives': 'can_manage_risks',
+    'exporter_risque': 'can_export_data',
+    'ajouter_champ_personnalise': 'can_manage_risks',
+    'modifier_champ_personnalise': 'can_manage_risks',
+    'ajouter_fichier_risque': 'can_manage_risks',
+    'telecharger_fichier_risque': 'can_manage_risks',
+    'supprimer_fichier_risque': 'can_manage_risks',
+    
+    # ==================== KRI ====================
+    'liste_kri': 'can_manage_kri',
+    'nouveau_kri': 'can_manage_kri',
+    'nouveau_kri_sans_risque': 'can_manage_kri',
+    'modifier_kri': 'can_manage_kri',
+    'detail_kri': 'can_manage_kri',
+    'archiver_kri': 'can_manage_kri',
+    'restaurer_kri': 'can_manage_kri',
+    'ajouter_mesure_kri': 'can_manage_kri',
+    'supprimer_mesure_kri': 'can_manage_kri',
+    'exporter_kri': 'can_export_data',
+    
+    # ==================== VEILLE RÈGLEMENTAIRE ====================
+    'veille_reglementaire': 'can_manage_regulatory',
+    'nouvelle_veille': 'can_manage_regulatory',
+    'modifier_veille': 'can_manage_regulatory',
+    'detail_veille': 'can_manage_regulatory',
+    'veille_archives': 'can_manage_regulatory',
+    'archiver_veille': 'can_manage_regulatory',
+    'restaurer_veille': 'can_manage_regulatory',
+    'ajouter_action_conformite': 'can_manage_regulatory',
+    'modifier_action_conformite': 'can_manage_regulatory',
+    'supprimer_action_conformite': 'can_manage_regulatory',
+    'telecharger_document_veille': 'can_manage_regulatory',
+    'supprimer_document_veille': 'can_manage_regulatory',
+    
+    # ==================== LOGIGRAMMES ====================
+    'liste_logigrammes': 'can_manage_logigram',
+    'nouveau_logigramme': 'can_manage_logigram',
+    'editer_logigramme': 'can_manage_logigram',
+    'detail_logigramme': 'can_manage_logigram',
+    'archiver_logigramme': 'can_manage_logigram',
+    'restaurer_logigramme': 'can_manage_logigram',
+    'export_logigramme': 'can_manage_logigram',
+    'export_diagramme_complet': 'can_manage_logigram',
+    'api_creer_element': 'can_manage_logigram',
+    'api_modifier_element': 'can_manage_logigram',
+    'api_supprimer_element': 'can_manage_logigram',
+    'api_creer_lien': 'can_manage_logigram',
+    'api_supprimer_lien': 'can_manage_logigram',
+    
+    # ==================== AUDIT INTERNE ====================
+    'liste_audits': 'can_manage_audit',
+    'nouvel_audit': 'can_manage_audit',
+    'detail_audit': 'can_manage_audit',
+    'modifier_audit': 'can_manage_audit',
+    'archiver_audit': 'can_manage_audit',
+    'restaurer_audit': 'can_manage_audit',
+    'dashboard_audit_global_complet': 'can_manage_audit',
+    'creer_constatation': 'can_manage_audit',
+    'modifier_constatation': 'can_manage_audit',
+    'supprimer_constatation': 'can_manage_audit',
+    'creer_recommandation': 'can_manage_audit',
+    'modifier_recommandation': 'can_manage_audit',
+    'supprimer_recommandation': 'can_manage_audit',
+    'generer_rapport_audit': 'can_manage_audit',
+    
+    # ==================== PLANS D'ACTION ====================
+    'liste_plans_action': 'can_view_action_plans',
+    'nouveau_plan_action': 'can_manage_action_plans',
+    'editer_plan_action': 'can_manage_action_plans',
+    'detail_plan_action': 'can_view_action_plans',
+    'supprimer_plan_action': 'can_manage_action_plans',
+    'archiver_plan_action': 'can_manage_action_plans',
+    'restaurer_plan_action': 'can_manage_action_plans',
+    'ajouter_commentaire_plan': 'can_manage_action_plans',
+    'supprimer_commentaire_plan': 'can_manage_action_plans',
+    'ajouter_fichier_plan': 'can_manage_action_plans',
+    'supprimer_fichier_plan': 'can_manage_action_plans',
+    'creer_sous_action': 'can_manage_action_plans',
+    'modifier_sous_action': 'can_manage_action_plans',
+    'supprimer_sous_action': 'can_manage_action_plans',
+    
+    # ==================== PROGRAMME D'AUDIT ====================
+    'liste_programmes_audit': 'can_manage_audit_program',
+    'nouveau_programme_audit': 'can_manage_audit_program',
+    'editer_programme_audit': 'can_manage_audit_program',
+    'detail_programme_audit': 'can_manage_audit_program',
+    'supprimer_programme_audit': 'can_manage_audit_program',
+    'approuver_programme_audit': 'can_manage_audit_program',
+    
+    # ==================== RAPPORTS ====================
+    'rapports_audit': 'can_view_reports',
+    'export_dashboard': 'can_export_data',
+    'export_dashboard_csv': 'can_export_data',
+    
+    # ==================== QUALITÉ ====================
+    'liste_plans_qualite': 'can_manage_quality',
+    'nouveau_plan_qualite': 'can_manage_quality',
+    'editer_plan_qualite': 'can_manage_quality',
+    'detail_plan_qualite': 'can_manage_quality',
+    'supprimer_plan_qualite': 'can_manage_quality',
+    'archiver_plan_qualite': 'can_manage_quality',
+    
+    # ==================== CAMPAGNES DE CONTRÔLE ====================
+    'liste_campagnes_controle': 'can_manage_campaigns',
+    'nouvelle_campagne_controle': 'can_manage_campaigns',
+    'detail_campagne_controle': 'can_manage_campaigns',
+    'editer_campagne_controle': 'can_manage_campaigns',
+    'supprimer_campagne_controle': 'can_manage_campaigns',
+    'exporter_campagne_controle': 'can_manage_campaigns',
+    
+    # ==================== PLANS DE CONTINUITÉ (PCA) ====================
+    'liste_plans_pca': 'can_manage_bcp',
+    'nouveau_plan_pca': 'can_manage_bcp',
+    'detail_plan_pca': 'can_manage_bcp',
+    'editer_plan_pca': 'can_manage_bcp',
+    'supprimer_plan_pca': 'can_manage_bcp',
+    'tester_plan_pca': 'can_manage_bcp',
+    
+    # ==================== GESTION DES INCIDENTS ====================
+    'liste_incidents': 'can_manage_incidents',
+    'nouvel_incident': 'can_manage_incidents',
+    'detail_incident': 'can_manage_incidents',
+    'editer_incident': 'can_manage_incidents',
+    'supprimer_incident': 'can_manage_incidents',
+    'resoudre_incident': 'can_manage_incidents',
+    'escalader_incident': 'can_manage_incidents',
+    
+    # ==================== QUESTIONNAIRES ====================
+    'liste_questionnaires': 'can_manage_questionnaires',
+    'nouveau_questionnaire': 'can_manage_questionnaires',
+    'editer_questionnaire': 'can_manage_questionnaires',
+    'dupliquer_questionnaire': 'can_manage_questionnaires',
+    'supprimer_questionnaire': 'can_manage_questionnaires',
+    'repondre_questionnaire': 'can_view_responses',
+    'voir_reponses_questionnaire': 'can_view_responses',
+    'exporter_questionnaire': 'can_export_responses',
+    'importer_questionnaire': 'can_manage_questionnaires',
+    
+    # ==================== SUPPORT ====================
+    'liste_tickets_support': 'can_view_tickets',
+    'nouveau_ticket_support': 'can_manage_tickets',
+    'detail_ticket_support': 'can_view_tickets',
+    'repondre_ticket_support': 'can_manage_tickets',
+    'fermer_ticket_support': 'can_manage_tickets',
+    
+    # ==================== GESTION DES UTILISATEURS ====================
+    'admin_utilisateurs': ('can_view_users_list', 'can_manage_users'),
+    'admin_nouvel_utilisateur': 'can_create_users',
+    'admin_editer_utilisateur': 'can_edit_users',
+    'admin_supprimer_utilisateur': 'can_delete_users',
+    'admin_gerer_permissions': 'can_manage_permissions',
+    'admin_toggle_user_status': 'can_deactivate_users',
+    
+    'gestionnaire_utilisateurs': 'can_view_users_list',
+    'gestionnaire_creer_utilisateur': 'can_create_users',
+    'gestionnaire_editer_utilisateur': 'can_edit_users',
+    'gestionnaire_supprimer_utilisateur': 'can_delete_users',
+    'gestionnaire_gerer_permissions': 'can_manage_permissions',
+    'gestionnaire_toggle_user_status': 'can_deactivate_users',
+    
+    'client_admin_utilisateurs': 'can_view_users_list',
+    'client_admin_creer_utilisateur': 'can_create_users',
+    'client_admin_editer_utilisateur': 'can_edit_users',
+    'client_admin_gerer_permissions': 'can_manage_permissions',
+    'client_admin_creer_gestionnaire': 'can_manage_users',
+    'client_admin_toggle_user_status': 'can_deactivate_users',
+    
+    # ==================== DIRECTIONS ET SERVICES ====================
+    'admin_directions': 'can_view_departments',
+    'nouvelle_direction': 'can_manage_departments',
+    'modifier_direction': 'can_manage_departments',
+    'supprimer_direction': 'can_manage_departments',
+    'nouveau_service': 'can_manage_departments',
+    'modifier_service': 'can_manage_departments',
+    'supprimer_service': 'can_manage_departments',
+    'admin_poles': 'can_view_departments',
+    'nouveau_pole': 'can_manage_departments',
+    'editer_pole': 'can_manage_departments',
+    'supprimer_pole': 'can_manage_departments',
+    
+    # ==================== PARAMÉTRAGE ====================
+    'parametrage_risque': 'can_manage_settings',
+    'parametrage_champs': 'can_manage_settings',
+    'parametrage_fichiers': 'can_manage_settings',
+    'ajouter_champ_risque': 'can_manage_settings',
+    'editer_champ_risque': 'can_manage_settings',
+    'supprimer_champ_risque': 'can_manage_settings',
+    'parametrage_listes': 'can_manage_settings',
+    'ajouter_liste_deroulante': 'can_manage_settings',
+    'editer_liste_deroulante': 'can_manage_settings',
+    'supprimer_liste_deroulante': 'can_manage_settings',
+    'admin_parametres_evaluation': 'can_manage_settings',
+    'admin_save_parametres': 'can_manage_settings',
+    
+    # ==================== ANALYSE IA ====================
+    'analyse_ia_dashboard': 'can_use_ia_analysis',
+    'analyse_ia_recommandations': 'can_use_ia_analysis',
+    'analyser_audit_ia': 'can_use_ia_analysis',
+    'analyser_risque_ia': 'can_use_ia_analysis',
+    
+    # ==================== TABLEAUX DE BORD PERSONNALISABLES ====================
+    'tableaux_bord': 'can_view_dashboard_advanced',
+    'creer_tableau_bord': 'can_view_dashboard_advanced',
+    'editer_tableau_bord': 'can_view_dashboard_advanced',
+    'supprimer_tableau_bord': 'can_view_dashboard_advanced',
+    'exporter_tableau_bord': 'can_export_data',
+    
+    # ==================== API (si utilisé) ====================
+    'api_get_kri_data': 'can_manage_kri',
+    'api_get_risques_data': 'can_manage_risks',
+    'api_get_audits_data': 'can_manage_audit',
+    'api_get_logigrammes_data': 'can_manage_logigram',
+    'api_get_veille_data': 'can_manage_regulatory',
+    
+    # ==================== ADMINISTRATION ====================
+    'admin_dashboard': 'can_manage_users',
+    'rapports': 'can_view_reports',
+    'export_risques': 'can_export_data',
+}
+
+# Permissions requises par endpoint, normalisées en tuples au chargement
+PERMISSIONS_PAR_ENDPOINT = {
+    endpoint: permissions if isinstance(permissions, tuple) else (permissions,)
+    for endpoint, permissions in ENDPOINTS_PROTEGES.items()
+}
+
+@pipeline_requete.etape('permissions', endpoints=PERMISSIONS_PAR_ENDPOINT,
+                        exemptes=['static', 'login', 'logout', 'dashboard', 'public_home',
+                                  'health', 'check_credentials'])
 def check_permissions_middleware():
-    """Middleware pour vérifier les permissions sur chaque requête - VERSION COMPLÈTE"""
+    """Vérifie les permissions de l'endpoint (seuls les endpoints protégés passent par ici)"""
     if not current_user.is_authenticated:
         return
     
@@ -3370,355 +3558,25 @@ def check_permissions_middleware():
     if current_user.role == 'super_admin':
         return
     
-    # Routes à ignorer
-    exempt_routes = ['static', 'login', 'logout', 'dashboard', 'public_home', 'health', 'check_credentials']
-    if request.endpoint in exempt_routes:
-        return
-    
-    # ==================== LISTE COMPLÈTE DES ENDPOINTS PROTÉGÉS ====================
-    protected_endpoints = {
-        # ==================== CARTOGRAPHIE RISQUES ====================
-        'liste_cartographies': 'can_manage_risks',
-        'nouvelle_cartographie': 'can_manage_risks',
-        'modifier_cartographie': 'can_manage_risks',
-        'detail_cartographie': 'can_manage_risks',
-        'dupliquer_cartographie': 'can_manage_risks',
-        'archiver_cartographie': 'can_manage_risks',
-        'restaurer_cartographie': 'can_manage_risks',
-        'cartographies_archives': 'can_manage_risks',
-        'export_risques_excel': 'can_manage_risks',
-        'telecharger_rapport_cartographie_pdf': 'can_manage_risks',
-        'telecharger_rapport_cartographie_pdf_campagne': 'can_manage_risks',
-        'choisir_cartographie_risque': 'can_manage_risks',
-        'nouveau_risque_sans_cartographie': 'can_manage_risks',
-        
-        # ==================== RISQUES ====================
-        'nouveau_risque': 'can_manage_risks',
-        'modifier_risque': 'can_manage_risks',
-        'detail_risque': 'can_manage_risks',
-        'archiver_risque': 'can_manage_risks',
-        'restaurer_risque': 'can_manage_risks',
-        'supprimer_risque': 'can_manage_risks',
-        'supprimer_definitivement_risque': 'can_manage_risks',
-        'risques_archives': 'can_manage_risks',
-        'exporter_risque': 'can_export_data',
-        'ajouter_champ_personnalise': 'can_manage_risks',
-        'modifier_champ_personnalise': 'can_manage_risks',
-        'ajouter_fichier_risque': 'can_manage_risks',
-        'telecharger_fichier_risque': 'can_manage_risks',
-        'supprimer_fichier_risque': 'can_manage_risks',
-        
-        # ==================== KRI ====================
-        'liste_kri': 'can_manage_kri',
-        'nouveau_kri': 'can_manage_kri',
-        'nouveau_kri_sans_risque': 'can_manage_kri',
-        'modifier_kri': 'can_manage_kri',
-        'detail_kri': 'can_manage_kri',
-        'archiver_kri': 'can_manage_kri',
-        'restaurer_kri': 'can_manage_kri',
-        'ajouter_mesure_kri': 'can_manage_kri',
-        'supprimer_mesure_kri': 'can_manage_kri',
-        'exporter_kri': 'can_export_data',
-        
-        # ==================== VEILLE RÈGLEMENTAIRE ====================
-        'veille_reglementaire': 'can_manage_regulatory',
-        'nouvelle_veille': 'can_manage_regulatory',
-        'modifier_veille': 'can_manage_regulatory',
-        'detail_veille': 'can_manage_regulatory',
-        'veille_archives': 'can_manage_regulatory',
-        'archiver_veille': 'can_manage_regulatory',
-        'restaurer_veille': 'can_manage_regulatory',
-        'ajouter_action_conformite': 'can_manage_regulatory',
-        'modifier_action_conformite': 'can_manage_regulatory',
-        'supprimer_action_conformite': 'can_manage_regulatory',
-        'telecharger_document_veille': 'can_manage_regulatory',
-        'supprimer_document_veille': 'can_manage_regulatory',
-        
-        # ==================== LOGIGRAMMES ====================
-        'liste_logigrammes': 'can_manage_logigram',
-        'nouveau_logigramme': 'can_manage_logigram',
-        'editer_logigramme': 'can_manage_logigram',
-        'detail_logigramme': 'can_manage_logigram',
-        'archiver_logigramme': 'can_manage_logigram',
-        'restaurer_logigramme': 'can_manage_logigram',
-        'export_logigramme': 'can_manage_logigram',
-        'export_diagramme_complet': 'can_manage_logigram',
-        'api_creer_element': 'can_manage_logigram',
-        'api_modifier_element': 'can_manage_logigram',
-        'api_supprimer_element': 'can_manage_logigram',
-        'api_creer_lien': 'can_manage_logigram',
-        'api_supprimer_lien': 'can_manage_logigram',
-        
-        # ==================== AUDIT INTERNE ====================
-        'liste_audits': 'can_manage_audit',
-        'nouvel_audit': 'can_manage_audit',
-        'detail_audit': 'can_manage_audit',
-        'modifier_audit': 'can_manage_audit',
-        'archiver_audit': 'can_manage_audit',
-        'restaurer_audit': 'can_manage_audit',
-        'dashboard_audit_global_complet': 'can_manage_audit',
-        'creer_constatation': 'can_manage_audit',
-        'modifier_constatation': 'can_manage_audit',
-        'supprimer_constatation': 'can_manage_audit',
-        'creer_recommandation': 'can_manage_audit',
-        'modifier_recommandation': 'can_manage_audit',
-        'supprimer_recommandation': 'can_manage_audit',
-        'generer_rapport_audit': 'can_manage_audit',
-        
-        # ==================== PLANS D'ACTION ====================
-        'liste_plans_action': 'can_view_action_plans',
-        'nouveau_plan_action': 'can_manage_action_plans',
-        'editer_plan_action': 'can_manage_action_plans',
-        'detail_plan_action': 'can_view_action_plans',
-        'supprimer_plan_action': 'can_manage_action_plans',
-        'archiver_plan_action': 'can_manage_action_plans',
-        'restaurer_plan_action': 'can_manage_action_plans',
-        'ajouter_commentaire_plan': 'can_manage_action_plans',
-        'supprimer_commentaire_plan': 'can_manage_action_plans',
-        'ajouter_fichier_plan': 'can_manage_action_plans',
-        'supprimer_fichier_plan': 'can_manage_action_plans',
-        'creer_sous_action': 'can_manage_action_plans',
-        'modifier_sous_action': 'can_manage_action_plans',
-        'supprimer_sous_action': 'can_manage_action_plans',
-        
-        # ==================== PROGRAMME D'AUDIT ====================
-        'liste_programmes_audit': 'can_manage_audit_program',
-        'nouveau_programme_audit': 'can_manage_audit_program',
-        'editer_programme_audit': 'can_manage_audit_program',
-        'detail_programme_audit': 'can_manage_audit_program',
-        'supprimer_programme_audit': 'can_manage_audit_program',
-        'approuver_programme_audit': 'can_manage_audit_program',
-        
-        # ==================== RAPPORTS ====================
-        'rapports_audit': 'can_view_reports',
-        'export_dashboard': 'can_export_data',
-        'export_dashboard_csv': 'can_export_data',
-        
-        # ==================== QUALITÉ ====================
-        'liste_plans_qualite': 'can_manage_quality',
-        'nouveau_plan_qualite': 'can_manage_quality',
-        'editer_plan_qualite': 'can_manage_quality',
-        'detail_plan_qualite': 'can_manage_quality',
-        'supprimer_plan_qualite': 'can_manage_quality',
-        'archiver_plan_qualite': 'can_manage_quality',
-        
-        # ==================== CAMPAGNES DE CONTRÔLE ====================
-        'liste_campagnes_controle': 'can_manage_campaigns',
-        'nouvelle_campagne_controle': 'can_manage_campaigns',
-        'detail_campagne_controle': 'can_manage_campaigns',
-        'editer_campagne_controle': 'can_manage_campaigns',
-        'supprimer_campagne_controle': 'can_manage_campaigns',
-        'exporter_campagne_controle': 'can_manage_campaigns',
-        
-        # ==================== PLANS DE CONTINUITÉ (PCA) ====================
-        'liste_plans_pca': 'can_manage_bcp',
-        'nouveau_plan_pca': 'can_manage_bcp',
-        'detail_plan_pca': 'can_manage_bcp',
-        'editer_plan_pca': 'can_manage_bcp',
-        'supprimer_plan_pca': 'can_manage_bcp',
-        'tester_plan_pca': 'can_manage_bcp',
-        
-        # ==================== GESTION DES INCIDENTS ====================
-        'liste_incidents': 'can_manage_incidents',
-        'nouvel_incident': 'can_manage_incidents',
-        'detail_incident': 'can_manage_incidents',
-        'editer_incident': 'can_manage_incidents',
-        'supprimer_incident': 'can_manage_incidents',
-        'resoudre_incident': 'can_manage_incidents',
-        'escalader_incident': 'can_manage_incidents',
-        
-        # ==================== QUESTIONNAIRES ====================
-        'liste_questionnaires': 'can_manage_questionnaires',
-        'nouveau_questionnaire': 'can_manage_questionnaires',
-        'editer_questionnaire': 'can_manage_questionnaires',
-        'dupliquer_questionnaire': 'can_manage_questionnaires',
-        'supprimer_questionnaire': 'can_manage_questionnaires',
-        'repondre_questionnaire': 'can_view_responses',
-        'voir_reponses_questionnaire': 'can_view_responses',
-        'exporter_questionnaire': 'can_export_responses',
-        'importer_questionnaire': 'can_manage_questionnaires',
-        
-        # ==================== SUPPORT ====================
-        'liste_tickets_support': 'can_view_tickets',
-        'nouveau_ticket_support': 'can_manage_tickets',
-        'detail_ticket_support': 'can_view_tickets',
-        'repondre_ticket_support': 'can_manage_tickets',
-        'fermer_ticket_support': 'can_manage_tickets',
-        
-        # ==================== GESTION DES UTILISATEURS ====================
-        'admin_utilisateurs': 'can_view_users_list',
-        'admin_nouvel_utilisateur': 'can_create_users',
-        'admin_editer_utilisateur': 'can_edit_users',
-        'admin_supprimer_utilisateur': 'can_delete_users',
-        'admin_gerer_permissions': 'can_manage_permissions',
-        'admin_toggle_user_status': 'can_deactivate_users',
-        
-        'gestionnaire_utilisateurs': 'can_view_users_list',
-        'gestionnaire_creer_utilisateur': 'can_create_users',
-        'gestionnaire_editer_utilisateur': 'can_edit_users',
-        'gestionnaire_supprimer_utilisateur': 'can_delete_users',
-        'gestionnaire_gerer_permissions': 'can_manage_permissions',
-        'gestionnaire_toggle_user_status': 'can_deactivate_users',
-        
-        'client_admin_utilisateurs': 'can_view_users_list',
-        'client_admin_creer_utilisateur': 'can_create_users',
-        'client_admin_editer_utilisateur': 'can_edit_users',
-        'client_admin_gerer_permissions': 'can_manage_permissions',
-        'client_admin_creer_gestionnaire': 'can_manage_users',
-        'client_admin_toggle_user_status': 'can_deactivate_users',
-        
-        # ==================== DIRECTIONS ET SERVICES ====================
-        'admin_directions': 'can_view_departments',
-        'nouvelle_direction': 'can_manage_departments',
-        'modifier_direction': 'can_manage_departments',
-        'supprimer_direction': 'can_manage_departments',
-        'nouveau_service': 'can_manage_departments',
-        'modifier_service': 'can_manage_departments',
-        'supprimer_service': 'can_manage_departments',
-        'admin_poles': 'can_view_departments',
-        'nouveau_pole': 'can_manage_departments',
-        'editer_pole': 'can_manage_departments',
-        'supprimer_pole': 'can_manage_departments',
-        
-        # ==================== PARAMÉTRAGE ====================
-        'parametrage_risque': 'can_manage_settings',
-        'parametrage_champs': 'can_manage_settings',
-        'parametrage_fichiers': 'can_manage_settings',
-        'ajouter_champ_risque': 'can_manage_settings',
-        'editer_champ_risque': 'can_manage_settings',
-        'supprimer_champ_risque': 'can_manage_settings',
-        'parametrage_listes': 'can_manage_settings',
-        'ajouter_liste_deroulante': 'can_manage_settings',
-        'editer_liste_deroulante': 'can_manage_settings',
-        'supprimer_liste_deroulante': 'can_manage_settings',
-        'admin_parametres_evaluation': 'can_manage_settings',
-        'admin_save_parametres': 'can_manage_settings',
-        
-        # ==================== ANALYSE IA ====================
-        'analyse_ia_dashboard': 'can_use_ia_analysis',
-        'analyse_ia_recommandations': 'can_use_ia_analysis',
-        'analyser_audit_ia': 'can_use_ia_analysis',
-        'analyser_risque_ia': 'can_use_ia_analysis',
-        
-        # ==================== TABLEAUX DE BORD PERSONNALISABLES ====================
-        'tableaux_bord': 'can_view_dashboard_advanced',
-        'creer_tableau_bord': 'can_view_dashboard_advanced',
-        'editer_tableau_bord': 'can_view_dashboard_advanced',
-        'supprimer_tableau_bord': 'can_view_dashboard_advanced',
-        'exporter_tableau_bord': 'can_export_data',
-        
-        # ==================== API (si utilisé) ====================
-        'api_get_kri_data': 'can_manage_kri',
-        'api_get_risques_data': 'can_manage_risks',
-        'api_get_audits_data': 'can_manage_audit',
-        'api_get_logigrammes_data': 'can_manage_logigram',
-        'api_get_veille_data': 'can_manage_regulatory',
-    }
-    
     endpoint = request.endpoint
-    
-    # Gestion spéciale pour les endpoints API
-    if endpoint and endpoint.startswith('api_'):
-        # Trouver la permission correspondante
-        for api_endpoint, permission in protected_endpoints.items():
-            if api_endpoint == endpoint:
-                if not current_user.has_permission(permission):
-                    return jsonify({'error': f'Permission {permission} requise'}), 403
-                break
-    
-    # Vérification normale
-    if endpoint in protected_endpoints:
-        required_permission = protected_endpoints[endpoint]
+    for required_permission in PERMISSIONS_PAR_ENDPOINT[endpoint]:
+        if current_user.has_permission(required_permission):
+            continue
         
-        if not current_user.has_permission(required_permission):
-            print(f"🔒 Accès refusé: {endpoint} - permission {required_permission} manquante")
-            print(f"   Permissions actuelles: {current_user.permissions}")
-            flash(f'Accès non autorisé. Permission "{required_permission}" requise.', 'error')
-            return redirect(url_for('dashboard'))
-    
-    return
+        # Gestion spéciale pour les endpoints API
+        if endpoint.startswith('api_'):
+            return jsonify({'error': f'Permission {required_permission} requise'}), 403
+        
+        print(f"🔒 Accès refusé: {endpoint} - permission {required_permission} manquante")
+        flash(f'Accès non autorisé. Permission "{required_permission}" requise.', 'error')
+        return redirect(url_for('dashboard'))
 
 
 # ========================
 # FONCTIONS DE JOURNALISATION
 # ========================
 
-def log_activity(utilisateur_id, action, details=None, entite_type=None, entite_id=None):
-    """
-    Journalise une activité utilisateur
-    
-    Args:
-        utilisateur_id: ID de l'utilisateur
-        action: Type d'action ('connexion', 'creation', 'modification', 'suppression', 'consultation')
-        details: Description détaillée de l'action
-        entite_type: Type d'entité concernée ('risque', 'audit', 'kri', 'utilisateur', etc.)
-        entite_id: ID de l'entité concernée
-    """
-    try:
-        # Récupérer l'adresse IP
-        if request:
-            if request.headers.get('X-Forwarded-For'):
-                ip_address = request.headers.get('X-Forwarded-For').split(',')[0].strip()
-            else:
-                ip_address = request.remote_addr
-        else:
-            ip_address = socket.gethostbyname(socket.gethostname())
-        
-        # Récupérer l'user agent
-        user_agent = request.user_agent.string if request else 'Système'
-        
-        # Créer l'entrée dans le journal
-        journal = JournalActivite(
-            utilisateur_id=utilisateur_id,
-            action=action,
-            details=details,
-            entite_type=entite_type,
-            entite_id=entite_id,
-            ip_address=ip_address,
-            user_agent=user_agent
-        )
-        
-        db.session.add(journal)
-        db.session.commit()
-        
-        print(f"📝 Activité journalisée: {action} - {details}")
-        
-    except Exception as e:
-        print(f"❌ Erreur journalisation: {e}")
-        try:
-            db.session.rollback()
-        except:
-            pass
 
-def journaliser_action_audit(audit_id, action_type, user_id, details=None):
-    """Journaliser les actions sur les audits avec notification optionnelle"""
-    try:
-        journal = JournalAudit(
-            audit_id=audit_id,
-            action=action_type,
-            details=details or {},
-            utilisateur_id=user_id,
-            signature=current_user.username if current_user.is_authenticated else 'System'
-        )
-        
-        db.session.add(journal)
-        
-        # Mettre à jour la date de modification de l'audit
-        if MODELS_IMPORTED:
-            audit = Audit.query.get(audit_id)
-            if audit:
-                audit.updated_at = datetime.utcnow()
-        
-        db.session.commit()
-        
-        print(f"📝 Journal audit: {action_type} pour audit {audit_id}")
-        
-    except Exception as e:
-        print(f"❌ Erreur journalisation audit: {str(e)}")
-        try:
-            db.session.rollback()
-        except:
-            pass
 
 print("✅ Fonctions de journalisation définies")
 
@@ -3726,56 +3584,7 @@ print("✅ Fonctions de journalisation définies")
 # FONCTIONS UTILITAIRES POUR AUDIT
 # ========================
 
-def historiser_action_audit_util(audit_id, action_type, user_id, donnees=None):
-    """Historiser les actions sur les audits"""
-    try:
-        if MODELS_IMPORTED:
-            historique = HistoriqueModification(
-                entite_type='audit',
-                entite_id=audit_id,
-                utilisateur_id=user_id,
-                modifications={
-                    'action': action_type,
-                    'donnees': donnees or {},
-                    'timestamp': datetime.utcnow().isoformat()
-                },
-                date_modification=datetime.utcnow()
-            )
-            
-            db.session.add(historique)
-            db.session.commit()
-            print(f"📝 Action audit historisée: {action_type} pour audit {audit_id}")
-            
-    except Exception as e:
-        print(f"❌ Erreur historisation action audit: {str(e)}")
-        try:
-            db.session.rollback()
-        except:
-            pass
 
-def creer_notification(type_notification, titre, message, destinataire_id, entite_type=None, entite_id=None):
-    """Créer une notification"""
-    try:
-        if MODELS_IMPORTED:
-            notification = Notification(
-                type_notification=type_notification,
-                titre=titre,
-                message=message,
-                destinataire_id=destinataire_id,
-                entite_type=entite_type,
-                entite_id=entite_id
-            )
-            
-            db.session.add(notification)
-            db.session.commit()
-            print(f"📢 Notification créée: {titre} pour utilisateur {destinataire_id}")
-            
-    except Exception as e:
-        print(f"❌ Erreur création notification: {str(e)}")
-        try:
-            db.session.rollback()
-        except:
-            pass
 
 print("✅ Fonctions utilitaires audit définies")
 
@@ -3854,9 +3663,10 @@ print("✅ Gestionnaires d'erreurs configurés")
 # MIDDLEWARE DE JOURNALISATION
 # ========================
 
-@app.before_request
+@pipeline_requete.etape('journalisation')
 def before_request_logging():
     """Journalise les requêtes entrantes."""
+    g.request_start_time = time.time()
     if request.endpoint and not request.endpoint.startswith('static'):
         g.start_time = datetime.now()
         print(f"🌐 Requête: {request.method} {request.path}")
@@ -3915,97 +3725,7 @@ if MODELS_IMPORTED:
 # FONCTIONS DE JOURNALISATION
 # ========================
 
-def journaliser_action_audit(audit_id, action_type, user_id, details=None):
-    """Journaliser les actions sur les audits avec notification optionnelle"""
-    try:
-        journal = JournalAudit(
-            audit_id=audit_id,
-            action=action_type,
-            details=details or {},
-            utilisateur_id=user_id,
-            signature=current_user.username if current_user.is_authenticated else 'System'
-        )
-        
-        db.session.add(journal)
-        
-        # Mettre à jour la date de modification de l'audit
-        audit = Audit.query.get(audit_id)
-        if audit:
-            audit.updated_at = datetime.utcnow()
-        
-        db.session.commit()
         
-        # Optionnel: créer une notification pour certaines actions
-        if action_type in ['creation_constatation', 'creation_recommandation', 'creation_plan_action']:
-            try:
-                from services.notification_service import NotificationService
-                from models import Notification
-                
-                type_notif = {
-                    'creation_constatation': Notification.TYPE_CONSTATATION,
-                    'creation_recommandation': Notification.TYPE_RECOMMANDATION,
-                    'creation_plan_action': Notification.TYPE_PLAN
-                }.get(action_type, Notification.TYPE_INFO)
-                
-                NotificationService.create(
-                    destinataire_id=user_id,
-                    type_notif=type_notif,
-                    titre=f"Action audit: {action_type}",
-                    message=f"L'action '{action_type}' a été enregistrée pour l'audit {audit.reference if audit else audit_id}",
-                    entite_type='audit',
-                    entite_id=audit_id,
-                    user_id=user_id
-                )
-            except ImportError:
-                pass
-        
-        print(f"📝 Journal audit: {action_type} pour audit {audit_id}")
-        
-    except Exception as e:
-        print(f"❌ Erreur journalisation: {str(e)}")
-        try:
-            db.session.rollback()
-        except:
-            pass
-        
-def log_activity(utilisateur_id, action, details=None, entite_type=None, entite_id=None):
-    """
-    Journalise une activité utilisateur
-    """
-    try:
-        if not MODELS_IMPORTED:
-            return
-        
-        if request:
-            if request.headers.get('X-Forwarded-For'):
-                ip_address = request.headers.get('X-Forwarded-For').split(',')[0].strip()
-            else:
-                ip_address = request.remote_addr
-            user_agent = request.user_agent.string
-        else:
-            ip_address = socket.gethostbyname(socket.gethostname())
-            user_agent = 'Système'
-        
-        journal = JournalActivite(
-            utilisateur_id=utilisateur_id,
-            action=action,
-            details=details,
-            entite_type=entite_type,
-            entite_id=entite_id,
-            ip_address=ip_address,
-            user_agent=user_agent
-        )
-        
-        db.session.add(journal)
-        db.session.commit()
-        print(f"📝 Activité journalisée: {action} - {details}")
-        
-    except Exception as e:
-        print(f"❌ Erreur journalisation: {e}")
-        try:
-            db.session.rollback()
-        except:
-            pass
 
 # ========================
 # FONCTIONS DE CONFIGURATION INITIALE
@@ -4046,33 +3766,32 @@ def config_initiales():
             pass
 
 
-@app.context_processor
+@contexte_templates.fournisseur
 def inject_clients():
     """Injecte la liste des clients disponibles dans tous les templates"""
+    # Liste en cache (invalidée à chaque écriture sur Client)
     if current_user.is_authenticated and current_user.role == 'super_admin':
         # Pour super admin: tous les clients actifs
-        available_clients = Client.query.filter_by(is_active=True)\
-            .order_by(Client.nom).all()
+        available_clients = list(ContexteTemplates.clients_actifs())
     else:
         # Pour autres utilisateurs: seulement leur client
+        client = None
         if hasattr(current_user, 'client_id') and current_user.client_id:
-            available_clients = Client.query.filter_by(
-                id=current_user.client_id, 
-                is_active=True
-            ).all()
-        else:
-            available_clients = []
-    
-    # Client actuellement visualisé
-    viewing_client_id = session.get('viewing_client_id')
-    viewing_client = Client.query.get(viewing_client_id) if viewing_client_id else None
+            client = ContexteTemplates.client_actif(current_user.client_id)
+        available_clients = [client] if client else []
     
+    # Le client visualisé est injecté par inject_view_info
     return {
         'available_clients': available_clients,
-        'viewing_client': viewing_client,
-        'is_viewing_other_client': viewing_client_id and viewing_client_id != getattr(current_user, 'client_id', None)
     }
 
+
+@ContexteTemplates.par_requete
+def client_visualise():
+    """Client actuellement visualisé (super admin), lu une fois par requête"""
+    viewing_client_id = session.get('viewing_client_id')
+    return db.session.get(Client, viewing_client_id) if viewing_client_id else None
+
 # ========================
 # INITIALISATION DE LA BASE DE DONNÉES
 # ========================
@@ -4145,74 +3864,29 @@ def get_tendance_text(score):
     else:
         return "Négative"
 
-def generate_cartographie_rows(cartographies):
-    """Génère les lignes du tableau des cartographies"""
-    rows = ""
-    for idx, (nom, nb_risques, score_moyen) in enumerate(cartographies, 1):
-        niveau = get_niveau_from_score(score_moyen or 0)
-        priorite = "Haute" if niveau in ["Élevé", "Critique"] else "Moyenne"
-        
-        rows += f"""
-        <tr>
-            <td><strong>{nom or 'Non nommé'}</strong></td>
-            <td><span class="alert-badge alert-info">{nb_risques or 0}</span></td>
-            <td><strong>{round(score_moyen or 0, 2)}</strong>/25</td>
-            <td>
-                <span class="alert-badge {'alert-danger' if niveau == 'Critique' else 'alert-warning' if niveau == 'Élevé' else 'alert-info'}">
-                    {niveau}
-                </span>
-            </td>
-            <td>
-                <span class="alert-badge {'alert-danger' if priorite == 'Haute' else 'alert-warning'}">
-                    {priorite}
-                </span>
-            </td>
-        </tr>
-        """
-    
-    if not rows:
-        rows = """
-        <tr>
-            <td colspan="5" style="text-align: center; padding: 30px; color: #64748b;">
-                Aucune donnée de cartographie disponible
-            </td>
-        </tr>
-        """
-    
-    return rows
+
+def get_indicateurs_portefeuille_6_mois(six_mois):
+    """Nouveaux risques, risques clôturés et taux de rotation (une lecture de l'historique)"""
+    return HistoriqueEvaluations.charger(avec_risques=True).portefeuille(six_mois)
 
 def get_nouveaux_risques_6_mois(six_mois):
     """Compte les nouveaux risques créés dans les 6 mois"""
     try:
-        count = Risque.query.filter(
-            Risque.is_archived == False,
-            Risque.created_at >= six_mois
-        ).count()
-        return count
+        return get_indicateurs_portefeuille_6_mois(six_mois)['nouveaux']
     except:
         return 0
 
 def get_risques_clotures_6_mois(six_mois):
-    """Compte les risques clôturés dans les 6 mois"""
+    """Compte les risques clôturés dans les 6 mois (évaluation récente à score faible)"""
     try:
-        # Recherche des évaluations avec score réduit significativement
-        count = db.session.query(Risque).join(EvaluationRisque).filter(
-            Risque.is_archived == False,
-            EvaluationRisque.created_at >= six_mois,
-            EvaluationRisque.score_risque <= 5  # Scores faibles
-        ).distinct().count()
-        return count
+        return get_indicateurs_portefeuille_6_mois(six_mois)['clotures']
     except:
         return 0
 
 def get_taux_rotation_6_mois(six_mois):
     """Calcule le taux de rotation du portefeuille risques"""
     try:
-        nouveaux = get_nouveaux_risques_6_mois(six_mois)
-        total = Risque.query.filter_by(is_archived=False).count()
-        if total > 0:
-            return round((nouveaux / total) * 100, 1)
-        return 0
+        return get_indicateurs_portefeuille_6_mois(six_mois)['taux_rotation']
     except:
         return 0
 
@@ -4253,144 +3927,12 @@ def historiser_action_audit_util(audit_id, action_type, user_id, donnees=None):
         except:
             pass
 
-def creer_notification(type_notification, titre, message, destinataire_id, entite_type=None, entite_id=None):
-    """Créer une notification"""
-    try:
-        if MODELS_IMPORTED:
-            notification = Notification(
-                type_notification=type_notification,
-                titre=titre,
-                message=message,
-                destinataire_id=destinataire_id,
-                entite_type=entite_type,
-                entite_id=entite_id
-            )
-            
-            db.session.add(notification)
-            db.session.commit()
-            print(f"📢 Notification créée: {titre} pour utilisateur {destinataire_id}")
-            
-    except Exception as e:
-        print(f"❌ Erreur création notification: {str(e)}")
-        try:
-            db.session.rollback()
-        except:
-            pass
 
 # ========================
 # FONCTIONS D'AUTOMATISATION
 # ========================
 
-def automatiser_statuts_audits():
-    """Automatise les mises à jour de statut des audits"""
-    if not MODELS_IMPORTED:
-        return
-    
-    print("🤖 Démarrage de l'automatisation des statuts d'audit...")
-    with app.app_context():
-        try:
-            audits = Audit.query.filter_by(is_archived=False).all()
-            
-            for audit in audits:
-                try:
-                    # Logique d'automatisation
-                    constatations_non_closes = Constatation.query.filter_by(
-                        audit_id=audit.id,
-                        is_archived=False
-                    ).filter(Constatation.statut != 'clos').count()
-                    
-                    total_constatations = Constatation.query.filter_by(
-                        audit_id=audit.id,
-                        is_archived=False
-                    ).count()
-                    
-                    if total_constatations > 0 and constatations_non_closes == 0:
-                        if audit.statut != 'clos':
-                            audit.statut = 'clos'
-                            audit.sous_statut = 'cloture'
-                            print(f"✅ Audit {audit.reference} automatiquement clos")
-                    
-                    db.session.commit()
-                    
-                except Exception as e:
-                    print(f"❌ Erreur sur audit {audit.reference}: {e}")
-                    db.session.rollback()
-                    
-        except Exception as e:
-            print(f"❌ Erreur automatisation: {e}")
-
-def verifier_echeances_et_alertes():
-    """Vérifie les échéances et génère des alertes"""
-    if not MODELS_IMPORTED:
-        return
-    
-    print("🔔 Vérification des échéances et alertes...")
-    with app.app_context():
-        try:
-            aujourdhui = datetime.utcnow().date()
-            recommandations = Recommandation.query.filter_by(is_archived=False).all()
-            
-            for recommandation in recommandations:
-                try:
-                    if recommandation.date_echeance:
-                        jours_restants = (recommandation.date_echeance - aujourdhui).days
-                        
-                        if 0 < jours_restants <= 7 and recommandation.statut != 'termine':
-                            # Créer une alerte
-                            creer_notification(
-                                type_notification='echeance_proche',
-                                titre=f"Échéance proche pour recommandation",
-                                message=f"La recommandation arrive à échéance dans {jours_restants} jours",
-                                destinataire_id=recommandation.responsable_id or recommandation.audit.responsable_id,
-                                entite_type='recommandation',
-                                entite_id=recommandation.id
-                            )
-                    
-                    db.session.commit()
-                    
-                except Exception as e:
-                    print(f"❌ Erreur sur recommandation {recommandation.id}: {e}")
-                    db.session.rollback()
-                    
-        except Exception as e:
-            print(f"❌ Erreur vérification échéances: {e}")
-
-def demarrer_scheduler():
-    """Démarre le scheduler pour les tâches automatiques"""
-    try:
-        scheduler = BackgroundScheduler()
-        
-        scheduler.add_job(
-            func=automatiser_statuts_audits,
-            trigger="interval",
-            hours=1,
-            id="verif_statuts",
-            name="Vérification automatique des statuts d'audit",
-            replace_existing=True
-        )
-        
-        scheduler.add_job(
-            func=verifier_echeances_et_alertes,
-            trigger="cron",
-            hour=8,
-            minute=0,
-            id="verif_echeances",
-            name="Vérification des échéances et alertes",
-            replace_existing=True
-        )
-        
-        scheduler.start()
-        print("✅ Scheduler démarré avec succès")
-        
-    except Exception as e:
-        print(f"❌ Erreur lors du démarrage du scheduler: {e}")
 
-# Démarrer le scheduler
-with app.app_context():
-    try:
-        demarrer_scheduler()
-    except:
-        print("⚠️ Scheduler non démarré (peut être normal en développement)")
 
 # ========================
 # MIDDLEWARE ET GESTION DES LANGUES
@@ -4774,8 +4316,54 @@ def verifier_echeances_et_alertes():
                 print(f"❌ Erreur sur plan {plan.id}: {e}")
                 db.session.rollback()
 
+
+
+# ========================
+# FONCTIONS DE SYNCHRONISATION
+# ========================
+
+
+def envoyer_notifications_kri_planifie():
+    """Envoie les notifications de franchissement de seuil KRI, regroupées par destinataire"""
+    with app.app_context():
+        try:
+            EvaluateurSeuilsKRI.vider_notifications()
+        except Exception as e:
+            db.session.rollback()
+            print(f"❌ Erreur envoi des notifications KRI: {e}")
+
+
+def purger_objets_stockes_planifie():
+    """Purge nocturne des pièces jointes qui ne sont plus référencées"""
+    with app.app_context():
+        try:
+            nombre, octets = StockageService.purger_orphelins()
+            if nombre:
+                print(f"🧹 {nombre} objets stockés purgés ({octets / 1024 / 1024:.1f} Mo)")
+        except Exception as e:
+            db.session.rollback()
+            print(f"❌ Erreur purge des objets stockés: {e}")
+
+
+def reconcilier_quotas_planifie():
+    """Réconciliation nocturne des compteurs d'usage (écritures en masse, dérives)"""
+    with app.app_context():
+        try:
+            nb_corriges = QuotaService.reconcilier()
+            if nb_corriges:
+                print(f"⚠️ {nb_corriges} compteurs d'usage recalés")
+        except Exception as e:
+            db.session.rollback()
+            print(f"❌ Erreur réconciliation des compteurs d'usage: {e}")
+
+
+@tache_planifiee
 def demarrer_scheduler():
-    """Démarre le scheduler pour les tâches automatiques"""
+    """
+    Démarre le scheduler pour les tâches automatiques. Sous gunicorn il tourne
+    dans un seul worker : les tâches ne travaillent que sur la base (ou
+    Redis), pas sur la mémoire des autres workers.
+    """
     try:
         scheduler = BackgroundScheduler()
         
@@ -4800,100 +4388,49 @@ def demarrer_scheduler():
             replace_existing=True
         )
         
-        scheduler.start()
-        print("✅ Scheduler démarré avec succès")
+        # Recaler les compteurs d'usage toutes les nuits à 3h
+        scheduler.add_job(
+            func=reconcilier_quotas_planifie,
+            trigger="cron",
+            hour=3,
+            minute=0,
+            id="reconciliation_quotas",
+            name="Réconciliation des compteurs d'usage",
+            replace_existing=True
+        )
         
+        # Purger les objets stockés orphelins toutes les nuits à 4h
+        scheduler.add_job(
+            func=purger_objets_stockes_planifie,
+            trigger="cron",
+            hour=4,
+            minute=0,
+            id="purge_objets_stockes",
+            name="Purge des pièces jointes orphelines",
+            replace_existing=True
+        )
+        
+        # Notifications de seuil KRI en attente (table notifications_seuil_kri), regroupées par destinataire
+        scheduler.add_job(
+            func=envoyer_notifications_kri_planifie,
+            trigger="interval",
+            minutes=1,
+            id="notifications_seuils_kri",
+            name="Notifications de franchissement de seuil KRI",
+            replace_existing=True
+        )
+        
+        scheduler.start()
+        print("✅ Scheduler démarré")
     except Exception as e:
-        print(f"❌ Erreur lors du démarrage du scheduler: {e}")
-
-
-# ========================
-# FONCTIONS DE SYNCHRONISATION
-# ========================
-def synchroniser_organigramme_complet(processus_id):
-    try:
-        processus = Processus.query.get(processus_id)
-        if not processus: return False
-        etapes_avec_position = EtapeProcessus.query.filter_by(processus_id=processus_id).filter(
-            EtapeProcessus.position_x.isnot(None),
-            EtapeProcessus.position_y.isnot(None)
-        ).count()
-        total_etapes = EtapeProcessus.query.filter_by(processus_id=processus_id).count()
-        processus.nb_etapes = total_etapes
-        processus.nb_liens = LienProcessus.query.filter_by(processus_id=processus_id).count()
-        processus.derniere_sync_organigramme = datetime.utcnow()
-        processus.a_besoin_sync = False
-        db.session.commit()
-        print(f"✅ Synchronisation réussie: {etapes_avec_position}/{total_etapes} étapes positionnées")
-        return True
-    except Exception as e:
-        db.session.rollback()
-        print(f"❌ Erreur synchronisation processus {processus_id}: {e}")
-        return False
-
-def synchroniser_etape_organigramme(etape_id, action_type, user_id):
-    try:
-        etape = EtapeProcessus.query.get(etape_id)
-        if not etape: return False
-        synchroniser_organigramme_complet(etape.processus_id)
-        return True
-    except Exception as e:
-        print(f"❌ Erreur synchronisation étape {etape_id}: {e}")
-        return False
-
-from apscheduler.schedulers.background import BackgroundScheduler
-
-def demarrer_scheduler():
-    """Démarre le scheduler pour les tâches automatiques"""
-    scheduler = BackgroundScheduler()
-    
-    # Vérifier les statuts toutes les heures
-    scheduler.add_job(
-        func=automatiser_statuts_audits,
-        trigger="interval",
-        hours=1,
-        id="verif_statuts",
-        name="Vérification automatique des statuts d'audit",
-        replace_existing=True
-    )
-    
-    # Vérifier les échéances tous les jours à 8h
-    scheduler.add_job(
-        func=verifier_echeances_et_alertes,
-        trigger="cron",
-        hour=8,
-        minute=0,
-        id="verif_echeances",
-        name="Vérification des échéances et alertes",
-        replace_existing=True
-    )
-    
-    scheduler.start()
-    print("✅ Scheduler démarré")
+        print(f"⚠️ Scheduler non démarré (peut être normal en développement): {e}")
 
-# Appeler dans le contexte de l'application
-with app.app_context():
-    demarrer_scheduler()
 
 # ========================
 # MIDDLEWARE MULTI-TENANT SIMPLE
 # ========================
 
-@app.before_request
-def setup_multi_tenant():
-    """Configure le multi-tenant pour chaque requête"""
-    if current_user.is_authenticated:
-        # Super admin : pas de filtre
-        if current_user.role == 'super_admin':
-            g.client_id = None
-            g.filter_by_client = False
-        else:
-            # Clients normaux : filtrer par client_id
-            g.client_id = current_user.client_id
-            g.filter_by_client = True
-    else:
-        g.client_id = None
-        g.filter_by_client = False
+# g.client_id / g.filter_by_client sont fixés par l'étape "client" du pipeline (auto_filter_data)
 
 def get_client_filter(model_class, **filters):
     """
@@ -4933,50 +4470,6 @@ def get_client_filter(model_class, **filters):
         # Par défaut : aucun résultat pour la sécurité
         return query.filter_by(id=-1)
 
-def check_client_access(entity):
-    """
-    Vérifie l'accès à une entité spécifique
-    MAINTENANT : Le super admin n'a plus d'accès universel
-    """
-    if not current_user.is_authenticated:
-        return False
-    
-    # TOUT LE MONDE doit vérifier le client_id
-    client_id = current_user.client_id
-    
-    if not client_id:
-        print(f"⚠️ {current_user.username} n'a pas de client_id")
-        return False
-    
-    # Vérifier client_id direct
-    if hasattr(entity, 'client_id'):
-        return entity.client_id == client_id
-    
-    # Vérifier par created_by
-    if hasattr(entity, 'created_by') and entity.created_by:
-        creator = User.query.get(entity.created_by)
-        if creator and hasattr(creator, 'client_id'):
-            return creator.client_id == client_id
-    
-    # Vérifier les relations
-    if hasattr(entity, 'audit_id'):
-        audit = Audit.query.get(entity.audit_id)
-        return check_client_access(audit) if audit else False
-    
-    if hasattr(entity, 'risque_id'):
-        risque = Risque.query.get(entity.risque_id)
-        return check_client_access(risque) if risque else False
-    
-    if hasattr(entity, 'cartographie_id'):
-        cartographie = Cartographie.query.get(entity.cartographie_id)
-        return check_client_access(cartographie) if cartographie else False
-    
-    # Pour les User, vérifier directement
-    if isinstance(entity, User):
-        return entity.client_id == client_id
-    
-    # Par défaut, refuser
-    return False
 
 def get_super_admin_access():
     """
@@ -5161,72 +4654,13 @@ class TenantManager:
         return model_instance
 
 # Injecter dans les templates
-@app.context_processor
+@contexte_templates.fournisseur
 def inject_tenant_utils():
     return {
         'tenant_manager': TenantManager,
         'has_tenant_access': TenantManager.ensure_client_access
     }
 
-def declencher_mise_a_jour_risque(risque_id, action, utilisateur_id, donnees_supplementaires=None):
-    """Déclencher une mise à jour automatique pour un risque"""
-    risque = Risque.query.get(risque_id)
-    if not risque:
-        return
-    
-    # Récupérer les informations de la requête si disponibles
-    from flask import request
-    
-    ip_address = None
-    user_agent = None
-    
-    try:
-        if request:
-            ip_address = request.remote_addr
-            user_agent = request.user_agent.string
-    except RuntimeError:
-        # Pas de contexte de requête (cela peut arriver dans certains cas)
-        pass
-    
-    # Créer la description
-    description = None
-    if donnees_supplementaires:
-        if isinstance(donnees_supplementaires, dict):
-            description_parts = []
-            for key, value in donnees_supplementaires.items():
-                # Formater les valeurs spéciales
-                if isinstance(value, list):
-                    value = ', '.join(str(v) for v in value)
-                elif isinstance(value, dict):
-                    value = str(value)
-                description_parts.append(f"{key}: {value}")
-            description = "\n".join(description_parts)
-        else:
-            description = str(donnees_supplementaires)
-    
-    # Journaliser l'action
-    journal = JournalActivite(
-        utilisateur_id=utilisateur_id,
-        action=action,
-        description=description,
-        entite_type='risque',
-        entite_id=risque_id,
-        ip_address=ip_address,
-        user_agent=user_agent
-    )
-    db.session.add(journal)
-    
-    # Synchroniser les matrices si nécessaire
-    actions_sync = [
-        'champ_personnalise_ajoute', 'champ_personnalise_modifie',
-        'fichier_ajoute', 'fichier_supprime', 'evaluation_modifiee',
-        'kri_associe', 'kri_modifie', 'risque_modifie'
-    ]
-    
-    if action in actions_sync:
-        synchroniser_matrices_apres_modification(risque.cartographie_id)
-    
-    db.session.commit()
 
     
 def journaliser_action(utilisateur_id, action, details=None, entite_type=None, entite_id=None):
@@ -5260,39 +4694,6 @@ def journaliser_action(utilisateur_id, action, details=None, entite_type=None, e
     
     return journal
 
-def declencher_mise_a_jour_risque(risque_id, action, utilisateur_id, donnees_supplementaires=None):
-    """Déclencher une mise à jour automatique pour un risque"""
-    risque = Risque.query.get(risque_id)
-    if not risque:
-        return
-    
-    # Créer la description à partir des données supplémentaires
-    description = None
-    if donnees_supplementaires:
-        # Convertir les données supplémentaires en texte descriptif
-        if isinstance(donnees_supplementaires, dict):
-            description_parts = []
-            for key, value in donnees_supplementaires.items():
-                description_parts.append(f"{key}: {value}")
-            description = "\n".join(description_parts)
-        else:
-            description = str(donnees_supplementaires)
-    
-    # Journaliser l'action
-    journal = JournalActivite(
-        utilisateur_id=utilisateur_id,
-        action=action,
-        description=description,  # Utilisez 'description' au lieu de 'details'
-        entite_type='risque',
-        entite_id=risque_id
-    )
-    db.session.add(journal)
-    
-    # Synchroniser les matrices si nécessaire
-    if action in ['champ_personnalise_ajoute', 'champ_personnalise_modifie', 'fichier_ajoute', 'fichier_supprime']:
-        synchroniser_matrices_apres_modification(risque.cartographie_id)
-    
-    db.session.commit()
     
 
 # ========================
@@ -5311,44 +4712,7 @@ def get_config_fichiers():
 # Puis dans vos routes, utilisez :
 config_fichiers = get_config_fichiers()
 
-def synchroniser_configuration_champ(champ):
-    """Synchroniser l'ajout d'un champ avec toutes les fiches de risque"""
-    print(f"🔄 Synchronisation champ ajouté: {champ.nom_technique}")
-    
-    # Pour les champs obligatoires, créer des entrées vides pour tous les risques existants
-    if champ.est_obligatoire and champ.est_actif:
-        risques = Risque.query.filter_by(is_archived=False).all()
-        
-        for risque in risques:
-            # Vérifier si le champ existe déjà
-            existing = ChampPersonnaliseRisque.query.filter_by(
-                risque_id=risque.id,
-                nom_technique=champ.nom_technique
-            ).first()
-            
-            if not existing:
-                # Créer une entrée vide
-                champ_perso = ChampPersonnaliseRisque(
-                    risque_id=risque.id,
-                    nom_technique=champ.nom_technique
-                )
-                # Définir une valeur par défaut si disponible
-                if champ.valeurs_possibles and len(champ.valeurs_possibles) > 0:
-                    champ_perso.set_valeur(champ.valeurs_possibles[0])
-                else:
-                    champ_perso.set_valeur('')
-                db.session.add(champ_perso)
-        
-        db.session.commit()
-        print(f"✅ Champ ajouté à {len(risques)} risques existants")
 
-def synchroniser_modification_champ(champ):
-    """Synchroniser la modification d'un champ"""
-    print(f"🔄 Synchronisation modification champ: {champ.nom_technique}")
-    
-    # Mettre à jour les champs personnalisés existants si le nom d'affichage a changé
-    # Cette logique peut être étendue selon les besoins
-    pass
 
 # ============================================
 # FONCTION DE JOURNALISATION DES ÉVÉNEMENTS DE SÉCURITÉ
@@ -5408,75 +4772,7 @@ def log_security_event_simple(event_type, details=None, user_id=None):
     
     print(f"🔒 [SECURITY] {event_type} - {user_info} - {ip_info} - {details}")
     
-def declencher_mise_a_jour_risque(risque_id, action, utilisateur_id, donnees_supplementaires=None):
-    """Déclencher une mise à jour automatique pour un risque"""
-    risque = Risque.query.get(risque_id)
-    if not risque:
-        return
-    
-    # Récupérer les informations de la requête si disponibles
-    from flask import request
-    
-    ip_address = None
-    user_agent = None
-    
-    try:
-        if request:
-            ip_address = request.remote_addr
-            user_agent = request.user_agent.string
-    except RuntimeError:
-        # Pas de contexte de requête
-        pass
-    
-    # Créer les détails
-    details = None
-    if donnees_supplementaires:
-        if isinstance(donnees_supplementaires, dict):
-            details_parts = []
-            for key, value in donnees_supplementaires.items():
-                # Formater les valeurs spéciales
-                if isinstance(value, list):
-                    value = ', '.join(str(v) for v in value)
-                elif isinstance(value, dict):
-                    value = str(value)
-                details_parts.append(f"{key}: {value}")
-            details = "\n".join(details_parts)
-        else:
-            details = str(donnees_supplementaires)
-    
-    # Journaliser l'action avec 'details' (pas 'description')
-    journal = JournalActivite(
-        utilisateur_id=utilisateur_id,
-        action=action,
-        details=details,  # ✅ CORRIGÉ : utilise 'details'
-        entite_type='risque',
-        entite_id=risque_id,
-        ip_address=ip_address,
-        user_agent=user_agent
-    )
-    db.session.add(journal)
-    
-    # Synchroniser les matrices si nécessaire
-    actions_sync = [
-        'champ_personnalise_ajoute', 'champ_personnalise_modifie',
-        'fichier_ajoute', 'fichier_supprime', 'evaluation_modifiee',
-        'kri_associe', 'kri_modifie', 'risque_modifie'
-    ]
-    
-    if action in actions_sync:
-        synchroniser_matrices_apres_modification(risque.cartographie_id)
-    
-    db.session.commit()
-    print(f"📝 Activité journalisée: {action} pour risque {risque_id}")
 
-def synchroniser_matrices_apres_modification(cartographie_id):
-    """Synchroniser les matrices après modification d'un risque"""
-    try:
-        # Import local pour éviter les dépendances circulaires
-        from utils import synchroniser_matrices_apres_evaluation
-        synchroniser_matrices_apres_evaluation(cartographie_id)
-    except Exception as e:
-        print(f"⚠️ Erreur synchronisation matrices: {e}")
 
 def analyser_constatations_pour_recommandations(constatations):
     """Analyser les constatations pour générer des recommandations intelligentes"""
@@ -5713,39 +5009,6 @@ def check_super_admin_access():
     """Vérifie si l'utilisateur courant est super admin"""
     return current_user.is_authenticated and current_user.role == 'super_admin'
 
-@app.before_request
-def check_permissions_middleware():
-    """Middleware pour vérifier les permissions sur chaque requête"""
-    if current_user.is_authenticated:
-        # Si c'est le super admin, BYPASS toutes les vérifications de permissions
-        if current_user.role == 'super_admin':
-            return  # Super admin passe partout sans vérification
-        
-        # Liste des endpoints protégés et leurs permissions requises
-        protected_endpoints = {
-            'liste_cartographies': 'can_manage_risks',
-            'nouvelle_cartographie': 'can_manage_risks',
-            'liste_kri': 'can_manage_kri',
-            'nouveau_kri': 'can_manage_kri',
-            'liste_audits': 'can_manage_audit',
-            'nouvel_audit': 'can_manage_audit',
-            'veille_reglementaire': 'can_manage_regulatory',
-            'liste_logigrammes': 'can_manage_logigram',
-            'admin_dashboard': 'can_manage_users',
-            'admin_utilisateurs': 'can_manage_users',
-            'rapports': 'can_view_reports',
-            'export_risques': 'can_export_data'
-        }
-        
-        endpoint = request.endpoint
-        
-        # Vérifier si l'endpoint nécessite une permission spécifique
-        if endpoint in protected_endpoints:
-            required_permission = protected_endpoints[endpoint]
-            if not current_user.has_permission(required_permission):
-                flash('Accès refusé : permissions insuffisantes', 'error')
-                return redirect(url_for('dashboard'))
-
 # ========================
 # FONCTION DE FILTRAGE DES DONNÉES
 # ========================
@@ -5769,50 +5032,6 @@ def filter_by_client(query, model_class):
         return query
 
 
-def check_client_access(entite):
-    """Vérifie que l'utilisateur a accès à l'entité"""
-    
-    # SUPER ADMIN : ACCÈS UNIVERSEL
-    if current_user.role == 'super_admin':
-        return True
-    
-    # Si l'entité n'existe pas
-    if not entite:
-        return False
-    
-    # Vérifier client_id direct
-    if hasattr(entite, 'client_id') and entite.client_id:
-        return entite.client_id == current_user.client_id
-    
-    # Vérifier par created_by
-    if hasattr(entite, 'created_by') and entite.created_by:
-        createur = User.query.get(entite.created_by)
-        if createur and hasattr(createur, 'client_id'):
-            return createur.client_id == current_user.client_id
-    
-    # Vérifier les relations
-    if hasattr(entite, 'audit_id'):
-        audit = Audit.query.get(entite.audit_id)
-        return check_client_access(audit) if audit else False
-    
-    if hasattr(entite, 'risque_id'):
-        risque = Risque.query.get(entite.risque_id)
-        return check_client_access(risque) if risque else False
-    
-    if hasattr(entite, 'constatation_id'):
-        constatation = Constatation.query.get(entite.constatation_id)
-        return check_client_access(constatation) if constatation else False
-    
-    if hasattr(entite, 'cartographie_id'):
-        cartographie = Cartographie.query.get(entite.cartographie_id)
-        return check_client_access(cartographie) if cartographie else False
-    
-    # Pour les User, vérifier directement
-    if isinstance(entite, User):
-        return entite.client_id == current_user.client_id
-    
-    # Par défaut, refuser
-    return False
 
 
 # ========================
@@ -6044,29 +5263,11 @@ def tenant_filtered_query(model_class, **filters):
     # PAR DÉFAUT : retourner une requête vide
     return query.filter(False)
 
-@app.context_processor
+@contexte_templates.fournisseur
 def inject_tenant_filter():
     """Injecte la fonction de filtrage dans tous les templates"""
     return dict(tenant_filtered_query=tenant_filtered_query)
 
-# ========================
-# MIDDLEWARE DE FILTRAGE
-# ========================
-
-@app.before_request
-def auto_filter_data():
-    """Filtre automatiquement les données par client"""
-    # Ne pas filtrer pour super admin
-    if current_user.is_authenticated and current_user.role == 'super_admin':
-        g.client_id = None  # Super admin voit tout
-        return
-    
-    # Pour les autres utilisateurs
-    if current_user.is_authenticated:
-        g.client_id = current_user.client_id
-
-
-
 # ========================
 # PATCH TEMPORAIRE POUR MULTI-TENANT
 # ========================
@@ -6522,16 +5723,23 @@ def view_reset():
 @super_admin_required
 def super_admin_control_panel():
     """Panel de contrôle pour choisir quel client voir"""
+    from sqlalchemy import func
     clients = Client.query.order_by(Client.nom).all()
     
-    # Statistiques pour chaque client
+    # Statistiques pour chaque client : compteurs de quotas + deux requêtes groupées
+    usages = QuotaService.usage_clients([c.id for c in clients])
+    nb_users = dict(db.session.query(User.client_id, func.count(User.id))
+                    .group_by(User.client_id).all())
+    nb_cartographies = dict(db.session.query(Cartographie.client_id, func.count(Cartographie.id))
+                            .filter(Cartographie.is_archived == False)
+                            .group_by(Cartographie.client_id).all())
     stats = {}
     for client in clients:
         stats[client.id] = {
-            'users': User.query.filter_by(client_id=client.id).count(),
-            'risques': Risque.query.filter_by(client_id=client.id, is_archived=False).count(),
-            'audits': Audit.query.filter_by(client_id=client.id, is_archived=False).count(),
-            'cartographies': Cartographie.query.filter_by(client_id=client.id, is_archived=False).count(),
+            'users': nb_users.get(client.id, 0),
+            'risques': usages[client.id]['risques'],
+            'audits': usages[client.id]['audits'],
+            'cartographies': nb_cartographies.get(client.id, 0),
         }
     
     # Client actuellement visualisé
@@ -6548,14 +5756,11 @@ def super_admin_control_panel():
                          view_mode=view_mode,
                          current_user=current_user)
 
-@app.context_processor
+@contexte_templates.fournisseur
 def inject_view_info():
     """Injecte les informations de vue dans tous les templates"""
-    viewing_client = None
     view_mode = session.get('view_mode', 'my_client')
-    
-    if 'viewing_client_id' in session:
-        viewing_client = Client.query.get(session['viewing_client_id'])
+    viewing_client = client_visualise()
     
     # Déterminer le texte à afficher
     view_text = "Mon client"
@@ -6888,7 +6093,7 @@ def api_maintenance_environment(env_id):
 
 # ==================== MIDDLEWARE SOUS-DOMAIN ====================
 
-@app.before_request
+@pipeline_requete.etape('sous_domaine', exemptes=['static'])
 def detect_client_subdomain():
     """Détecte le sous-domaine et route vers le client correspondant"""
     host = request.host
@@ -6905,7 +6110,9 @@ def detect_client_subdomain():
                 # Trouver le client par référence (pas par sous-domaine en dev)
                 client = Client.query.filter_by(reference=subdomain).first()
                 if client:
-                    g.client_id = client.id
+                    # Un utilisateur client reste sur son propre client_id
+                    if not g.get('filter_by_client'):
+                        g.client_id = client.id
                     g.client_subdomain = subdomain
     
     # En production, extraire le sous-domaine
@@ -6917,7 +6124,8 @@ def detect_client_subdomain():
             # Trouver le client par sous-domaine
             client = Client.query.filter_by(sous_domaine=f"{subdomain}.votresociete.com").first()
             if client:
-                g.client_id = client.id
+                if not g.get('filter_by_client'):
+                    g.client_id = client.id
                 g.client_subdomain = subdomain
                 
                 # Si l'utilisateur n'est pas connecté, rediriger vers login client
@@ -7537,7 +6745,7 @@ def url_exists(endpoint):
         return False
 
 # Injecter la fonction dans le contexte Jinja2
-@app.context_processor
+@contexte_templates.fournisseur
 def utility_processor():
     """Injecte des fonctions utilitaires dans tous les templates"""
     return {
@@ -9066,7 +8274,11 @@ def force_my_data_view():
     return redirect(url_for('liste_logigrammes'))
 
 
-@app.before_request
+# Listes de données (logigrammes, risques, etc.) dont le mode de vue est contrôlé
+ENDPOINTS_MODE_VUE = ['liste_logigrammes', 'liste_risques', 'liste_audits',
+                      'super_admin_clients', 'super_admin_formules']
+
+@pipeline_requete.etape('mode_vue', endpoints=ENDPOINTS_MODE_VUE)
 def auto_check_view_mode():
     """Vérifier et corriger automatiquement le mode de vue pour super admin"""
     
@@ -9074,11 +8286,7 @@ def auto_check_view_mode():
         
         endpoint = request.endpoint
         
-        # Si on accède à une liste de données (logigrammes, risques, etc.)
-        list_endpoints = ['liste_logigrammes', 'liste_risques', 'liste_audits', 
-                         'super_admin_clients', 'super_admin_formules']
-        
-        if endpoint in list_endpoints:
+        if endpoint in ENDPOINTS_MODE_VUE:
             # Vérifier si on est en mode "vue personnelle"
             current_mode = session.get('view_mode')
             
@@ -9097,210 +8305,21 @@ def auto_check_view_mode():
 # ========================
 
 def check_formule_limit(limit_type):
-    """Décorateur pour vérifier les limites de la formule"""
+    """Décorateur pour vérifier les limites de la formule (instantané des limites + compteurs d'usage)"""
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            if current_user.is_authenticated:
-                client = current_user.client
-                
-                if client and client.formule:
-                    formule = client.formule
-                    
-                    # Vérifier les limites
-                    if limit_type == 'utilisateurs':
-                        current_count = User.query.filter_by(client_id=client.id, is_active=True).count()
-                        if current_count >= formule.max_utilisateurs:
-                            flash(f'Limite d\'utilisateurs atteinte ({formule.max_utilisateurs}). Veuillez mettre à niveau votre formule.', 'error')
-                            return redirect(request.referrer or url_for('dashboard'))
-                    
-                    elif limit_type == 'risques':
-                        current_count = Risque.query.filter_by(client_id=client.id, is_archived=False).count()
-                        if current_count >= formule.max_risques:
-                            flash(f'Limite de risques atteinte ({formule.max_risques}). Veuillez mettre à niveau votre formule.', 'error')
-                            return redirect(request.referrer or url_for('dashboard'))
-                    
-                    elif limit_type == 'audits':
-                        current_count = Audit.query.filter_by(client_id=client.id, is_archived=False).count()
-                        if current_count >= formule.max_audits:
-                            flash(f'Limite d\'audits atteinte ({formule.max_audits}). Veuillez mettre à niveau votre formule.', 'error')
-                            return redirect(request.referrer or url_for('dashboard'))
+            if current_user.is_authenticated and current_user.client_id:
+                if QuotaService.limite_atteinte(current_user.client_id, limit_type):
+                    limite = QuotaService.limites(current_user.client_id)[limit_type]
+                    flash(f'Limite de {limit_type} atteinte ({limite}). Veuillez mettre à niveau votre formule.', 'error')
+                    return redirect(request.referrer or url_for('dashboard'))
             
             return f(*args, **kwargs)
         return decorated_function
     return decorator
 
 
-def check_module_access(module_code):
-    """Décorateur pour vérifier l'accès à un module - VERSION CORRIGÉE"""
-    def decorator(f):
-        @wraps(f)
-        def decorated_function(*args, **kwargs):
-            if not current_user.is_authenticated:
-                flash('Veuillez vous connecter', 'error')
-                return redirect(url_for('login'))
-            
-            # SUPER ADMIN : TOUT ACCÈS
-            if current_user.role == 'super_admin':
-                return f(*args, **kwargs)
-            
-            # Vérifier si l'utilisateur a un client et une formule
-            if not hasattr(current_user, 'client') or not current_user.client:
-                flash('Aucun client associé à votre compte', 'error')
-                return redirect(url_for('dashboard'))
-            
-            client = current_user.client
-            
-            if not client.formule:
-                flash('Aucune formule active pour votre client', 'error')
-                return redirect(url_for('dashboard'))
-            
-            formule = client.formule
-            
-            # MAPPING COMPLET ET COHÉRENT
-            # module_code (URL) → Nom dans la base de données → Permission
-            module_mapping = {
-                # ==================== MODULES PROBLÉMATIQUES ====================
-                'veille': 'veille_reglementaire',
-                'processus': 'gestion_processus',
-                'logigrammes': 'gestion_processus',
-                'ia_analyse': 'analyse_ia',
-                'tableaux_bord_personnalisables': 'tableaux_bord',
-                'plans_action': 'plans_action',  # AJOUTÉ
-                
-                # ==================== AUTRES MODULES ====================
-                'questionnaires': 'questionnaires',
-                'organigramme': 'organigramme',
-                'portail_fournisseurs': 'portail_fournisseurs',
-                'reporting_avance': 'reporting_avance',
-                'matrices_risque': 'matrices_risque',
-                'risques': 'cartographie',
-                'cartographie': 'cartographie',
-                'audit_interne': 'audit_interne',
-                'suivi_kri': 'suivi_kri'
-            }
-            
-            # Obtenir le vrai nom du module dans la base de données
-            real_module_db = module_mapping.get(module_code, module_code)
-            
-            # DEBUG LOG
-            print(f"""
-            🔍 [CHECK_MODULE_ACCESS] DEBUG:
-            Module URL: {module_code}
-            → DB Name: {real_module_db}
-            Client: {client.nom} (ID: {client.id})
-            Formule: {formule.nom} ({formule.code})
-            """)
-            
-            # Vérification 1: Module présent dans la formule
-            module_active = False
-            
-            # Rechercher le module dans la formule (avec différentes clés possibles)
-            for module_key in [real_module_db, module_code]:
-                if module_key in formule.modules:
-                    module_active = formule.modules[module_key]
-                    print(f"  ✅ Module trouvé avec clé '{module_key}': {module_active}")
-                    break
-            
-            # Si le module n'est pas trouvé du tout
-            if real_module_db not in formule.modules and module_code not in formule.modules:
-                print(f"  ❌ Module '{real_module_db}' NON TROUVÉ dans les modules de la formule")
-                print(f"     Modules disponibles: {list(formule.modules.keys())}")
-                
-                # Journaliser
-                log_activity(current_user.id, 'tentative_acces_restreint',
-                           f"Module '{real_module_db}' non trouvé dans la formule {formule.nom}",
-                           'system', None)
-                
-                return redirect(url_for('module_restricted', module=module_code))
-            
-            # Si le module est désactivé
-            if not module_active:
-                print(f"  ❌ Module '{real_module_db}' DÉSACTIVÉ dans la formule")
-                
-                # Journaliser
-                log_activity(current_user.id, 'tentative_acces_restreint',
-                           f"Module '{real_module_db}' désactivé dans la formule {formule.nom}",
-                           'system', None)
-                
-                return redirect(url_for('module_restricted', module=module_code))
-            
-            # Vérification 2: Permission utilisateur
-            # Mapping module → permission (pour les modules critiques)
-            module_permission_map = {
-                'veille_reglementaire': 'can_manage_regulatory',
-                'gestion_processus': 'can_manage_logigram',
-                'analyse_ia': 'can_use_ia_analysis',
-                'suivi_kri': 'can_manage_kri',
-                'audit_interne': 'can_manage_audit',
-                'cartographie': 'can_manage_risks',
-                'reporting_avance': 'can_export_data',
-                'tableaux_bord': 'can_view_dashboard',
-                'plans_action': 'can_manage_action_plans'  # AJOUTÉ
-            }
-            
-            # MODULES SANS PERMISSION SPÉCIFIQUE (accès basique)
-            modules_sans_permission = ['questionnaires', 'organigramme', 'portail_fournisseurs', 'matrices_risque']
-            
-            # Pour les modules sans permission spécifique, vérifier les permissions de base
-            if real_module_db in modules_sans_permission:
-                # Vérifier au moins une permission de base
-                permissions_de_base = ['can_view_dashboard', 'can_view_reports']
-                has_basic_access = any(
-                    current_user.permissions.get(perm, False)
-                    for perm in permissions_de_base
-                )
-                
-                if not has_basic_access:
-                    print(f"  ❌ Module '{real_module_db}' nécessite au moins une permission de base")
-                    flash(f'Permission de base requise pour accéder à ce module', 'error')
-                    return redirect(url_for('dashboard'))
-                
-                print(f"  ✅ Module '{real_module_db}' accessible avec permissions de base")
-                return f(*args, **kwargs)
-            
-            # Pour les modules avec permission spécifique
-            required_permission = None
-            
-            # Chercher avec le nom DB d'abord
-            if real_module_db in module_permission_map:
-                required_permission = module_permission_map[real_module_db]
-            # Sinon avec le nom URL
-            elif module_code in module_permission_map:
-                required_permission = module_permission_map[module_code]
-            
-            if required_permission:
-                print(f"  🔐 Permission requise: {required_permission}")
-                print(f"  👤 Permissions utilisateur: {current_user.permissions}")
-                
-                user_has_permission = current_user.permissions.get(required_permission, False)
-                
-                if not user_has_permission:
-                    print(f"  ❌ Utilisateur n'a pas la permission '{required_permission}'")
-                    
-                    # Vérifier si c'est un problème de synchronisation
-                    if required_permission in formule.permissions_template:
-                        formule_has_permission = formule.permissions_template[required_permission]
-                        if not formule_has_permission:
-                            print(f"  ⚠️  La formule {formule.nom} n'inclut pas '{required_permission}'")
-                            flash(f'Votre formule {formule.nom} n\'inclut pas cette fonctionnalité.', 'error')
-                        else:
-                            print(f"  ⚠️  Permission '{required_permission}' incluse dans la formule mais non attribuée")
-                            flash(f'Permission {required_permission} manquante dans votre profil.', 'error')
-                    
-                    # Suggérer la synchronisation
-                    if current_user.role in ['admin', 'super_admin']:
-                        flash('Veuillez synchroniser vos permissions avec la formule.', 'info')
-                    
-                    return redirect(url_for('dashboard'))
-                else:
-                    print(f"  ✅ Utilisateur a la permission '{required_permission}'")
-            
-            print(f"  🎉 Accès AUTORISÉ au module '{module_code}' ({real_module_db})")
-            return f(*args, **kwargs)
-        
-        return decorated_function
-    return decorator
 
 
 @app.route('/super-admin/fix-module-inconsistency')
@@ -9386,141 +8405,6 @@ def fix_module_inconsistency():
         return jsonify({'error': str(e)}), 500
 
 
-def sync_user_permissions_with_formule(user_id):
-    """Synchronise COMPLÈTEMENT les permissions d'un utilisateur avec sa formule"""
-    user = User.query.get(user_id)
-    if not user or not user.client or not user.client.formule:
-        return False
-    
-    formule = user.client.formule
-    needs_update = False
-    
-    # Initialiser les permissions
-    if user.permissions is None:
-        user.permissions = {}
-    
-    # ============================================
-    # ÉTAPE 1: FORCER les permissions obligatoires selon le rôle
-    # ============================================
-    
-    # ADMIN CLIENT : permissions obligatoires
-    if user.is_client_admin or user.role == 'admin':
-        admin_required_permissions = {
-            'can_view_dashboard': True,
-            'can_view_reports': True,
-            'can_export_data': True,
-            'can_view_notifications': True,       # ← CRITIQUE
-            'can_view_departments': True,
-            'can_manage_departments': True,
-            'can_view_users_list': True,
-            'can_edit_users': True,
-            'can_create_users': True,
-            'can_deactivate_users': True,
-            'can_delete_users': True,
-            'can_manage_users': True,
-            'can_manage_risks': True,
-            'can_validate_risks': True,
-            'can_manage_kri': True,
-            'can_manage_audit': True,
-            'can_manage_action_plans': True,      # ← AJOUTÉ
-            'can_view_action_plans': True,         # ← AJOUTÉ
-            'can_manage_settings': True
-        }
-        
-        for perm, value in admin_required_permissions.items():
-            if user.permissions.get(perm) != value:
-                user.permissions[perm] = value
-                needs_update = True
-                print(f"  🔧 Admin {perm}: forcé = {value}")
-    
-    # GESTIONNAIRE : permissions obligatoires
-    elif user.role == 'manager' or user.can_manage_users:
-        manager_required_permissions = {
-            'can_view_dashboard': True,
-            'can_view_reports': True,
-            'can_export_data': True,
-            'can_view_notifications': True,
-            'can_view_departments': True,
-            'can_access_all_departments': True,
-            'can_view_users_list': True,
-            'can_create_users': True,               # ← AJOUTÉ
-            'can_edit_users': True,                  # ← AJOUTÉ
-            'can_deactivate_users': True,            # ← AJOUTÉ
-            'can_delete_users': True,                # ← AJOUTÉ
-            'can_manage_users': True,
-            'can_manage_permissions': True,          # ← AJOUTÉ
-            'can_manage_risks': True,
-            'can_validate_risks': True,
-            'can_manage_kri': True,
-            'can_manage_audit': True,
-            'can_manage_action_plans': True,         # ← AJOUTÉ
-            'can_view_action_plans': True,            # ← AJOUTÉ
-            'can_archive_data': True
-        }
-        
-        for perm, value in manager_required_permissions.items():
-            if user.permissions.get(perm) != value:
-                user.permissions[perm] = value
-                needs_update = True
-                print(f"  🔧 Manager {perm}: forcé = {value}")
-    
-    # ============================================
-    # ÉTAPE 2: MAPPING COMPLET module → permission
-    # ============================================
-    module_permission_map = {
-        'veille_reglementaire': ['can_manage_regulatory'],
-        'gestion_processus': ['can_manage_logigram'],
-        'analyse_ia': ['can_use_ia_analysis'],
-        'tableaux_bord': ['can_view_dashboard'],
-        'suivi_kri': ['can_manage_kri'],
-        'audit_interne': ['can_manage_audit'],
-        'reporting_avance': ['can_export_data'],
-        'plans_action': ['can_manage_action_plans', 'can_view_action_plans']  # ← CRITIQUE
-    }
-    
-    for module_name, permission_list in module_permission_map.items():
-        is_module_active = formule.modules.get(module_name, False)
-        
-        for permission in permission_list:
-            user_has_permission = user.permissions.get(permission, False)
-            
-            # Si le module est activé, activer la permission (sauf si déjà forcée)
-            if is_module_active and not user_has_permission:
-                user.permissions[permission] = True
-                needs_update = True
-                print(f"  🔄 {permission}: {user_has_permission} → {True} (module {module_name} activé)")
-            
-            # Si le module est désactivé, désactiver la permission (sauf admin/client)
-            elif not is_module_active and user_has_permission:
-                # Ne pas désactiver les permissions des admins ou gestionnaires
-                if not (user.is_client_admin or user.role == 'manager' or user.can_manage_users):
-                    user.permissions[permission] = False
-                    needs_update = True
-                    print(f"  🔄 {permission}: {user_has_permission} → {False} (module {module_name} désactivé)")
-    
-    # ============================================
-    # ÉTAPE 3: DÉSACTIVER les permissions système pour non-super-admin
-    # ============================================
-    if user.role != 'super_admin':
-        system_permissions = ['can_manage_clients', 'can_provision_servers']
-        for perm in system_permissions:
-            if user.permissions.get(perm, False):
-                user.permissions[perm] = False
-                needs_update = True
-                print(f"  🔒 {perm}: désactivée pour non-super-admin")
-    
-    if needs_update:
-        try:
-            user.updated_at = datetime.utcnow()
-            db.session.commit()
-            print(f"✅ Permissions synchronisées pour {user.username}")
-            return True
-        except Exception as e:
-            db.session.rollback()
-            print(f"❌ Erreur: {e}")
-            return False
-    
-    return True
 
 def check_feature_access(feature_code):
     """Décorateur pour vérifier l'accès à une feature"""
@@ -9540,164 +8424,7 @@ def check_feature_access(feature_code):
     return decorator
 
 
-def exporter_json_questionnaire(questionnaire, form):
-    """Exporter un questionnaire au format JSON"""
-    data = {
-        'titre': questionnaire.titre,
-        'description': questionnaire.description,
-        'code': questionnaire.code,
-        'instructions': questionnaire.instructions,
-        'date_creation': questionnaire.date_creation.isoformat() if questionnaire.date_creation else None,
-        'est_actif': questionnaire.est_actif,
-        'est_public': questionnaire.est_public,
-        'categories': [],
-        'statistiques': {
-            'total_reponses': len(questionnaire.reponses),
-            'reponses_completes': len([r for r in questionnaire.reponses if r.statut == 'complet']),
-            'reponses_en_cours': len([r for r in questionnaire.reponses if r.statut == 'en_cours']),
-        }
-    }
-    
-    # Filtrage par dates
-    date_debut = form.date_debut.data
-    date_fin = form.date_fin.data
-    reponses_filtrees = questionnaire.reponses
-    
-    if date_debut:
-        reponses_filtrees = [r for r in reponses_filtrees if r.date_debut and r.date_debut.date() >= date_debut]
-    if date_fin:
-        reponses_filtrees = [r for r in reponses_filtrees if r.date_debut and r.date_debut.date() <= date_fin]
-    
-    if form.inclure_questions.data:
-        for categorie in questionnaire.categories:
-            cat_data = {
-                'titre': categorie.titre,
-                'description': categorie.description,
-                'ordre': categorie.ordre,
-                'questions': []
-            }
-            
-            for question in categorie.questions:
-                q_data = {
-                    'texte': question.texte,
-                    'description': question.description,
-                    'type': question.type,
-                    'ordre': question.ordre,
-                    'est_obligatoire': question.est_obligatoire,
-                    'options': []
-                }
-                
-                for option in question.options:
-                    q_data['options'].append({
-                        'valeur': option.valeur,
-                        'texte': option.texte,
-                        'ordre': option.ordre,
-                        'score': option.score
-                    })
-                
-                cat_data['questions'].append(q_data)
-            
-            data['categories'].append(cat_data)
-    
-    if form.inclure_reponses.data:
-        data['reponses'] = []
-        for reponse in reponses_filtrees:
-            rep_data = {
-                'session_id': reponse.session_id,
-                'statut': reponse.statut,
-                'date_debut': reponse.date_debut.isoformat() if reponse.date_debut else None,
-                'date_fin': reponse.date_fin.isoformat() if reponse.date_fin else None,
-                'duree': reponse.duree,
-                'email_repondant': reponse.email_repondant,
-                'nom_repondant': reponse.nom_repondant,
-                'reponses': []
-            }
-            
-            for rep_question in reponse.reponses:
-                rep_q_data = {
-                    'question_id': rep_question.question_id,
-                    'valeur_texte': rep_question.valeur_texte,
-                    'valeur_numerique': rep_question.valeur_numerique,
-                    'valeur_date': rep_question.valeur_date.isoformat() if rep_question.valeur_date else None,
-                    'options_selectionnees': []
-                }
-                
-                for opt in rep_question.options_selectionnees:
-                    rep_q_data['options_selectionnees'].append({
-                        'option_id': opt.option_id,
-                        'valeur': opt.option.valeur if opt.option else None,
-                        'texte': opt.option.texte if opt.option else None
-                    })
-                
-                rep_data['reponses'].append(rep_q_data)
-            
-            data['reponses'].append(rep_data)
-    
-    response = make_response(json.dumps(data, indent=2, ensure_ascii=False, default=str))
-    response.headers['Content-Type'] = 'application/json'
-    response.headers['Content-Disposition'] = f'attachment; filename=questionnaire_{questionnaire.code}_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json'
-    return response
 
-def exporter_csv_reponses(questionnaire, form):
-    """Exporter les réponses au format CSV"""
-    # Filtrage par dates
-    date_debut = form.date_debut.data
-    date_fin = form.date_fin.data
-    reponses_filtrees = questionnaire.reponses
-    
-    if date_debut:
-        reponses_filtrees = [r for r in reponses_filtrees if r.date_debut and r.date_debut.date() >= date_debut]
-    if date_fin:
-        reponses_filtrees = [r for r in reponses_filtrees if r.date_debut and r.date_debut.date() <= date_fin]
-    
-    # Préparer les données CSV
-    output = io.StringIO()
-    writer = csv.writer(output)
-    
-    # En-têtes
-    headers = ['Session ID', 'Statut', 'Date début', 'Date fin', 'Durée (s)', 'Email', 'Nom']
-    
-    # Ajouter les questions comme colonnes
-    for categorie in questionnaire.categories:
-        for question in categorie.questions:
-            headers.append(f"{categorie.titre} - {question.texte[:50]}")
-    
-    writer.writerow(headers)
-    
-    # Données
-    for reponse in reponses_filtrees:
-        row = [
-            reponse.session_id,
-            reponse.statut,
-            reponse.date_debut.strftime('%Y-%m-%d %H:%M:%S') if reponse.date_debut else '',
-            reponse.date_fin.strftime('%Y-%m-%d %H:%M:%S') if reponse.date_fin else '',
-            reponse.duree or '',
-            reponse.email_repondant or '',
-            reponse.nom_repondant or ''
-        ]
-        
-        for categorie in questionnaire.categories:
-            for question in categorie.questions:
-                # Trouver la réponse à cette question
-                rep_question = next((rq for rq in reponse.reponses if rq.question_id == question.id), None)
-                valeur = ''
-                
-                if rep_question:
-                    if rep_question.valeur_texte:
-                        valeur = rep_question.valeur_texte
-                    elif rep_question.valeur_numerique is not None:
-                        valeur = str(rep_question.valeur_numerique)
-                    elif rep_question.valeur_date:
-                        valeur = rep_question.valeur_date.strftime('%Y-%m-%d')
-                
-                row.append(valeur)
-        
-        writer.writerow(row)
-    
-    response = make_response(output.getvalue())
-    response.headers['Content-Type'] = 'text/csv; charset=utf-8'
-    response.headers['Content-Disposition'] = f'attachment; filename=reponses_{questionnaire.code}_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'
-    return response
 
 def exporter_excel_reponses(questionnaire, form):
     """Exporter les réponses au format Excel"""
@@ -9997,33 +8724,8 @@ def get_client_usage_stats(client_id):
     
     formule = client.formule
     
-    stats = {
-        'utilisateurs': {
-            'current': User.query.filter_by(client_id=client_id, is_active=True).count(),
-            'limit': formule.max_utilisateurs,
-            'percent': 0
-        },
-        'risques': {
-            'current': Risque.query.filter_by(client_id=client_id, is_archived=False).count(),
-            'limit': formule.max_risques,
-            'percent': 0
-        },
-        'audits': {
-            'current': Audit.query.filter_by(client_id=client_id, is_archived=False).count(),
-            'limit': formule.max_audits,
-            'percent': 0
-        },
-        'processus': {
-            'current': Processus.query.filter_by(client_id=client_id).count(),
-            'limit': formule.max_processus,
-            'percent': 0
-        },
-        'logigrammes': {
-            'current': ProcessusActivite.query.filter_by(client_id=client_id).count(),
-            'limit': formule.max_logigrammes,
-            'percent': 0
-        }
-    }
+    # Compteurs maintenus par QuotaService (pas de COUNT par ressource)
+    stats = QuotaService.stats_usage(formule, client_id)
     
     # Calculer les pourcentages
     for key, data in stats.items():
@@ -10523,91 +9225,6 @@ def init_default_formules():
             db.session.rollback()
             print(f"❌ Erreur lors de l'initialisation: {e}")
 
-@app.before_request
-def check_permissions_middleware_complete():
-    """Middleware pour vérifier les permissions sur chaque requête - VERSION COMPLÈTE"""
-    
-    if not current_user.is_authenticated:
-        return
-    
-    # SUPER ADMIN : BYPASS toutes les vérifications
-    if current_user.role == 'super_admin':
-        return
-    
-    # Liste des endpoints protégés et leurs permissions requises
-    protected_endpoints = {
-        # Risques
-        'liste_cartographies': 'can_manage_risks',
-        'nouvelle_cartographie': 'can_manage_risks',
-        'modifier_cartographie': 'can_manage_risks',
-        
-        # KRI
-        'liste_kri': 'can_manage_kri',
-        'nouveau_kri': 'can_manage_kri',
-        'modifier_kri': 'can_manage_kri',
-        
-        # Audit
-        'liste_audits': 'can_manage_audit',
-        'nouvel_audit': 'can_manage_audit',
-        'detail_audit': 'can_manage_audit',
-        
-        # Veille
-        'veille_reglementaire': 'can_manage_regulatory',
-        'nouvelle_veille': 'can_manage_regulatory',
-        
-        # Logigrammes
-        'liste_logigrammes': 'can_manage_logigram',
-        'nouveau_logigramme': 'can_manage_logigram',
-        
-        # Plans d'action
-        'liste_plans_action': 'can_view_action_plans',
-        'nouveau_plan_action': 'can_manage_action_plans',
-        'editer_plan_action': 'can_manage_action_plans',
-        
-        # Utilisateurs
-        'admin_utilisateurs': 'can_view_users_list',
-        'admin_nouvel_utilisateur': 'can_create_users',
-        'admin_editer_utilisateur': 'can_edit_users',
-        'gestionnaire_utilisateurs': 'can_view_users_list',
-        'gestionnaire_creer_utilisateur': 'can_create_users',
-        'gestionnaire_editer_utilisateur': 'can_edit_users',
-        
-        # Directions
-        'admin_directions': 'can_view_departments',
-        'nouvelle_direction': 'can_manage_departments',
-        
-        # Paramétrage
-        'parametrage_risque': 'can_manage_settings',
-        'parametrage_champs': 'can_manage_settings',
-        'parametrage_fichiers': 'can_manage_settings'
-    }
-    
-    endpoint = request.endpoint
-    
-    if endpoint in protected_endpoints:
-        required_permission = protected_endpoints[endpoint]
-        
-        # DEBUG
-        print(f"🔍 [MIDDLEWARE] Vérification endpoint: {endpoint}")
-        print(f"   Permission requise: {required_permission}")
-        print(f"   Utilisateur: {current_user.username} (rôle: {current_user.role})")
-        
-        # Vérifier la permission
-        has_perm = current_user.has_permission(required_permission)
-        
-        if not has_perm:
-            print(f"   ❌ Permission refusée par middleware")
-            
-            # Message personnalisé selon le type d'utilisateur
-            if current_user.role == 'manager' and required_permission.startswith('can_'):
-                flash(f'Permission "{required_permission}" manquante. Contactez votre administrateur client.', 'error')
-            else:
-                flash(f'Accès non autorisé. Permission "{required_permission}" requise.', 'error')
-            
-            return redirect(url_for('dashboard'))
-        else:
-            print(f"   ✅ Permission accordée par middleware")
-
 @app.route('/module-restricted/<module>')
 @login_required
 def module_restricted(module):
@@ -10698,23 +9315,7 @@ def api_check_formule_limits():
     formule = current_user.client.formule
     client = current_user.client
     
-    stats = {
-        'utilisateurs': {
-            'current': User.query.filter_by(client_id=client.id, is_active=True).count(),
-            'limit': formule.max_utilisateurs,
-            'percent': 0
-        },
-        'risques': {
-            'current': Risque.query.filter_by(client_id=client.id, is_archived=False).count(),
-            'limit': formule.max_risques,
-            'percent': 0
-        },
-        'audits': {
-            'current': Audit.query.filter_by(client_id=client.id, is_archived=False).count(),
-            'limit': formule.max_audits,
-            'percent': 0
-        }
-    }
+    stats = QuotaService.stats_usage(formule, client.id, ressources=('utilisateurs', 'risques', 'audits'))
     
     # Calculer les pourcentages
     for key, data in stats.items():
@@ -10787,62 +9388,68 @@ def api_check_module_access(module_code):
 # MIDDLEWARE POUR VÉRIFIER LES LIMITES
 # ========================
 
-@app.before_request
+# Endpoints de création soumis aux limites de la formule
+ENDPOINTS_LIMITES_FORMULE = {
+    'admin_nouvel_utilisateur': 'utilisateurs',
+    'nouveau_risque': 'risques',
+    'nouvel_audit': 'audits',
+    'nouveau_processus': 'processus',
+    'nouveau_logigramme': 'logigrammes'
+}
+
+# Vérifier seulement pour les actions de création
+@pipeline_requete.etape('limites_formule', endpoints=ENDPOINTS_LIMITES_FORMULE, methodes=['POST', 'PUT'])
 def check_formule_limits_middleware():
     """Middleware pour vérifier les limites de formule avant certaines actions"""
-    if not current_user.is_authenticated:
+    if not current_user.is_authenticated or not current_user.client_id:
         return
     
-    # Vérifier seulement pour les actions de création
-    if request.method not in ['POST', 'PUT']:
+    limit_type = ENDPOINTS_LIMITES_FORMULE.get(request.endpoint)
+    if not limit_type:
         return
     
-    # Liste des endpoints à vérifier
-    limit_check_endpoints = {
-        'admin_nouvel_utilisateur': 'utilisateurs',
-        'nouveau_risque': 'risques',
-        'nouvel_audit': 'audits',
-        'nouveau_processus': 'processus',
-        'nouveau_logigramme': 'logigrammes'
-    }
+    # Limites de la formule et compteur d'usage : des lectures par clé primaire.
+    # Ce contrôle évite un formulaire perdu ; la limite est garantie à l'insertion
+    # (incrément conditionnel du compteur, voir LimiteFormuleAtteinte).
+    if QuotaService.limite_atteinte(current_user.client_id, limit_type):
+        limit = QuotaService.limites(current_user.client_id)[limit_type]
+        return _refuser_limite_formule(limit_type, limit)
+
+
+def _refuser_limite_formule(limit_type, limit):
+    """Message et redirection communs au middleware et au refus à l'insertion"""
+    flash(f'Limite de {limit_type} atteinte ({limit}). Veuillez mettre à niveau votre formule.', 'error')
     
-    endpoint = request.endpoint
-    if endpoint in limit_check_endpoints:
-        limit_type = limit_check_endpoints[endpoint]
-        
-        if current_user.client and current_user.client.formule:
-            formule = current_user.client.formule
-            
-            # Obtenir le compteur actuel
-            if limit_type == 'utilisateurs':
-                current_count = User.query.filter_by(client_id=current_user.client_id, is_active=True).count()
-                limit = formule.max_utilisateurs
-            elif limit_type == 'risques':
-                current_count = Risque.query.filter_by(client_id=current_user.client_id, is_archived=False).count()
-                limit = formule.max_risques
-            elif limit_type == 'audits':
-                current_count = Audit.query.filter_by(client_id=current_user.client_id, is_archived=False).count()
-                limit = formule.max_audits
-            elif limit_type == 'processus':
-                current_count = Processus.query.filter_by(client_id=current_user.client_id).count()
-                limit = formule.max_processus
-            elif limit_type == 'logigrammes':
-                current_count = ProcessusActivite.query.filter_by(client_id=current_user.client_id).count()
-                limit = formule.max_logigrammes
-            else:
-                return
-            
-            # Vérifier la limite
-            if current_count >= limit:
-                flash(f'Limite de {limit_type} atteinte ({limit}). Veuillez mettre à niveau votre formule.', 'error')
-                
-                # Stocker les données du formulaire pour ne pas les perdre
-                if request.method == 'POST':
-                    for key, value in request.form.items():
-                        if key != 'csrf_token':
-                            session[f'form_data_{key}'] = value
-                
-                return redirect(request.referrer or url_for('dashboard'))
+    # Stocker les données du formulaire pour ne pas les perdre
+    if request.method == 'POST':
+        for key, value in request.form.items():
+            if key != 'csrf_token':
+                session[f'form_data_{key}'] = value
+    
+    return redirect(request.referrer or url_for('dashboard'))
+
+
+@app.errorhandler(LimiteFormuleAtteinte)
+def limite_formule_atteinte(e):
+    """Création refusée à l'insertion (création concurrente ou hors endpoints contrôlés)"""
+    QuotaService.refus()
+    db.session.rollback()
+    print(f"⚠️ {e} (client {e.client_id}) : {request.path}")
+    if request.is_json or request.path.startswith('/api/'):
+        return jsonify({'success': False, 'error': str(e), 'ressource': e.ressource, 'limite': e.limite}), 403
+    return _refuser_limite_formule(e.ressource, e.limite)
+
+
+def limite_formule_interceptee(response):
+    """
+    Refus à l'insertion intercepté par le try/except d'une vue (message
+    d'erreur générique, réponse 500...) : remplacé par la réponse de refus.
+    Enregistré en fin de fichier, après tous les autres after_request.
+    """
+    refus = QuotaService.refus()
+    if refus is None:
+        return response
+    return make_response(limite_formule_atteinte(refus))
 
 
 # ========================
@@ -10987,7 +9594,7 @@ def api_formule_comparison(formule_id):
 # UTILITAIRES POUR LES TEMPLATES
 # ========================
 
-@app.context_processor
+@contexte_templates.fournisseur
 def inject_formule_info():
     """Injecter les informations de formule dans tous les templates"""
     formule_info = {
@@ -10998,8 +9605,11 @@ def inject_formule_info():
         'is_module_restricted': lambda module: False
     }
     
-    if current_user.is_authenticated and current_user.client and current_user.client.formule:
-        formule = current_user.client.formule
+    # Client lu par son id : évite de charger l'objet User complet à chaque rendu
+    client = db.session.get(Client, current_user.client_id) if current_user.is_authenticated and current_user.client_id else None
+    
+    if client and client.formule:
+        formule = client.formule
         formule_info['current_formule'] = formule
         formule_info['has_formule'] = True
         formule_info['formule_limits'] = {
@@ -12307,10 +10917,11 @@ def admin_pays():
         pays = get_client_filter(Pays).filter_by(is_archived=False).order_by(Pays.ordre, Pays.nom).all()
     
     # Statistiques
+    comptages_pays = HierarchieService.compter_organisation('pays', [p.id for p in pays])
     stats = {
         'total_pays': len(pays),
-        'total_poles': sum(p.nb_poles for p in pays),
-        'total_directions': sum(p.nb_directions for p in pays)
+        'total_poles': sum(comptages_pays[p.id]['poles'] for p in pays),
+        'total_directions': sum(comptages_pays[p.id]['directions'] for p in pays)
     }
     
     return render_template('admin/pays/liste.html', pays=pays, stats=stats)
@@ -12538,13 +11149,12 @@ def admin_poles():
     
     # Organisation par pays (pour le mode pays)
     pays_organisation = []
+    comptages_poles = HierarchieService.compter_organisation('pole', [p.id for p in poles])
     for pays in pays_list:
         poles_du_pays = [p for p in poles if p.pays_id == pays.id]
         if poles_du_pays:  # Ne montrer que les pays avec des pôles
             # Compter les directions pour chaque pôle
-            nb_directions = 0
-            for pole in poles_du_pays:
-                nb_directions += len([d for d in pole.directions if not d.is_archived and d.is_active])
+            nb_directions = sum(comptages_poles[pole.id]['directions'] for pole in poles_du_pays)
             
             pays_organisation.append({
                 'pays': pays,
@@ -14404,53 +13014,6 @@ def fix_all_formules_modules_mapping():
         print("🎉 Toutes les formules corrigées")
 
 
-def sync_user_permissions_with_formule(user_id):
-    """Synchronise les permissions d'un utilisateur avec sa formule - VERSION CORRIGÉE"""
-    user = User.query.get(user_id)
-    if not user or not user.client or not user.client.formule:
-        return False
-    
-    formule = user.client.formule
-    needs_update = False
-    
-    # Initialiser les permissions
-    if user.permissions is None:
-        user.permissions = {}
-    
-    # Mappage COMPLET module → permission
-    module_permission_map = {
-        'veille_reglementaire': 'can_manage_regulatory',
-        'gestion_processus': 'can_manage_logigram',
-        'analyse_ia': 'can_use_ia_analysis',
-        'tableaux_bord': 'can_view_dashboard',
-        'suivi_kri': 'can_manage_kri',
-        'audit_interne': 'can_manage_audit',
-        'reporting_avance': 'can_export_data'
-    }
-    
-    # Synchroniser chaque permission
-    for module_name, permission in module_permission_map.items():
-        is_module_active = formule.modules.get(module_name, False)
-        user_has_permission = user.permissions.get(permission, False)
-        
-        # Correction nécessaire ?
-        if user_has_permission != is_module_active:
-            user.permissions[permission] = is_module_active
-            needs_update = True
-            print(f"  🔄 {permission}: {user_has_permission} → {is_module_active}")
-    
-    if needs_update:
-        try:
-            user.updated_at = datetime.utcnow()
-            db.session.commit()
-            print(f"✅ Permissions synchronisées pour {user.username}")
-            return True
-        except Exception as e:
-            db.session.rollback()
-            print(f"❌ Erreur: {e}")
-            return False
-    
-    return True
 
 
 @app.route('/super-admin/correct-modules-permissions')
@@ -16162,16 +14725,12 @@ def sync_client_permissions(client_id):
         flash(f'❌ Erreur: {str(e)}', 'error')
         return redirect(url_for('super_admin_client_detail', id=client_id))
 
-@app.before_request
+@pipeline_requete.etape('synchronisation_permissions', exemptes=['static'])
 def auto_sync_user_permissions():
     """Synchronise automatiquement les permissions manquantes"""
     if current_user.is_authenticated:
-        # Vérifier toutes les 10 requêtes
-        session_key = f'permission_sync_{current_user.id}'
-        request_count = session.get(session_key, 0) + 1
-        session[session_key] = request_count
-        
-        if request_count % 10 == 0:  # Toutes les 10 requêtes
+        # Vérifier toutes les 5 minutes par utilisateur (sans écriture en session)
+        if pipeline_requete.periodique('synchronisation_permissions', current_user.id, 300):
             if current_user.client and current_user.client.formule:
                 formule = current_user.client.formule
                 
@@ -16884,16 +15443,15 @@ def verify_user_permissions_on_update(user_id):
                 # Désactiver la permission
                 user.permissions[perm_key] = False
 
-@app.before_request
+@pipeline_requete.etape('verification_permissions', methodes=['POST'],
+                        endpoints=lambda endpoint: endpoint is not None and 'permissions' in endpoint)
 def auto_verify_permissions():
     """Vérifie automatiquement les permissions pour les requêtes POST"""
-    if request.method == 'POST' and current_user.is_authenticated:
-        # Vérifier que request.endpoint n'est pas None avant de l'utiliser
-        if request.endpoint and 'permissions' in request.endpoint:
-            # Récupérer l'ID utilisateur depuis l'URL
-            user_id = request.view_args.get('id') if request.view_args else None
-            if user_id:
-                verify_user_permissions_on_update(user_id)
+    if current_user.is_authenticated:
+        # Récupérer l'ID utilisateur depuis l'URL
+        user_id = request.view_args.get('id') if request.view_args else None
+        if user_id:
+            verify_user_permissions_on_update(user_id)
                 
 @app.route('/webhook/formule-updated/<int:formule_id>', methods=['POST'])
 @login_required
@@ -16911,18 +15469,14 @@ def webhook_formule_updated(formule_id):
     return jsonify({'success': True, 'message': f'Permissions synchronisées pour la formule {formule.nom}'})
 
 
-@app.before_request
+@pipeline_requete.etape('correction_permissions', exemptes=['static'])
 def auto_correct_permissions():
-    """Corrige automatiquement les permissions à chaque requête pour les admin client"""
+    """Corrige automatiquement les permissions pour les admin client"""
     
     if current_user.is_authenticated and current_user.role in ['admin', 'manager']:
         # Vérifier les permissions toutes les 5 minutes
-        last_check = session.get('last_permission_check')
-        now = datetime.utcnow().timestamp()
-        
-        if not last_check or (now - last_check > 300):  # 5 minutes
+        if pipeline_requete.periodique('correction_permissions', current_user.id, 300):
             verify_and_correct_user_permissions(current_user.id)
-            session['last_permission_check'] = now
             
 
 def migrate_and_correct_all_formules():
@@ -17740,16 +16294,6 @@ def can_view_filter(endpoint):
     return True
 
 
-@app.context_processor
-def inject_permission_helpers():
-    """Injecte les helpers de permissions dans tous les templates"""
-    return {
-        'should_display_module': should_display_module,
-        'has_permission': lambda perm: current_user.has_permission(perm) if current_user.is_authenticated else False,
-        'can_access_module': lambda module: current_user.client and current_user.client.formule and current_user.client.formule.modules.get(module, False) if current_user.is_authenticated else False,
-        'current_formule': lambda: current_user.client.formule if current_user.is_authenticated and current_user.client else None,
-        'is_module_active': lambda module: current_user.client and current_user.client.formule and current_user.client.formule.modules.get(module, False) if current_user.is_authenticated else False
-    }
 # Dans app.py, assurez-vous que ce filtre est enregistré
 
 @app.template_filter('should_display_module')
@@ -17766,108 +16310,18 @@ def has_permission_filter(permission):
     return False
 
 # Injecter dans tous les templates
-@app.context_processor
+@contexte_templates.fournisseur
 def inject_permission_helpers():
     """Injecte les helpers de permissions dans tous les templates"""
     return {
         'should_display_module': should_display_module,
         'get_visible_modules': get_visible_modules,
         'has_permission': lambda perm: current_user.permissions.get(perm, False) if current_user.is_authenticated else False,
-        'can_access_route': lambda endpoint: can_view_filter(endpoint)
-    }
-
-@app.before_request
-def check_module_access_middleware():
-    """
-    Middleware pour vérifier l'accès aux routes en fonction des permissions
-    - VERSION CORRIGÉE pour gestionnaire aussi
-    """
-    if not current_user.is_authenticated:
-        return
-    
-    # Ne pas vérifier pour certaines routes
-    exempt_routes = ['static', 'login', 'logout', 'public_home']
-    if request.endpoint in exempt_routes:
-        return
-    
-    # Liste des endpoints qui nécessitent une permission spécifique
-    protected_endpoints = {
-        # Risques
-        'liste_cartographies': 'can_manage_risks',
-        'nouvelle_cartographie': 'can_manage_risks',
-        'modifier_cartographie': 'can_manage_risks',
-        'detail_cartographie': 'can_manage_risks',
-        
-        # KRI
-        'liste_kri': 'can_manage_kri',
-        'nouveau_kri': 'can_manage_kri',
-        'modifier_kri': 'can_manage_kri',
-        
-        # Audit
-        'liste_audits': 'can_manage_audit',
-        'nouvel_audit': 'can_manage_audit',
-        'detail_audit': 'can_manage_audit',
-        
-        # Veille
-        'veille_reglementaire': 'can_manage_regulatory',
-        'nouvelle_veille': 'can_manage_regulatory',
-        
-        # Logigrammes
-        'liste_logigrammes': 'can_manage_logigram',
-        'nouveau_logigramme': 'can_manage_logigram',
-        'editer_logigramme': 'can_manage_logigram',
-        
-        # Plans d'action
-        'liste_plans_action': 'can_view_action_plans',
-        
-        # Utilisateurs - CORRECTION ICI
-        'admin_utilisateurs': 'can_view_users_list',
-        'admin_nouvel_utilisateur': 'can_create_users',  # CHANGÉ de 'can_edit_users' à 'can_create_users'
-        'admin_editer_utilisateur': 'can_edit_users',
-        
-        # Routes GESTIONNAIRE spécifiques
-        'gestionnaire_utilisateurs': 'can_view_users_list',
-        'gestionnaire_creer_utilisateur': 'can_create_users',  # AJOUTÉ
-        'gestionnaire_editer_utilisateur': 'can_edit_users',   # AJOUTÉ
-        'gestionnaire_gerer_permissions': 'can_manage_permissions',  # AJOUTÉ
-        
-        # Directions
-        'admin_directions': 'can_view_departments',
-        'nouvelle_direction': 'can_manage_departments',
-        
-        # Paramétrage
-        'parametrage_risque': 'can_manage_settings',
-        'parametrage_champs': 'can_manage_settings',
-        'parametrage_fichiers': 'can_manage_settings'
+        'can_access_route': lambda endpoint: can_view_filter(endpoint),
+        'can_access_module': lambda module: current_user.client and current_user.client.formule and current_user.client.formule.modules.get(module, False) if current_user.is_authenticated else False,
+        'current_formule': lambda: current_user.client.formule if current_user.is_authenticated and current_user.client else None,
+        'is_module_active': lambda module: current_user.client and current_user.client.formule and current_user.client.formule.modules.get(module, False) if current_user.is_authenticated else False
     }
-    
-    endpoint = request.endpoint
-    
-    if endpoint in protected_endpoints:
-        required_permission = protected_endpoints[endpoint]
-        
-        # DEBUG
-        print(f"🔍 [MIDDLEWARE] Vérification endpoint: {endpoint}")
-        print(f"   Permission requise: {required_permission}")
-        print(f"   Utilisateur: {current_user.username} (rôle: {current_user.role})")
-        
-        # Vérifier la permission
-        has_perm = current_user.has_permission(required_permission)
-        print(f"   Résultat permission: {has_perm}")
-        
-        if not has_perm:
-            print(f"   ❌ Permission refusée par middleware")
-            
-            # Si c'est une route gestionnaire, proposer une solution
-            if endpoint.startswith('gestionnaire_'):
-                flash(f'Permission "{required_permission}" manquante. Les gestionnaires doivent avoir "can_manage_users = True" pour accéder à cette fonctionnalité.', 'error')
-            else:
-                flash(f'Accès non autorisé au module {endpoint}. Permission "{required_permission}" requise.', 'error')
-            
-            return redirect(url_for('dashboard'))
-        else:
-            print(f"   ✅ Permission accordée par middleware")
-
 
 @app.route('/activate-gestionnaire-permissions')
 @login_required
@@ -18694,17 +17148,14 @@ def fix_all_admin_permissions():
         return jsonify({'error': str(e)}), 500
 
 
-@app.before_request
+@pipeline_requete.etape('permissions_admin_client', exemptes=['static'])
 def ensure_admin_client_permissions():
     """Garantit que les admin clients ont toujours les permissions de base"""
     
     if current_user.is_authenticated:
         # Vérifier toutes les 5 minutes seulement
-        last_check = session.get('last_admin_check', 0)
-        now = datetime.utcnow().timestamp()
-        
-        if (current_user.is_client_admin or current_user.role == 'admin') and (now - last_check > 300):
-            session['last_admin_check'] = now
+        if ((current_user.is_client_admin or current_user.role == 'admin')
+                and pipeline_requete.periodique('permissions_admin_client', current_user.id, 300)):
             
             # Permissions obligatoires
             required_permissions = [
@@ -18807,36 +17258,6 @@ def format_permissions_filter(permissions_dict):
     
     return result
 
-@app.before_request
-def check_permissions():
-    """Vérifie les permissions pour chaque requête"""
-    if current_user.is_authenticated:
-        # Liste des endpoints protégés et leurs permissions requises
-        protected_endpoints = {
-            'liste_cartographies': 'can_manage_risks',
-            'nouvelle_cartographie': 'can_manage_risks',
-            'liste_kri': 'can_manage_kri',
-            'nouveau_kri': 'can_manage_kri',
-            'liste_audits': 'can_manage_audit',
-            'nouvel_audit': 'can_manage_audit',
-            'veille_reglementaire': 'can_manage_regulatory',
-            'liste_logigrammes': 'can_manage_logigram',
-            'admin_dashboard': 'can_manage_users',
-            'admin_utilisateurs': 'can_manage_users',
-            'rapports': 'can_view_reports',
-            'export_risques': 'can_export_data'
-        }
-        
-        endpoint = request.endpoint
-        if endpoint in protected_endpoints:
-            required_permission = protected_endpoints[endpoint]
-            if not current_user.has_permission(required_permission):
-                flash('Accès refusé : permissions insuffisantes', 'error')
-                return redirect(url_for('dashboard'))
-
-            
-
-
 # ========================
 # ROUTES SUPERVISEUR CLIENT
 # ========================
@@ -18847,7 +17268,8 @@ def check_permissions():
 def super_admin_clients():
     """Liste des clients (super admin uniquement)"""
     clients = Client.query.order_by(Client.created_at.desc()).all()
-    return render_template('super_admin/clients.html', clients=clients)
+    usages = QuotaService.usage_clients([c.id for c in clients])
+    return render_template('super_admin/clients.html', clients=clients, usages=usages)
 
 @app.route('/super-admin/client/nouveau', methods=['GET', 'POST'])
 @login_required
@@ -21927,54 +20349,8 @@ def debug_form_errors(form):
 # MIDDLEWARE DE FILTRAGE CLIENT
 # ========================
 
-@app.before_request
-def filter_client_data():
-    """Filtre automatiquement les données par client"""
-    if current_user.is_authenticated and not current_user.role == 'super_admin':
-        # Ne pas filtrer les routes publiques ou d'administration
-        if request.endpoint and not request.endpoint.startswith(('login', 'logout', 'static', 
-                                                                'super_admin', 'client_admin')):
-            # Ajouter le filtre client_id aux requêtes
-            g.client_id = current_user.client_id
 
 # Dans chaque route qui manipule des données, ajoutez ce filtre :
-def check_client_access(entite):
-    """Vérifie que l'utilisateur a accès à l'entité"""
-    
-    # SUPER ADMIN : ACCÈS UNIVERSEL (sauf aux autres super admin)
-    if current_user.role == 'super_admin':
-        # Un super admin ne peut pas accéder à un autre super admin
-        if isinstance(entite, User) and entite.role == 'super_admin':
-            return current_user.id == entite.id  # Seulement son propre compte
-        return True
-    
-    # Si l'entité n'existe pas
-    if not entite:
-        return False
-    
-    # Vérifier client_id direct
-    if hasattr(entite, 'client_id') and entite.client_id:
-        return entite.client_id == current_user.client_id
-    
-    # Vérifier par created_by
-    if hasattr(entite, 'created_by') and entite.created_by:
-        createur = User.query.get(entite.created_by)
-        if createur:
-            # Un utilisateur normal ne peut pas accéder aux données créées par un super admin
-            if createur.role == 'super_admin':
-                return False
-            if hasattr(createur, 'client_id'):
-                return createur.client_id == current_user.client_id
-    
-    # Pour les User, vérifier directement
-    if isinstance(entite, User):
-        # Ne pas permettre l'accès aux super admin
-        if entite.role == 'super_admin':
-            return False
-        return entite.client_id == current_user.client_id
-    
-    # Par défaut, refuser
-    return False
 
 def check_client_access(entite):
     """Vérifie que l'utilisateur a accès à l'entité"""
@@ -22178,33 +20554,19 @@ def dashboard():
         # 4. ANALYSE DES RISQUES
         # ========================
         
-        derniere_eval_subq = db.session.query(
-            EvaluationRisque.risque_id,
-            func.max(EvaluationRisque.created_at).label('max_date')
-        ).join(Risque, EvaluationRisque.risque_id == Risque.id)
-        
-        if current_user.role != 'super_admin':
-            derniere_eval_subq = derniere_eval_subq.filter(Risque.client_id == current_user.client_id)
-        
-        derniere_eval_subq = derniere_eval_subq.group_by(EvaluationRisque.risque_id).subquery()
-        
-        niveaux_query = db.session.query(
-            EvaluationRisque.niveau_risque, func.count(EvaluationRisque.id)
-        ).select_from(EvaluationRisque).join(
-            derniere_eval_subq,
-            and_(
-                EvaluationRisque.risque_id == derniere_eval_subq.c.risque_id,
-                EvaluationRisque.created_at == derniere_eval_subq.c.max_date
-            )
-        ).join(Risque, EvaluationRisque.risque_id == Risque.id)
+        # État courant des risques : dernière évaluation confirmée ou validée (projection maintenue)
+        etats_query = db.session.query(RisqueEtatCourant).join(
+            Risque, RisqueEtatCourant.risque_id == Risque.id
+        ).filter(Risque.is_archived == False)
         
         if current_user.role != 'super_admin':
-            niveaux_query = niveaux_query.filter(Risque.client_id == current_user.client_id)
+            etats_query = etats_query.filter(Risque.client_id == current_user.client_id)
         
-        niveaux_risques = niveaux_query.filter(
-            Risque.is_archived == False, 
-            EvaluationRisque.niveau_risque.isnot(None)
-        ).group_by(EvaluationRisque.niveau_risque).all()
+        niveaux_risques = etats_query.filter(
+            RisqueEtatCourant.niveau_risque.isnot(None)
+        ).with_entities(
+            RisqueEtatCourant.niveau_risque, func.count(RisqueEtatCourant.risque_id)
+        ).group_by(RisqueEtatCourant.niveau_risque).all()
         
         risques_faibles = risques_moyens = risques_eleves = risques_critiques_count = 0
         for niveau, count in niveaux_risques:
@@ -22221,22 +20583,10 @@ def dashboard():
         # 5. RISQUES CRITIQUES
         # ========================
         
-        risques_critiques_query = db.session.query(Risque, EvaluationRisque
-        ).select_from(EvaluationRisque).join(
-            derniere_eval_subq,
-            and_(
-                EvaluationRisque.risque_id == derniere_eval_subq.c.risque_id,
-                EvaluationRisque.created_at == derniere_eval_subq.c.max_date
-            )
-        ).join(Risque, EvaluationRisque.risque_id == Risque.id)
-        
-        if current_user.role != 'super_admin':
-            risques_critiques_query = risques_critiques_query.filter(Risque.client_id == current_user.client_id)
-        
-        risques_critiques_list = risques_critiques_query.filter(
-            Risque.is_archived == False, 
-            EvaluationRisque.niveau_risque == 'Critique'
-        ).order_by(EvaluationRisque.score_risque.desc()
+        risques_critiques_list = etats_query.filter(
+            RisqueEtatCourant.niveau_risque == 'Critique'
+        ).with_entities(Risque, RisqueEtatCourant
+        ).order_by(RisqueEtatCourant.score_risque.desc()
         ).limit(10).all()
         
         risques_critiques_formatted = [{'risque': r, 'evaluation': e} for r, e in risques_critiques_list]
@@ -22304,20 +20654,7 @@ def dashboard():
         # 8. TENDANCE GLOBALE
         # ========================
         
-        score_query = db.session.query(func.avg(EvaluationRisque.score_risque)
-        ).select_from(EvaluationRisque).join(
-            derniere_eval_subq,
-            and_(
-                EvaluationRisque.risque_id == derniere_eval_subq.c.risque_id,
-                EvaluationRisque.created_at == derniere_eval_subq.c.max_date
-            )
-        ).join(Risque, EvaluationRisque.risque_id == Risque.id
-        ).filter(Risque.is_archived == False)
-        
-        if current_user.role != 'super_admin':
-            score_query = score_query.filter(Risque.client_id == current_user.client_id)
-        
-        score_risque_moyen = score_query.scalar()
+        score_risque_moyen = etats_query.with_entities(func.avg(RisqueEtatCourant.score_risque)).scalar()
         score_risque_moyen = round(score_risque_moyen, 2) if score_risque_moyen else 0
         
         if score_risque_moyen < 8:
@@ -22460,26 +20797,15 @@ def export_dashboard():
             is_archived=False
         ).count()
         
-        # 2. Calcul des risques par niveau
-        derniere_eval_subq = db.session.query(
-            EvaluationRisque.risque_id,
-            func.max(EvaluationRisque.created_at).label('max_date')
-        ).group_by(EvaluationRisque.risque_id).subquery()
-        
+        # 2. Calcul des risques par niveau (état courant : dernière évaluation confirmée ou validée)
         niveaux_risques = db.session.query(
-            EvaluationRisque.niveau_risque, 
-            func.count(EvaluationRisque.id)
-        ).select_from(EvaluationRisque).join(
-            derniere_eval_subq,
-            and_(
-                EvaluationRisque.risque_id == derniere_eval_subq.c.risque_id,
-                EvaluationRisque.created_at == derniere_eval_subq.c.max_date
-            )
-        ).join(Risque, EvaluationRisque.risque_id == Risque.id
+            RisqueEtatCourant.niveau_risque, 
+            func.count(RisqueEtatCourant.risque_id)
+        ).join(Risque, RisqueEtatCourant.risque_id == Risque.id
         ).filter(
             Risque.is_archived == False, 
-            EvaluationRisque.niveau_risque.isnot(None)
-        ).group_by(EvaluationRisque.niveau_risque).all()
+            RisqueEtatCourant.niveau_risque.isnot(None)
+        ).group_by(RisqueEtatCourant.niveau_risque).all()
         
         # Initialisation des compteurs
         risques_faibles = risques_moyens = risques_eleves = risques_critiques_count = 0
@@ -22514,18 +20840,14 @@ def export_dashboard():
         cartographies_risque = db.session.query(
             Cartographie.nom,
             func.count(Risque.id).label('nb_risques'),
-            func.avg(EvaluationRisque.score_risque).label('score_moyen')
+            func.avg(RisqueEtatCourant.score_risque).label('score_moyen')
         ).join(Risque, Risque.cartographie_id == Cartographie.id
-        ).join(EvaluationRisque, EvaluationRisque.risque_id == Risque.id
-        ).join(derniere_eval_subq,
-            and_(
-                EvaluationRisque.risque_id == derniere_eval_subq.c.risque_id,
-                EvaluationRisque.created_at == derniere_eval_subq.c.max_date
-            )
+        ).join(RisqueEtatCourant, RisqueEtatCourant.risque_id == Risque.id
         ).filter(
-            Risque.is_archived == False
+            Risque.is_archived == False,
+            RisqueEtatCourant.evaluation_id.isnot(None)
         ).group_by(Cartographie.id
-        ).order_by(func.avg(EvaluationRisque.score_risque).desc()
+        ).order_by(func.avg(RisqueEtatCourant.score_risque).desc()
         ).limit(5).all()
         
         # 5. KRI en alerte
@@ -22559,14 +20881,8 @@ def export_dashboard():
         
         # 7. Score de risque moyen
         score_risque_moyen = db.session.query(
-            func.avg(EvaluationRisque.score_risque)
-        ).select_from(EvaluationRisque).join(
-            derniere_eval_subq,
-            and_(
-                EvaluationRisque.risque_id == derniere_eval_subq.c.risque_id,
-                EvaluationRisque.created_at == derniere_eval_subq.c.max_date
-            )
-        ).join(Risque
+            func.avg(RisqueEtatCourant.score_risque)
+        ).join(Risque, RisqueEtatCourant.risque_id == Risque.id
         ).filter(Risque.is_archived == False
         ).scalar()
         
@@ -22587,22 +20903,17 @@ def export_dashboard():
         if total_risques > 0:
             pourcentage_critiques = round((risques_critiques_count / total_risques) * 100, 1)
         
-        # 10. Calcul des moyennes par niveau
-        scores_par_niveau = {}
+        # 10. Calcul des moyennes par niveau (une requête groupée)
         niveaux = ['Faible', 'Moyen', 'Élevé', 'Critique']
-        for niveau in niveaux:
-            score = db.session.query(
-                func.avg(EvaluationRisque.score_risque)
-            ).select_from(EvaluationRisque).join(
-                derniere_eval_subq,
-                and_(
-                    EvaluationRisque.risque_id == derniere_eval_subq.c.risque_id,
-                    EvaluationRisque.created_at == derniere_eval_subq.c.max_date
-                )
-            ).join(Risque).filter(
-                Risque.is_archived == False,
-                EvaluationRisque.niveau_risque == niveau
-            ).scalar()
+        scores_par_niveau = dict.fromkeys(niveaux, 0)
+        for niveau, score in db.session.query(
+            RisqueEtatCourant.niveau_risque,
+            func.avg(RisqueEtatCourant.score_risque)
+        ).join(Risque, RisqueEtatCourant.risque_id == Risque.id
+        ).filter(
+            Risque.is_archived == False,
+            RisqueEtatCourant.niveau_risque.in_(niveaux)
+        ).group_by(RisqueEtatCourant.niveau_risque).all():
             scores_par_niveau[niveau] = round(score, 2) if score else 0
         
         # 11. Nouvelles données pour l'évolution
@@ -23187,26 +21498,15 @@ def export_dashboard_csv():
         logigrammes_actifs = ProcessusActivite.query.filter_by(is_archived=False).count()
         veilles_actives = VeilleReglementaire.query.filter_by(is_active=True, is_archived=False).count()
         
-        # Données risques avec sous-requête
-        derniere_eval_subq = db.session.query(
-            EvaluationRisque.risque_id,
-            func.max(EvaluationRisque.created_at).label('max_date')
-        ).group_by(EvaluationRisque.risque_id).subquery()
-        
+        # Données risques depuis l'état courant (dernière évaluation confirmée ou validée)
         niveaux_risques = db.session.query(
-            EvaluationRisque.niveau_risque, 
-            func.count(EvaluationRisque.id)
-        ).select_from(EvaluationRisque).join(
-            derniere_eval_subq,
-            and_(
-                EvaluationRisque.risque_id == derniere_eval_subq.c.risque_id,
-                EvaluationRisque.created_at == derniere_eval_subq.c.max_date
-            )
-        ).join(Risque, EvaluationRisque.risque_id == Risque.id
+            RisqueEtatCourant.niveau_risque, 
+            func.count(RisqueEtatCourant.risque_id)
+        ).join(Risque, RisqueEtatCourant.risque_id == Risque.id
         ).filter(
             Risque.is_archived == False, 
-            EvaluationRisque.niveau_risque.isnot(None)
-        ).group_by(EvaluationRisque.niveau_risque).all()
+            RisqueEtatCourant.niveau_risque.isnot(None)
+        ).group_by(RisqueEtatCourant.niveau_risque).all()
         
         risques_faibles = risques_moyens = risques_eleves = risques_critiques_count = 0
         for niveau, count in niveaux_risques:
@@ -23246,14 +21546,9 @@ def export_dashboard_csv():
         
         # Score moyen
         score_risque_moyen = db.session.query(
-            func.avg(EvaluationRisque.score_risque)
-        ).select_from(EvaluationRisque).join(
-            derniere_eval_subq,
-            and_(
-                EvaluationRisque.risque_id == derniere_eval_subq.c.risque_id,
-                EvaluationRisque.created_at == derniere_eval_subq.c.max_date
-            )
-        ).join(Risque).filter(Risque.is_archived == False).scalar()
+            func.avg(RisqueEtatCourant.score_risque)
+        ).join(Risque, RisqueEtatCourant.risque_id == Risque.id
+        ).filter(Risque.is_archived == False).scalar()
         score_risque_moyen = round(score_risque_moyen, 2) if score_risque_moyen else 0
         
         # Taux couverture
@@ -23391,47 +21686,6 @@ def export_dashboard_csv():
 # FONCTIONS UTILITAIRES POUR LE PARAMETRAGE
 # ------------------------------------------------------------
 
-def get_parametres_evaluation():
-    """Récupère tous les paramètres d'évaluation depuis la base"""
-    parametres = {}
-    
-    try:
-        # Récupérer les paramètres par catégorie
-        categories = ['impact', 'probabilite', 'maitrise']
-        
-        for categorie in categories:
-            params = ParametreEvaluation.query.filter_by(
-                categorie=categorie, 
-                est_actif=True
-            ).order_by('niveau').all()
-            
-            parametres[categorie] = {
-                str(param.niveau): {
-                    'nom_court': param.nom_court,
-                    'description': param.description_longue or '',
-                    'couleur': param.couleur_hex or get_couleur_par_defaut(categorie, param.niveau)
-                }
-                for param in params
-            }
-            
-        # Récupérer les sections du guide
-        guide_sections = GuideEvaluation.query.filter_by(
-            est_actif=True
-        ).order_by('ordre').all()
-        
-        parametres['guide'] = {
-            section.section: {
-                'titre': section.titre,
-                'contenu': section.contenu or ''
-            }
-            for section in guide_sections
-        }
-        
-    except Exception as e:
-        print(f"⚠️ Erreur chargement paramètres: {e}")
-        parametres = get_parametres_par_defaut()
-    
-    return parametres
 
 
 def get_parametres_par_defaut():
@@ -23475,79 +21729,8 @@ def get_couleur_par_defaut(categorie, niveau):
     return '#28a745'
 
 
-def init_parametres_par_defaut():
-    """Initialise les paramètres par défaut dans la base"""
-    try:
-        # Vérifier si des paramètres existent déjà
-        if ParametreEvaluation.query.count() == 0:
-            print("🔄 Initialisation des paramètres d'évaluation par défaut...")
-            
-            parametres_defaut = get_parametres_par_defaut()
-            
-            for categorie, niveaux in parametres_defaut.items():
-                for niveau_str, valeurs in niveaux.items():
-                    niveau = int(niveau_str)
-                    
-                    param = ParametreEvaluation(
-                        categorie=categorie,
-                        niveau=niveau,
-                        nom_court=valeurs['nom_court'],
-                        description_longue=valeurs['description'],
-                        couleur_hex=valeurs['couleur'],
-                        ordre=niveau,
-                        est_actif=True
-                    )
-                    db.session.add(param)
-            
-            # Initialiser le guide
-            sections_guide = [
-                {
-                    'section': 'phase1',
-                    'titre': 'Phase 1 - Pré-évaluation',
-                    'contenu': '<p><strong>Objectif:</strong> Identification initiale du risque</p><p><strong>Acteur:</strong> Référent métier</p><p><strong>Livrable:</strong> Score préliminaire</p>',
-                    'ordre': 1
-                },
-                {
-                    'section': 'phase2',
-                    'titre': 'Phase 2 - Validation',
-                    'contenu': '<p><strong>Objectif:</strong> Validation et ajustement</p><p><strong>Acteur:</strong> Comité de validation</p><p><strong>Livrable:</strong> Score validé</p>',
-                    'ordre': 2
-                },
-                {
-                    'section': 'phase3',
-                    'titre': 'Phase 3 - Confirmation',
-                    'contenu': '<p><strong>Objectif:</strong> Finalisation et reporting</p><p><strong>Acteur:</strong> Évaluateur final</p><p><strong>Livrable:</strong> Score définitif</p>',
-                    'ordre': 3
-                },
-                {
-                    'section': 'matrice',
-                    'titre': 'Matrice des Risques',
-                    'contenu': '<table class="table table-sm"><thead><tr><th>Score</th><th>Niveau</th><th>Interprétation</th></tr></thead><tbody><tr><td>1-4</td><td>Faible</td><td>Risque acceptable</td></tr><tr><td>5-10</td><td>Moyen</td><td>Surveillance nécessaire</td></tr><tr><td>11-16</td><td>Élevé</td><td>Action corrective requise</td></tr><tr><td>17-25</td><td>Critique</td><td>Traitement urgent</td></tr></tbody></table>',
-                    'ordre': 4
-                }
-            ]
-            
-            for section in sections_guide:
-                guide = GuideEvaluation(
-                    section=section['section'],
-                    titre=section['titre'],
-                    contenu=section['contenu'],
-                    ordre=section['ordre'],
-                    est_actif=True
-                )
-                db.session.add(guide)
-            
-            db.session.commit()
-            print("✅ Paramètres d'évaluation initialisés avec succès")
-        
-        return True
-        
-    except Exception as e:
-        db.session.rollback()
-        print(f"❌ Erreur initialisation paramètres: {e}")
-        return False
 
-@app.context_processor
+@contexte_templates.fournisseur
 def utility_processor():
     def get_file_size(filepath):
         # La même fonction que ci-dessus
@@ -23634,6 +21817,8 @@ if os.environ.get('REDIS_URL'):
         app.config['SESSION_KEY_PREFIX'] = 'sess:'
         
         Session(app)
+        SessionUtilisateurService.configurer_redis(app.config['SESSION_REDIS'])
+        CacheFragments.configurer_redis(app.config['SESSION_REDIS'])
         print("✅ Sessions Redis activées")
     except ImportError:
         print("⚠️ Flask-Session/Redis non disponible, sessions en mémoire")
@@ -23647,10 +21832,7 @@ else:
 # OPTIMISATION DES REQUÊTES DATABASE
 # ========================
 
-@app.before_request
-def before_request():
-    """Hook avant chaque requête"""
-    g.request_start_time = time.time()
+# g.request_start_time est fixé par l'étape "journalisation" du pipeline
 
 @app.teardown_request
 def teardown_request(exception=None):
@@ -23688,10 +21870,12 @@ def cleanup_temp_files():
         app.logger.error(f"Erreur cleanup fichiers: {e}")
 
 # Schedule cleanup tasks
-scheduler = BackgroundScheduler()
-scheduler.add_job(cleanup_old_sessions, 'interval', hours=1)
-scheduler.add_job(cleanup_temp_files, 'interval', hours=6)
-scheduler.start()
+@tache_planifiee
+def demarrer_nettoyage_planifie():
+    scheduler = BackgroundScheduler()
+    scheduler.add_job(cleanup_old_sessions, 'interval', hours=1)
+    scheduler.add_job(cleanup_temp_files, 'interval', hours=6)
+    scheduler.start()
 
 # ------------------------------------------------------------
 # ROUTES D'ADMINISTRATION
@@ -24441,6 +22625,10 @@ def export_risques_excel(cartographie_id):
             is_archived=False
         ).all()
         
+        # État courant et évaluation retenue de chaque risque (deux requêtes au total)
+        etats = RisqueEtatCourantService.par_risque([r.id for r in risques])
+        evaluations_retenues = RisqueEtatCourantService.evaluations_retenues(etats.values())
+        
         # Créer un workbook
         wb = Workbook()
         
@@ -24511,36 +22699,14 @@ def export_risques_excel(cartographie_id):
             ]
             
             # ========== ÉVALUATION ==========
-            # Récupérer la dernière évaluation
-            derniere_eval = EvaluationRisque.query.filter_by(
-                risque_id=risque.id
-            ).order_by(EvaluationRisque.created_at.desc()).first()
-            
-            if derniere_eval:
-                # Calcul des valeurs finales selon la hiérarchie triphasée
-                impact_final = (
-                    derniere_eval.impact_conf 
-                    if derniere_eval.impact_conf and derniere_eval.impact_conf > 0 
-                    else derniere_eval.impact_val 
-                    if derniere_eval.impact_val and derniere_eval.impact_val > 0 
-                    else derniere_eval.impact_pre
-                )
-                
-                probabilite_final = (
-                    derniere_eval.probabilite_conf 
-                    if derniere_eval.probabilite_conf and derniere_eval.probabilite_conf > 0 
-                    else derniere_eval.probabilite_val 
-                    if derniere_eval.probabilite_val and derniere_eval.probabilite_val > 0 
-                    else derniere_eval.probabilite_pre
-                )
-                
-                niveau_maitrise_final = (
-                    derniere_eval.niveau_maitrise_conf 
-                    if derniere_eval.niveau_maitrise_conf and derniere_eval.niveau_maitrise_conf > 0 
-                    else derniere_eval.niveau_maitrise_val 
-                    if derniere_eval.niveau_maitrise_val and derniere_eval.niveau_maitrise_val > 0 
-                    else derniere_eval.niveau_maitrise_pre
-                )
+            # État courant : dernière évaluation confirmée ou validée et ses valeurs finales
+            etat = etats.get(risque.id)
+            derniere_eval = evaluations_retenues.get(risque.id)
+            
+            if etat and derniere_eval:
+                impact_final = etat.impact
+                probabilite_final = etat.probabilite
+                niveau_maitrise_final = etat.niveau_maitrise
                 
                 # Calculer le score et niveau de risque
                 if impact_final and probabilite_final:
@@ -24557,7 +22723,7 @@ def export_risques_excel(cartographie_id):
                     niveau_maitrise_final or "À évaluer",
                     score_final or "À évaluer",
                     niveau_final,
-                    derniere_eval.created_at.strftime('%d/%m/%Y') if derniere_eval.created_at else '',
+                    etat.date_evaluation.strftime('%d/%m/%Y') if etat.date_evaluation else '',
                     derniere_eval.evaluateur_final.username if derniere_eval.evaluateur_final else 
                         (derniere_eval.validateur.username if derniere_eval.validateur else 
                         (derniere_eval.referent_pre_evaluation.username if derniere_eval.referent_pre_evaluation else '')),
@@ -26706,40 +24872,29 @@ def ajouter_fichier_risque(risque_id):
             flash(f'Extension non autorisée: {extension}. Formats autorisés: {", ".join(allowed_extensions)}', 'error')
             return redirect(url_for('detail_risque', id=risque_id))
     
-    # Vérifier la taille (max 10Mo par défaut)
+    # Sauvegarder le fichier (stockage par contenu, max 10Mo vérifié pendant la lecture)
     max_size = 10 * 1024 * 1024  # 10Mo en octets
-    fichier.seek(0, 2)  # Aller à la fin du fichier
-    size = fichier.tell()
-    fichier.seek(0)  # Retourner au début
-    
-    if size > max_size:
-        flash(f'Fichier trop volumineux ({size/1024/1024:.2f} Mo). Maximum: 10 Mo', 'error')
-        return redirect(url_for('detail_risque', id=risque_id))
-    
-    # Sauvegarder le fichier
     nom_fichier = secure_filename(fichier.filename)
-    timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
-    nom_unique = f"{timestamp}_{nom_fichier}"
-    
-    dossier = os.path.join(app.config['UPLOAD_FOLDER_RISQUES'], str(risque_id))
-    os.makedirs(dossier, exist_ok=True)
-    chemin = os.path.join(dossier, nom_unique)
-    
-    fichier.save(chemin)
     
     # Enregistrer en base
     fichier_db = FichierRisque(
         risque_id=risque_id,
         nom_fichier=nom_fichier,
-        chemin_fichier=chemin,
         type_fichier=fichier.content_type,
-        taille=size,
         categorie=request.form.get('categorie', 'document'),
         description=request.form.get('description', ''),
-        uploaded_by=current_user.id
+        uploaded_by=current_user.id,
+        client_id=risque.client_id
     )
     
-    db.session.add(fichier_db)
+    try:
+        StockageService.joindre(fichier_db, fichier, 'fichier_risque',
+                                created_by=current_user.id, taille_max=max_size)
+    except FichierTropVolumineux:
+        db.session.rollback()
+        flash('Fichier trop volumineux. Maximum: 10 Mo', 'error')
+        return redirect(url_for('detail_risque', id=risque_id))
+    
     db.session.commit()
     
     # 🔥 SYNCHRONISATION AUTOMATIQUE
@@ -26756,6 +24911,26 @@ def ajouter_fichier_risque(risque_id):
     flash('Fichier ajouté avec succès', 'success')
     return redirect(url_for('detail_risque', id=risque_id))
 
+@app.route('/api/stockage/usage')
+@login_required
+def api_usage_stockage():
+    """Volume des pièces jointes : référencé (logique) et réellement stocké (physique)"""
+    if current_user.role == 'super_admin':
+        usage = StockageService.usage_clients()
+        return jsonify({'success': True, 'usage': {str(client_id): ligne for client_id, ligne in usage.items()}})
+    if not current_user.is_client_admin:
+        return jsonify({'success': False, 'error': 'Accès non autorisé'}), 403
+    return jsonify({'success': True, 'usage': StockageService.usage_client(current_user.client_id)})
+
+@app.route('/api/pipeline-requete/mesures', methods=['GET', 'DELETE'])
+@login_required
+@super_admin_required
+def api_mesures_pipeline_requete():
+    """Durées cumulées de chaque étape du pipeline avant requête (DELETE : remise à zéro)"""
+    if request.method == 'DELETE':
+        pipeline_requete.reinitialiser_mesures()
+    return jsonify({'success': True, 'etapes': pipeline_requete.mesures()})
+
 @app.route('/risque/fichier/<int:id>/telecharger')
 @login_required
 def telecharger_fichier_risque(id):
@@ -26774,9 +24949,7 @@ def telecharger_fichier_risque(id):
                 f'Téléchargement du fichier {fichier.nom_fichier} du risque {fichier.risque.reference}', 
                 'risque', fichier.risque_id)
     
-    return send_file(fichier.chemin_fichier, 
-                    as_attachment=True, 
-                    download_name=fichier.nom_fichier)
+    return StockageService.envoyer(fichier.chemin_fichier, fichier.nom_fichier)
 @app.route('/risque/fichier/<int:id>/supprimer', methods=['POST'])
 @login_required
 @csrf.exempt
@@ -26797,10 +24970,8 @@ def supprimer_fichier_risque(id):
         return redirect(url_for('detail_risque', id=risque_id))
     
     try:
-        # Supprimer le fichier physique
-        if os.path.exists(fichier.chemin_fichier):
-            os.remove(fichier.chemin_fichier)
-            print(f"🔍 DEBUG: Fichier physique supprimé: {fichier.chemin_fichier}")
+        # Libérer le contenu (ou supprimer l'ancien fichier physique)
+        StockageService.detacher(fichier, 'fichier_risque')
         
         # Journaliser l'action avant suppression
         log_activity(current_user.id, 'suppression_fichier', 
@@ -27693,7 +25864,7 @@ def debug_synchronisation():
 @login_required
 def liste_risques():
     """Liste des risques avec isolation multi-tenant et filtres par cartographie/campagne"""
-    from sqlalchemy.orm import joinedload
+    from sqlalchemy.orm import joinedload, selectinload
     from sqlalchemy import func
     
     # ========================
@@ -27726,14 +25897,17 @@ def liste_risques():
     # ========================
     # 4. OPTIMISATION DES JOINTURES
     # ========================
-    risques_query = base_query\
-        .options(
-            joinedload(Risque.cartographie),
-            joinedload(Risque.createur),
-            joinedload(Risque.kri),
-            joinedload(Risque.evaluations)
-        )\
-        .order_by(Risque.reference)
+    # Dernière évaluation lue dans l'état courant (Risque.derniere_evaluation) ;
+    # les évaluations ne sont chargées que pour retrouver celle de la campagne
+    options = [
+        joinedload(Risque.cartographie),
+        joinedload(Risque.createur),
+        joinedload(Risque.kri),
+        selectinload(Risque.etat_courant).joinedload(RisqueEtatCourant.derniere_evaluation)
+    ]
+    if campagne_id:
+        options.append(selectinload(Risque.evaluations))
+    risques_query = base_query.options(*options).order_by(Risque.reference)
     
     # ========================
     # 5. PAGINATION
@@ -27750,32 +25924,19 @@ def liste_risques():
     # ========================
     # 6. STATISTIQUES
     # ========================
-    # Sous-requête pour les dernières évaluations
-    derniere_eval_subq = db.session.query(
-        EvaluationRisque.risque_id,
-        func.max(EvaluationRisque.created_at).label('max_date')
-    ).group_by(EvaluationRisque.risque_id).subquery()
-    
-    # Compter les risques critiques
-    risques_critiques_query = db.session.query(Risque.id).join(
-        EvaluationRisque, Risque.id == EvaluationRisque.risque_id
-    ).join(
-        derniere_eval_subq,
-        (EvaluationRisque.risque_id == derniere_eval_subq.c.risque_id) &
-        (EvaluationRisque.created_at == derniere_eval_subq.c.max_date)
-    ).filter(
-        Risque.is_archived == False,
-        EvaluationRisque.niveau_risque == 'Critique'
-    )
-    
     # Appliquer les mêmes filtres aux stats
     stats_query = get_client_filter(Risque).filter_by(is_archived=False)
     if cartographie_id:
         stats_query = stats_query.filter_by(cartographie_id=cartographie_id)
     
+    # Compter les risques critiques (état courant : dernière évaluation confirmée ou validée)
+    risques_critiques_query = stats_query.join(
+        RisqueEtatCourant, RisqueEtatCourant.risque_id == Risque.id
+    ).filter(RisqueEtatCourant.niveau_risque == 'Critique')
+    
     stats = {
         'total': stats_query.count(),
-        'critiques': risques_critiques_query.distinct().count(),
+        'critiques': risques_critiques_query.count(),
         'avec_evaluations': stats_query.filter(Risque.evaluations.any()).count(),
         'sans_evaluations': stats_query.filter(~Risque.evaluations.any()).count(),
         'avec_kri': stats_query.filter(Risque.kri.has()).count(),
@@ -27798,18 +25959,9 @@ def liste_risques():
             .all()
     
     # ========================
-    # 8. AJOUTER LA DERNIÈRE ÉVALUATION ET INFOS DE CAMPAGNE
+    # 8. AJOUTER LES INFOS DE CAMPAGNE
     # ========================
     for risque in risques.items:
-        # 🔴 CORRECTION : Ne pas assigner directement à la propriété
-        # Utiliser une variable temporaire ou un attribut dynamique
-        
-        # Dernière évaluation globale
-        if risque.evaluations:
-            risque._derniere_evaluation = max(risque.evaluations, key=lambda x: x.created_at)
-        else:
-            risque._derniere_evaluation = None
-        
         # Si une campagne spécifique est sélectionnée, trouver l'évaluation pour cette campagne
         risque._evaluation_campagne = None
         if campagne_id and risque.evaluations:
@@ -34794,6 +32946,27 @@ def detail_cartographie(id):
         db.session.commit()
         print(f"✅ Campagne par défaut créée: {campagne_active.nom}")
     
+    # Corps de page en cache pour cette version des données : seules la
+    # cartographie et la campagne active servent hors du fragment
+    risques_cartographie = db.session.query(Risque.id).filter(Risque.cartographie_id == id)
+    version_fragment = (campagne_active.id, CacheFragments.version(
+        cartographie.client_id,
+        (Cartographie, Cartographie.id == id),
+        (CampagneEvaluation, CampagneEvaluation.cartographie_id == id),
+        (Risque, Risque.cartographie_id == id),
+        (EvaluationRisque, EvaluationRisque.risque_id.in_(risques_cartographie)),
+        (DispositifMaitrise, DispositifMaitrise.risque_id.in_(risques_cartographie)),
+        (DemandeReevaluation, DemandeReevaluation.risque_id.in_(risques_cartographie)),
+        (Constatation, Constatation.risque_id.in_(risques_cartographie)),
+    ))
+    if CacheFragments.obtenir('cartographie_detail', id, version_fragment) is not None:
+        return render_template('cartographie/detail.html',
+                             cartographie=cartographie,
+                             campagne_active=campagne_active,
+                             version_fragment=version_fragment,
+                             now=datetime.now,
+                             current_user=current_user)
+    
     # 3. Récupérer toutes les campagnes pour le sélecteur
     campagnes = get_client_filter(CampagneEvaluation)\
         .filter_by(cartographie_id=id)\
@@ -34974,8 +33147,6 @@ def detail_cartographie(id):
     progression_campagne = int((nb_risques_evalues / nb_risques_total * 100) if nb_risques_total > 0 else 0)
     
     # 8. 🔥 RÉCUPÉRER LES DEMANDES DE RÉÉVALUATION
-    from models import DemandeReevaluation
-    
     risque_ids = [r['risque'].id for r in risques_avec_evaluation]
     
     demandes_reevaluation = []
@@ -35046,8 +33217,6 @@ def detail_cartographie(id):
         })
     
     # 11. 🔥 RÉCUPÉRER LES CONSTATS D'AUDIT
-    from models import Constatation
-    
     constats_audit = []
     nb_constats_ouverts = 0
     
@@ -35118,6 +33287,7 @@ def detail_cartographie(id):
                          nb_constats_ouverts=nb_constats_ouverts,
                          
                          # Utilitaires
+                         version_fragment=version_fragment,
                          now=datetime.now,
                          current_user=current_user)
 
@@ -35690,7 +33860,7 @@ def filter_notifications_by_permissions(notifications, user):
     
     return filtered
 
-@app.context_processor
+@contexte_templates.fournisseur
 def inject_notification_helpers():
     """Injecte des helpers de notifications dans tous les templates"""
     
@@ -35900,21 +34070,11 @@ def nouveau_risque(cartographie_id):
                     fichier = request.files[fichier_key]
                     if fichier and fichier.filename:
                         nom_fichier = secure_filename(fichier.filename)
-                        timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
-                        nom_unique = f"{timestamp}_{nom_fichier}"
-                        
-                        dossier = os.path.join(app.config['UPLOAD_FOLDER'], 'risques', str(risque.id))
-                        os.makedirs(dossier, exist_ok=True)
-                        chemin = os.path.join(dossier, nom_unique)
-                        
-                        fichier.save(chemin)
                         
                         fichier_db = FichierRisque(
                             risque_id=risque.id,
                             nom_fichier=nom_fichier,
-                            chemin_fichier=chemin,
                             type_fichier=fichier.content_type,
-                            taille=os.path.getsize(chemin),
                             categorie=request.form.get(categorie_key, 'document'),
                             description=request.form.get(description_key, ''),
                             uploaded_by=current_user.id
@@ -35924,7 +34084,7 @@ def nouveau_risque(cartographie_id):
                         if current_user.role != 'super_admin' and hasattr(current_user, 'client_id'):
                             fichier_db.client_id = current_user.client_id
                         
-                        db.session.add(fichier_db)
+                        StockageService.joindre(fichier_db, fichier, 'fichier_risque', created_by=current_user.id)
             
             db.session.commit()
             
@@ -36867,7 +35027,8 @@ def lier_source_kri(kri_id):
         chemin_donnee=data.get('chemin'),
         mapping_config=data.get('mapping', {}),
         seuil_min=data.get('seuil_min'),
-        seuil_max=data.get('seuil_max')
+        seuil_max=data.get('seuil_max'),
+        validation_regles={'anomalies': data['anomalies']} if data.get('anomalies') else {}
     )
     
     db.session.add(link)
@@ -37173,21 +35334,20 @@ def liste_kri():
         if check_client_access(risque):
             risques_disponibles.append(risque)
     
-    # Calculer la tendance pour chaque indicateur accessible
+    # Tendances et statistiques de tous les indicateurs en une passe
+    # (mesures filtrées sur le client de l'utilisateur, toutes pour le super admin)
+    resultats_kri = AnalytiqueKRI.calculer(
+        None if current_user.role == 'super_admin' else current_user.client_id
+    )
     for kri in accessible_kris:
-        # Récupérer seulement les mesures accessibles
-        mesures_accessibles = []
-        if hasattr(kri, 'mesures'):
-            for mesure in kri.mesures:
-                if check_client_access(mesure):
-                    mesures_accessibles.append(mesure)
+        statistiques_kri = resultats_kri.get(kri.id)
         
-        kri.tendance = calculer_tendance_kri(mesures_accessibles) if mesures_accessibles else 'stable'
+        kri.tendance = resultats_kri.tendance(kri.id)
         
         # Ajouter d'autres informations utiles
-        kri.nb_mesures = len(mesures_accessibles)
-        if hasattr(kri, 'derniere_valeur') and kri.derniere_valeur:
-            kri.valeur_formatee = f"{kri.derniere_valeur:.2f}"
+        kri.nb_mesures = statistiques_kri['nb_mesures'] if statistiques_kri else 0
+        if statistiques_kri and statistiques_kri['derniere_valeur']:
+            kri.valeur_formatee = f"{statistiques_kri['derniere_valeur']:.2f}"
         else:
             kri.valeur_formatee = "N/A"
         
@@ -37417,56 +35577,6 @@ def nouveau_kri(risque_id):
             flash(f'Erreur lors de la création du KRI: {str(e)}', 'error')
             return redirect(url_for('detail_risque', id=risque_id))
 
-def get_risques_pour_formulaire():
-    """
-    Récupère les risques disponibles pour les formulaires KRI
-    avec une gestion d'erreur robuste
-    """
-    try:
-        # Pour super admin, on peut vouloir voir tous les risques
-        if current_user.role == 'super_admin':
-            # Option 1: Voir tous les risques non archivés
-            risques = Risque.query.filter_by(is_archived=False)\
-                .order_by(Risque.reference)\
-                .all()
-            
-            # Option 2: Filtrer par client si un client spécifique est visualisé
-            viewing_client_id = session.get('viewing_client_id')
-            if viewing_client_id:
-                risques = Risque.query.filter_by(
-                    client_id=viewing_client_id,
-                    is_archived=False
-                ).order_by(Risque.reference).all()
-        else:
-            # Pour les utilisateurs normaux: utiliser get_client_filter
-            risques = get_client_filter(Risque)\
-                .filter_by(is_archived=False)\
-                .order_by(Risque.reference)\
-                .all()
-        
-        # S'assurer que tous les risques ont les attributs nécessaires
-        risques_valides = []
-        for risque in risques:
-            try:
-                # Vérifier que le risque a les attributs de base
-                if hasattr(risque, 'reference') and hasattr(risque, 'intitule'):
-                    # Formatage pour l'affichage
-                    risque._display_text = f"{risque.reference} - {risque.intitule}"
-                    risques_valides.append(risque)
-                else:
-                    print(f"⚠️ Risque {risque.id} manque d'attributs")
-            except Exception as e:
-                print(f"⚠️ Erreur sur risque {risque.id}: {e}")
-                continue
-        
-        print(f"✅ {len(risques_valides)} risques valides pour le formulaire")
-        return risques_valides
-        
-    except Exception as e:
-        print(f"❌ Erreur get_risques_pour_formulaire: {e}")
-        import traceback
-        traceback.print_exc()
-        return []
 
     
 @app.route('/kri/<int:kri_id>/modifier', methods=['GET', 'POST'])
@@ -38203,40 +36313,29 @@ def ajouter_fichier_kri(kri_id):
             flash(f'Extension non autorisée: {extension}', 'error')
             return redirect(url_for('detail_kri', kri_id=kri_id))
     
-    # Vérifier la taille (max 10Mo)
+    # Sauvegarder le fichier (stockage par contenu, max 10Mo vérifié pendant la lecture)
     max_size = 10 * 1024 * 1024
-    fichier.seek(0, 2)
-    size = fichier.tell()
-    fichier.seek(0)
-    
-    if size > max_size:
-        flash(f'Fichier trop volumineux ({size/1024/1024:.2f} Mo). Maximum: 10 Mo', 'error')
-        return redirect(url_for('detail_kri', kri_id=kri_id))
-    
-    # Sauvegarder le fichier
     nom_fichier = secure_filename(fichier.filename)
-    timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
-    nom_unique = f"{timestamp}_{nom_fichier}"
-    
-    dossier = os.path.join(app.config['UPLOAD_FOLDER'], 'kri', str(kri_id))
-    os.makedirs(dossier, exist_ok=True)
-    chemin = os.path.join(dossier, nom_unique)
     
-    fichier.save(chemin)
-    
-    # Enregistrer en base (vous devez créer un modèle FichierKRI similaire à FichierRisque)
+    # Enregistrer en base
     fichier_db = FichierKRI(
         kri_id=kri_id,
         nom_fichier=nom_fichier,
-        chemin_fichier=chemin,
         type_fichier=fichier.content_type,
-        taille=size,
         categorie=request.form.get('categorie', 'document'),
         description=request.form.get('description', ''),
-        uploaded_by=current_user.id
+        uploaded_by=current_user.id,
+        client_id=kri.client_id
     )
     
-    db.session.add(fichier_db)
+    try:
+        StockageService.joindre(fichier_db, fichier, 'fichier_kri',
+                                created_by=current_user.id, taille_max=max_size)
+    except FichierTropVolumineux:
+        db.session.rollback()
+        flash('Fichier trop volumineux. Maximum: 10 Mo', 'error')
+        return redirect(url_for('detail_kri', kri_id=kri_id))
+    
     db.session.commit()
     
     flash('Fichier ajouté avec succès', 'success')
@@ -38256,9 +36355,7 @@ def telecharger_fichier_kri(fichier_id):
         flash('Accès non autorisé', 'error')
         return redirect(url_for('detail_kri', kri_id=fichier.kri_id))
     
-    return send_file(fichier.chemin_fichier, 
-                    as_attachment=True, 
-                    download_name=fichier.nom_fichier)
+    return StockageService.envoyer(fichier.chemin_fichier, fichier.nom_fichier)
 
 # Route pour supprimer un fichier
 @app.route('/kri/fichier/<int:fichier_id>/supprimer', methods=['POST'])
@@ -38274,9 +36371,8 @@ def supprimer_fichier_kri(fichier_id):
         return jsonify({'success': False, 'error': 'Permission refusée'}), 403
     
     try:
-        # Supprimer le fichier physique
-        if os.path.exists(fichier.chemin_fichier):
-            os.remove(fichier.chemin_fichier)
+        # Libérer le contenu (ou supprimer l'ancien fichier physique)
+        StockageService.detacher(fichier, 'fichier_kri')
         
         # Supprimer l'enregistrement en base
         db.session.delete(fichier)
@@ -39776,30 +37872,16 @@ def get_parametres_evaluation_dynamique():
         return {'maitrise_inverse': True}
 
 
-# ============================================================
-# CONTEXT PROCESSOR POUR INJECTER LES FONCTIONS DANS TOUS LES TEMPLATES
-# ============================================================
-
-@app.context_processor
-def inject_evaluation_functions():
-    """Injecte les fonctions d'évaluation dans tous les templates"""
-    return {
-        'get_niveau_description': get_niveau_description_dynamique,
-        'get_niveau_nom_court': get_niveau_nom_court_dynamique,
-        'get_niveau_couleur': get_niveau_couleur_dynamique,
-        'get_parametres_evaluation': get_parametres_evaluation_dynamique
-    }
-
+# Les fonctions get_niveau_*_dynamique ne sont plus injectées dans les templates :
+# evaluation_params_processor définit les mêmes noms (paramètres en session).
 
 
-@app.before_request
+@pipeline_requete.etape('transaction', exemptes=['static'])
 def handle_transaction():
     """Vérifie l'état de la transaction avant chaque requête"""
-    try:
-        # Tester la connexion
-        db.session.execute(text('SELECT 1'))
-    except Exception as e:
-        print(f"⚠️ Transaction corrompue détectée, rollback: {e}")
+    # Sans requête SQL : la connexion est validée par le pool (pool_pre_ping)
+    if not db.session.is_active:
+        print("⚠️ Transaction corrompue détectée, rollback")
         db.session.rollback()
 
 @app.teardown_request
@@ -39935,7 +38017,7 @@ def api_notifications_stats():
 # AJOUTER UN CONTEXT PROCESSOR POUR LES NOTIFICATIONS
 # ========================
 
-@app.context_processor
+@contexte_templates.fournisseur
 def inject_notifications():
     """Injecter les données de notifications dans tous les templates"""
     def get_notifications_count():
@@ -40026,30 +38108,6 @@ def cloturer_campagne_cartographie(cartographie_id):
 
 
 
-def calculer_niveau_risque(score):
-    """
-    Calcule le niveau de risque à partir du score
-    
-    Args:
-        score: Le score de risque (impact * probabilité)
-    
-    Returns:
-        tuple: (niveau_risque, couleur_css)
-    
-    Exemple:
-        >>> calculer_niveau_risque(9)
-        ('Moyen', 'warning')
-        >>> calculer_niveau_risque(25)
-        ('Critique', 'dark')
-    """
-    if score <= 4:
-        return 'Faible', 'success'
-    elif score <= 10:
-        return 'Moyen', 'warning'
-    elif score <= 16:
-        return 'Élevé', 'danger'
-    else:
-        return 'Critique', 'dark'
 
 
 def calculer_niveau_risque(impact, probabilite):
@@ -42048,28 +40106,39 @@ def api_risques_critiques():
 @app.route('/api/kri/<int:kri_id>/evolution')
 @login_required
 def api_kri_evolution(kri_id):
-    """API pour récupérer les données d'évolution d'un KRI"""
+    """
+    Série de l'évolution d'un KRI pour les graphiques (JSON).
+    Paramètres : debut / fin (dates ISO), points (nombre cible, défaut 500),
+    methode ('lttb' ou 'minmax'). Réponse conditionnelle par ETag.
+    """
     try:
         kri = KRI.query.get_or_404(kri_id)
+        if not check_client_access(kri):
+            return jsonify({'success': False, 'error': 'Accès non autorisé'}), 403
         
-        # Récupérer les mesures triées par date
-        mesures = MesureKRI.query.filter_by(kri_id=kri_id)\
-            .order_by(MesureKRI.date_mesure.asc())\
-            .all()
-        
-        dates = [mesure.date_mesure.strftime('%Y-%m-%d') for mesure in mesures]
-        valeurs = [float(mesure.valeur) for mesure in mesures]
+        try:
+            debut = datetime.fromisoformat(request.args['debut']) if request.args.get('debut') else None
+            fin = datetime.fromisoformat(request.args['fin']) if request.args.get('fin') else None
+            if fin is not None and len(request.args['fin']) <= 10:
+                fin = fin + timedelta(days=1) - timedelta(microseconds=1)  # date seule : journée incluse
+            points = request.args.get('points', 500, type=int)
+            methode = request.args.get('methode', 'lttb')
+            donnees, etag = SeriesKRI.serie(
+                kri,
+                client_id=None if current_user.role == 'super_admin' else current_user.client_id,
+                debut=debut, fin=fin, points=points, methode=methode
+            )
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
         
-        return jsonify({
-            'success': True,
-            'kri': {
-                'id': kri.id,
-                'nom': kri.nom,
-                'unite_mesure': kri.unite_mesure
-            },
-            'dates': dates,
-            'valeurs': valeurs
-        })
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+        else:
+            response = jsonify({'success': True, **donnees})
+        response.set_etag(etag)
+        # Le navigateur revalide à chaque affichage (304 si rien n'a changé)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
         
     except Exception as e:
         return jsonify({
@@ -42226,10 +40295,10 @@ def admin_directions():
     
     # ===== STATISTIQUES PAR PÔLE =====
     stats_poles = {}
+    comptages_poles = HierarchieService.compter_organisation('pole', [pole.id for pole in poles])
     for pole in poles:
-        nb_directions = len([d for d in pole.directions if not d.is_archived and d.is_active])
         stats_poles[pole.id] = {
-            'directions': nb_directions
+            'directions': comptages_poles[pole.id]['directions']
         }
     
     # ===== STATISTIQUES GLOBALES =====
@@ -42399,195 +40468,6 @@ def admin_organigramme_png():
     return redirect(url_for('admin_organigramme'))
 
 
-def generer_organigramme_html(directions, config=None):
-    """
-    Génère un organigramme HTML/CSS moderne
-    """
-    if config:
-        if hasattr(config, 'nom_entreprise'):
-            nom_entreprise = config.nom_entreprise
-            couleur_primaire = config.couleur_primaire
-            couleur_secondaire = config.couleur_secondaire
-            pied_de_page = config.pied_de_page
-            logo = config.logo_entreprise
-        else:
-            nom_entreprise = config.get('nom_entreprise', 'Entreprise')
-            couleur_primaire = config.get('couleur_primaire', '#2563eb')
-            couleur_secondaire = config.get('couleur_secondaire', '#10b981')
-            pied_de_page = config.get('pied_de_page', 'Document confidentiel')
-            logo = config.get('logo_entreprise')
-    else:
-        nom_entreprise = "Organigramme de l'entreprise"
-        couleur_primaire = "#2563eb"
-        couleur_secondaire = "#10b981"
-        pied_de_page = "Document confidentiel"
-        logo = None
-    
-    # Statistiques
-    total_directions = len(directions)
-    total_services = sum(len([s for s in d.services if s.is_active]) for d in directions)
-    
-    html = f"""
-    <!DOCTYPE html>
-    <html lang="fr">
-    <head>
-        <meta charset="UTF-8">
-        <style>
-            :root {{
-                --primary: {couleur_primaire};
-                --secondary: {couleur_secondaire};
-            }}
-            body {{
-                font-family: Arial, sans-serif;
-                margin: 20px;
-                padding: 20px;
-                background: #f5f5f5;
-            }}
-            .org-header {{
-                background: white;
-                padding: 20px;
-                border-radius: 10px;
-                box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-                margin-bottom: 20px;
-                display: flex;
-                justify-content: space-between;
-                align-items: center;
-            }}
-            .org-title h1 {{
-                color: var(--primary);
-                margin: 0;
-            }}
-            .org-stats {{
-                display: flex;
-                gap: 20px;
-            }}
-            .stat-card {{
-                background: #f8f9fa;
-                padding: 10px 20px;
-                border-radius: 5px;
-                text-align: center;
-            }}
-            .stat-number {{
-                font-size: 24px;
-                font-weight: bold;
-                color: var(--primary);
-            }}
-            .org-grid {{
-                display: grid;
-                grid-template-columns: repeat(auto-fit, minmax(300px, 1fr));
-                gap: 20px;
-            }}
-            .direction-card {{
-                background: white;
-                border-radius: 8px;
-                box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-                overflow: hidden;
-            }}
-            .direction-header {{
-                background: var(--primary);
-                color: white;
-                padding: 15px;
-            }}
-            .direction-header h2 {{
-                margin: 0 0 10px 0;
-            }}
-            .direction-responsable {{
-                background: rgba(255,255,255,0.1);
-                padding: 10px;
-                border-radius: 5px;
-            }}
-            .direction-body {{
-                padding: 15px;
-            }}
-            .services-list {{
-                display: grid;
-                grid-template-columns: repeat(auto-fill, minmax(200px, 1fr));
-                gap: 10px;
-                margin-top: 10px;
-            }}
-            .service-item {{
-                background: #f8f9fa;
-                padding: 10px;
-                border-left: 3px solid var(--secondary);
-            }}
-            .service-name {{
-                font-weight: bold;
-            }}
-            .org-footer {{
-                text-align: center;
-                margin-top: 20px;
-                color: #666;
-            }}
-        </style>
-    </head>
-    <body>
-        <div class="org-header">
-            <div style="display: flex; align-items: center;">
-                {f'<img src="{logo}" style="max-height: 50px; margin-right: 15px;">' if logo else ''}
-                <div class="org-title">
-                    <h1>{nom_entreprise}</h1>
-                    <p>Généré le {datetime.now().strftime('%d/%m/%Y %H:%M')}</p>
-                </div>
-            </div>
-            <div class="org-stats">
-                <div class="stat-card">
-                    <div class="stat-number">{total_directions}</div>
-                    <div>Directions</div>
-                </div>
-                <div class="stat-card">
-                    <div class="stat-number">{total_services}</div>
-                    <div>Services</div>
-                </div>
-            </div>
-        </div>
-        
-        <div class="org-grid">
-    """
-    
-    for direction in directions:
-        services_actifs = [s for s in direction.services if s.is_active]
-        
-        html += f"""
-            <div class="direction-card">
-                <div class="direction-header">
-                    <h2>{direction.nom}</h2>
-                    <div class="direction-responsable">
-                        <strong>Responsable:</strong> {direction.responsable.username if direction.responsable else 'Non assigné'}
-                    </div>
-                </div>
-                <div class="direction-body">
-                    <p>{direction.description or 'Aucune description'}</p>
-                    <h4>Services ({len(services_actifs)})</h4>
-                    <div class="services-list">
-        """
-        
-        for service in services_actifs:
-            html += f"""
-                        <div class="service-item">
-                            <div class="service-name">{service.nom}</div>
-                            <div class="service-responsable">
-                                {service.responsable.username if service.responsable else 'Non assigné'}
-                            </div>
-                        </div>
-            """
-        
-        html += """
-                    </div>
-                </div>
-            </div>
-        """
-    
-    html += f"""
-        </div>
-        
-        <div class="org-footer">
-            <p>{pied_de_page}</p>
-        </div>
-    </body>
-    </html>
-    """
-    
-    return html
 
 @app.route('/admin/organigramme/pdf')
 @login_required
@@ -42956,29 +40836,6 @@ def get_config_organigramme():
     }
 
 
-def generer_organigramme_html(directions, config=None):
-    """
-    Génère un organigramme HTML/CSS moderne avec la configuration du client
-    """
-    if config:
-        if hasattr(config, 'nom_entreprise'):
-            nom_entreprise = config.nom_entreprise
-            couleur_primaire = config.couleur_primaire
-            couleur_secondaire = config.couleur_secondaire
-            pied_de_page = config.pied_de_page
-            logo = config.logo_entreprise
-        else:
-            nom_entreprise = config.get('nom_entreprise', 'Entreprise')
-            couleur_primaire = config.get('couleur_primaire', '#2563eb')
-            couleur_secondaire = config.get('couleur_secondaire', '#10b981')
-            pied_de_page = config.get('pied_de_page', 'Document confidentiel')
-            logo = config.get('logo_entreprise')
-    else:
-        nom_entreprise = "Organigramme de l'entreprise"
-        couleur_primaire = "#2563eb"
-        couleur_secondaire = "#10b981"
-        pied_de_page = "Document confidentiel"
-        logo = None
     
 
 def generer_organigramme_html(directions, config=None):
@@ -45999,29 +43856,18 @@ def modifier_risque(id):
             if fichier_key in request.files:
                 fichier = request.files[fichier_key]
                 if fichier and fichier.filename:
-                    # Sauvegarder le fichier
+                    # Sauvegarder le fichier (stockage par contenu) et l'enregistrer en base
                     nom_fichier = secure_filename(fichier.filename)
-                    timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
-                    nom_unique = f"{timestamp}_{nom_fichier}"
-                    
-                    dossier = os.path.join(app.config['UPLOAD_FOLDER'], 'risques', str(risque.id))
-                    os.makedirs(dossier, exist_ok=True)
-                    chemin = os.path.join(dossier, nom_unique)
-                    
-                    fichier.save(chemin)
-                    
-                    # Enregistrer en base
                     fichier_db = FichierRisque(
                         risque_id=risque.id,
                         nom_fichier=nom_fichier,
-                        chemin_fichier=chemin,
                         type_fichier=fichier.content_type,
-                        taille=os.path.getsize(chemin),
                         categorie=request.form.get(categorie_key, 'document'),
                         description=request.form.get(description_key, ''),
-                        uploaded_by=current_user.id
+                        uploaded_by=current_user.id,
+                        client_id=risque.client_id
                     )
-                    db.session.add(fichier_db)
+                    StockageService.joindre(fichier_db, fichier, 'fichier_risque', created_by=current_user.id)
         
         db.session.commit()
         
@@ -46762,12 +44608,14 @@ def risques_non_evalues(id):
     """Liste des risques non évalués d'une cartographie"""
     cartographie = Cartographie.query.get_or_404(id)
     
-    risques_non_evalues = []
-    for risque in cartographie.risques:
-        if hasattr(risque, 'is_archived') and risque.is_archived:
-            continue
-        if not risque.evaluations:
-            risques_non_evalues.append(risque)
+    # Sans évaluation d'après l'état courant (pas de chargement des évaluations)
+    risques_non_evalues = Risque.query.outerjoin(
+        RisqueEtatCourant, RisqueEtatCourant.risque_id == Risque.id
+    ).filter(
+        Risque.cartographie_id == cartographie.id,
+        Risque.is_archived == False,
+        RisqueEtatCourant.evaluation_id.is_(None)
+    ).all()
     
     return render_template('cartographie/risques_non_evalues.html',
                          cartographie=cartographie,
@@ -46861,19 +44709,22 @@ def api_stats_cartographie(id):
         'moyenne_scores': 0
     }
     
+    # État courant des risques (dernière évaluation confirmée ou validée), en une requête
+    risques = Risque.query.filter_by(cartographie_id=cartographie.id, is_archived=False)\
+        .options(joinedload(Risque.etat_courant)).all()
+    
     scores = []
-    for risque in cartographie.risques:
-        if hasattr(risque, 'is_archived') and risque.is_archived:
-            continue
-            
+    for risque in risques:
         stats['total_risques'] += 1
         
-        if risque.evaluations:
+        etat = risque.etat_courant
+        if etat is not None and etat.evaluation_id is not None:
             stats['risques_evalues'] += 1
-            derniere_eval = max(risque.evaluations, key=lambda x: x.created_at)
-            niveau = derniere_eval.niveau_risque
-            stats['repartition_niveaux'][niveau] += 1
-            scores.append(derniere_eval.score_risque)
+            niveau = etat.niveau_risque
+            if niveau in stats['repartition_niveaux']:
+                stats['repartition_niveaux'][niveau] += 1
+            if etat.score_risque is not None:
+                scores.append(etat.score_risque)
         else:
             stats['risques_non_evalues'] += 1
     
@@ -46902,13 +44753,18 @@ def dashboard_risques():
         risques_query = get_client_filter(Risque).filter_by(is_archived=False)
         cartographies = get_client_filter(Cartographie).filter_by(is_archived=False).all()
     
-    # Récupérer tous les risques
-    tous_risques = risques_query.all()
+    # Récupérer tous les risques avec leur état courant (dernière évaluation confirmée ou validée)
+    tous_risques = risques_query.options(joinedload(Risque.etat_courant)).all()
+    
+    def etat_evalue(risque):
+        etat = risque.etat_courant
+        return etat if etat is not None and etat.evaluation_id is not None else None
+    
+    etats = {risque.id: etat_evalue(risque) for risque in tous_risques}
     
     # ========== 1. STATISTIQUES GLOBALES ==========
     total_risques = len(tous_risques)
-    risques_avec_eval = [r for r in tous_risques if r.evaluations]
-    total_risques_evalues = len(risques_avec_eval)
+    total_risques_evalues = sum(1 for etat in etats.values() if etat)
     
     # ========== 2. COMPTAGE PAR NIVEAU ==========
     compteur_niveaux = {
@@ -46918,27 +44774,15 @@ def dashboard_risques():
         'faible': 0,
         'non_evalue': 0
     }
+    cles_niveaux = {'Critique': 'critique', 'Élevé': 'eleve', 'Moyen': 'moyen', 'Faible': 'faible'}
     
     scores_totaux = []
     
-    for risque in tous_risques:
-        if risque.evaluations:
-            derniere_eval = max(risque.evaluations, key=lambda x: x.created_at)
-            niveau = derniere_eval.niveau_risque
-            if niveau == 'Critique':
-                compteur_niveaux['critique'] += 1
-                scores_totaux.append(derniere_eval.score_risque)
-            elif niveau == 'Élevé':
-                compteur_niveaux['eleve'] += 1
-                scores_totaux.append(derniere_eval.score_risque)
-            elif niveau == 'Moyen':
-                compteur_niveaux['moyen'] += 1
-                scores_totaux.append(derniere_eval.score_risque)
-            elif niveau == 'Faible':
-                compteur_niveaux['faible'] += 1
-                scores_totaux.append(derniere_eval.score_risque)
-            else:
-                compteur_niveaux['non_evalue'] += 1
+    for etat in etats.values():
+        cle = cles_niveaux.get(etat.niveau_risque) if etat else None
+        if cle:
+            compteur_niveaux[cle] += 1
+            scores_totaux.append(etat.score_risque)
         else:
             compteur_niveaux['non_evalue'] += 1
     
@@ -46962,28 +44806,20 @@ def dashboard_risques():
     risques_filtres_data = []
     
     for risque in tous_risques:
-        derniere_eval = None
-        if risque.evaluations:
-            derniere_eval = max(risque.evaluations, key=lambda x: x.created_at)
+        etat = etats[risque.id]
         
         # Appliquer le filtre si demandé
         inclure = True
         if niveau_filtre:
             if niveau_filtre == 'non_evalue':
-                inclure = derniere_eval is None
-            elif niveau_filtre == 'critique':
-                inclure = derniere_eval and derniere_eval.niveau_risque == 'Critique'
-            elif niveau_filtre == 'eleve':
-                inclure = derniere_eval and derniere_eval.niveau_risque == 'Élevé'
-            elif niveau_filtre == 'moyen':
-                inclure = derniere_eval and derniere_eval.niveau_risque == 'Moyen'
-            elif niveau_filtre == 'faible':
-                inclure = derniere_eval and derniere_eval.niveau_risque == 'Faible'
+                inclure = etat is None
+            else:
+                inclure = etat is not None and cles_niveaux.get(etat.niveau_risque) == niveau_filtre
         
         if inclure:
             risques_filtres_data.append({
                 'risque': risque,
-                'evaluation': derniere_eval
+                'evaluation': etat
             })
     
     # ========== 5. STATISTIQUES PAR CATÉGORIE ==========
@@ -46994,15 +44830,16 @@ def dashboard_risques():
     repartition_categories = sorted(categories_counts.items(), key=lambda x: x[1], reverse=True)[:8]
     
     # ========== 6. STATISTIQUES PAR CARTOGRAPHIE ==========
+    risques_par_cartographie = {}
+    for risque in tous_risques:
+        risques_par_cartographie.setdefault(risque.cartographie_id, []).append(risque)
+    
     cartographies_actives = []
     for cartographie in cartographies:
-        nb_risques = len([r for r in cartographie.risques if not getattr(r, 'is_archived', False)])
+        risques_carto = risques_par_cartographie.get(cartographie.id, [])
+        nb_risques = len(risques_carto)
         if nb_risques > 0:
-            scores_carto = []
-            for risque in cartographie.risques:
-                if not getattr(risque, 'is_archived', False) and risque.evaluations:
-                    derniere_eval = max(risque.evaluations, key=lambda x: x.created_at)
-                    scores_carto.append(derniere_eval.score_risque)
+            scores_carto = [etats[r.id].score_risque for r in risques_carto if etats[r.id]]
             score_moyen = round(sum(scores_carto) / len(scores_carto), 1) if scores_carto else None
             
             cartographies_actives.append({
@@ -47017,13 +44854,13 @@ def dashboard_risques():
     date_limite = datetime.now() - timedelta(days=30)
     risques_critiques_recents = []
     for risque in tous_risques:
-        if risque.evaluations:
-            derniere_eval = max(risque.evaluations, key=lambda x: x.created_at)
-            if derniere_eval.niveau_risque in ['Critique', 'Élevé'] and derniere_eval.created_at >= date_limite:
-                risques_critiques_recents.append({
-                    'risque': risque,
-                    'evaluation': derniere_eval
-                })
+        etat = etats[risque.id]
+        if etat and etat.niveau_risque in ['Critique', 'Élevé'] \
+                and etat.date_evaluation and etat.date_evaluation >= date_limite:
+            risques_critiques_recents.append({
+                'risque': risque,
+                'evaluation': etat
+            })
     
     # Trier les risques par score décroissant
     def get_risk_priority(r):
@@ -47057,19 +44894,20 @@ def export_risques_excel_data():
     from models import Risque, EvaluationRisque
     
     if current_user.role == 'super_admin':
-        risques = Risque.query.filter_by(is_archived=False).all()
+        risques_query = Risque.query.filter_by(is_archived=False)
     else:
-        risques = get_client_filter(Risque).filter_by(is_archived=False).all()
+        risques_query = get_client_filter(Risque).filter_by(is_archived=False)
+    risques = risques_query.options(joinedload(Risque.etat_courant)).all()
     
     data = []
     for risque in risques:
-        derniere_eval = None
-        if risque.evaluations:
-            derniere_eval = max(risque.evaluations, key=lambda x: x.created_at)
+        # État courant : dernière évaluation confirmée ou validée
+        etat = risque.etat_courant
+        evalue = etat is not None and etat.evaluation_id is not None
         
         niveau = ''
-        if derniere_eval:
-            niveau = derniere_eval.niveau_risque or 'Non évalué'
+        if evalue:
+            niveau = etat.niveau_risque or 'Non évalué'
         else:
             niveau = 'Non évalué'
         
@@ -47079,9 +44917,9 @@ def export_risques_excel_data():
             'Description': risque.description or '',
             'Catégorie': risque.categorie,
             'Niveau de risque': niveau,
-            'Score': derniere_eval.score_risque if derniere_eval else 0,
+            'Score': (etat.score_risque or 0) if evalue else 0,
             'Cartographie': risque.cartographie.nom if risque.cartographie else '',
-            'Date évaluation': derniere_eval.created_at.strftime('%d/%m/%Y') if derniere_eval and derniere_eval.created_at else '',
+            'Date évaluation': etat.date_evaluation.strftime('%d/%m/%Y') if evalue and etat.date_evaluation else '',
         })
     
     df = pd.DataFrame(data)
@@ -47118,7 +44956,7 @@ def export_risques_excel_data():
 @login_required
 def recherche_risques():
     """Recherche avancée dans les risques - Version multi-tenant"""
-    from models import Risque, Cartographie
+    from models import Risque, Cartographie, RisqueEtatCourant
     from sqlalchemy import or_
     
     query = request.args.get('q', '')
@@ -47150,23 +44988,17 @@ def recherche_risques():
     if cartographie_id:
         risques_query = risques_query.filter_by(cartographie_id=int(cartographie_id))
     
-    risques = risques_query.all()
-    
-    # Filtre par niveau de risque (post-requête car dépend de la dernière évaluation)
+    # Filtre par niveau de risque sur l'état courant (dernière évaluation confirmée ou validée)
     if niveau_risque:
-        risques_filtres = []
-        for risque in risques:
-            if risque.evaluations:
-                derniere_eval = max(risque.evaluations, key=lambda x: x.created_at)
-                if niveau_risque == 'Non évalué':
-                    # Déjà exclu car a des évaluations
-                    continue
-                elif derniere_eval.niveau_risque == niveau_risque:
-                    risques_filtres.append(risque)
-            else:
-                if niveau_risque == 'Non évalué':
-                    risques_filtres.append(risque)
-        risques = risques_filtres
+        risques_query = risques_query.outerjoin(
+            RisqueEtatCourant, RisqueEtatCourant.risque_id == Risque.id
+        )
+        if niveau_risque == 'Non évalué':
+            risques_query = risques_query.filter(RisqueEtatCourant.evaluation_id.is_(None))
+        else:
+            risques_query = risques_query.filter(RisqueEtatCourant.niveau_risque == niveau_risque)
+    
+    risques = risques_query.all()
     
     # Options pour les filtres
     categories = db.session.query(Risque.categorie).filter_by(is_archived=False).distinct().all()
@@ -47189,27 +45021,29 @@ def export_risques():
     from models import Risque, EvaluationRisque
     
     if current_user.role == 'super_admin':
-        risques = Risque.query.filter_by(is_archived=False).all()
+        risques_query = Risque.query.filter_by(is_archived=False)
     else:
-        risques = get_client_filter(Risque).filter_by(is_archived=False).all()
+        risques_query = get_client_filter(Risque).filter_by(is_archived=False)
+    risques = risques_query.options(joinedload(Risque.etat_courant)).all()
     
     data = []
     for risque in risques:
-        derniere_eval = None
-        if risque.evaluations:
-            derniere_eval = max(risque.evaluations, key=lambda x: x.created_at)
+        # État courant : dernière évaluation confirmée ou validée
+        etat = risque.etat_courant
+        if etat is not None and etat.evaluation_id is None:
+            etat = None
         
         data.append({
             'reference': risque.reference,
             'intitule': risque.intitule,
             'description': risque.description or '',
             'categorie': risque.categorie,
-            'impact': derniere_eval.impact if derniere_eval else None,
-            'probabilite': derniere_eval.probabilite if derniere_eval else None,
-            'niveau_risque': derniere_eval.niveau_risque if derniere_eval else 'Non évalué',
-            'score_risque': derniere_eval.score_risque if derniere_eval else 0,
+            'impact': etat.impact if etat else None,
+            'probabilite': etat.probabilite if etat else None,
+            'niveau_risque': etat.niveau_risque if etat else 'Non évalué',
+            'score_risque': etat.score_risque if etat else 0,
             'cartographie': risque.cartographie.nom if risque.cartographie else None,
-            'date_evaluation': derniere_eval.created_at.strftime('%d/%m/%Y') if derniere_eval and derniere_eval.created_at else None
+            'date_evaluation': etat.date_evaluation.strftime('%d/%m/%Y') if etat and etat.date_evaluation else None
         })
     
     return jsonify({
@@ -48546,7 +46380,21 @@ def c2n_liste_planifications():
     if statut:
         query = query.filter_by(statut=statut)
     
-    planifications = query.order_by(PlanificationControle.date_prevue).all()
+    planifications = query.options(
+        selectinload(PlanificationControle.controleur),
+        selectinload(PlanificationControle.pays),
+        selectinload(PlanificationControle.pole),
+        selectinload(PlanificationControle.direction),
+        selectinload(PlanificationControle.service)
+    ).order_by(PlanificationControle.date_prevue).all()
+    
+    # Référentiels chargés en une requête (p.referentiel les retrouve ensuite dans la session)
+    referentiel_ids = {p.referentiel_id for p in planifications}
+    if referentiel_ids:
+        ReferentielControle.query.filter(ReferentielControle.id.in_(referentiel_ids)).all()
+    nc_par_execution = ControleMetriquesService.non_conformites_par_execution(
+        p.execution_id for p in planifications
+    )
     
     stats = {
         'total': len(planifications),
@@ -48559,6 +46407,7 @@ def c2n_liste_planifications():
     
     return render_template('c2n/planification_liste.html', 
                          planifications=planifications, 
+                         nc_par_execution=nc_par_execution,
                          stats=stats,
                          annee=annee,
                          now=datetime.now())
@@ -49858,7 +47707,7 @@ def c2n_recommandations_central():
 # ============================================
 # CONTEXT PROCESSOR - VARIABLES GLOBALES
 # ============================================
-@app.context_processor
+@contexte_templates.fournisseur
 def utility_processor():
     """Injecte des variables globales dans tous les templates"""
     from datetime import datetime
@@ -49867,21 +47716,6 @@ def utility_processor():
     # 1. FONCTIONS DE STATISTIQUES
     # ============================================
     
-    def get_alertes_non_lues():
-        """Récupère le nombre d'alertes d'approbation non lues"""
-        if not current_user.is_authenticated:
-            return 0
-        try:
-            from models import AlerteApprobation
-            count = AlerteApprobation.query.filter(
-                AlerteApprobation.destinataire_id == current_user.id,
-                AlerteApprobation.est_lue == False
-            ).count()
-            return count
-        except Exception as e:
-            print(f"⚠️ Erreur comptage alertes: {e}")
-            return 0
-    
     def get_stats_recommandations():
         """Récupère les stats des recommandations pour le menu et dashboard"""
         if not current_user.is_authenticated:
@@ -50058,8 +47892,7 @@ def utility_processor():
     # ============================================
     
     return {
-        # Stats et alertes
-        'alertes_non_lues': get_alertes_non_lues(),
+        # Stats et alertes (alertes_non_lues : voir le utility_processor des alertes d'approbation)
         'stats': get_stats_recommandations(),
         'nc_non_lues': get_nc_non_lues(),
         'controles_a_valider': get_controles_a_valider(),
@@ -52163,73 +49996,11 @@ def get_stats_veille_par_direction(direction_id=None, pays_id=None, pole_id=None
     
     return stats
 
-def get_risques_eleves_direction_detail(direction_id):
-    """Récupère les risques élevés d'une direction avec détails complets"""
-    cartos = Cartographie.query.filter_by(direction_id=direction_id, is_archived=False).all()
-    carto_ids = [c.id for c in cartos]
-    
-    if not carto_ids:
-        return []
-    
-    risques = Risque.query.filter(Risque.cartographie_id.in_(carto_ids), Risque.is_archived == False).all()
-    risques_eleves = []
-    
-    for risque in risques:
-        derniere_eval = EvaluationRisque.query.filter_by(risque_id=risque.id)\
-            .order_by(EvaluationRisque.created_at.desc()).first()
-        if derniere_eval and derniere_eval.niveau_risque == 'Élevé':
-            risques_eleves.append({
-                'id': risque.id,
-                'reference': risque.reference,
-                'intitule': risque.intitule,
-                'description': risque.description,
-                'niveau': 'Élevé',
-                'categorie': risque.categorie,
-                'date_creation': risque.created_at.strftime('%d/%m/%Y') if risque.created_at else None
-            })
-    
-    return risques_eleves
 
 
 
 
 
-def get_risques_critiques_pole(pole_id):
-    """Récupère les risques critiques d'un pôle avec le nom de la direction"""
-    directions = Direction.query.filter(
-        Direction.pole_id == pole_id,
-        Direction.is_archived == False,
-        Direction.is_active == True
-    ).all()
-    
-    risques_critiques = []
-    
-    for direction in directions:
-        cartos = Cartographie.query.filter_by(direction_id=direction.id, is_archived=False).all()
-        carto_ids = [c.id for c in cartos]
-        
-        if not carto_ids:
-            continue
-        
-        risques = Risque.query.filter(
-            Risque.cartographie_id.in_(carto_ids),
-            Risque.is_archived == False
-        ).all()
-        
-        for risque in risques:
-            derniere_eval = EvaluationRisque.query.filter_by(risque_id=risque.id)\
-                .order_by(EvaluationRisque.created_at.desc()).first()
-            
-            if derniere_eval and derniere_eval.niveau_risque == 'Critique':
-                risques_critiques.append({
-                    'id': risque.id,
-                    'reference': risque.reference,
-                    'intitule': risque.intitule,
-                    'direction_nom': direction.nom,
-                    'direction_id': direction.id
-                })
-    
-    return risques_critiques
 
 
 
@@ -52802,151 +50573,15 @@ def get_stats_pole_detail(pole_id):
     ).distinct(EvaluationRisque.risque_id).count() if risque_ids else 0
     taux_eval = round((eval_total / len(risques) * 100) if risques else 0, 1)
     
-    # ===== STATISTIQUES INCIDENTS =====
-    incident_query = get_client_filter(Incident).filter_by(is_archived=False)
-    # Filtrer par les directions du pôle
-    direction_names = [d.nom for d in directions]
-    if direction_names:
-        if hasattr(Incident, 'direction_associee'):
-            incident_query = incident_query.filter(Incident.direction_associee.in_(direction_names))
-        elif hasattr(Incident, 'direction_id'):
-            incident_query = incident_query.filter(Incident.direction_id.in_(direction_ids))
-    
-    incidents_stats = {
-        'total': incident_query.count(),
-        'critiques': incident_query.filter_by(gravite='critique').count() if hasattr(Incident, 'gravite') else 0,
-        'eleves': incident_query.filter_by(gravite='elevee').count() if hasattr(Incident, 'gravite') else 0,
-        'ouverts': incident_query.filter(Incident.statut.in_(['ouvert', 'en_cours'])).count() if hasattr(Incident, 'statut') else 0
-    }
-    
-    # ===== STATISTIQUES VEILLE =====
-    veille_query = get_client_filter(VeilleReglementaire).filter_by(is_archived=False, is_active=True)
-    if direction_names:
-        if hasattr(VeilleReglementaire, 'direction_associee'):
-            veille_query = veille_query.filter(VeilleReglementaire.direction_associee.in_(direction_names))
-        elif hasattr(VeilleReglementaire, 'direction_id'):
-            veille_query = veille_query.filter(VeilleReglementaire.direction_id.in_(direction_ids))
-        else:
-            # Essayer de filtrer via les actions
-            try:
-                actions = get_client_filter(ActionConformite).all()
-                veille_ids = []
-                for action in actions:
-                    if action.veille_id:
-                        if hasattr(action, 'direction_associee') and action.direction_associee in direction_names:
-                            veille_ids.append(action.veille_id)
-                        elif hasattr(action, 'direction_id') and action.direction_id in direction_ids:
-                            veille_ids.append(action.veille_id)
-                if veille_ids:
-                    veille_query = veille_query.filter(VeilleReglementaire.id.in_(veille_ids))
-            except Exception as e:
-                print(f"Erreur filtrage veille: {e}")
-    
-    veille_stats = {
-        'total': veille_query.count(),
-        'a_surveiller': veille_query.filter_by(statut='a_surveiller').count() if hasattr(VeilleReglementaire, 'statut') else 0,
-        'echeance_proche': 0
-    }
-    
-    # Compter les échéances proches
-    for veille in veille_query.all():
-        if hasattr(veille, 'date_application') and veille.date_application:
-            days_left = (veille.date_application - today).days
-            if 0 <= days_left <= 30:
-                veille_stats['echeance_proche'] += 1
-    
-    return {
-        'risques': {
-            'total': len(risques),
-            'critiques': critiques,
-            'eleves': eleves
-        },
-        'dmr': {
-            'total': len(dmr),
-            'efficaces': dmr_efficaces,
-            'inefficaces': dmr_inefficaces
-        },
-        'plans_action': {
-            'total': len(plans),
-            'en_retard': plans_retard,
-            'en_cours': plans_en_cours,
-            'termines': plans_termines
-        },
-        'evaluations': {
-            'taux': taux_eval,
-            'score_moyen': 0
-        },
-        'incidents': incidents_stats,
-        'veille': veille_stats
-    }
-
-
-def get_stats_direction_detail(direction_id):
-    """Statistiques détaillées pour une direction avec incidents et veille"""
-    cartos = Cartographie.query.filter_by(direction_id=direction_id, is_archived=False).all()
-    carto_ids = [c.id for c in cartos]
-    
-    # Récupérer le nom de la direction
-    direction = Direction.query.get(direction_id)
-    direction_nom = direction.nom if direction else None
-    
-    if not carto_ids:
-        return {
-            'risques': {'total': 0, 'critiques': 0, 'eleves': 0},
-            'dmr': {'total': 0, 'efficaces': 0, 'inefficaces': 0},
-            'plans_action': {'total': 0, 'en_retard': 0, 'en_cours': 0, 'termines': 0},
-            'evaluations': {'taux': 0, 'score_moyen': 0},
-            'incidents': {'total': 0, 'critiques': 0, 'eleves': 0, 'ouverts': 0},
-            'veille': {'total': 0, 'a_surveiller': 0, 'echeance_proche': 0}
-        }
-    
-    risques = Risque.query.filter(
-        Risque.cartographie_id.in_(carto_ids),
-        Risque.is_archived == False
-    ).all()
-    risque_ids = [r.id for r in risques]
-    
-    critiques = 0
-    eleves = 0
-    for risque in risques:
-        derniere_eval = EvaluationRisque.query.filter_by(risque_id=risque.id)\
-            .order_by(EvaluationRisque.created_at.desc()).first()
-        if derniere_eval:
-            if derniere_eval.niveau_risque == 'Critique':
-                critiques += 1
-            elif derniere_eval.niveau_risque == 'Élevé':
-                eleves += 1
-    
-    dmr = DispositifMaitrise.query.filter(
-        DispositifMaitrise.risque_id.in_(risque_ids),
-        DispositifMaitrise.is_archived == False
-    ).all() if risque_ids else []
-    dmr_efficaces = sum(1 for d in dmr if d.efficacite_reelle and d.efficacite_reelle >= 4)
-    dmr_inefficaces = sum(1 for d in dmr if d.efficacite_reelle and d.efficacite_reelle < 3)
-    
-    today = datetime.now().date()
-    plans = PlanAction.query.filter(
-        PlanAction.risque_id.in_(risque_ids),
-        PlanAction.is_archived == False
-    ).all() if risque_ids else []
-    plans_retard = sum(1 for p in plans if p.date_fin_prevue and p.date_fin_prevue < today and p.statut != 'termine')
-    plans_en_cours = sum(1 for p in plans if p.statut == 'en_cours')
-    plans_termines = sum(1 for p in plans if p.statut == 'termine')
-    
-    eval_total = EvaluationRisque.query.filter(
-        EvaluationRisque.risque_id.in_(risque_ids)
-    ).distinct(EvaluationRisque.risque_id).count() if risque_ids else 0
-    taux_eval = round((eval_total / len(risques) * 100) if risques else 0, 1)
-    
-    # ===== STATISTIQUES INCIDENTS (filtrées par direction) =====
+    # ===== STATISTIQUES INCIDENTS =====
     incident_query = get_client_filter(Incident).filter_by(is_archived=False)
-    if direction_nom:
+    # Filtrer par les directions du pôle
+    direction_names = [d.nom for d in directions]
+    if direction_names:
         if hasattr(Incident, 'direction_associee'):
-            incident_query = incident_query.filter(Incident.direction_associee == direction_nom)
+            incident_query = incident_query.filter(Incident.direction_associee.in_(direction_names))
         elif hasattr(Incident, 'direction_id'):
-            incident_query = incident_query.filter(Incident.direction_id == direction_id)
-        else:
-            incident_query = incident_query.filter(False)
+            incident_query = incident_query.filter(Incident.direction_id.in_(direction_ids))
     
     incidents_stats = {
         'total': incident_query.count(),
@@ -52955,15 +50590,28 @@ def get_stats_direction_detail(direction_id):
         'ouverts': incident_query.filter(Incident.statut.in_(['ouvert', 'en_cours'])).count() if hasattr(Incident, 'statut') else 0
     }
     
-    # ===== STATISTIQUES VEILLE (filtrées par direction) =====
+    # ===== STATISTIQUES VEILLE =====
     veille_query = get_client_filter(VeilleReglementaire).filter_by(is_archived=False, is_active=True)
-    if direction_nom:
+    if direction_names:
         if hasattr(VeilleReglementaire, 'direction_associee'):
-            veille_query = veille_query.filter(VeilleReglementaire.direction_associee == direction_nom)
+            veille_query = veille_query.filter(VeilleReglementaire.direction_associee.in_(direction_names))
         elif hasattr(VeilleReglementaire, 'direction_id'):
-            veille_query = veille_query.filter(VeilleReglementaire.direction_id == direction_id)
+            veille_query = veille_query.filter(VeilleReglementaire.direction_id.in_(direction_ids))
         else:
-            veille_query = veille_query.filter(False)
+            # Essayer de filtrer via les actions
+            try:
+                actions = get_client_filter(ActionConformite).all()
+                veille_ids = []
+                for action in actions:
+                    if action.veille_id:
+                        if hasattr(action, 'direction_associee') and action.direction_associee in direction_names:
+                            veille_ids.append(action.veille_id)
+                        elif hasattr(action, 'direction_id') and action.direction_id in direction_ids:
+                            veille_ids.append(action.veille_id)
+                if veille_ids:
+                    veille_query = veille_query.filter(VeilleReglementaire.id.in_(veille_ids))
+            except Exception as e:
+                print(f"Erreur filtrage veille: {e}")
     
     veille_stats = {
         'total': veille_query.count(),
@@ -53004,6 +50652,8 @@ def get_stats_direction_detail(direction_id):
     }
 
 
+
+
 def get_c2n_stats_pays(pays_id):
     """Statistiques C2N pour un pays"""
     poles = Pole.query.filter_by(pays_id=pays_id, is_archived=False).all()
@@ -54432,49 +52082,64 @@ def c2n_dashboard():
         planifications_query = planifications_query.join(ReferentielControle).filter(ReferentielControle.metier == metier_filtre)
     
     # ============================================
-    # 2. RÉCUPÉRATION DES DONNÉES
+    # 2. CALCUL DES STATISTIQUES (requêtes groupées)
     # ============================================
     
-    planifications = planifications_query.all()
-    executions = get_client_filter(ExecutionControle).all()
-    non_conformites = get_client_filter(NonConformiteC2N).all()
-    plans_action = get_client_filter(PlanActionC2N).all()
-    
-    # ============================================
-    # 3. CALCUL DES STATISTIQUES
-    # ============================================
-    
-    total_planifies = len(planifications)
-    realises = len([p for p in planifications if p.statut in ['valide', 'rejete']])
-    en_retard = len([p for p in planifications if p.date_prevue < datetime.now().date() and p.statut not in ['valide', 'rejete']])
-    a_valider = len([p for p in planifications if p.statut == 'soumis'])
-    
-    # Taux de conformité
-    taux_conformites = [e.taux_conformite for e in executions if e.taux_conformite]
-    taux_moyen = round(sum(taux_conformites) / len(taux_conformites), 1) if taux_conformites else 0
+    # Même périmètre que le calcul ligne à ligne : planifications filtrées,
+    # toutes les exécutions et non-conformités du client (hors filtres)
+    from sqlalchemy import func, case
+    aujourd_hui = datetime.now().date()
+    non_realisee = PlanificationControle.statut.notin_(['valide', 'rejete'])
+    total_planifies, realises, a_valider, en_retard = planifications_query.with_entities(
+        func.count(PlanificationControle.id),
+        func.coalesce(func.sum(case((PlanificationControle.statut.in_(['valide', 'rejete']), 1), else_=0)), 0),
+        func.coalesce(func.sum(case((PlanificationControle.statut == 'soumis', 1), else_=0)), 0),
+        func.coalesce(func.sum(case((db.and_(PlanificationControle.date_prevue < aujourd_hui, non_realisee), 1), else_=0)), 0)
+    ).one()
+    
+    # Taux de conformité (exécutions dont le taux est renseigné et non nul)
+    taux_moyen = get_client_filter(ExecutionControle).with_entities(
+        func.avg(ExecutionControle.taux_conformite)
+    ).filter(ExecutionControle.taux_conformite.isnot(None), ExecutionControle.taux_conformite != 0).scalar()
+    taux_moyen = round(float(taux_moyen), 1) if taux_moyen is not None else 0
     
     # Actions
-    actions_ouvertes = len([a for a in plans_action if a.statut not in ['terminee', 'annulee']])
-    actions_closes = len([a for a in plans_action if a.statut == 'terminee'])
-    non_conformites_ouvertes = len([n for n in non_conformites if n.statut != 'ferme'])
+    actions_par_statut = dict(get_client_filter(PlanActionC2N).with_entities(
+        PlanActionC2N.statut, func.count(PlanActionC2N.id)
+    ).group_by(PlanActionC2N.statut).all())
+    actions_ouvertes = sum(nb for statut, nb in actions_par_statut.items() if statut not in ['terminee', 'annulee'])
+    actions_closes = actions_par_statut.get('terminee', 0)
+    
+    # Non-conformités : ouvertes et répartition par criticité, un seul SELECT
+    niveaux_criticite = ['mineur', 'majeur', 'critique']
+    comptes_nc = get_client_filter(NonConformiteC2N).with_entities(
+        func.coalesce(func.sum(case((db.or_(NonConformiteC2N.statut != 'ferme',
+                                            NonConformiteC2N.statut.is_(None)), 1), else_=0)), 0),
+        *[func.coalesce(func.sum(case((NonConformiteC2N.niveau_criticite == niveau, 1), else_=0)), 0)
+          for niveau in niveaux_criticite]
+    ).one()
+    non_conformites_ouvertes = comptes_nc[0]
     
     # Répartition par métier
-    repartition_metier = {}
-    referentiels = referentiels_query.all()
-    for ref in referentiels:
-        if ref.metier:
-            repartition_metier[ref.metier] = repartition_metier.get(ref.metier, 0) + 1
+    repartition_metier = dict(referentiels_query.with_entities(
+        ReferentielControle.metier, func.count(ReferentielControle.id)
+    ).filter(ReferentielControle.metier.isnot(None), ReferentielControle.metier != '').group_by(ReferentielControle.metier).all())
     
     # Répartition par risque
-    repartition_risque = {'mineur': 0, 'majeur': 0, 'critique': 0}
-    for nc in non_conformites:
-        if nc.niveau_criticite in repartition_risque:
-            repartition_risque[nc.niveau_criticite] += 1
+    repartition_risque = dict(zip(niveaux_criticite, comptes_nc[1:]))
     
     # ============================================
     # 4. ÉVOLUTION SUR 6 MOIS
     # ============================================
     
+    debut_evolution = (datetime.now().replace(day=1) - timedelta(days=30*5)).replace(day=1)
+    lignes_evolution = planifications_query.with_entities(
+        PlanificationControle.date_prevue, PlanificationControle.updated_at, PlanificationControle.statut
+    ).filter(db.or_(
+        PlanificationControle.date_prevue >= debut_evolution.date(),
+        PlanificationControle.updated_at >= debut_evolution
+    )).all()
+    
     evolution_labels = []
     evolution_planifies = []
     evolution_realises = []
@@ -54483,10 +52148,10 @@ def c2n_dashboard():
         mois_label = mois.strftime('%b %Y')
         evolution_labels.append(mois_label)
         
-        count_planifies = len([p for p in planifications if p.date_prevue and p.date_prevue.year == mois.year and p.date_prevue.month == mois.month])
+        count_planifies = len([p for p in lignes_evolution if p.date_prevue and p.date_prevue.year == mois.year and p.date_prevue.month == mois.month])
         evolution_planifies.append(count_planifies)
         
-        count_realises = len([p for p in planifications if p.updated_at and p.updated_at.year == mois.year and p.updated_at.month == mois.month and p.statut in ['valide', 'rejete']])
+        count_realises = len([p for p in lignes_evolution if p.updated_at and p.updated_at.year == mois.year and p.updated_at.month == mois.month and p.statut in ['valide', 'rejete']])
         evolution_realises.append(count_realises)
     
     # ============================================
@@ -54530,7 +52195,7 @@ def c2n_dashboard():
     pays_list = get_client_filter(Pays).filter_by(is_archived=False).order_by(Pays.nom).all()
     poles_list = get_client_filter(Pole).filter_by(is_archived=False).order_by(Pole.nom).all()
     directions_list = get_client_filter(Direction).filter_by(is_archived=False, is_active=True).order_by(Direction.nom).all()
-    metiers_list = list(set([r.metier for r in referentiels if r.metier]))
+    metiers_list = list(repartition_metier.keys())
     
     # ============================================
     # 7. STATISTIQUES GLOBALES
@@ -54571,6 +52236,33 @@ def c2n_dashboard():
                          timedelta=timedelta)  # ← AJOUTER timedelta POUR LE TEMPLATE
 
 
+@app.route('/c2n/dashboard/metriques')
+@login_required
+def c2n_dashboard_metriques():
+    """Agrégats C2N par référentiel (JSON), servis depuis metriques_controle"""
+    if not current_user.has_permission('can_manage_audit'):
+        return jsonify({'success': False, 'error': 'Permission requise'}), 403
+    
+    client_id = None if current_user.role == 'super_admin' else current_user.client_id
+    metriques = ControleMetriquesService.par_referentiel(client_id)
+    en_retard = ControleMetriquesService.en_retard_par_referentiel(client_id)
+    
+    referentiels = []
+    for referentiel_id, metrique in metriques.items():
+        donnees = metrique.to_dict()
+        donnees['nb_en_retard'] = en_retard.get(referentiel_id, 0)
+        referentiels.append(donnees)
+    
+    totaux = ControleMetriquesService.totaux(client_id)
+    totaux['nb_en_retard'] = sum(en_retard.values())
+    
+    return jsonify({
+        'success': True,
+        'totaux': totaux,
+        'referentiels': referentiels
+    })
+
+
 @app.route('/c2n/planification/<int:id>/modifier', methods=['GET', 'POST'])
 @login_required
 def c2n_modifier_planification(id):
@@ -55293,10 +52985,17 @@ def c2n_annuler_planification(id):
 def c2n_historique_planification(id):
     """Afficher l'historique des actions"""
     planification = get_client_object_or_404(PlanificationControle, id)
+    page = request.args.get('page', 1, type=int)
+    par_page = 50
+    
+    total = JournalEvenement.compter(PlanificationControle.__tablename__, planification.id)
     
     return render_template('c2n/planification_historique.html',
                          planification=planification,
-                         historique=planification.historique_actions or [])
+                         historique=planification.get_historique(page, par_page),
+                         page=page,
+                         nb_pages=max((total + par_page - 1) // par_page, 1),
+                         total=total)
 
 
 # ============================================
@@ -55883,6 +53582,15 @@ def statistiques_campagne_controle(campagne_id):
         'conformes': campagne.nb_conformes
     }
     
+    # Suivi C2N lié (non-conformités, validations) depuis les agrégats
+    metrique = ControleMetriquesService.pour_campagne(campagne.id)
+    if metrique:
+        stats.update({
+            'non_conformites_c2n': metrique.nb_non_conformites,
+            'non_conformites_c2n_ouvertes': metrique.nb_nc_ouvertes,
+            'validations_c2n': metrique.nb_validations
+        })
+    
     return render_template('controle/statistiques.html',
                          campagne=campagne,
                          stats=stats)
@@ -59288,6 +56996,7 @@ def verifier_escalades_auto():
         print(f"✅ Vérification terminée: {escalades_declenchees} escalade(s) déclenchée(s)")
 
 # Ajoutez cette tâche à votre scheduler existant
+@tache_planifiee
 def demarrer_taches_escalade():
     """Démarre les tâches planifiées pour les escalades"""
     from apscheduler.schedulers.background import BackgroundScheduler
@@ -59307,13 +57016,6 @@ def demarrer_taches_escalade():
     scheduler.start()
     print("✅ Tâches d'escalade démarrées")
 
-# Appeler au démarrage (dans votre contexte d'application)
-with app.app_context():
-    try:
-        demarrer_taches_escalade()
-    except Exception as e:
-        print(f"⚠️ Erreur démarrage tâches escalade: {e}")
-
 
 # ========================
 # ROUTES API POUR ESCALADE
@@ -59518,7 +57220,8 @@ def supprimer_definitivement_incident(id):
         return redirect(url_for('incidents_archives'))
     
     try:
-        # Supprimer les fichiers joints physiquement
+        # Libérer les fichiers stockés par contenu, supprimer les anciens fichiers physiquement
+        StockageService.liberer('incident', incident.id)
         for filename in incident.get_fichiers_joints_list():
             filepath = os.path.join('static/uploads/incidents', filename)
             if os.path.exists(filepath):
@@ -60870,10 +58573,14 @@ def download_incident_fichier(incident_id, filename):
             flash('Fichier non trouvé', 'error')
             return redirect(url_for('detail_incident', id=incident_id))
         
+        sha256 = incident.get_fichiers_metadonnees_dict().get(filename, {}).get('sha256')
+        if sha256:
+            return StockageService.reponse(sha256, filename)
+        
         filepath = os.path.join('static/uploads/incidents', filename)
         
         if os.path.exists(filepath):
-            return send_file(filepath, as_attachment=True, download_name=filename)
+            return send_file(filepath, as_attachment=True, download_name=filename, conditional=True)
         else:
             flash('Fichier non trouvé', 'error')
             return redirect(url_for('detail_incident', id=incident_id))
@@ -60920,10 +58627,13 @@ def api_supprimer_fichier_incident(incident_id, filename):
         if not current_user.is_client_admin and current_user.id != incident.created_by:
             return jsonify({'success': False, 'error': 'Permission non autorisée'}), 403
         
-        # Supprimer le fichier physique
-        filepath = os.path.join('static/uploads/incidents', filename)
-        if os.path.exists(filepath):
-            os.remove(filepath)
+        # Libérer le contenu stocké (ou supprimer l'ancien fichier physique)
+        if incident.get_fichiers_metadonnees_dict().get(filename, {}).get('sha256'):
+            StockageService.liberer('incident', incident.id, filename)
+        else:
+            filepath = os.path.join('static/uploads/incidents', filename)
+            if os.path.exists(filepath):
+                os.remove(filepath)
         
         # Supprimer des métadonnées de l'incident
         incident.supprimer_fichier(filename)
@@ -60964,33 +58674,29 @@ def upload_fichier_incident(incident_id):
             flash(f'Extension .{ext} non autorisée', 'error')
             return redirect(url_for('detail_incident', id=incident_id))
         
-        # Vérifier la taille (max 10 Mo)
-        fichier.seek(0, 2)
-        taille = fichier.tell()
-        fichier.seek(0)
-        
-        if taille > 10 * 1024 * 1024:
-            flash('Fichier trop volumineux (max 10 Mo)', 'error')
-            return redirect(url_for('detail_incident', id=incident_id))
-        
-        # Créer le dossier
-        upload_folder = os.path.join('static/uploads/incidents')
-        os.makedirs(upload_folder, exist_ok=True)
-        
         # Générer un nom unique
         from werkzeug.utils import secure_filename
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         safe_filename = secure_filename(fichier.filename)
         unique_filename = f"incident_{incident_id}_{timestamp}_{safe_filename}"
-        filepath = os.path.join(upload_folder, unique_filename)
         
-        # Sauvegarder
-        fichier.save(filepath)
+        # Sauvegarder (stockage par contenu, max 10 Mo vérifié pendant la lecture)
+        try:
+            reference = StockageService.enregistrer(
+                fichier, 'incident', incident.id,
+                client_id=incident.client_id, created_by=current_user.id,
+                nom_fichier=unique_filename, taille_max=10 * 1024 * 1024
+            )
+        except FichierTropVolumineux:
+            db.session.rollback()
+            flash('Fichier trop volumineux (max 10 Mo)', 'error')
+            return redirect(url_for('detail_incident', id=incident_id))
         
         # Ajouter à l'incident
         incident.ajouter_fichier(unique_filename, {
             'nom_original': safe_filename,
-            'taille': taille,
+            'taille': db.session.get(ObjetStocke, reference.sha256).taille,
+            'sha256': reference.sha256,
             'type': ext,
             'uploaded_at': datetime.now().isoformat(),
             'uploaded_by': current_user.username
@@ -61747,6 +59453,7 @@ def analyser_incidents_ia_auto():
 
 # ==================== DÉMARRAGE TÂCHES AUTOMATIQUES ====================
 
+@tache_planifiee
 def demarrer_taches_incidents():
     """Démarre les tâches planifiées pour les incidents"""
     from apscheduler.schedulers.background import BackgroundScheduler
@@ -61766,13 +59473,6 @@ def demarrer_taches_incidents():
     scheduler.start()
     print("✅ Tâches incidents démarrées (escalade auto toutes les heures)")
 
-# Appeler au démarrage de l'application
-with app.app_context():
-    try:
-        demarrer_taches_incidents()
-    except Exception as e:
-        print(f"⚠️ Erreur démarrage tâches incidents: {e}")
-
 
 
 @app.route('/incident/<int:id>/modifier', methods=['GET', 'POST'])
@@ -64914,10 +62614,16 @@ def api_import_excel():
     except Exception as e:
         import traceback
         traceback.print_exc()
+        db.session.rollback()
+        # Limite de la formule atteinte pendant l'import (les lignes suivantes échouent avec elle)
+        refus = QuotaService.refus()
         if 'import_job' in locals():
             import_job.statut = 'failed'
-            import_job.erreurs = [str(e)]
+            import_job.erreurs = [str(refus or e)]
             db.session.commit()
+        if refus is not None:
+            return jsonify({'success': False, 'error': str(refus), 'ressource': refus.ressource,
+                            'limite': refus.limite}), 403
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
@@ -65065,7 +62771,7 @@ def api_cartographies_liste():
     
     return jsonify({'success': True, 'cartographies': data})
 
-@app.context_processor
+@contexte_templates.fournisseur
 def utility_processor():
     """Injecte les cartographies dans tous les templates"""
     def get_cartographies():
@@ -65816,6 +63522,12 @@ def api_generer_plan_complet():
     try:
         data = request.get_json()
         titre = data.get('titre', '')
+        if data.get('async') and IA_TACHES_ROUTES_AVAILABLE:
+            tache = IACacheService.soumettre_tache(
+                'plan_qualite_complet', {'titre': titre},
+                client_id=current_user.client_id, user_id=current_user.id
+            )
+            return reponse_tache_soumise(tache)
         result = IAQualiteService.generer_plan_complet(titre)
         return jsonify({'success': True, **result})
     except Exception as e:
@@ -69500,33 +67212,18 @@ def api_creer_version_feuille(feuille_id):
     
     data = request.get_json()
     
-    # Récupérer le dernier numéro de version
-    derniere_version = FeuilleTravailVersion.query.filter_by(
-        feuille_travail_id=feuille_id
-    ).order_by(FeuilleTravailVersion.version_numero.desc()).first()
-    
-    nouveau_numero = (derniere_version.version_numero + 1) if derniere_version else 1
-    
-    # Capturer l'état actuel
+    # Capturer l'état actuel (instantané complet ou delta selon le numéro)
     tests = TestControleFeuille.query.filter_by(feuille_travail_id=feuille_id).all()
     
-    version = FeuilleTravailVersion(
-        feuille_travail_id=feuille_id,
-        version_numero=nouveau_numero,
-        contenu_snapshot={
-            'titre': feuille.titre,
-            'description': feuille.description,
-            'type_feuille': feuille.type_feuille,
-            'statut': feuille.statut,
-            'contenu': feuille.contenu
-        },
-        tests_snapshot=[t.to_dict() for t in tests],
-        version_commentaire=data.get('commentaire', ''),
+    version = VersionsFeuilleService.creer_version(
+        feuille,
+        tests,
+        commentaire=data.get('commentaire', ''),
         version_type=data.get('type', 'modification'),
         created_by=current_user.id
     )
+    nouveau_numero = version.version_numero
     
-    db.session.add(version)
     db.session.commit()
     
     return jsonify({
@@ -69924,33 +67621,18 @@ def api_creer_version_complete(feuille_id):
     feuille = get_client_object_or_404(FeuilleTravail, feuille_id)
     data = request.get_json()
     
-    # Récupérer le dernier numéro de version
-    derniere_version = FeuilleTravailVersion.query.filter_by(
-        feuille_travail_id=feuille_id
-    ).order_by(FeuilleTravailVersion.version_numero.desc()).first()
-    
-    nouveau_numero = (derniere_version.version_numero + 1) if derniere_version else 1
-    
-    # Capturer l'état actuel
+    # Capturer l'état actuel (instantané complet ou delta selon le numéro)
     tests = TestControleFeuille.query.filter_by(feuille_travail_id=feuille_id).all()
     
-    version = FeuilleTravailVersion(
-        feuille_travail_id=feuille_id,
-        version_numero=nouveau_numero,
-        contenu_snapshot={
-            'titre': feuille.titre,
-            'description': feuille.description,
-            'type_feuille': feuille.type_feuille,
-            'statut': feuille.statut,
-            'contenu': feuille.contenu
-        },
-        tests_snapshot=[t.to_dict() for t in tests],
-        version_commentaire=data.get('commentaire', ''),
+    version = VersionsFeuilleService.creer_version(
+        feuille,
+        tests,
+        commentaire=data.get('commentaire', ''),
         version_type=data.get('type', 'modification'),
         created_by=current_user.id
     )
+    nouveau_numero = version.version_numero
     
-    db.session.add(version)
     db.session.commit()
     
     return jsonify({
@@ -69971,7 +67653,8 @@ def api_restaurer_version_complete(feuille_id, version_id):
         return jsonify({'success': False, 'error': 'Version non trouvée'}), 404
     
     # Restaurer les données
-    snapshot = version.contenu_snapshot
+    etat = VersionsFeuilleService.etat_version(version)
+    snapshot = etat['contenu']
     feuille.titre = snapshot.get('titre', feuille.titre)
     feuille.description = snapshot.get('description', feuille.description)
     feuille.type_feuille = snapshot.get('type_feuille', feuille.type_feuille)
@@ -69979,9 +67662,9 @@ def api_restaurer_version_complete(feuille_id, version_id):
     feuille.contenu = snapshot.get('contenu', feuille.contenu)
     
     # Restaurer les tests
-    if version.tests_snapshot:
+    if etat['tests']:
         TestControleFeuille.query.filter_by(feuille_travail_id=feuille_id).delete()
-        for test_data in version.tests_snapshot:
+        for test_data in etat['tests']:
             test = TestControleFeuille(
                 feuille_travail_id=feuille_id,
                 objet_test=test_data['objet_test'],
@@ -70720,8 +68403,12 @@ def api_liste_versions_feuille(feuille_id):
     """Lister toutes les versions d'une feuille"""
     feuille = get_client_object_or_404(FeuilleTravail, feuille_id)
     
+    # Métadonnées seulement : les instantanés ne sont pas chargés
     versions = FeuilleTravailVersion.query.filter_by(
         feuille_travail_id=feuille_id
+    ).options(
+        defer(FeuilleTravailVersion.contenu_snapshot),
+        defer(FeuilleTravailVersion.tests_snapshot)
     ).order_by(FeuilleTravailVersion.version_numero.desc()).all()
     
     return jsonify({
@@ -70749,7 +68436,8 @@ def api_restaurer_version_feuille(feuille_id, version_id):
         return jsonify({'success': False, 'error': 'Version non trouvée'}), 404
     
     # Restaurer les données
-    snapshot = version.contenu_snapshot
+    etat = VersionsFeuilleService.etat_version(version)
+    snapshot = etat['contenu']
     feuille.titre = snapshot.get('titre', feuille.titre)
     feuille.description = snapshot.get('description', feuille.description)
     feuille.type_feuille = snapshot.get('type_feuille', feuille.type_feuille)
@@ -70757,9 +68445,9 @@ def api_restaurer_version_feuille(feuille_id, version_id):
     feuille.contenu = snapshot.get('contenu', feuille.contenu)
     
     # Restaurer les tests
-    if version.tests_snapshot:
+    if etat['tests']:
         TestControleFeuille.query.filter_by(feuille_travail_id=feuille_id).delete()
-        for test_data in version.tests_snapshot:
+        for test_data in etat['tests']:
             test = TestControleFeuille(
                 feuille_travail_id=feuille_id,
                 objet_test=test_data['objet_test'],
@@ -72262,23 +69950,15 @@ def init_versions_feuille(feuille_id):
     tests = TestControleFeuille.query.filter_by(feuille_travail_id=feuille_id).all()
     
     # Créer la version initiale
-    version = FeuilleTravailVersion(
-        feuille_travail_id=feuille_id,
-        version_numero=1,
-        contenu_snapshot={
-            'titre': feuille.titre,
-            'description': feuille.description,
-            'type_feuille': feuille.type_feuille,
-            'statut': feuille.statut,
-            'contenu': feuille.contenu
-        },
-        tests_snapshot=[t.to_dict() for t in tests],
-        version_commentaire='Version initiale',
+    VersionsFeuilleService.creer_version(
+        feuille,
+        tests,
+        commentaire='Version initiale',
         version_type='creation',
-        created_by=current_user.id
+        created_by=current_user.id,
+        numero=1
     )
     
-    db.session.add(version)
     db.session.commit()
     
     return jsonify({'success': True, 'message': 'Version initiale créée'})
@@ -72628,14 +70308,13 @@ def api_liste_versions_complete(feuille_id):
     """Lister toutes les versions avec statistiques"""
     feuille = get_client_object_or_404(FeuilleTravail, feuille_id)
     
-    versions = FeuilleTravailVersion.query.filter_by(
-        feuille_travail_id=feuille_id
-    ).order_by(FeuilleTravailVersion.version_numero.desc()).all()
+    # États de toutes les versions reconstruits en un passage (deltas appliqués dans l'ordre)
+    historique = VersionsFeuilleService.historique(feuille_id)
     
     versions_data = []
-    for v in versions:
+    for v, etat in reversed(historique):
         # Calculer le taux de conformité pour cette version
-        tests_snapshot = v.tests_snapshot or []
+        tests_snapshot = etat['tests']
         total = len(tests_snapshot)
         conformes = len([t for t in tests_snapshot if t.get('resultat') == 'conforme'])
         taux = round((conformes / total * 100), 1) if total > 0 else 0
@@ -72656,6 +70335,24 @@ def api_liste_versions_complete(feuille_id):
         'success': True,
         'versions': versions_data
     })
+
+
+@app.route('/api/feuille-travail/<int:feuille_id>/versions/comparer')
+@login_required
+def api_comparer_versions_feuille(feuille_id):
+    """Différences entre deux versions (?de=<numéro>&a=<numéro>)"""
+    feuille = get_client_object_or_404(FeuilleTravail, feuille_id)
+    
+    numero_de = request.args.get('de', type=int)
+    numero_a = request.args.get('a', type=int)
+    if not numero_de or not numero_a:
+        return jsonify({'success': False, 'error': 'Paramètres de et a requis'}), 400
+    
+    differences = VersionsFeuilleService.comparer(feuille.id, numero_de, numero_a)
+    if differences is None:
+        return jsonify({'success': False, 'error': 'Version non trouvée'}), 404
+    
+    return jsonify({'success': True, **differences})
 # ============================================
 # ROUTES POUR COMMENTAIRES
 # ============================================
@@ -72996,22 +70693,14 @@ def init_all_versions():
         tests = TestControleFeuille.query.filter_by(feuille_travail_id=feuille.id).all()
         
         # Créer la version initiale
-        version = FeuilleTravailVersion(
-            feuille_travail_id=feuille.id,
-            version_numero=1,
-            contenu_snapshot={
-                'titre': feuille.titre,
-                'description': feuille.description,
-                'type_feuille': feuille.type_feuille,
-                'statut': feuille.statut,
-                'contenu': feuille.contenu
-            },
-            tests_snapshot=[t.to_dict() for t in tests],
-            version_commentaire='Version initiale (créée automatiquement)',
+        VersionsFeuilleService.creer_version(
+            feuille,
+            tests,
+            commentaire='Version initiale (créée automatiquement)',
             version_type='creation',
-            created_by=current_user.id
+            created_by=current_user.id,
+            numero=1
         )
-        db.session.add(version)
         compteur += 1
     
     db.session.commit()
@@ -74057,6 +71746,20 @@ def dashboard_developpement_auditeurs():
         flash('Permission requise', 'error')
         return redirect(url_for('dashboard'))
     
+    # Tableau de bord en cache pour cette version des données
+    client_id = current_user.client_id
+    version_fragment = CacheFragments.version(
+        client_id,
+        (User, User.client_id == client_id),
+        (EvaluationCompetence, EvaluationCompetence.client_id == client_id),
+        (PlanDeveloppementIndividuel, PlanDeveloppementIndividuel.client_id == client_id),
+        (Competence, Competence.client_id == client_id),
+        (Formation, Formation.client_id == client_id),
+        (InscriptionFormation, InscriptionFormation.client_id == client_id),
+    )
+    if CacheFragments.obtenir('auditeurs_dashboard', client_id, version_fragment) is not None:
+        return render_template('auditeurs/dashboard.html', version_fragment=version_fragment)
+    
     auditeurs = User.query.filter(
         User.client_id == current_user.client_id,
         User.role.in_(['auditeur', 'auditor', 'manager'])
@@ -74129,6 +71832,7 @@ def dashboard_developpement_auditeurs():
                          stats=stats,
                          competences_par_categorie=competences_par_categorie,
                          competences_a_developper=competences_a_developper,
+                         version_fragment=version_fragment,
                          now=datetime.now())
 @app.route('/api/developpement-auditeurs/auditeurs/creer-demo', methods=['POST'])
 @login_required
@@ -74873,11 +72577,7 @@ def run_alerte_job():
 
 
 # Initialiser le planificateur au démarrage de l'application
-scheduler = None
-try:
-    scheduler = init_alerte_scheduler()
-except Exception as e:
-    print(f"⚠️ Erreur initialisation planificateur: {e}")
+tache_planifiee(init_alerte_scheduler)
 
 @app.route('/api/alertes-approbation/<int:alerte_id>/marquer-lue', methods=['POST'])
 @login_required
@@ -74902,8 +72602,24 @@ def dashboard_audit_global_complet():
     if current_user.role == 'super_admin' and session.get('viewing_client_id'):
         client_id = session['viewing_client_id']
     
+    # Tableau de bord en cache pour cette version des données (alertes propres à l'utilisateur)
+    version_fragment = CacheFragments.version(
+        client_id,
+        (Audit, Audit.client_id == client_id),
+        (WorkflowApprobation, WorkflowApprobation.client_id == client_id),
+        (Constatation, Constatation.client_id == client_id),
+        (Recommandation, Recommandation.client_id == client_id),
+        (User, User.client_id == client_id),
+        (AlerteApprobation, AlerteApprobation.destinataire_id == current_user.id, AlerteApprobation.est_lue == False),
+    )
+    entite_fragment = f"{client_id}:{current_user.id}"
+    if CacheFragments.obtenir('audit_dashboard_global', entite_fragment, version_fragment) is not None:
+        return render_template('audit/dashboard_global_complet.html',
+                               version_fragment=version_fragment, entite_fragment=entite_fragment)
+    
     # Récupérer tous les audits
     audits = Audit.query.filter_by(client_id=client_id, is_archived=False).all()
+    AuditKPIService.precharger(audits)
     
     # ✅ PRÉPARER LES DONNÉES DES AUDITS AVEC WORKFLOW
     audits_data = []
@@ -75082,6 +72798,8 @@ def dashboard_audit_global_complet():
         audits_en_attente=audits_en_attente,
         audits_par_type=audits_par_type,
         evolution_mensuelle=evolution_mensuelle,
+        version_fragment=version_fragment,
+        entite_fragment=entite_fragment,
         datetime=datetime,
         timedelta=timedelta,
         now=datetime.utcnow
@@ -75107,6 +72825,7 @@ def dashboard_audit_export():
     
     # Récupérer les données
     audits = Audit.query.filter_by(client_id=client_id, is_archived=False).all()
+    AuditKPIService.precharger(audits)
     
     # Préparer les données des audits
     audits_data = []
@@ -75506,7 +73225,7 @@ def api_nettoyer_alertes_obsoletes():
         'message': f'{alertes_supprimees} alerte(s) obsolète(s) supprimée(s)'
     })
 
-@app.context_processor
+@contexte_templates.fournisseur
 def utility_processor():
     """Injecte des variables globales dans tous les templates"""
     
@@ -75937,9 +73656,8 @@ def start_alerte_scheduler():
 
 # Démarrer le planificateur (uniquement si le module est exécuté directement)
 # Cette condition évite les problèmes avec le rechargement automatique de Flask
-import os
 if os.environ.get('WERKZEUG_RUN_MAIN') or not app.debug:
-    start_alerte_scheduler()
+    tache_planifiee(start_alerte_scheduler)
 
 
 
@@ -76000,6 +73718,7 @@ def api_auth_required(permission=None):
 def api_audits():
     """Récupérer la liste des audits"""
     audits = get_client_filter(Audit).filter_by(is_archived=False).all()
+    kpis = AuditKPIService.precharger(audits)
     
     return jsonify({
         'success': True,
@@ -76011,8 +73730,8 @@ def api_audits():
             'statut': a.statut,
             'date_debut_prevue': a.date_debut_prevue.isoformat() if a.date_debut_prevue else None,
             'date_fin_prevue': a.date_fin_prevue.isoformat() if a.date_fin_prevue else None,
-            'score_global': a.score_global,
-            'progression': a.progression_globale,
+            'score_global': kpis[a.id]['score_global'],
+            'progression': kpis[a.id]['progression_globale'],
             'created_at': a.created_at.isoformat() if a.created_at else None
         } for a in audits]
     })
@@ -76366,6 +74085,9 @@ def liste_audits():
         if check_client_access(audit):
             accessible_audits.append(audit)
     
+    # Indicateurs de tous les audits en une requête groupée
+    kpis = AuditKPIService.precharger(accessible_audits)
+    
     # Calcul des statistiques
     stats = {
         'total': len(accessible_audits),
@@ -76376,14 +74098,15 @@ def liste_audits():
         'en_redaction': len([a for a in accessible_audits if a.sous_statut == 'redaction']),
         'en_validation': len([a for a in accessible_audits if a.sous_statut == 'validation']),
         'clos': len([a for a in accessible_audits if a.statut == 'clos']),
-        'constatations_total': sum(len(a.constatations) for a in accessible_audits),
-        'recommandations_total': sum(len(a.recommandations) for a in accessible_audits),
-        'plans_action_total': sum(len(a.plans_action) for a in accessible_audits),
+        'constatations_total': sum(k['nb_constatations'] for k in kpis.values()),
+        'recommandations_total': sum(k['nb_recommandations'] for k in kpis.values()),
+        'plans_action_total': sum(k['nb_plans_action'] for k in kpis.values()),
         'archives': get_client_filter(Audit).filter_by(is_archived=True).count()
     }
     
     return render_template('audits.html', 
                          audits=accessible_audits, 
+                         kpis=kpis,
                          stats=stats,
                          show_archived=show_archived,
                            now=datetime.now())
@@ -77738,6 +75461,22 @@ def dashboard_audit(audit_id):
         flash('Accès non autorisé à cet audit', 'error')
         return redirect(url_for('liste_audits'))
     
+    # Tableau de bord en cache pour cette version des données
+    risques_audit = db.session.query(Recommandation.risque_id).filter(Recommandation.audit_id == audit_id)\
+        .union(db.session.query(PlanAction.risque_id).filter(PlanAction.audit_id == audit_id))
+    version_fragment = CacheFragments.version(
+        audit.client_id,
+        (Audit, Audit.id == audit_id),
+        (Constatation, Constatation.audit_id == audit_id),
+        (Recommandation, Recommandation.audit_id == audit_id),
+        (PlanAction, PlanAction.audit_id == audit_id),
+        (Risque, Risque.id.in_(risques_audit)),
+        (AnalyseIA, AnalyseIA.audit_id == audit_id),
+        (JournalAudit, JournalAudit.audit_id == audit_id),
+    )
+    if CacheFragments.obtenir('audit_dashboard', audit_id, version_fragment) is not None:
+        return render_template('audit/dashboard.html', audit=audit, version_fragment=version_fragment)
+    
     # CORRECTION : Filtrer les données associées par client
     
     # Constatations du même client
@@ -77911,6 +75650,7 @@ def dashboard_audit(audit_id):
                          dernieres_activites=dernieres_activites,
                          echeances_a_venir=echeances_a_venir,
                          alertes=alertes,
+                         version_fragment=version_fragment,
                          datetime=datetime,
                          current_user=current_user)
 
@@ -88351,18 +86091,20 @@ def admin_analyses_ia():
 def rapport_comparaison_audits():
     """Rapport de comparaison entre audits"""
     audits = Audit.query.filter_by(is_archived=False).all()
+    kpis = AuditKPIService.precharger(audits)
     
     # Calculer les statistiques pour la comparaison
     comparaison_data = []
     
     for audit in audits:
+        kpi = kpis[audit.id]
         stats = {
             'audit': audit,
-            'nb_constatations': len(audit.constatations),
-            'nb_recommandations': len(audit.recommandations),
-            'nb_plans_action': len(audit.plans_action),
-            'taux_realisation': audit.taux_realisation_recommandations,
-            'score_global': audit.score_global
+            'nb_constatations': kpi['nb_constatations'],
+            'nb_recommandations': kpi['nb_recommandations'],
+            'nb_plans_action': kpi['nb_plans_action'],
+            'taux_realisation': kpi['taux_realisation_recommandations'],
+            'score_global': kpi['score_global']
         }
         comparaison_data.append(stats)
     
@@ -89311,231 +87053,56 @@ def detail_reponse(id):
 @login_required
 def statistiques_questionnaire(id):
     """Afficher les statistiques d'un questionnaire"""
+    from services.questionnaire_resultats_service import ResultatsQuestionnaireService
     questionnaire = Questionnaire.query.get_or_404(id)
     
-    # Récupérer toutes les réponses
-    reponses = ReponseQuestionnaire.query.filter_by(
-        questionnaire_id=id
-    ).all()
-    
-    # Calculer les statistiques de base
-    total_reponses = len(reponses)
-    reponses_completes = sum(1 for r in reponses if r.statut == 'complet')
-    
-    stats = {
-        'total_reponses': total_reponses,
-        'reponses_completes': reponses_completes,
-        'taux_completion': (reponses_completes / total_reponses * 100) if total_reponses > 0 else 0
-    }
-    
-    # Statistiques par question
-    questions_stats = []
-    for categorie in questionnaire.categories:
-        for question in categorie.questions:
-            # Récupérer les réponses pour cette question
-            reponses_question = ReponseQuestion.query.join(ReponseQuestionnaire).filter(
-                ReponseQuestionnaire.questionnaire_id == id,
-                ReponseQuestion.question_id == question.id
-            ).all()
-            
-            total = len(reponses_question)
-            details = None
-            
-            if total > 0:
-                if question.type in ['radio', 'select', 'checkbox']:
-                    # Distribution des options
-                    distribution = {}
-                    for rep in reponses_question:
-                        if rep.valeur_texte:
-                            distribution[rep.valeur_texte] = distribution.get(rep.valeur_texte, 0) + 1
-                    details = distribution
-                
-                elif question.type == 'number':
-                    # Statistiques numériques
-                    valeurs = [r.valeur_numerique for r in reponses_question if r.valeur_numerique is not None]
-                    if valeurs:
-                        details = {
-                            'moyenne': sum(valeurs) / len(valeurs),
-                            'min': min(valeurs),
-                            'max': max(valeurs),
-                            'median': sorted(valeurs)[len(valeurs) // 2] if valeurs else 0
-                        }
-            
-            # Type d'affichage
-            type_display_map = {
-                'text': 'Texte court',
-                'textarea': 'Texte long',
-                'radio': 'Choix unique',
-                'checkbox': 'Choix multiple',
-                'select': 'Liste déroulante',
-                'date': 'Date',
-                'email': 'Email',
-                'number': 'Nombre',
-                'range': 'Échelle',
-                'rating': 'Évaluation',
-                'yesno': 'Oui/Non'
-            }
-            
-            questions_stats.append({
-                'question': question.texte[:100] + ('...' if len(question.texte) > 100 else ''),
-                'type': question.type,
-                'type_display': type_display_map.get(question.type, question.type),
-                'total_reponses': total,
-                'details': details
-            })
+    # Statistiques globales et par question (requêtes groupées)
+    stats, questions_stats = ResultatsQuestionnaireService.statistiques(questionnaire)
     
     return render_template('questionnaire/stats.html',
                          questionnaire=questionnaire,
                          stats=stats,
                          questions_stats=questions_stats)
 
-def exporter_json_questionnaire(questionnaire, form):
-    """Exporter un questionnaire au format JSON"""
-    print(f"📊 Génération JSON pour questionnaire {questionnaire.id}")
-    
-    data = {
-        'titre': questionnaire.titre,
-        'description': questionnaire.description,
-        'code': questionnaire.code,
-        'instructions': questionnaire.instructions,
-        'date_creation': questionnaire.date_creation.isoformat() if questionnaire.date_creation else None,
-        'est_actif': questionnaire.est_actif,
-        'est_public': questionnaire.est_public,
-    }
-    
-    if form.inclure_questions.data:
-        data['categories'] = []
-        for categorie in questionnaire.categories:
-            cat_data = {
-                'titre': categorie.titre,
-                'description': categorie.description,
-                'ordre': categorie.ordre,
-                'questions': []
-            }
-            
-            for question in categorie.questions:
-                q_data = {
-                    'texte': question.texte,
-                    'description': question.description,
-                    'type': question.type,
-                    'ordre': question.ordre,
-                    'est_obligatoire': question.est_obligatoire,
-                    'options': [{
-                        'valeur': option.valeur,
-                        'texte': option.texte,
-                        'ordre': option.ordre,
-                        'score': option.score
-                    } for option in question.options]
-                }
-                cat_data['questions'].append(q_data)
-            
-            data['categories'].append(cat_data)
-    
-    if form.inclure_reponses.data:
-        # Filtrer les réponses par date
-        reponses_filtrees = questionnaire.reponses
-        if form.date_debut.data:
-            reponses_filtrees = [r for r in reponses_filtrees if r.date_debut and r.date_debut.date() >= form.date_debut.data]
-        if form.date_fin.data:
-            reponses_filtrees = [r for r in reponses_filtrees if r.date_debut and r.date_debut.date() <= form.date_fin.data]
-        
-        data['reponses'] = []
-        for reponse in reponses_filtrees:
-            rep_data = {
-                'session_id': reponse.session_id,
-                'statut': reponse.statut,
-                'date_debut': reponse.date_debut.isoformat() if reponse.date_debut else None,
-                'date_fin': reponse.date_fin.isoformat() if reponse.date_fin else None,
-                'duree': reponse.duree,
-                'email_repondant': reponse.email_repondant,
-                'nom_repondant': reponse.nom_repondant,
-            }
-            data['reponses'].append(rep_data)
-    
-    # Créer la réponse
-    response = make_response(json.dumps(data, indent=2, ensure_ascii=False, default=str))
-    response.headers['Content-Type'] = 'application/json'
-    response.headers['Content-Disposition'] = f'attachment; filename=questionnaire_{questionnaire.code}_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json'
-    return response
 
 def exporter_csv_reponses(questionnaire, form):
-    """Exporter les réponses au format CSV"""
+    """Exporter les réponses au format CSV (streamé, une colonne par question)"""
+    from flask import stream_with_context
+    from services.questionnaire_resultats_service import ResultatsQuestionnaireService
     print(f"📊 Génération CSV pour questionnaire {questionnaire.id}")
     
-    # Filtrer les réponses par date
-    reponses_filtrees = questionnaire.reponses
-    if form.date_debut.data:
-        reponses_filtrees = [r for r in reponses_filtrees if r.date_debut and r.date_debut.date() >= form.date_debut.data]
-    if form.date_fin.data:
-        reponses_filtrees = [r for r in reponses_filtrees if r.date_debut and r.date_debut.date() <= form.date_fin.data]
-    
-    # Créer le CSV
-    output = io.StringIO()
-    writer = csv.writer(output)
-    
-    # En-têtes
-    headers = ['Session ID', 'Statut', 'Date début', 'Date fin', 'Durée (s)', 'Email', 'Nom', 'IP']
-    writer.writerow(headers)
-    
-    # Données
-    for reponse in reponses_filtrees:
-        row = [
-            reponse.session_id or '',
-            reponse.statut or '',
-            reponse.date_debut.strftime('%Y-%m-%d %H:%M:%S') if reponse.date_debut else '',
-            reponse.date_fin.strftime('%Y-%m-%d %H:%M:%S') if reponse.date_fin else '',
-            reponse.duree or '',
-            reponse.email_repondant or '',
-            reponse.nom_repondant or '',
-            reponse.ip_address or '',
-        ]
-        writer.writerow(row)
-    
-    # Créer la réponse
-    response = make_response(output.getvalue())
+    flux = ResultatsQuestionnaireService.flux_csv(
+        questionnaire, form.date_debut.data, form.date_fin.data
+    )
+    response = Response(stream_with_context(flux), mimetype='text/csv')
     response.headers['Content-Type'] = 'text/csv; charset=utf-8'
-    response.headers['Content-Disposition'] = f'attachment; filename=reponses_{questionnaire.code}_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'
+    response.headers['Content-Disposition'] = f'attachment; filename={ResultatsQuestionnaireService.nom_fichier(questionnaire, "csv")}'
     return response
 
 def exporter_excel_reponses_simple(questionnaire, form):
-    """Exporter les réponses au format Excel (CSV renommé)"""
-    print(f"📊 Génération Excel simplifiée pour questionnaire {questionnaire.id}")
-    
-    # Filtrer les réponses par date
-    reponses_filtrees = questionnaire.reponses
-    if form.date_debut.data:
-        reponses_filtrees = [r for r in reponses_filtrees if r.date_debut and r.date_debut.date() >= form.date_debut.data]
-    if form.date_fin.data:
-        reponses_filtrees = [r for r in reponses_filtrees if r.date_debut and r.date_debut.date() <= form.date_fin.data]
+    """Exporter les réponses au format Excel (xlsx write-only, CSV ';' si openpyxl absent)"""
+    from flask import stream_with_context
+    from services.questionnaire_resultats_service import ResultatsQuestionnaireService
+    print(f"📊 Génération Excel pour questionnaire {questionnaire.id}")
     
-    # Créer le CSV
-    output = io.StringIO()
-    writer = csv.writer(output, delimiter=';')  # Point-virgule pour Excel français
-    
-    # En-têtes
-    headers = ['Session ID', 'Statut', 'Date début', 'Date fin', 'Durée (s)', 'Email', 'Nom', 'IP']
-    writer.writerow(headers)
-    
-    # Données
-    for reponse in reponses_filtrees:
-        row = [
-            reponse.session_id or '',
-            reponse.statut or '',
-            reponse.date_debut.strftime('%d/%m/%Y %H:%M:%S') if reponse.date_debut else '',
-            reponse.date_fin.strftime('%d/%m/%Y %H:%M:%S') if reponse.date_fin else '',
-            reponse.duree or '',
-            reponse.email_repondant or '',
-            reponse.nom_repondant or '',
-            reponse.ip_address or '',
-        ]
-        writer.writerow(row)
-    
-    # Créer la réponse
-    response = make_response(output.getvalue())
-    # Utiliser l'extension .xls pour ouvrir dans Excel
-    response.headers['Content-Type'] = 'application/vnd.ms-excel'
-    response.headers['Content-Disposition'] = f'attachment; filename=reponses_{questionnaire.code}_{datetime.now().strftime("%Y%m%d_%H%M%S")}.xls'
-    return response
+    try:
+        fichier = ResultatsQuestionnaireService.fichier_xlsx(
+            questionnaire, form.date_debut.data, form.date_fin.data
+        )
+        return send_file(
+            fichier,
+            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+            as_attachment=True,
+            download_name=ResultatsQuestionnaireService.nom_fichier(questionnaire, 'xlsx')
+        )
+    except ImportError:
+        # Point-virgule pour Excel français
+        flux = ResultatsQuestionnaireService.flux_csv(
+            questionnaire, form.date_debut.data, form.date_fin.data, delimiter=';'
+        )
+        response = Response(stream_with_context(flux), mimetype='application/vnd.ms-excel')
+        response.headers['Content-Disposition'] = f'attachment; filename={ResultatsQuestionnaireService.nom_fichier(questionnaire, "xls")}'
+        return response
 
 def exporter_pdf_questionnaire_simple(questionnaire, form):
     """Export PDF ultra simple et fiable"""
@@ -91936,6 +89503,14 @@ def configurer_hooks_multi_tenant():
 with app.app_context():
     configurer_hooks_multi_tenant()
 
+# Filtre client global en lecture (sous-requêtes, sans listes d'ids)
+if app.config.get('FILTRAGE_CLIENT_GLOBAL'):
+    try:
+        from models import ClientDataFilter
+        ClientDataFilter.activer_filtrage_global()
+    except Exception as e:
+        print(f"❌ Erreur activation filtrage client global: {e}")
+
 # Dans app.py, après les routes existantes pour les audits
 
 @app.route('/audit/<int:audit_id>/upload-rapport-fichier', methods=['POST'])
@@ -94990,7 +92565,7 @@ def load_parametres_evaluation(client_id):
         }
 
 
-@app.context_processor
+@contexte_templates.fournisseur
 def evaluation_params_processor():
     """Ajoute les fonctions de paramètres d'évaluation à tous les templates"""
     
@@ -95113,62 +92688,69 @@ def analyse_ia_ultra(id):
     
     client_id = current_user.client_id if current_user.role != 'super_admin' else cartographie.client_id
     
-    # Récupérer les données
-    risques = Risque.query.filter_by(
-        cartographie_id=id,
-        is_archived=False,
-        client_id=client_id
-    ).all()
+    # Résultat mémorisé tant que les données de la cartographie n'ont pas changé
+    version = AnalyseHybrideService.version_cartographie(id, client_id)
+    resultat = AnalyseHybrideService.resultat_en_cache(id, version)
     
-    evaluations = EvaluationRisque.query.join(
-        Risque, EvaluationRisque.risque_id == Risque.id
-    ).filter(
-        Risque.cartographie_id == id,
-        Risque.is_archived == False,
-        Risque.client_id == client_id
-    ).all()
+    if resultat is None:
+        # Récupérer les données
+        risques = Risque.query.filter_by(
+            cartographie_id=id,
+            is_archived=False,
+            client_id=client_id
+        ).all()
     
-    dispositifs = DispositifMaitrise.query.join(
-        Risque, DispositifMaitrise.risque_id == Risque.id
-    ).filter(
-        Risque.cartographie_id == id,
-        Risque.is_archived == False,
-        Risque.client_id == client_id,
-        DispositifMaitrise.is_archived == False
-    ).all()
+        evaluations = EvaluationRisque.query.join(
+            Risque, EvaluationRisque.risque_id == Risque.id
+        ).filter(
+            Risque.cartographie_id == id,
+            Risque.is_archived == False,
+            Risque.client_id == client_id
+        ).all()
     
-    incidents = Incident.query.filter(
-        Incident.risque_id.in_([r.id for r in risques]),
-        Incident.is_archived == False
-    ).all()
+        dispositifs = DispositifMaitrise.query.join(
+            Risque, DispositifMaitrise.risque_id == Risque.id
+        ).filter(
+            Risque.cartographie_id == id,
+            Risque.is_archived == False,
+            Risque.client_id == client_id,
+            DispositifMaitrise.is_archived == False
+        ).all()
     
-    demandes_reevaluation = DemandeReevaluation.query.filter(
-        DemandeReevaluation.risque_id.in_([r.id for r in risques])
-    ).all()
+        incidents = Incident.query.filter(
+            Incident.risque_id.in_([r.id for r in risques]),
+            Incident.is_archived == False
+        ).all()
     
-    constats_audit = Constatation.query.filter(
-        Constatation.risque_id.in_([r.id for r in risques])
-    ).all()
+        demandes_reevaluation = DemandeReevaluation.query.filter(
+            DemandeReevaluation.risque_id.in_([r.id for r in risques])
+        ).all()
     
-    # Lancer l'analyse
-    resultat = AnalyseHybrideService.analyser_complet(
-        cartographie=cartographie,
-        risques=risques,
-        evaluations=evaluations,
-        dispositifs=dispositifs,
-        incidents=incidents,
-        demandes_reevaluation=demandes_reevaluation,
-        constats_audit=constats_audit
-    )
+        constats_audit = Constatation.query.filter(
+            Constatation.risque_id.in_([r.id for r in risques])
+        ).all()
     
-    # Statistiques
+        # Lancer l'analyse
+        resultat = AnalyseHybrideService.analyser_complet(
+            cartographie=cartographie,
+            risques=risques,
+            evaluations=evaluations,
+            dispositifs=dispositifs,
+            incidents=incidents,
+            demandes_reevaluation=demandes_reevaluation,
+            constats_audit=constats_audit,
+            version=version
+        )
+    
+    # Statistiques (calculées par l'index de l'analyse)
+    statistiques = resultat['statistiques']
     stats = {
-        'risques_total': len(risques),
-        'risques_evalues': len([e for e in evaluations if e.date_confirmation]),
-        'dispositifs_total': len(dispositifs),
-        'incidents_recents': len([i for i in incidents if i.date_occurrence >= datetime.now() - timedelta(days=365)]),
-        'taux_evaluation': int((len([e for e in evaluations if e.date_confirmation]) / len(risques) * 100) if risques else 0),
-        'taux_couverture': int((len(set([d.risque_id for d in dispositifs])) / len(risques) * 100) if risques else 0)
+        'risques_total': statistiques['total_risques'],
+        'risques_evalues': statistiques['risques_evalues'],
+        'dispositifs_total': statistiques['dispositifs_total'],
+        'incidents_recents': statistiques['incidents_recents'],
+        'taux_evaluation': int(statistiques['taux_evaluation']),
+        'taux_couverture': int(statistiques['taux_couverture'])
     }
     
     campagne_active = cartographie.get_campagne_active()
@@ -96052,5 +93634,16 @@ def send_password_reset_email(to_email, reset_url, username):
 
 
 
+# Plans du pipeline avant requête : toutes les routes sont enregistrées
+pipeline_requete.preparer(app)
+
+# Enregistré en dernier, donc exécuté en premier : les autres after_request
+# complètent la réponse de refus qui remplace celle de la vue
+app.after_request(limite_formule_interceptee)
+
+# Sous gunicorn, les planificateurs démarrent dans un worker (gunicorn.conf.py post_fork)
+if os.environ.get('TACHES_PLANIFIEES', 'import') == 'import':
+    demarrer_taches_planifiees()
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5005)
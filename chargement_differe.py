@@ -0,0 +1,57 @@
+# chargement_differe.py
+"""
+Import différé des bibliothèques lourdes (matplotlib, numpy, pandas, openai...).
+
+    np = ModuleParesseux('numpy')
+    plt = ModuleParesseux('matplotlib.pyplot', avant=_backend_agg)
+
+Le module n'est réellement importé qu'au premier accès à un attribut,
+ce qui évite de payer son coût au démarrage des workers pour des
+routes rarement appelées.
+"""
+import importlib
+import importlib.util
+import threading
+
+
+class ModuleParesseux:
+    """Proxy vers un module importé au premier accès"""
+
+    def __init__(self, nom, avant=None):
+        self.__dict__['_nom'] = nom
+        self.__dict__['_avant'] = avant
+        self.__dict__['_module'] = None
+        self.__dict__['_verrou'] = threading.Lock()
+
+    def _charger(self):
+        module = self.__dict__['_module']
+        if module is None:
+            with self.__dict__['_verrou']:
+                module = self.__dict__['_module']
+                if module is None:
+                    if self.__dict__['_avant']:
+                        self.__dict__['_avant']()
+                    module = importlib.import_module(self.__dict__['_nom'])
+                    self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, attribut):
+        return getattr(self._charger(), attribut)
+
+    def __setattr__(self, attribut, valeur):
+        setattr(self._charger(), attribut, valeur)
+
+    def __dir__(self):
+        return dir(self._charger())
+
+    def __repr__(self):
+        etat = 'chargé' if self.__dict__['_module'] is not None else 'non chargé'
+        return f"<ModuleParesseux {self.__dict__['_nom']} ({etat})>"
+
+
+def module_disponible(nom):
+    """Vérifie qu'un module est installé sans l'importer"""
+    try:
+        return importlib.util.find_spec(nom) is not None
+    except (ImportError, ValueError):
+        return False
@@ -2,13 +2,16 @@
 
 import json
 import requests
-import pandas as pd
 from datetime import datetime, timedelta
 from sqlalchemy import create_engine
 import logging
 from typing import Any, Dict, List, Optional
 import jsonpath_ng
 
+from chargement_differe import ModuleParesseux
+
+pd = ModuleParesseux('pandas')
+
 logger = logging.getLogger(__name__)
 
 class CollecteEngine:
@@ -21,7 +24,9 @@ class CollecteEngine:
         
     def collecter_source(self, source_id: int, force: bool = False) -> Dict[str, Any]:
         """Collecte les données d'une source spécifique"""
-        from models import SourceDonnee, SourceKRILink, CollecteDonnee, db
+        from models import SourceDonnee, SourceKRILink, CollecteDonnee, AlerteCollecte, db
+        from services.series_temporelles_service import SeriesTemporellesKRI
+        from services.kri_anomalies_service import DetecteurAnomaliesKRI
         
         source = SourceDonnee.query.get(source_id)
         if not source:
@@ -38,6 +43,7 @@ class CollecteEngine:
             'source': source.nom,
             'timestamp': datetime.utcnow().isoformat(),
             'kri_collectes': [],
+            'anomalies': [],
             'erreurs': []
         }
         
@@ -45,37 +51,78 @@ class CollecteEngine:
             # Récupérer les données brutes selon le type de source
             donnees_brutes = self._recuperer_donnees_brutes(source)
             
-            # Pour chaque KRI lié à cette source
+            # Extraire et valider la valeur de chaque KRI lié à cette source
+            extraites = []
             for link in source.kri_associes:
                 if not link.est_actif:
                     continue
                 
                 try:
-                    # Extraire la valeur spécifique pour ce KRI
                     valeur = self._extraire_valeur(link, donnees_brutes)
-                    
-                    # Valider la valeur
-                    validation = link.valider_valeur(valeur)
+                    extraites.append((link, valeur, link.valider_valeur(valeur)))
+                except Exception as e:
+                    logger.error(f"Erreur pour KRI {link.kri_id}: {e}")
+                    resultats['erreurs'].append({
+                        'kri_id': link.kri_id,
+                        'error': str(e)
+                    })
+            
+            # Détection des valeurs anormales, tous les KRI de la source en un pas
+            # Point de sauvegarde : un échec de la détection n'annule pas la collecte
+            try:
+                with db.session.begin_nested():
+                    detections = DetecteurAnomaliesKRI.evaluer_collecte(
+                        source, [(link, valeur) for link, valeur, validation in extraites if validation['valide']]
+                    )
+            except Exception as e:
+                logger.error(f"Erreur détection d'anomalies pour source {source_id}: {e}")
+                detections = {}
+            
+            for link, valeur, validation in extraites:
+                try:
+                    detection = detections.get(link.id)
+                    anomalie = bool(detection and detection['anomalie'])
                     
                     # Créer l'enregistrement de collecte
                     collecte = CollecteDonnee(
                         source_link_id=link.id,
                         valeur=valeur,
-                        donnees_brutes=donnees_brutes if link == source.kri_associes[0] else None,
                         metadonnees={
                             'timestamp': datetime.utcnow().isoformat(),
-                            'validation': validation
+                            'validation': validation,
+                            'anomalie': detection
                         },
-                        statut='succes' if validation['valide'] else 'avertissement',
-                        message=validation.get('message', ''),
+                        statut='succes' if validation['valide'] and not anomalie else 'avertissement',
+                        message=validation.get('message', '') or (detection['message'] if anomalie else ''),
                         date_valeur=datetime.utcnow()
                     )
                     
                     db.session.add(collecte)
                     db.session.flush()
                     
-                    # Créer automatiquement la mesure KRI
-                    if validation['valide']:
+                    # Données brutes sur la première collecte de la source (compressées si volumineuses)
+                    if link == source.kri_associes[0]:
+                        SeriesTemporellesKRI.archiver_donnees_brutes(
+                            collecte, donnees_brutes, client_id=link.kri.client_id if link.kri else None
+                        )
+                    
+                    if anomalie:
+                        db.session.add(AlerteCollecte(
+                            collecte_id=collecte.id,
+                            type_alerte='anomalie',
+                            niveau='danger' if detection['bloquer'] else 'warning',
+                            message=detection['message']
+                        ))
+                        resultats['anomalies'].append({
+                            'kri_id': link.kri_id,
+                            'valeur': valeur,
+                            'score': detection['score'],
+                            'bloquee': detection['bloquer'],
+                            'collecte_id': collecte.id
+                        })
+                    
+                    # Créer automatiquement la mesure KRI (sauf valeur anormale retenue)
+                    if validation['valide'] and not (anomalie and detection['bloquer']):
                         mesure = collecte.creer_mesure_kri()
                         resultats['kri_collectes'].append({
                             'kri_id': link.kri_id,
@@ -83,7 +130,7 @@ class CollecteEngine:
                             'mesure_id': mesure.id,
                             'collecte_id': collecte.id
                         })
-                    else:
+                    elif not validation['valide']:
                         resultats['erreurs'].append({
                             'kri_id': link.kri_id,
                             'error': validation['message']
@@ -89,6 +89,9 @@ class Config:
     REMEMBER_COOKIE_SECURE = IS_RENDER
     REMEMBER_COOKIE_HTTPONLY = True
     
+    # Filtre client appliqué à toutes les requêtes ORM (ClientDataFilter)
+    FILTRAGE_CLIENT_GLOBAL = os.environ.get('FILTRAGE_CLIENT_GLOBAL', 'False').lower() in ['true', '1', 't']
+    
     # ============================================================================
     # CONFIGURATIONS AUDIT - STATUTS INTELLIGENTS
     # ============================================================================
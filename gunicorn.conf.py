@@ -0,0 +1,72 @@
+# gunicorn.conf.py - chargé automatiquement par `gunicorn app:app`
+"""
+Démarrage des workers par fork d'un maître déjà initialisé.
+
+Avec preload_app, app.py (modèles, routes, traductions, création des
+tables) n'est importé qu'une fois dans le maître ; les workers en héritent
+par copy-on-write au lieu de refaire chacun tout l'import. Les options
+passées en ligne de commande (render.yaml) restent prioritaires.
+
+Les tâches planifiées (APScheduler) ne démarrent pas à l'import : le maître
+ne lance aucun thread avant de forker ses workers. Après le fork, le premier
+worker qui obtient le verrou VERROU_TACHES les démarre ; à sa sortie
+(recyclage, arrêt) le verrou est libéré et le worker qui le remplace les
+reprend. Les tâches ne lisent que l'état partagé (base, Redis), jamais la
+mémoire d'un autre worker.
+"""
+import os
+import tempfile
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 4))
+threads = int(os.environ.get('GUNICORN_THREADS', 2))
+worker_class = 'gthread'
+timeout = 120
+
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') != '0'
+
+# Lu par app.py à l'import : planificateurs démarrés par post_fork
+os.environ['TACHES_PLANIFIEES'] = 'post_fork'
+VERROU_TACHES = os.environ.get(
+    'VERROU_TACHES_PLANIFIEES', os.path.join(tempfile.gettempdir(), 'controle_interne_taches.lock')
+)
+
+# Descripteur du verrou, gardé ouvert toute la vie du worker qui le détient
+_verrou = None
+
+
+def _prendre_verrou_taches():
+    """Verrou exclusif non bloquant sur VERROU_TACHES (libéré à la sortie du processus)"""
+    global _verrou
+    import fcntl
+
+    fichier = open(VERROU_TACHES, 'a')
+    try:
+        fcntl.flock(fichier, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        fichier.close()
+        return False
+    _verrou = fichier
+    return True
+
+
+def post_fork(server, worker):
+    """
+    Chaque worker ouvre ses propres connexions (le pool du maître n'est pas
+    partagé) ; un seul démarre les tâches planifiées.
+    """
+    try:
+        from app import app
+        from models import db
+        with app.app_context():
+            db.engine.dispose(close=False)
+    except Exception as e:
+        server.log.warning(f"⚠️ Réinitialisation du pool SQLAlchemy impossible: {e}")
+
+    try:
+        if _prendre_verrou_taches():
+            from app import demarrer_taches_planifiees
+            demarrer_taches_planifiees()
+            server.log.info(f"✅ Tâches planifiées démarrées dans le worker {worker.pid}")
+    except Exception as e:
+        server.log.warning(f"⚠️ Tâches planifiées non démarrées: {e}")
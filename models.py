@@ -447,117 +447,120 @@ class User(UserMixin, db.Model):
         self.session_token = secrets.token_urlsafe(32)
         db.session.commit()
 
-    def has_permission(self, permission):
-        """Vérifie si l'utilisateur a une permission spécifique"""
-        
-        print(f"🔐 [DEBUG] Vérification permission '{permission}' pour {self.username} (rôle: {self.role})")
-        
+    # Permissions automatiques des admins clients
+    PERMISSIONS_ADMIN_CLIENT = {
+        'can_view_dashboard': True,
+        'can_view_departments': True,
+        'can_view_notifications': True,
+        'can_manage_risks': True,
+        'can_validate_risks': True,
+        'can_manage_kri': True,
+        'can_manage_audit': True,
+        'can_confirm_evaluations': True,
+        'can_manage_action_plans': True,
+        'can_view_action_plans': True,
+        'can_view_users_list': True,
+        'can_edit_users': True,
+        'can_manage_users': True,
+        'can_create_users': True,
+        'can_deactivate_users': True,
+        'can_delete_users': True,
+        'can_manage_departments': True,
+        'can_access_all_departments': True,
+        'can_manage_settings': True,
+        'can_archive_data': True,
+        'can_export_data': True,
+        'can_manage_permissions': True,
+        # 🔥 NOUVEAUX MODULES
+        'can_view_tableau_bord_strategique': True,
+        'can_view_controle_interne_n2': True,
+        'can_manage_controle_interne_n2': True,
+        'can_manage_clients': False,
+        'can_provision_servers': False,
+    }
+
+    # Permissions par défaut des gestionnaires (manager)
+    PERMISSIONS_MANAGER = {
+        'can_view_dashboard': True,
+        'can_view_departments': True,
+        'can_view_notifications': True,
+        'can_view_action_plans': True,
+        'can_export_data': True,
+        'can_view_tableau_bord_strategique': False,  # Optionnel
+        'can_view_controle_interne_n2': False,       # Optionnel
+        'can_manage_controle_interne_n2': False,  
+    }
+
+    # Permissions par défaut selon le rôle
+    PERMISSIONS_PAR_ROLE = {
+        'auditeur': {
+            'can_view_dashboard': True,
+            'can_view_departments': True,
+            'can_view_notifications': True,
+            'can_manage_audit': True,
+            'can_view_action_plans': True,
+        },
+        'utilisateur': {
+            'can_view_dashboard': True,
+            'can_view_departments': True,
+            'can_view_notifications': True,
+            'can_view_action_plans': True,
+        },
+        'compliance': {
+            'can_view_dashboard': True,
+            'can_view_departments': True,
+            'can_view_notifications': True,
+            'can_manage_regulatory': True,
+        },
+        'consultant': {
+            'can_view_dashboard': True,
+            'can_view_departments': True,
+        }
+    }
+
+    @staticmethod
+    def resoudre_permission(role, is_client_admin, permissions, permission):
+        """Valeur d'une permission à partir du rôle et des permissions explicites"""
         # 1. SUPER ADMIN : TOUJOURS AUTORISÉ
-        if self.role == 'super_admin':
-            print(f"   ✅ Super admin - accès immédiat")
+        if role == 'super_admin':
             return True
-        
-        # 2. Vérifier d'abord les permissions EXPLICITES dans la base
-        if self.permissions and permission in self.permissions:
-            value = bool(self.permissions[permission])
-            print(f"   📋 Permission explicite dans DB: {permission} = {value}")
-            return value
-        
+
+        # 2. Permissions EXPLICITES dans la base
+        if permissions and permission in permissions:
+            return bool(permissions[permission])
+
         # 3. ADMIN CLIENT : Permissions automatiques
-        is_admin_client = (self.role == 'admin') or (getattr(self, 'is_client_admin', False))
-        
-        if is_admin_client:
-            print(f"   👑 Utilisateur est un ADMIN CLIENT")
-            
-            permissions_admin_obligatoires = {
-                'can_view_dashboard': True,
-                'can_view_departments': True,
-                'can_view_notifications': True,
-                'can_manage_risks': True,
-                'can_validate_risks': True,
-                'can_manage_kri': True,
-                'can_manage_audit': True,
-                'can_confirm_evaluations': True,
-                'can_manage_action_plans': True,
-                'can_view_action_plans': True,
-                'can_view_users_list': True,
-                'can_edit_users': True,
-                'can_manage_users': True,
-                'can_create_users': True,
-                'can_deactivate_users': True,
-                'can_delete_users': True,
-                'can_manage_departments': True,
-                'can_access_all_departments': True,
-                'can_manage_settings': True,
-                'can_archive_data': True,
-                'can_export_data': True,
-                'can_manage_permissions': True,
-                # 🔥 NOUVEAUX MODULES
-                'can_view_tableau_bord_strategique': True,
-                'can_view_controle_interne_n2': True,
-                'can_manage_controle_interne_n2': True,
-                'can_manage_clients': False,
-                'can_provision_servers': False,
-            }
-            
-            if permission in permissions_admin_obligatoires:
-                return permissions_admin_obligatoires[permission]
-        
+        if (role == 'admin' or is_client_admin) and permission in User.PERMISSIONS_ADMIN_CLIENT:
+            return User.PERMISSIONS_ADMIN_CLIENT[permission]
+
         # 4. GESTIONNAIRE (manager)
-        if self.role == 'manager':
-            print(f"   👤 Utilisateur est un GESTIONNAIRE")
-            
-            if self.permissions and permission in self.permissions:
-                return bool(self.permissions[permission])
-            
-            manager_defaults = {
-                'can_view_dashboard': True,
-                'can_view_departments': True,
-                'can_view_notifications': True,
-                'can_view_action_plans': True,
-                'can_export_data': True,
-                'can_view_tableau_bord_strategique': False,  # Optionnel
-                'can_view_controle_interne_n2': False,       # Optionnel
-                'can_manage_controle_interne_n2': False,  
-            }
-            
-            if permission in manager_defaults:
-                return manager_defaults[permission]
-            
-            return False
-        
+        if role == 'manager':
+            return User.PERMISSIONS_MANAGER.get(permission, False)
+
         # 5. PERMISSIONS PAR DÉFAUT SELON LE RÔLE
-        role_defaults = {
-            'auditeur': {
-                'can_view_dashboard': True,
-                'can_view_departments': True,
-                'can_view_notifications': True,
-                'can_manage_audit': True,
-                'can_view_action_plans': True,
-            },
-            'utilisateur': {
-                'can_view_dashboard': True,
-                'can_view_departments': True,
-                'can_view_notifications': True,
-                'can_view_action_plans': True,
-            },
-            'compliance': {
-                'can_view_dashboard': True,
-                'can_view_departments': True,
-                'can_view_notifications': True,
-                'can_manage_regulatory': True,
-            },
-            'consultant': {
-                'can_view_dashboard': True,
-                'can_view_departments': True,
-            }
+        return User.PERMISSIONS_PAR_ROLE.get(role, {}).get(permission, False)
+
+    @staticmethod
+    def permissions_effectives_pour(role, is_client_admin, permissions):
+        """{permission: bool} pour toutes les permissions connues (hors super admin)"""
+        connues = set(permissions or {}) | set(User.PERMISSIONS_ADMIN_CLIENT) | set(User.PERMISSIONS_MANAGER)
+        for defauts in User.PERMISSIONS_PAR_ROLE.values():
+            connues.update(defauts)
+        return {
+            permission: User.resoudre_permission(role, is_client_admin, permissions, permission)
+            for permission in connues
         }
+
+    def has_permission(self, permission):
+        """Vérifie si l'utilisateur a une permission spécifique"""
         
-        if self.role in role_defaults and permission in role_defaults[self.role]:
-            return role_defaults[self.role][permission]
+        print(f"🔐 [DEBUG] Vérification permission '{permission}' pour {self.username} (rôle: {self.role})")
         
-        print(f"   ❌ Permission '{permission}' REFUSÉE")
-        return False
+        valeur = User.resoudre_permission(self.role, getattr(self, 'is_client_admin', False),
+                                          self.permissions, permission)
+        if not valeur:
+            print(f"   ❌ Permission '{permission}' REFUSÉE")
+        return valeur
 
     @property
     def est_operateur(self):
@@ -685,6 +688,10 @@ class User(UserMixin, db.Model):
             Notification.created_at.desc()
         ).limit(limit).all()
     
+    @property
+    def client_nom(self):
+        return self.client.nom if self.client else None
+
     def get_role_display_name(self):
         role_names = {
             'admin': 'Administrateur',
@@ -921,16 +928,13 @@ class Pole(db.Model):
     
     @property
     def nb_directions(self):
-        return len([d for d in self.directions if not d.is_archived and d.is_active])
+        from services.hierarchie_service import HierarchieService
+        return HierarchieService.compter_organisation('pole', [self.id])[self.id]['directions']
     
     @property
     def nb_services(self):
-        total = 0
-        for direction in self.directions:
-            if not direction.is_archived and direction.is_active:
-                total += len([s for s in direction.services 
-                             if not s.is_archived and s.is_active])
-        return total
+        from services.hierarchie_service import HierarchieService
+        return HierarchieService.compter_organisation('pole', [self.id])[self.id]['services']
     
     @property
     def pays_nom(self):
@@ -973,14 +977,38 @@ class Pays(db.Model):
     
     @property
     def nb_directions(self):
-        total = 0
-        for pole in self.poles:
-            if not pole.is_archived:
-                total += len([d for d in pole.directions if not d.is_archived and d.is_active])
-        return total
+        from services.hierarchie_service import HierarchieService
+        return HierarchieService.compter_organisation('pays', [self.id])[self.id]['directions']
 
 
 
+# -------------------- HIÉRARCHIES (TABLE DE FERMETURE) --------------------
+class HierarchieFermeture(db.Model):
+    """
+    Table de fermeture (closure table) des hiérarchies :
+    - arbre 'processus' : Processus -> sous-processus
+    - arbre 'organisation' : Pays -> Pôle -> Direction -> Service
+    Une ligne par couple (ancêtre, descendant), y compris (noeud, noeud, 0).
+    Maintenue par services/hierarchie_service.py.
+    """
+    __tablename__ = 'hierarchie_fermeture'
+    __table_args__ = (
+        db.Index('ix_hierarchie_descendant', 'type_descendant', 'descendant_id'),
+        db.Index('ix_hierarchie_ancetre_profondeur', 'type_ancetre', 'ancetre_id', 'profondeur'),
+    )
+
+    type_ancetre = db.Column(db.String(20), primary_key=True)  # processus, pays, pole, direction, service
+    ancetre_id = db.Column(db.Integer, primary_key=True)
+    type_descendant = db.Column(db.String(20), primary_key=True)
+    descendant_id = db.Column(db.Integer, primary_key=True)
+    profondeur = db.Column(db.Integer, nullable=False, default=0)
+    client_id = db.Column(db.Integer, db.ForeignKey('clients.id'), nullable=True, index=True)
+
+    def __repr__(self):
+        return (f'<HierarchieFermeture {self.type_ancetre}:{self.ancetre_id} -> '
+                f'{self.type_descendant}:{self.descendant_id} ({self.profondeur})>')
+
+
 # -------------------- CONFIGURATION ORGANIGRAMME --------------------
 class ConfigurationOrganigramme(db.Model):
     """Configuration de l'organigramme pour chaque client"""
@@ -1002,6 +1030,9 @@ class ConfigurationOrganigramme(db.Model):
 
 class Cartographie(db.Model):
     __tablename__ = 'cartographie'
+    __table_args__ = (
+        db.Index('ix_cartographie_client_archived', 'client_id', 'is_archived'),
+    )
     
     # ============================================
     # COLONNES EXISTANTES
@@ -1225,13 +1256,24 @@ class Cartographie(db.Model):
     
     @property
     def hierarchie_complete(self):
-        parts = []
-        if self.pole:
-            parts.append(self.pole.nom)
-        if self.direction:
-            parts.append(self.direction.nom)
-        if self.service:
-            parts.append(self.service.nom)
+        from services.hierarchie_service import HierarchieService
+        
+        # Chemin Pôle > Direction > Service en une requête via la table de fermeture
+        if self.service_id:
+            parts = HierarchieService.chemin_noms('service', self.service_id, types=('pole', 'direction', 'service'))
+        elif self.direction_id:
+            parts = HierarchieService.chemin_noms('direction', self.direction_id, types=('pole', 'direction'))
+        else:
+            parts = None
+        
+        if not parts:
+            parts = []
+            if self.pole:
+                parts.append(self.pole.nom)
+            if self.direction:
+                parts.append(self.direction.nom)
+            if self.service:
+                parts.append(self.service.nom)
         return " > ".join(parts)
     
     @property
@@ -1327,6 +1369,10 @@ test_risques = db.Table('test_risques',
 
 class Risque(db.Model):
     __tablename__ = 'risques'
+    __table_args__ = (
+        db.Index('ix_risques_client_archived', 'client_id', 'is_archived'),
+        db.Index('ix_risques_cartographie_archived', 'cartographie_id', 'is_archived'),
+    )
     
     # ============================================
     # COLONNES DE BASE
@@ -1394,6 +1440,7 @@ class Risque(db.Model):
     createur = db.relationship('User', foreign_keys=[created_by])
     archive_user = db.relationship('User', foreign_keys=[archived_by])
     evaluations = db.relationship('EvaluationRisque', back_populates='risque', lazy=True)
+    etat_courant = db.relationship('RisqueEtatCourant', uselist=False, viewonly=True, lazy=True)
     kri = db.relationship('KRI', back_populates='risque', uselist=False, lazy=True)
     dispositifs_maitrise = db.relationship('DispositifMaitrise', back_populates='risque', cascade='all, delete-orphan', lazy=True)
     
@@ -1466,6 +1513,15 @@ class Risque(db.Model):
     
     @property
     def derniere_evaluation(self):
+        # Évaluations déjà chargées : pas de requête supplémentaire. Sur les listes,
+        # charger l'état courant et sa dernière évaluation avec les risques :
+        # selectinload(Risque.etat_courant).joinedload(RisqueEtatCourant.derniere_evaluation)
+        etat = self.etat_courant if 'evaluations' not in self.__dict__ else None
+        if etat is not None:
+            if not etat.derniere_evaluation_id:
+                return None
+            if etat.derniere_evaluation is not None:
+                return etat.derniere_evaluation
         if self.evaluations:
             return max(self.evaluations, key=lambda x: x.created_at)
         return None
@@ -1641,6 +1697,9 @@ class Risque(db.Model):
 
 class EvaluationRisque(db.Model):
     __tablename__ = 'evaluations_risque'
+    __table_args__ = (
+        db.Index('ix_evaluations_risque_risque_created', 'risque_id', db.text('created_at DESC')),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     risque_id = db.Column(db.Integer, db.ForeignKey('risques.id'), nullable=False)
@@ -2021,6 +2080,48 @@ class EvaluationRisque(db.Model):
     def __repr__(self):
         return f'<EvaluationRisque {self.id} pour risque {self.risque_id}>'
 
+
+class RisqueEtatCourant(db.Model):
+    """
+    État courant de chaque risque : dernière évaluation confirmée ou validée
+    (à défaut la dernière évaluation) et ses valeurs finales. Recalculé par
+    RisqueEtatCourantService dans la transaction qui écrit une évaluation.
+    """
+    __tablename__ = 'risque_etat_courant'
+    
+    risque_id = db.Column(db.Integer, db.ForeignKey('risques.id', ondelete='CASCADE'), primary_key=True)
+    client_id = db.Column(db.Integer, db.ForeignKey('clients.id', ondelete='CASCADE'))
+    
+    # Évaluation retenue et dernière évaluation saisie (peuvent différer)
+    evaluation_id = db.Column(db.Integer)
+    derniere_evaluation_id = db.Column(db.Integer)
+    phase = db.Column(db.String(20))  # 'confirmee', 'validee' ou 'pre_evaluation'
+    nb_evaluations = db.Column(db.Integer, default=0)
+    
+    # Valeurs finales (confirmation > validation > pré-évaluation)
+    impact = db.Column(db.Integer)
+    probabilite = db.Column(db.Integer)
+    niveau_maitrise = db.Column(db.Integer)
+    score_risque = db.Column(db.Integer)
+    niveau_risque = db.Column(db.String(20))
+    date_evaluation = db.Column(db.DateTime)
+    
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('idx_risque_etat_courant_client', 'client_id', 'niveau_risque'),
+    )
+    
+    # Dernière évaluation saisie (Risque.derniere_evaluation)
+    derniere_evaluation = db.relationship(
+        'EvaluationRisque',
+        primaryjoin='foreign(RisqueEtatCourant.derniere_evaluation_id) == EvaluationRisque.id',
+        viewonly=True, lazy=True
+    )
+    
+    def __repr__(self):
+        return f'<RisqueEtatCourant risque {self.risque_id} ({self.niveau_risque})>'
+
 class CampagneEvaluation(db.Model):
     __tablename__ = 'campagnes_evaluation'
     
@@ -2072,6 +2173,10 @@ class CampagneEvaluation(db.Model):
 # -------------------- KRI (CORRIGÉ) --------------------
 class KRI(db.Model):
     __tablename__ = 'kri'
+    __table_args__ = (
+        db.Index('ix_kri_client', 'client_id'),
+        db.Index('ix_kri_risque', 'risque_id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     
@@ -2475,6 +2580,9 @@ class KRI(db.Model):
 # -------------------- MESURE KRI --------------------
 class MesureKRI(db.Model):
     __tablename__ = 'mesure_kri'
+    __table_args__ = (
+        db.Index('ix_mesure_kri_kri_date', 'kri_id', db.text('date_mesure DESC')),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     kri_id = db.Column(db.Integer, db.ForeignKey('kri.id'))
@@ -2488,6 +2596,134 @@ class MesureKRI(db.Model):
     createur = db.relationship('User', back_populates='mesures_prises', foreign_keys=[created_by])
     client_id = db.Column(db.Integer, db.ForeignKey('clients.id'), nullable=True)
 
+
+class AgregatMesureKRI(db.Model):
+    """
+    Agrégat horaire ou journalier des mesures collectées automatiquement et
+    purgées par la politique de rétention (SeriesTemporellesKRI). Les séries
+    sur de longues périodes lisent ces agrégats à la place des mesures brutes.
+    """
+    __tablename__ = 'agregats_mesure_kri'
+
+    kri_id = db.Column(db.Integer, db.ForeignKey('kri.id', ondelete='CASCADE'), primary_key=True)
+    granularite = db.Column(db.String(10), primary_key=True)  # 'heure' ou 'jour'
+    debut = db.Column(db.DateTime, primary_key=True)  # début de l'heure / du jour
+    client_id = db.Column(db.Integer, db.ForeignKey('clients.id'), nullable=True, index=True)
+
+    nb_mesures = db.Column(db.Integer, nullable=False, default=0)
+    valeur_min = db.Column(db.Float)
+    valeur_max = db.Column(db.Float)
+    somme = db.Column(db.Float, default=0)
+    somme_carres = db.Column(db.Float, default=0)
+    derniere_valeur = db.Column(db.Float)
+    derniere_date = db.Column(db.DateTime)
+
+    @property
+    def moyenne(self):
+        return self.somme / self.nb_mesures if self.nb_mesures else None
+
+    def __repr__(self):
+        return f'<AgregatMesureKRI {self.kri_id} {self.granularite} {self.debut}>'
+
+
+class EtatSeuilKRI(db.Model):
+    """
+    État de seuil courant de chaque KRI (normal, alerte, critique ; libellés
+    KPI pour les indicateurs de performance), tenu à jour par
+    EvaluateurSeuilsKRI à chaque nouvelle mesure. Seuls les changements
+    d'état produisent une alerte et une notification.
+    """
+    __tablename__ = 'etats_seuil_kri'
+
+    kri_id = db.Column(db.Integer, db.ForeignKey('kri.id', ondelete='CASCADE'), primary_key=True)
+    client_id = db.Column(db.Integer, db.ForeignKey('clients.id'), nullable=True, index=True)
+
+    etat = db.Column(db.String(20), nullable=False, default='inconnu')
+    mesure_id = db.Column(db.Integer)  # mesure qui a fixé l'état
+    valeur = db.Column(db.Float)
+    date_mesure = db.Column(db.DateTime)
+    depuis = db.Column(db.DateTime, default=datetime.utcnow)  # date du dernier changement d'état
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<EtatSeuilKRI {self.kri_id} {self.etat}>'
+
+
+class NotificationSeuilKRI(db.Model):
+    """
+    Franchissement de seuil KRI en attente de notification. Écrit dans la
+    transaction de la mesure par EvaluateurSeuilsKRI, lu et supprimé par la
+    tâche planifiée qui envoie les notifications regroupées par destinataire.
+    """
+    __tablename__ = 'notifications_seuil_kri'
+
+    id = db.Column(db.Integer, primary_key=True)
+    kri_id = db.Column(db.Integer, db.ForeignKey('kri.id', ondelete='CASCADE'), nullable=False)
+    client_id = db.Column(db.Integer, db.ForeignKey('clients.id'), nullable=True)
+    destinataire_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
+
+    nom = db.Column(db.String(200))
+    unite_mesure = db.Column(db.String(50))
+    precedent = db.Column(db.String(20))
+    etat = db.Column(db.String(20), nullable=False)
+    valeur = db.Column(db.Float)
+    date_mesure = db.Column(db.DateTime)
+    seuil_alerte = db.Column(db.Float)
+    seuil_critique = db.Column(db.Float)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<NotificationSeuilKRI {self.kri_id} {self.etat} -> {self.destinataire_id}>'
+
+
+class VersionAnalytiqueKRI(db.Model):
+    """
+    Version des mesures et seuils KRI d'un client, incrémentée dans la
+    transaction de chaque écriture. Les workers comparent leur cache
+    AnalytiqueKRI à cette version partagée avant de le servir.
+    """
+    __tablename__ = 'versions_analytique_kri'
+
+    # Identifiant du client ; 0 pour les KRI sans client, -1 pour une invalidation globale
+    client_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<VersionAnalytiqueKRI {self.client_id} v{self.version}>'
+
+
+class EtatAnomalieKRI(db.Model):
+    """
+    Références statistiques d'un KRI collecté automatiquement, mises à jour
+    à chaque valeur acceptée par DetecteurAnomaliesKRI : fenêtre glissante
+    des dernières valeurs, moyenne et variance exponentielles (EWMA) et
+    référence saisonnière par créneau (heure du jour ou jour de semaine).
+    """
+    __tablename__ = 'etats_anomalie_kri'
+
+    kri_id = db.Column(db.Integer, db.ForeignKey('kri.id', ondelete='CASCADE'), primary_key=True)
+    client_id = db.Column(db.Integer, db.ForeignKey('clients.id'), nullable=True, index=True)
+
+    saison = db.Column(db.String(20), nullable=False, default='jour_semaine')  # heure, jour_semaine, aucune
+    nb_valeurs = db.Column(db.Integer, nullable=False, default=0)  # valeurs acceptées depuis la dernière rupture
+    nb_consecutives = db.Column(db.Integer, nullable=False, default=0)  # anomalies consécutives en cours
+
+    fenetre = db.Column(db.JSON, default=list)  # dernières valeurs acceptées, de la plus ancienne à la plus récente
+    ewma_moyenne = db.Column(db.Float)
+    ewma_variance = db.Column(db.Float)
+    saison_moyenne = db.Column(db.JSON, default=list)  # par créneau
+    saison_variance = db.Column(db.JSON, default=list)
+    saison_nb = db.Column(db.JSON, default=list)
+
+    derniere_valeur = db.Column(db.Float)
+    derniere_date = db.Column(db.DateTime)
+    dernier_score = db.Column(db.Float)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<EtatAnomalieKRI {self.kri_id} n={self.nb_valeurs}>'
+
 # -------------------- SOUS-ETAPE PROCESSUS --------------------
 class SousEtapeProcessus(db.Model):
     __tablename__ = 'sous_etape_processus'
@@ -3300,11 +3536,16 @@ class Processus(db.Model):
     # ============================================
     
     def get_chemin_complet(self):
-        chemin = [self.nom]
-        parent = self.processus_parent
-        while parent:
-            chemin.insert(0, parent.nom)
-            parent = parent.processus_parent
+        from services.hierarchie_service import HierarchieService
+        
+        # Fil d'Ariane en une requête via la table de fermeture
+        chemin = HierarchieService.chemin_noms('processus', self.id) if self.id else None
+        if not chemin:
+            chemin = [self.nom]
+            parent = self.processus_parent
+            while parent:
+                chemin.insert(0, parent.nom)
+                parent = parent.processus_parent
         return " > ".join(chemin)
     
     def get_etapes_ordonnees(self):
@@ -3651,6 +3892,7 @@ class Audit(db.Model):
     # ============================================
     __table_args__ = (
         db.UniqueConstraint('reference', 'client_id', name='uix_audit_reference_client'),
+        db.Index('ix_audits_client_archived', 'client_id', 'is_archived'),
     )
     
     # ============================================
@@ -3673,80 +3915,36 @@ class Audit(db.Model):
             return self.processus_concerne
         return "Non spécifié"
     
+    @property
+    def kpi(self):
+        """Indicateurs d'avancement (calcul groupé, mémorisé pour la requête, voir AuditKPIService)"""
+        from services.audit_kpi_service import AuditKPIService
+        return AuditKPIService.pour_audit(self)
+    
     @property
     def progression_globale(self):
         """Progression globale de l'audit basée sur les constatations"""
-        if not self.constatations:
-            return 0
-        
-        points_obtenus = 0
-        for constat in self.constatations:
-            if constat.statut == 'clos':
-                points_obtenus += 100
-            elif constat.statut == 'en_action':
-                points_obtenus += 50
-            elif constat.statut == 'a_valider':
-                points_obtenus += 25
-        
-        total_points = len(self.constatations) * 100
-        if total_points == 0:
-            return 0
-        
-        progression = (points_obtenus / total_points) * 100
-        return round(progression, 2)
+        return self.kpi['progression_globale']
     
     @property
     def taux_realisation_recommandations(self):
         """Taux de réalisation des recommandations"""
-        if not self.recommandations:
-            return 0
-        
-        recommandations_terminees = sum(1 for r in self.recommandations if r.statut == 'termine')
-        taux = (recommandations_terminees / len(self.recommandations)) * 100 if self.recommandations else 0
-        return round(taux, 2)
+        return self.kpi['taux_realisation_recommandations']
     
     @property
     def taux_realisation_plans(self):
         """Taux de réalisation des plans d'action"""
-        if not self.plans_action:
-            return 0
-        
-        plans_termines = len([p for p in self.plans_action if p.statut == 'termine'])
-        taux = (plans_termines / len(self.plans_action)) * 100
-        return round(taux, 2)
+        return self.kpi['taux_realisation_plans']
     
     @property
     def score_global(self):
         """Score global de l'audit - Moyenne pondérée"""
-        if not self.constatations and not self.recommandations and not self.plans_action:
-            return 0
-        
-        poids = {
-            'progression': 0.4,
-            'recommandations': 0.4,
-            'plans': 0.2
-        }
-        
-        score = (
-            self.progression_globale * poids['progression'] +
-            self.taux_realisation_recommandations * poids['recommandations'] +
-            self.taux_realisation_plans * poids['plans']
-        )
-        
-        return min(round(score, 2), 100)
+        return self.kpi['score_global']
     
     @property
     def couleur_progression(self):
         """Retourne la couleur Bootstrap en fonction du score"""
-        score = self.score_global
-        if score >= 80:
-            return 'success'
-        elif score >= 60:
-            return 'info'
-        elif score >= 40:
-            return 'warning'
-        else:
-            return 'danger'
+        return self.kpi['couleur_progression']
     
     @property
     def pourcentage_completion(self):
@@ -3978,10 +4176,20 @@ class Audit(db.Model):
     
     def get_risques_avec_contexte_grc(self):
         """Retourne les risques avec leur contexte GRC complet"""
-        from models import DispositifMaitrise, ControleProcessus
+        from models import DispositifMaitrise, ControleProcessus, Risque, RisqueEtatCourant
+        from sqlalchemy.orm import selectinload
+        
+        risques = self.get_risques_lies()
+        if risques:
+            # États courants et dernières évaluations en une requête (Risque.derniere_evaluation)
+            Risque.query.options(
+                selectinload(Risque.etat_courant).joinedload(RisqueEtatCourant.derniere_evaluation)
+            ).filter(
+                Risque.id.in_([risque.id for risque in risques])
+            ).all()
         
         result = []
-        for risque in self.get_risques_lies():
+        for risque in risques:
             # Récupérer les DMR
             dispositifs = DispositifMaitrise.query.filter_by(
                 risque_id=risque.id,
@@ -4204,6 +4412,7 @@ class Constatation(db.Model):
     # ============================================
     __table_args__ = (
         db.UniqueConstraint('reference', 'client_id', name='uix_constatation_reference_client'),
+        db.Index('ix_constatations_client_archived', 'client_id', 'is_archived'),
     )
     
     # ============================================
@@ -4681,16 +4890,13 @@ class DemandeReevaluation(db.Model):
         return True
     
     def _ajouter_historique(self, action, user_id, details):
-        """Ajoute une entrée dans l'historique"""
-        user_nom = User.query.get(user_id).username if user_id else 'Système'
-        
-        self.historique_actions.append({
-            'date': datetime.utcnow().isoformat(),
-            'action': action,
-            'utilisateur_id': user_id,
-            'utilisateur_nom': user_nom,
-            'details': details
-        })
+        """Ajoute une entrée dans le journal d'événements"""
+        JournalEvenement.enregistrer(self, action, user_id, details,
+                                     ancien_statut=None, nouveau_statut=self.statut)
+    
+    def get_historique(self, page=1, par_page=50, plus_recents_dabord=True):
+        """Historique paginé (plus récents d'abord)"""
+        return JournalEvenement.lister(self.__tablename__, self.id, page, par_page, plus_recents_dabord)
     
     def get_statut_label(self):
         labels = {
@@ -4749,7 +4955,7 @@ class DemandeReevaluation(db.Model):
             'date_validation': self.date_validation.isoformat() if self.date_validation else None,
             'recommandations': self.recommandations_generees,
             'nouvelle_evaluation_id': self.nouvelle_evaluation_id,
-            'historique': self.historique_actions,
+            'historique': self.get_historique(par_page=None, plus_recents_dabord=False) if self.id else [],
             'created_at': self.created_at.isoformat() if self.created_at else None,
             'updated_at': self.updated_at.isoformat() if self.updated_at else None
         }
@@ -6382,6 +6588,8 @@ class PlanAction(db.Model):
     # ===== CONTRAINTE UNIQUE COMPOSITE =====
     __table_args__ = (
         db.UniqueConstraint('reference', 'client_id', name='uix_planaction_reference_client'),
+        db.Index('ix_plans_action_client_archived', 'client_id', 'is_archived'),
+        db.Index('ix_plans_action_risque', 'risque_id'),
     )
     
     # ===== MÉTHODE STATIQUE DE GÉNÉRATION =====
@@ -6899,6 +7107,98 @@ class HistoriqueModification(db.Model):
     
     utilisateur = db.relationship('User')
 
+# -------------------- JOURNAL D'ÉVÉNEMENTS --------------------
+class JournalEvenement(db.Model):
+    """
+    Journal append-only des actions sur les entités (workflows, demandes...).
+    Une ligne par événement : l'écriture est un simple INSERT, la lecture
+    est paginée par (type_entite, entite_id, created_at).
+    """
+    __tablename__ = 'journal_evenements'
+    
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True)
+    type_entite = db.Column(db.String(50), nullable=False)
+    entite_id = db.Column(db.Integer, nullable=False)
+    action = db.Column(db.String(50), nullable=False)
+    ancien_statut = db.Column(db.String(50))
+    nouveau_statut = db.Column(db.String(50))
+    details = db.Column(db.Text)
+    donnees = db.Column(db.JSON)
+    utilisateur_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    client_id = db.Column(db.Integer, db.ForeignKey('clients.id'), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    
+    utilisateur = db.relationship('User')
+    
+    __table_args__ = (
+        db.Index('ix_journal_evenements_entite', 'type_entite', 'entite_id', 'created_at'),
+    )
+    
+    @classmethod
+    def enregistrer(cls, entite, action, utilisateur_id=None, details=None,
+                    ancien_statut=None, nouveau_statut=None, donnees=None, date=None):
+        """Ajoute un événement pour une entité (objet du modèle) dans la transaction courante"""
+        if entite.id is None:
+            db.session.flush()
+        
+        evenement = cls(
+            type_entite=entite.__tablename__,
+            entite_id=entite.id,
+            action=action,
+            ancien_statut=ancien_statut,
+            nouveau_statut=nouveau_statut,
+            details=details,
+            donnees=donnees,
+            utilisateur_id=utilisateur_id,
+            client_id=getattr(entite, 'client_id', None),
+            created_at=date or datetime.utcnow()
+        )
+        db.session.add(evenement)
+        return evenement
+    
+    @classmethod
+    def requete(cls, type_entite, entite_id):
+        return cls.query.filter_by(type_entite=type_entite, entite_id=entite_id)
+    
+    @classmethod
+    def lister(cls, type_entite, entite_id, page=1, par_page=50, plus_recents_dabord=True):
+        """Page d'événements d'une entité (tous si par_page est None), noms d'utilisateurs résolus par jointure"""
+        ordre = (cls.created_at.desc(), cls.id.desc()) if plus_recents_dabord else (cls.created_at, cls.id)
+        requete = (
+            db.session.query(cls, User.username)
+            .outerjoin(User, User.id == cls.utilisateur_id)
+            .filter(cls.type_entite == type_entite, cls.entite_id == entite_id)
+            .order_by(*ordre)
+        )
+        if par_page:
+            requete = requete.offset((max(page, 1) - 1) * par_page).limit(par_page)
+        return [evenement.to_dict(username) for evenement, username in requete.all()]
+    
+    @classmethod
+    def compter(cls, type_entite, entite_id):
+        return cls.requete(type_entite, entite_id).count()
+    
+    def to_dict(self, utilisateur_nom=None):
+        """Format compatible avec les anciens historiques JSON"""
+        return {
+            'id': self.id,
+            'date': self.created_at.isoformat() if self.created_at else None,
+            'action': self.action,
+            'utilisateur_id': self.utilisateur_id,
+            'utilisateur_nom': utilisateur_nom or (self.utilisateur.username if self.utilisateur else 'Système'),
+            'details': self.details,
+            'commentaire': self.details,
+            'ancien_statut': self.ancien_statut,
+            'nouveau_statut': self.nouveau_statut,
+            'ancienne_etape': self.ancien_statut,
+            'nouvelle_etape': self.nouveau_statut,
+            'donnees': self.donnees
+        }
+    
+    def __repr__(self):
+        return f'<JournalEvenement {self.type_entite}#{self.entite_id} {self.action}>'
+
+
 # -------------------- ALERTE --------------------
 class Alerte(db.Model):
     __tablename__ = 'alertes'
@@ -7507,7 +7807,46 @@ class FichierKRI(db.Model):
     # Relations
     kri = db.relationship('KRI', backref=db.backref('fichiers', lazy=True))
     uploader = db.relationship('User', foreign_keys=[uploaded_by])
-    
+
+
+class ObjetStocke(db.Model):
+    """Contenu d'un fichier, adressé par son empreinte SHA-256 (stocké une seule fois)"""
+    __tablename__ = 'objets_stockes'
+
+    sha256 = db.Column(db.String(64), primary_key=True)
+    taille = db.Column(db.BigInteger, nullable=False)
+    type_mime = db.Column(db.String(150))
+    backend = db.Column(db.String(20), nullable=False, default='local')
+    nb_references = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<ObjetStocke {self.sha256[:12]} ({self.nb_references} réf.)>'
+
+
+class ReferenceObjet(db.Model):
+    """Utilisation d'un objet stocké par une entité (fichier de risque, incident...)"""
+    __tablename__ = 'references_objets'
+
+    id = db.Column(db.Integer, primary_key=True)
+    sha256 = db.Column(db.String(64), db.ForeignKey('objets_stockes.sha256'), nullable=False, index=True)
+    client_id = db.Column(db.Integer, db.ForeignKey('clients.id'), index=True)
+    entite_type = db.Column(db.String(50), nullable=False)
+    entite_id = db.Column(db.Integer, nullable=False)
+    nom_fichier = db.Column(db.String(255), nullable=False)
+    created_by = db.Column(db.Integer, db.ForeignKey('user.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    objet = db.relationship('ObjetStocke')
+
+    __table_args__ = (
+        db.Index('ix_references_objets_entite', 'entite_type', 'entite_id'),
+    )
+
+    def __repr__(self):
+        return f'<ReferenceObjet {self.entite_type}:{self.entite_id} {self.nom_fichier}>'
+
 # ========================
 # MODÈLES QUESTIONNAIRE (à ajouter à la fin de models.py)
 # ========================
@@ -7714,6 +8053,10 @@ class ReponseQuestionnaire(db.Model):
     reponses = db.relationship('ReponseQuestion', back_populates='reponse_questionnaire', 
                               cascade='all, delete-orphan', lazy=True)
     
+    __table_args__ = (
+        db.Index('ix_reponse_questionnaire_questionnaire', 'questionnaire_id', 'id'),
+    )
+    
     def __repr__(self):
         return f'<ReponseQuestionnaire #{self.id}>'
 
@@ -7742,6 +8085,11 @@ class ReponseQuestion(db.Model):
     reponse_questionnaire = db.relationship('ReponseQuestionnaire', back_populates='reponses')
     question = db.relationship('Question', back_populates='reponses')
     
+    __table_args__ = (
+        db.Index('ix_reponse_question_repondant', 'reponse_questionnaire_id'),
+        db.Index('ix_reponse_question_question', 'question_id'),
+    )
+    
     def get_valeur_formatee(self):
         """Retourne la valeur formatée pour l'affichage"""
         if self.valeur_texte:
@@ -7817,6 +8165,88 @@ class AnalyseIA(db.Model):
     def __repr__(self):
         return f'<AnalyseIA {self.id} - Audit {self.audit_id}>'
 
+
+class ReponseIACache(db.Model):
+    """Cache des réponses IA adressé par contenu (fournisseur + modèle + prompt normalisé)"""
+    __tablename__ = 'reponses_ia_cache'
+    __table_args__ = (
+        db.UniqueConstraint('cle', 'client_id', name='uq_reponse_ia_cle_client'),
+        db.Index('ix_reponses_ia_cache_expires_at', 'expires_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    cle = db.Column(db.String(64), nullable=False, index=True)  # SHA-256 hex
+    fournisseur = db.Column(db.String(50), nullable=False)  # openai, gemini, anthropic, simulation, factice
+    modele = db.Column(db.String(100), nullable=False)
+    prompt_hash = db.Column(db.String(64), nullable=False)
+    reponse = db.Column(db.JSON, nullable=False)
+
+    # Multi-tenant (NULL = cache partagé hors contexte client)
+    client_id = db.Column(db.Integer, db.ForeignKey('clients.id'), nullable=True, index=True)
+
+    nb_hits = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=True)
+    last_hit_at = db.Column(db.DateTime, nullable=True)
+
+    @property
+    def est_expire(self):
+        return self.expires_at is not None and self.expires_at <= datetime.utcnow()
+
+    def __repr__(self):
+        return f'<ReponseIACache {self.fournisseur}/{self.modele} {self.cle[:12]}>'
+
+
+class TacheIA(db.Model):
+    """Tâche IA exécutée en arrière-plan (mode asynchrone avec polling)"""
+    __tablename__ = 'taches_ia'
+
+    id = db.Column(db.String(36), primary_key=True)  # UUID
+    operation = db.Column(db.String(100), nullable=False)
+    statut = db.Column(db.String(20), default='en_attente', index=True)  # en_attente, en_cours, termine, erreur
+    parametres = db.Column(db.JSON, default={})
+    resultat = db.Column(db.JSON, nullable=True)
+    erreur = db.Column(db.Text, nullable=True)
+
+    client_id = db.Column(db.Integer, db.ForeignKey('clients.id'), nullable=True, index=True)
+    created_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'operation': self.operation,
+            'statut': self.statut,
+            'resultat': self.resultat,
+            'erreur': self.erreur,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
+
+    def __repr__(self):
+        return f'<TacheIA {self.id} {self.operation} ({self.statut})>'
+
+
+class GenerationFragment(db.Model):
+    """
+    Génération des données d'une table pour un client, incrémentée dans la
+    transaction de chaque écriture ORM. Lue dans la version des fragments de
+    templates (CacheFragments) quand Redis n'est pas configuré.
+    """
+    __tablename__ = 'generations_fragments'
+
+    table_nom = db.Column(db.String(100), primary_key=True)
+    # Identifiant du client ; 0 pour les lignes sans client
+    client_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    generation = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<GenerationFragment {self.table_nom}:{self.client_id} g{self.generation}>'
+
 class Notification(db.Model):
     __tablename__ = 'notification'
     
@@ -8317,54 +8747,134 @@ class ClientDataFilter:
         RecommandationGlobale
     ]
     
+    # Modèles sans client_id rattachés à un parent qui en a un : (clé étrangère, parent)
+    RELATIONS_CLIENT = {
+        EtapePlanAction: ('plan_action_id', PlanAction),
+        AuditRisque: ('audit_id', Audit),
+        PointDecision: ('processus_id', Processus),
+        ConditionQuestion: ('question_id', Question),
+        HistoriqueModification: ('utilisateur_id', User),
+    }
+    
     @classmethod
-    def apply_client_filter(cls, query, model_class):
-        """Applique automatiquement le filtre client_id à une requête"""
+    def critere_client(cls, model_class, client_id):
+        """
+        Condition SQL limitant model_class aux lignes du client, ou None.
+        Les filtrages indirects passent par une sous-requête (IN (SELECT id ...))
+        évaluée par la base : aucune liste d'ids n'est chargée en Python.
+        """
+        from sqlalchemy import select
         
-        # 1. SUPER ADMIN : PAS DE FILTRE
-        if current_user.is_authenticated and current_user.role == 'super_admin':
-            return query
+        # 1. CLIENT_ID DIRECT
+        if hasattr(model_class, 'client_id'):
+            return model_class.client_id == client_id
         
-        # 2. USER NON CONNECTÉ : PAS DE FILTRE (arrivera à la page login)
-        if not current_user.is_authenticated:
-            return query
+        # 2. RELATION VERS UN MODÈLE DU CLIENT
+        relation = cls.RELATIONS_CLIENT.get(model_class)
+        if relation:
+            colonne, parent = relation
+            critere_parent = cls.critere_client(parent, client_id)
+            if critere_parent is not None:
+                return getattr(model_class, colonne).in_(select(parent.id).where(critere_parent))
         
-        # 3. USER CONNECTÉ AVEC CLIENT_ID
-        client_id = current_user.client_id
+        # 3. CREATED_BY (utilisateur du client)
+        if hasattr(model_class, 'created_by'):
+            return model_class.created_by.in_(cls._client_user_ids_select(client_id))
         
-        # 4. FILTRER PAR CLIENT_ID DIRECT
-        if hasattr(model_class, 'client_id'):
-            return query.filter(model_class.client_id == client_id)
+        return None
+    
+    @classmethod
+    def apply_client_filter(cls, query, model_class):
+        """Applique automatiquement le filtre client à une requête"""
+        from flask_login import current_user
         
-        # 5. FILTRER PAR CREATED_BY (utilisateur du client)
-        if hasattr(model_class, 'created_by'):
-            # Récupérer tous les utilisateurs du même client
-            user_ids = cls._get_client_user_ids(client_id)
-            return query.filter(model_class.created_by.in_(user_ids))
+        # 1. USER NON CONNECTÉ : PAS DE FILTRE (arrivera à la page login)
+        if not current_user.is_authenticated:
+            return query
+        
+        # 2. SUPER ADMIN : PAS DE FILTRE
+        if current_user.role == 'super_admin':
+            return query
         
-        # 6. FILTRER PAR RELATIONS
-        # Pour les modèles qui n'ont pas client_id mais sont liés à un modèle qui en a
-        filter_map = cls._get_filter_mappings(model_class, client_id)
-        if filter_map:
-            return query.filter(*filter_map)
+        # 3. FILTRE PAR CLIENT_ID, RELATION OU CREATED_BY
+        critere = cls.critere_client(model_class, current_user.client_id)
+        if critere is not None:
+            return query.filter(critere)
         
-        # 7. PAR DÉFAUT : retourner la requête originale
+        # 4. PAR DÉFAUT : retourner la requête originale
         return query
     
     @staticmethod
-    def _get_client_user_ids(client_id):
-        """Récupère tous les IDs d'utilisateurs d'un client"""
-        user_ids = User.query.filter_by(client_id=client_id).with_entities(User.id).all()
-        return [uid[0] for uid in user_ids] if user_ids else [-1]  # [-1] pour éviter les résultats
+    def _client_user_ids_select(client_id):
+        """Sous-requête des IDs d'utilisateurs d'un client (évaluée par la base)"""
+        from sqlalchemy import select
+        return select(User.id).where(User.client_id == client_id)
     
     @classmethod
-    def _get_filter_mappings(cls, model_class, client_id):
-        """Mappage des relations pour filtrer indirectement"""
-        mappings = {
-            # Mappages spécifiques si nécessaire
-        }
+    def _get_client_user_ids(cls, client_id):
+        """Récupère tous les IDs d'utilisateurs d'un client (liste Python)"""
+        user_ids = db.session.execute(cls._client_user_ids_select(client_id)).scalars().all()
+        return user_ids or [-1]  # [-1] pour éviter les résultats
+    
+    # ============================================
+    # FILTRAGE GLOBAL (do_orm_execute)
+    # ============================================
+    
+    _filtrage_global_actif = False
+    
+    @staticmethod
+    def _client_id_requete():
+        """
+        (actif, client_id) pour la requête HTTP en cours.
+        Lit l'utilisateur déjà chargé par Flask-Login sans déclencher son
+        chargement (qui repasserait par une requête ORM filtrée).
+        """
+        from flask import g, has_request_context
+        
+        if not has_request_context():
+            return False, None
+        utilisateur = g.get('_login_user')
+        if utilisateur is None or not getattr(utilisateur, 'is_authenticated', False):
+            return False, None
+        if getattr(utilisateur, 'role', None) == 'super_admin':
+            return False, None
+        return True, utilisateur.client_id
+    
+    @classmethod
+    def _filtrer_execution(cls, execute_state):
+        if (not execute_state.is_select
+                or execute_state.is_column_load
+                or execute_state.is_relationship_load
+                or execute_state.execution_options.get('sans_filtre_client', False)):
+            return
         
-        return mappings.get(model_class)
+        actif, client_id = cls._client_id_requete()
+        if not actif:
+            return
+        
+        from sqlalchemy.orm import with_loader_criteria
+        options = []
+        for model_class in cls.CLIENT_MODELS:
+            critere = cls.critere_client(model_class, client_id)
+            if critere is not None:
+                options.append(with_loader_criteria(model_class, critere, include_aliases=True))
+        if options:
+            execute_state.statement = execute_state.statement.options(*options)
+    
+    @classmethod
+    def activer_filtrage_global(cls):
+        """
+        Applique le filtre client à toutes les requêtes ORM SELECT portant sur
+        CLIENT_MODELS (chargements relationnels compris). Contournement ponctuel :
+        query.execution_options(sans_filtre_client=True).
+        """
+        if cls._filtrage_global_actif:
+            return
+        from sqlalchemy import event
+        from sqlalchemy.orm import Session
+        event.listen(Session, 'do_orm_execute', cls._filtrer_execution)
+        cls._filtrage_global_actif = True
+        print(f"✅ Filtrage client global actif sur {len(cls.CLIENT_MODELS)} modèles")
 
 # ====================
 # MODÈLES FORMULES
@@ -8761,22 +9271,23 @@ class FormuleAbonnement(db.Model):
     
     def get_usage_stats(self, client_id=None):
         """Retourne les statistiques d'utilisation"""
-        from models import User, Risque, Audit, Processus, ProcessusActivite
+        from services.quota_service import QuotaService
         
         if client_id:
-            # Pour un client spécifique
-            users_count = User.query.filter_by(client_id=client_id, is_active=True).count()
-            risks_count = Risque.query.filter_by(client_id=client_id, is_archived=False).count()
-            audits_count = Audit.query.filter_by(client_id=client_id, is_archived=False).count()
-            processes_count = Processus.query.filter_by(client_id=client_id).count()
-            logigrammes_count = ProcessusActivite.query.filter_by(client_id=client_id).count()
+            # Pour un client spécifique (compteurs maintenus par QuotaService)
+            usage = QuotaService.usage(client_id)
         else:
             # Pour tous les clients de cette formule
-            users_count = sum(client.nb_utilisateurs or 0 for client in self.clients)
-            risks_count = sum(client.nb_risques or 0 for client in self.clients)
-            audits_count = sum(client.nb_audits or 0 for client in self.clients)
-            processes_count = 0
-            logigrammes_count = 0
+            usage = {}
+            for usage_client in QuotaService.usage_clients([c.id for c in self.clients]).values():
+                for ressource, valeur in usage_client.items():
+                    usage[ressource] = usage.get(ressource, 0) + valeur
+        
+        users_count = usage.get('utilisateurs', 0)
+        risks_count = usage.get('risques', 0)
+        audits_count = usage.get('audits', 0)
+        processes_count = usage.get('processus', 0)
+        logigrammes_count = usage.get('logigrammes', 0)
         
         stats = {
             'utilisateurs': {
@@ -8921,6 +9432,24 @@ class FormuleAbonnement(db.Model):
         return fixes_applied
 
 
+class CompteurUsageClient(db.Model):
+    """
+    Compteurs d'usage par client (utilisateurs actifs, risques, audits...)
+    maintenus par QuotaService dans la transaction de chaque écriture
+    et recalés périodiquement.
+    """
+    __tablename__ = 'compteurs_usage_client'
+    
+    client_id = db.Column(db.Integer, db.ForeignKey('clients.id', ondelete='CASCADE'), primary_key=True)
+    ressource = db.Column(db.String(30), primary_key=True)
+    valeur = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    reconcilie_at = db.Column(db.DateTime)
+    
+    def __repr__(self):
+        return f'<CompteurUsageClient client={self.client_id} {self.ressource}={self.valeur}>'
+
+
 class AbonnementClient(db.Model):
     """Historique et détails d'abonnement d'un client"""
     __tablename__ = 'abonnements_client'
@@ -15685,29 +16214,13 @@ class WorkflowApprobation(db.Model):
         return True
     
     def _ajouter_historique(self, ancienne, nouvelle, user_id, commentaire):
-        """Ajouter une entrée dans l'historique"""
-        from models import User
-        from datetime import datetime
-        
-        if not self.historique_etapes:
-            self.historique_etapes = []
-        
-        # Récupérer le nom de l'utilisateur
-        user = User.query.get(user_id)
-        utilisateur_nom = user.username if user else 'Système'
-        
-        self.historique_etapes.append({
-            'date': datetime.utcnow().isoformat(),
-            'ancienne_etape': ancienne,
-            'nouvelle_etape': nouvelle,
-            'utilisateur_id': user_id,
-            'utilisateur_nom': utilisateur_nom,
-            'commentaire': commentaire
-        })
-        
-        # Garder seulement les 50 derniers
-        if len(self.historique_etapes) > 50:
-            self.historique_etapes = self.historique_etapes[-50:]
+        """Ajouter une entrée dans le journal d'événements"""
+        JournalEvenement.enregistrer(self, 'transition', user_id, commentaire,
+                                     ancien_statut=ancienne, nouveau_statut=nouvelle)
+    
+    def get_historique(self, page=1, par_page=50, plus_recents_dabord=True):
+        """Historique paginé des étapes (plus récentes d'abord)"""
+        return JournalEvenement.lister(self.__tablename__, self.id, page, par_page, plus_recents_dabord)
     
     # ============================================
     # MÉTHODES POUR LES APPROBATEURS SPÉCIFIQUES
@@ -15959,7 +16472,7 @@ class WorkflowApprobation(db.Model):
             'etape_couleur': self.get_couleur_etape(),
             'etape_icone': self.get_etape_icone(),
             'progression': self.get_progression_pourcentage(),
-            'historique': self.historique_etapes,
+            'historique': self.get_historique(par_page=None, plus_recents_dabord=False) if self.id else [],
             'dates': {
                 'envoi_relecture': self.date_envoi_relecture.isoformat() if self.date_envoi_relecture else None,
                 'approbation_niveau1': self.date_approbation_niveau1.isoformat() if self.date_approbation_niveau1 else None,
@@ -16992,28 +17505,13 @@ class PlanificationControle(db.Model):
     # ============================================
     
     def _ajouter_historique(self, action, user_id, details, ancien_statut=None, nouveau_statut=None):
-        """Ajoute une entrée dans l'historique des actions"""
-        if not self.historique_actions:
-            self.historique_actions = []
-        
-        # Récupérer le nom de l'utilisateur
-        user = User.query.get(user_id)
-        utilisateur_nom = user.username if user else 'Système'
-        
-        entry = {
-            'date': datetime.utcnow().isoformat(),
-            'action': action,
-            'utilisateur_id': user_id,
-            'utilisateur_nom': utilisateur_nom,
-            'details': details,
-            'ancien_statut': ancien_statut,
-            'nouveau_statut': nouveau_statut
-        }
-        self.historique_actions.append(entry)
-        
-        # Garder seulement les 100 derniers
-        if len(self.historique_actions) > 100:
-            self.historique_actions = self.historique_actions[-100:]
+        """Ajoute une entrée dans le journal d'événements (INSERT, sans réécrire la ligne)"""
+        JournalEvenement.enregistrer(self, action, user_id, details,
+                                     ancien_statut=ancien_statut, nouveau_statut=nouveau_statut)
+    
+    def get_historique(self, page=1, par_page=50, plus_recents_dabord=True):
+        """Historique paginé des actions (plus récentes d'abord)"""
+        return JournalEvenement.lister(self.__tablename__, self.id, page, par_page, plus_recents_dabord)
     
     def _is_admin_or_manager(self, user):
         """Vérifie si l'utilisateur est admin ou manager"""
@@ -17379,7 +17877,7 @@ class PlanificationControle(db.Model):
                     'raison_rejet': self.raison_rejet,
                     'rouvert_par': self.rouvert_par.username if self.rouvert_par else None,
                     'date_rouverture': self.date_rouverture.isoformat() if self.date_rouverture else None,
-                    'historique': self.historique_actions[-20:] if self.historique_actions else []
+                    'historique': self.get_historique(par_page=20)[::-1] if self.id else []
                 }
             })
         
@@ -18404,6 +18902,82 @@ class NonConformiteC2N(db.Model):
     
     def __repr__(self):
         return f'<NonConformiteC2N {self.reference}>'
+
+
+class MetriqueControle(db.Model):
+    """
+    Agrégats des contrôles C2N par référentiel et par campagne (exécutions,
+    conformité, anomalies, non-conformités, validations). Recalculés par
+    ControleMetriquesService dans la transaction qui modifie une
+    planification, une exécution, une validation ou une non-conformité.
+    """
+    __tablename__ = 'metriques_controle'
+    
+    niveau = db.Column(db.String(20), primary_key=True)  # 'referentiel' ou 'campagne'
+    cle_id = db.Column(db.Integer, primary_key=True)
+    client_id = db.Column(db.Integer, db.ForeignKey('clients.id', ondelete='CASCADE'))
+    
+    # Planifications (hors archivées)
+    nb_planifications = db.Column(db.Integer, default=0)
+    nb_realisees = db.Column(db.Integer, default=0)
+    nb_a_valider = db.Column(db.Integer, default=0)
+    
+    # Exécutions
+    nb_executions = db.Column(db.Integer, default=0)
+    volume_previsionnel = db.Column(db.Integer, default=0)
+    volume_controle = db.Column(db.Integer, default=0)
+    nb_conformes = db.Column(db.Integer, default=0)
+    nb_anomalies = db.Column(db.Integer, default=0)
+    somme_taux = db.Column(db.Float, default=0)
+    nb_taux = db.Column(db.Integer, default=0)
+    nb_validations = db.Column(db.Integer, default=0)
+    
+    # Non-conformités
+    nb_non_conformites = db.Column(db.Integer, default=0)
+    nb_nc_ouvertes = db.Column(db.Integer, default=0)
+    nb_nc_mineures = db.Column(db.Integer, default=0)
+    nb_nc_majeures = db.Column(db.Integer, default=0)
+    nb_nc_critiques = db.Column(db.Integer, default=0)
+    
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('idx_metriques_controle_client', 'client_id', 'niveau'),
+    )
+    
+    @property
+    def taux_conformite(self):
+        """Taux de conformité moyen des exécutions renseignées"""
+        return round(self.somme_taux / self.nb_taux, 1) if self.nb_taux else 0
+    
+    def to_dict(self):
+        return {
+            'niveau': self.niveau,
+            'id': self.cle_id,
+            'nb_planifications': self.nb_planifications,
+            'nb_realisees': self.nb_realisees,
+            'nb_a_valider': self.nb_a_valider,
+            'nb_executions': self.nb_executions,
+            'volume_previsionnel': self.volume_previsionnel,
+            'volume_controle': self.volume_controle,
+            'nb_conformes': self.nb_conformes,
+            'nb_anomalies': self.nb_anomalies,
+            'taux_conformite': self.taux_conformite,
+            'nb_validations': self.nb_validations,
+            'nb_non_conformites': self.nb_non_conformites,
+            'nb_nc_ouvertes': self.nb_nc_ouvertes,
+            'repartition_criticite': {
+                'mineur': self.nb_nc_mineures,
+                'majeur': self.nb_nc_majeures,
+                'critique': self.nb_nc_critiques
+            },
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+        }
+    
+    def __repr__(self):
+        return f'<MetriqueControle {self.niveau}:{self.cle_id}>'
+
+
 class PermissionOperateur(db.Model):
     """Permissions spécifiques pour les opérateurs"""
     __tablename__ = 'permissions_operateur'
@@ -0,0 +1,37 @@
+# routes/__init__.py
+"""
+Registre des blueprints de l'application.
+
+Chaque entrée (module, attribut) est importée au moment de l'enregistrement :
+un blueprint dont les dépendances manquent est signalé sans bloquer le
+démarrage des autres.
+
+Périmètre : il n'y a pas de fabrique d'application et les routes d'app.py
+ne sont pas découpées en blueprints. Seuls les deux blueprints existants
+passent par ce registre ; chaque worker importe toujours app.py en entier
+(preload : une seule fois, dans le maître). Déplacer une route dans un
+blueprint renomme son endpoint (« domaine.nom »), donc chaque url_for des
+templates qui la cite est à mettre à jour dans le même changement.
+"""
+import importlib
+
+BLUEPRINTS = [
+    ('routes.notifications', 'notifications_bp'),
+    ('routes.ia_taches', 'ia_taches_bp'),
+]
+
+
+def enregistrer_blueprints(app, blueprints=None):
+    """Importe et enregistre les blueprints ; retourne les noms enregistrés"""
+    enregistres = []
+    for nom_module, attribut in blueprints or BLUEPRINTS:
+        try:
+            blueprint = getattr(importlib.import_module(nom_module), attribut)
+            if blueprint.name not in app.blueprints:
+                app.register_blueprint(blueprint)
+            enregistres.append(blueprint.name)
+        except Exception as e:
+            print(f"❌ Erreur enregistrement blueprint {nom_module}.{attribut}: {e}")
+
+    print(f"✅ Blueprints enregistrés: {', '.join(enregistres) or 'aucun'}")
+    return enregistres
@@ -0,0 +1,87 @@
+# routes/ia_taches.py - Tâches IA asynchrones (soumission + polling)
+from flask import Blueprint, jsonify, request, url_for
+from flask_login import login_required, current_user
+
+from services.ia_cache_service import IACacheService
+
+ia_taches_bp = Blueprint('ia_taches', __name__)
+
+
+# ==================== OPÉRATIONS DISPONIBLES ====================
+
+def _plan_qualite_complet(titre=''):
+    from services.ia_qualite_service import IAQualiteService
+    return IAQualiteService.generer_plan_complet(titre)
+
+
+def _kris_pour_risque(risque_data=None):
+    from services.kri_ia_service import kri_ia_service
+    return kri_ia_service.generer_kris_pour_risque(risque_data or {})
+
+
+def _analyse_audit(audit_data=None, fournisseur='openai'):
+    from services.api_ia import APIIntegration
+    fonctions = {
+        'openai': APIIntegration.analyser_avec_openai,
+        'gemini': APIIntegration.analyser_avec_gemini,
+        'anthropic': APIIntegration.analyser_avec_anthropic
+    }
+    if fournisseur not in fonctions:
+        raise ValueError(f"Fournisseur IA inconnu: {fournisseur}")
+    return fonctions[fournisseur](audit_data or {})
+
+
+IACacheService.enregistrer_operation('plan_qualite_complet', _plan_qualite_complet)
+IACacheService.enregistrer_operation('kris_risque', _kris_pour_risque)
+IACacheService.enregistrer_operation('analyse_audit', _analyse_audit)
+
+
+def reponse_tache_soumise(tache):
+    """Réponse HTTP 202 standard pour une tâche IA soumise"""
+    return jsonify({
+        'success': True,
+        'tache_id': tache.id,
+        'statut': tache.statut,
+        'url_statut': url_for('ia_taches.statut_tache', tache_id=tache.id)
+    }), 202
+
+
+# ==================== ROUTES ====================
+
+@ia_taches_bp.route('/api/ia/taches', methods=['POST'])
+@login_required
+def soumettre_tache():
+    """Soumettre une opération IA en arrière-plan"""
+    data = request.get_json(silent=True) or {}
+    operation = data.get('operation')
+
+    if operation not in IACacheService.operations_disponibles():
+        return jsonify({
+            'success': False,
+            'error': 'Opération inconnue',
+            'operations': IACacheService.operations_disponibles()
+        }), 400
+
+    tache = IACacheService.soumettre_tache(
+        operation,
+        data.get('parametres') or {},
+        client_id=current_user.client_id,
+        user_id=current_user.id
+    )
+    return reponse_tache_soumise(tache)
+
+
+@ia_taches_bp.route('/api/ia/taches/<tache_id>', methods=['GET'])
+@login_required
+def statut_tache(tache_id):
+    """Polling du statut d'une tâche IA"""
+    tache = IACacheService.statut_tache(
+        tache_id,
+        client_id=current_user.client_id,
+        user_id=current_user.id,
+        super_admin=current_user.role == 'super_admin'
+    )
+    if tache is None:
+        return jsonify({'success': False, 'error': 'Tâche introuvable'}), 404
+
+    return jsonify({'success': True, 'tache': tache.to_dict()})
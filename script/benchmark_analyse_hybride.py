@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Mesure du moteur de règles de l'analyse hybride (AnalyseHybrideService) sur
+une cartographie synthétique : construction de l'index, évaluation des
+règles, entrées en colonnes et résultat mémorisé.
+
+Usage :
+    python script/benchmark_analyse_hybride.py
+    python script/benchmark_analyse_hybride.py --risques 50000 --repetitions 5
+    python script/benchmark_analyse_hybride.py --risques 2000 --ancien
+
+--ancien mesure aussi le parcours d'origine (recherche de l'évaluation de
+chaque risque par next(...) sur toute la liste), quadratique : à éviter
+au-delà de quelques milliers de risques.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+RACINE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RACINE)
+
+from services.analyse_hybride import AnalyseHybrideService, IndexAnalyse  # noqa: E402
+
+CATEGORIES = ['Stratégique', 'Opérationnel', 'Financier', 'Conformité', 'Informatique', 'RH', 'Juridique']
+NIVEAUX = ['Faible', 'Moyen', 'Élevé', 'Critique']
+TYPES_DISPOSITIF = ['preventif', 'detectif', 'correctif', 'directif']
+CAMPAGNES = ['Campagne 2024', 'Campagne 2025', 'Campagne 2026']
+COMMENTAIRES = [
+    None, '', 'RAS',
+    'Risque majeur identifié lors du dernier comité, suivi prioritaire demandé par la direction',
+    'Contrôle renforcé, plan de traitement urgent en cours de déploiement sur les filiales',
+]
+
+
+def generer(nb_risques, graine=42):
+    """Données synthétiques (listes d'objets) pour nb_risques risques"""
+    alea = random.Random(graine)
+    maintenant = datetime.now()
+
+    risques = [
+        SimpleNamespace(id=i, reference=f"R{i:05d}", categorie=alea.choice(CATEGORIES),
+                        type_risque=alea.choice(['inherent', 'residuel']))
+        for i in range(1, nb_risques + 1)
+    ]
+
+    evaluations = []
+    for risque in risques:
+        if alea.random() < 0.7:
+            evaluations.append(SimpleNamespace(
+                risque_id=risque.id,
+                niveau_risque=alea.choice(NIVEAUX),
+                score_risque=alea.randint(1, 25),
+                date_confirmation=maintenant if alea.random() < 0.6 else None,
+                impact_pre=alea.randint(1, 5), probabilite_pre=alea.randint(1, 5),
+                impact_val=alea.randint(1, 5), impact_conf=alea.randint(1, 5),
+                commentaire_pre_evaluation=alea.choice(COMMENTAIRES),
+                commentaire_validation=alea.choice(COMMENTAIRES),
+                commentaire_confirmation=alea.choice(COMMENTAIRES),
+                campagne_nom=alea.choice(CAMPAGNES),
+            ))
+
+    dispositifs = [
+        SimpleNamespace(risque_id=alea.randint(1, nb_risques), type_dispositif=alea.choice(TYPES_DISPOSITIF))
+        for _ in range(nb_risques // 2)
+    ]
+
+    incidents = [
+        SimpleNamespace(date_occurrence=maintenant - timedelta(days=alea.randint(0, 730)),
+                        gravite=alea.choice(['faible', 'moyenne', 'elevee', 'critique']))
+        for _ in range(nb_risques // 20)
+    ]
+
+    demandes = [SimpleNamespace(statut=alea.choice(['en_attente', 'traitee'])) for _ in range(nb_risques // 50)]
+    constats = [SimpleNamespace(statut=alea.choice(['ouvert', 'en_action', 'clos'])) for _ in range(nb_risques // 50)]
+
+    return risques, evaluations, dispositifs, incidents, demandes, constats
+
+
+def en_colonnes(objets, colonnes):
+    """Liste d'objets -> dict de colonnes (tableaux NumPy si disponible)"""
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+    donnees = {c: [getattr(o, c, None) for o in objets] for c in colonnes}
+    if np is not None:
+        donnees = {c: np.array(v, dtype=object) for c, v in donnees.items()}
+    return donnees
+
+
+def parcours_ancien(risques, evaluations, dispositifs):
+    """Motif d'origine : une recherche linéaire par risque (O(n²))"""
+    evalues = 0
+    critiques_sans_dispositif = 0
+    for risque in risques:
+        evaluation = next((e for e in evaluations if e.risque_id == risque.id), None)
+        if evaluation and evaluation.date_confirmation:
+            evalues += 1
+        if evaluation and evaluation.niveau_risque == 'Critique':
+            if not any(d.risque_id == risque.id for d in dispositifs):
+                critiques_sans_dispositif += 1
+    return evalues, critiques_sans_dispositif
+
+
+def chronometrer(fonction, repetitions):
+    durees = []
+    resultat = None
+    for _ in range(repetitions):
+        debut = time.perf_counter()
+        resultat = fonction()
+        durees.append(time.perf_counter() - debut)
+    return resultat, statistics.median(durees)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark du moteur d'analyse hybride")
+    parser.add_argument('--risques', type=int, default=10000, help="Nombre de risques (défaut : 10000)")
+    parser.add_argument('--repetitions', type=int, default=3, help="Mesures par scénario (médiane)")
+    parser.add_argument('--ancien', action='store_true', help="Mesurer aussi le parcours quadratique d'origine")
+    args = parser.parse_args()
+
+    print(f"🔧 Génération de {args.risques} risques synthétiques...")
+    risques, evaluations, dispositifs, incidents, demandes, constats = generer(args.risques)
+    print(f"   {len(evaluations)} évaluations, {len(dispositifs)} dispositifs, {len(incidents)} incidents")
+
+    def analyser(version=None, **donnees):
+        return AnalyseHybrideService.analyser_complet(
+            cartographie=0,
+            risques=donnees.get('risques', risques),
+            evaluations=donnees.get('evaluations', evaluations),
+            dispositifs=donnees.get('dispositifs', dispositifs),
+            incidents=donnees.get('incidents', incidents),
+            demandes_reevaluation=demandes,
+            constats_audit=constats,
+            version=version,
+        )
+
+    mesures = []
+
+    _, duree = chronometrer(lambda: IndexAnalyse(risques, evaluations, dispositifs, incidents, demandes, constats),
+                            args.repetitions)
+    mesures.append(('Construction de l\'index', duree))
+
+    resultat, duree = chronometrer(analyser, args.repetitions)
+    mesures.append(('Analyse complète (objets)', duree))
+
+    colonnes = {
+        'risques': en_colonnes(risques, ('id', 'reference', 'categorie', 'type_risque')),
+        'evaluations': en_colonnes(evaluations, list(vars(evaluations[0])) if evaluations else []),
+        'dispositifs': en_colonnes(dispositifs, ('risque_id', 'type_dispositif')),
+        'incidents': en_colonnes(incidents, ('date_occurrence', 'gravite')),
+    }
+    resultat_colonnes, duree = chronometrer(lambda: analyser(**colonnes), args.repetitions)
+    mesures.append(('Analyse complète (colonnes)', duree))
+
+    try:
+        import pandas as pd
+        frames = {nom: pd.DataFrame(donnees) for nom, donnees in colonnes.items()}
+        _, duree = chronometrer(lambda: analyser(**frames), args.repetitions)
+        mesures.append(('Analyse complète (DataFrame)', duree))
+    except ImportError:
+        print("ℹ️ pandas non installé : scénario DataFrame ignoré")
+
+    AnalyseHybrideService.invalider()
+    analyser(version='benchmark')
+    _, duree = chronometrer(lambda: analyser(version='benchmark'), args.repetitions)
+    mesures.append(('Résultat mémorisé', duree))
+    AnalyseHybrideService.invalider()
+
+    if args.ancien:
+        _, duree = chronometrer(lambda: parcours_ancien(risques, evaluations, dispositifs), 1)
+        mesures.append(('Parcours d\'origine (2 règles)', duree))
+
+    print()
+    print(f"📊 {args.risques} risques, médiane sur {args.repetitions} mesure(s)")
+    for libelle, duree in mesures:
+        print(f"   {libelle:<34} {duree * 1000:>10.1f} ms")
+
+    identiques = resultat['statistiques'] == resultat_colonnes['statistiques']
+    print()
+    print(f"{'✅' if identiques else '❌'} Statistiques identiques objets / colonnes")
+    print(f"   Score global : {resultat['score_global']} ({resultat['niveau_label']}), "
+          f"{len(resultat['suggestions'])} suggestion(s), {len(resultat['alertes'])} alerte(s)")
+    return 0 if identiques else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Mesure du coût de démarrage d'un worker : temps d'import d'app.py,
+mémoire résidente et modules les plus coûteux (python -X importtime).
+
+Usage :
+    python script/benchmark_demarrage.py
+    python script/benchmark_demarrage.py --repetitions 5 --top 30
+    python script/benchmark_demarrage.py --module app --json resultats.json
+
+Chaque mesure est faite dans un processus neuf pour ne bénéficier
+d'aucun module déjà chargé.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+RACINE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CODE_MESURE = (
+    "import resource, sys, time\n"
+    "debut = time.perf_counter()\n"
+    "import {module}\n"
+    "duree = time.perf_counter() - debut\n"
+    "rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss\n"
+    "print('@@MESURE', duree, rss, len(sys.modules), file=sys.stderr)\n"
+)
+
+
+def _lancer(module, importtime=False):
+    commande = [sys.executable]
+    if importtime:
+        commande += ['-X', 'importtime']
+    commande += ['-c', CODE_MESURE.format(module=module)]
+
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE='0')
+    debut = time.perf_counter()
+    resultat = subprocess.run(commande, cwd=RACINE, env=env, capture_output=True, text=True)
+    duree_totale = time.perf_counter() - debut
+
+    mesure = None
+    for ligne in resultat.stderr.splitlines():
+        if ligne.startswith('@@MESURE'):
+            _, duree, rss, nb_modules = ligne.split()
+            mesure = {
+                'import_s': float(duree),
+                # ru_maxrss est en Ko sous Linux, en octets sous macOS
+                'rss_mo': int(rss) / (1024 * 1024 if sys.platform == 'darwin' else 1024),
+                'nb_modules': int(nb_modules),
+            }
+    if mesure is None:
+        raise RuntimeError(f"Import de {module} impossible :\n{resultat.stderr[-2000:]}")
+
+    mesure['processus_s'] = duree_totale
+    return mesure, resultat.stderr
+
+
+def modules_les_plus_couteux(sortie_importtime, top=20):
+    """[(cumul_ms, module)] à partir de la sortie de -X importtime"""
+    modules = []
+    for ligne in sortie_importtime.splitlines():
+        if not ligne.startswith('import time:') or 'self [us]' in ligne:
+            continue
+        try:
+            _, cumul, nom = ligne[len('import time:'):].split('|', 2)
+            modules.append((int(cumul) / 1000.0, nom[1:]))
+        except ValueError:
+            continue
+    # Ne garder que les imports de premier niveau (le cumul inclut les sous-modules)
+    premiers_niveaux = [(ms, nom) for ms, nom in modules if not nom.startswith(' ')]
+    return sorted(premiers_niveaux or modules, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark du démarrage de l'application")
+    parser.add_argument('--module', default='app', help="Module à importer (défaut : app)")
+    parser.add_argument('--repetitions', type=int, default=3)
+    parser.add_argument('--top', type=int, default=20, help="Nombre de modules à afficher")
+    parser.add_argument('--json', help="Écrire les résultats dans ce fichier")
+    args = parser.parse_args()
+
+    mesures = []
+    for i in range(args.repetitions):
+        mesure, _ = _lancer(args.module)
+        mesures.append(mesure)
+        print(f"  #{i + 1}: import {mesure['import_s']:.2f}s, "
+              f"processus {mesure['processus_s']:.2f}s, RSS {mesure['rss_mo']:.0f} Mo, "
+              f"{mesure['nb_modules']} modules")
+
+    _, sortie = _lancer(args.module, importtime=True)
+    couteux = modules_les_plus_couteux(sortie, args.top)
+
+    resume = {
+        'module': args.module,
+        'import_median_s': statistics.median(m['import_s'] for m in mesures),
+        'processus_median_s': statistics.median(m['processus_s'] for m in mesures),
+        'rss_max_mo': max(m['rss_mo'] for m in mesures),
+        'nb_modules': mesures[-1]['nb_modules'],
+        'modules_couteux': [{'module': nom, 'cumul_ms': ms} for ms, nom in couteux],
+    }
+
+    print(f"\n📊 Démarrage de '{args.module}' (médiane sur {args.repetitions})")
+    print(f"   Import : {resume['import_median_s']:.2f}s — processus : {resume['processus_median_s']:.2f}s")
+    print(f"   RSS max : {resume['rss_max_mo']:.0f} Mo — {resume['nb_modules']} modules chargés")
+    print("\n   Modules les plus coûteux (cumul) :")
+    for ms, nom in couteux:
+        print(f"   {ms:9.1f} ms  {nom}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(resume, f, indent=2)
+        print(f"\n✅ Résultats écrits dans {args.json}")
+
+
+if __name__ == '__main__':
+    main()
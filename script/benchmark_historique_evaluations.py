@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Mesure de l'analyse de l'historique des évaluations (HistoriqueEvaluations)
+sur un historique synthétique, comparée au parcours d'origine (boucle sur
+les risques puis sur risque.evaluations) : score moyen, tendances,
+indice de sévérité, dernière évaluation confirmée (tableau de Bordeaux)
+et indicateurs de portefeuille sur 6 mois.
+
+Usage :
+    python script/benchmark_historique_evaluations.py
+    python script/benchmark_historique_evaluations.py --evaluations 200000 --repetitions 5
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+RACINE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RACINE)
+
+from services.historique_evaluations_service import (  # noqa: E402
+    HistoriqueEvaluations, COLONNES, SCORE_CLOTURE
+)
+
+NIVEAUX = ['Faible', 'Moyen', 'Élevé', 'Critique', None]
+
+
+def generer(nb_evaluations, graine=42):
+    """Risques (avec leurs évaluations) pour nb_evaluations évaluations, environ 4 par risque"""
+    alea = random.Random(graine)
+    maintenant = datetime.now()
+    nb_risques = max(nb_evaluations // 4, 1)
+
+    risques = [
+        SimpleNamespace(id=i, is_archived=False, evaluations=[],
+                        created_at=maintenant - timedelta(days=alea.randint(0, 1100)))
+        for i in range(1, nb_risques + 1)
+    ]
+    for identifiant in range(1, nb_evaluations + 1):
+        risque = risques[alea.randrange(nb_risques)]
+        creation = maintenant - timedelta(days=alea.randint(0, 400), minutes=alea.randint(0, 1440))
+        phase = alea.random()
+        risque.evaluations.append(SimpleNamespace(
+            id=identifiant,
+            risque_id=risque.id,
+            created_at=creation,
+            date_validation=creation + timedelta(days=2) if phase < 0.7 else None,
+            date_confirmation=creation + timedelta(days=alea.randint(3, 30)) if phase < 0.4 else None,
+            score_risque=alea.randint(1, 25),
+            niveau_risque=alea.choice(NIVEAUX),
+            impact=alea.randint(1, 5),
+            probabilite=alea.randint(1, 5),
+        ))
+    return risques
+
+
+def en_colonnes(risques):
+    """Historique en colonnes, tel que HistoriqueEvaluations.charger le lit en base"""
+    lignes = [
+        (e.id, e.risque_id, e.created_at, e.date_validation, e.date_confirmation,
+         e.score_risque, e.niveau_risque, e.impact, e.probabilite)
+        for r in risques for e in r.evaluations
+    ]
+    colonnes = dict(zip(COLONNES, zip(*lignes)))
+    return colonnes, {'id': [r.id for r in risques], 'created_at': [r.created_at for r in risques]}
+
+
+# ============================================
+# PARCOURS D'ORIGINE (objets)
+# ============================================
+
+def _validee(e):
+    return e.date_validation is not None or e.date_confirmation is not None
+
+
+def ancien_score_moyen(risques):
+    scores = []
+    for risque in risques:
+        validees = [e for e in risque.evaluations if _validee(e)]
+        if validees:
+            scores.append(max(validees, key=lambda x: x.created_at).score_risque)
+    return sum(scores) / len(scores) if scores else 0
+
+
+def ancien_tendances(risques, maintenant, periode_jours=90):
+    limite = maintenant - timedelta(days=periode_jours)
+    tendances = dict.fromkeys(('risques_critiques', 'risques_en_hausse', 'risques_en_baisse',
+                               'risques_stables', 'nouveaux_risques'), 0)
+    for risque in risques:
+        recentes = sorted((e for e in risque.evaluations if e.created_at >= limite and _validee(e)),
+                          key=lambda x: x.created_at)
+        if not recentes:
+            continue
+        if len(recentes) == 1 and (maintenant - recentes[0].created_at).days <= 30:
+            tendances['nouveaux_risques'] += 1
+        if len(recentes) >= 2:
+            premier, dernier = recentes[0].score_risque, recentes[-1].score_risque
+            if dernier > premier + 2:
+                tendances['risques_en_hausse'] += 1
+            elif dernier < premier - 2:
+                tendances['risques_en_baisse'] += 1
+            else:
+                tendances['risques_stables'] += 1
+        if recentes[-1].score_risque >= 16:
+            tendances['risques_critiques'] += 1
+    return tendances
+
+
+def ancien_severite(risques):
+    severites = []
+    for risque in risques:
+        if risque.evaluations:
+            derniere = max(risque.evaluations, key=lambda x: x.created_at)
+            severites.append(derniere.impact * derniere.probabilite / 25.0)
+    return round(sum(severites) / len(severites) * 100, 2) if severites else 0
+
+
+def ancien_confirmees(risques):
+    resultat = {}
+    for risque in risques:
+        confirmees = [e for e in risque.evaluations if e.date_confirmation is not None]
+        if confirmees:
+            derniere = max(confirmees, key=lambda x: x.date_confirmation)
+            resultat[risque.id] = (derniere.id, derniere.score_risque, derniere.niveau_risque)
+    return resultat
+
+
+def ancien_portefeuille(risques, depuis):
+    total = len(risques)
+    nouveaux = sum(1 for r in risques if r.created_at >= depuis)
+    clotures = sum(1 for r in risques
+                   if any(e.created_at >= depuis and e.score_risque <= SCORE_CLOTURE for e in r.evaluations))
+    return {'total': total, 'nouveaux': nouveaux, 'clotures': clotures,
+            'taux_rotation': round((nouveaux / total) * 100, 1) if total > 0 else 0}
+
+
+def chronometrer(fonction, repetitions):
+    durees = []
+    resultat = None
+    for _ in range(repetitions):
+        debut = time.perf_counter()
+        resultat = fonction()
+        durees.append(time.perf_counter() - debut)
+    return resultat, statistics.median(durees)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de l'analyse de l'historique des évaluations")
+    parser.add_argument('--evaluations', type=int, default=50000, help="Nombre d'évaluations (défaut : 50000)")
+    parser.add_argument('--repetitions', type=int, default=3, help="Mesures par scénario (médiane)")
+    args = parser.parse_args()
+
+    print(f"🔧 Génération de {args.evaluations} évaluations synthétiques...")
+    risques = generer(args.evaluations)
+    colonnes, colonnes_risques = en_colonnes(risques)
+    maintenant = datetime.now()
+    six_mois = maintenant - timedelta(days=180)
+    print(f"   {len(risques)} risques")
+
+    def ancien():
+        return (ancien_score_moyen(risques), ancien_tendances(risques, maintenant), ancien_severite(risques),
+                ancien_confirmees(risques), ancien_portefeuille(risques, six_mois))
+
+    def nouveau(historique):
+        return (historique.score_moyen(), historique.tendances(maintenant=maintenant), historique.indice_severite(),
+                historique.dernieres_confirmees(), historique.portefeuille(six_mois))
+
+    mesures = []
+    resultat_ancien, duree = chronometrer(ancien, args.repetitions)
+    mesures.append(("Parcours d'origine (objets)", duree))
+
+    historique, duree = chronometrer(lambda: HistoriqueEvaluations(colonnes, colonnes_risques), args.repetitions)
+    mesures.append(('Mise en colonnes', duree))
+
+    resultat_nouveau, duree = chronometrer(lambda: nouveau(historique), args.repetitions)
+    mesures.append(('Indicateurs vectorisés', duree))
+
+    print()
+    print(f"📊 {args.evaluations} évaluations, médiane sur {args.repetitions} mesure(s)")
+    for libelle, duree in mesures:
+        print(f"   {libelle:<34} {duree * 1000:>10.1f} ms")
+
+    noms = ('Score moyen', 'Tendances', 'Indice de sévérité', 'Dernières confirmées', 'Portefeuille 6 mois')
+    identiques = True
+    print()
+    for nom, ancien_valeur, nouvelle_valeur in zip(noms, resultat_ancien, resultat_nouveau):
+        egal = abs(ancien_valeur - nouvelle_valeur) < 1e-9 if isinstance(ancien_valeur, float) \
+            else ancien_valeur == nouvelle_valeur
+        identiques = identiques and egal
+        print(f"{'✅' if egal else '❌'} {nom}")
+    return 0 if identiques else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,423 @@
+#!/usr/bin/env python3
+"""
+Conseiller d'index pour le schéma multi-tenant.
+
+1. Capture la charge réelle de requêtes (événements SQLAlchemy
+   before/after_cursor_execute) pendant un benchmark
+2. Exécute EXPLAIN (PostgreSQL) sur les requêtes les plus coûteuses
+3. Propose des index composites (égalités d'abord, colonne de tri en dernier)
+   en écartant ceux déjà couverts par un index existant
+4. Mesure les temps avant/après création et génère une migration Alembic
+
+Usage :
+    python script/conseiller_index.py --rapport
+    python script/conseiller_index.py --appliquer
+    python script/conseiller_index.py --migration migrations/versions
+    python script/conseiller_index.py --pack --migration migrations/versions
+"""
+import os
+import re
+import sys
+import time
+import json
+import argparse
+import logging
+from collections import defaultdict
+from datetime import datetime
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event, inspect, text
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Index recommandés d'office pour les filtres multi-tenant les plus fréquents
+# (table, colonnes, colonne de tri descendante éventuelle)
+INDEX_PACK = [
+    ('risques', ['client_id', 'is_archived'], None),
+    ('risques', ['cartographie_id', 'is_archived'], None),
+    ('cartographie', ['client_id', 'is_archived'], None),
+    ('audits', ['client_id', 'is_archived'], None),
+    ('constatations', ['client_id', 'is_archived'], None),
+    ('plans_action', ['client_id', 'is_archived'], None),
+    ('plans_action', ['risque_id'], None),
+    ('kri', ['client_id'], None),
+    ('kri', ['risque_id'], None),
+    ('evaluations_risque', ['risque_id'], 'created_at'),
+    ('mesure_kri', ['kri_id'], 'date_mesure'),
+    ('notification', ['destinataire_id', 'est_lue'], None),
+]
+
+RE_TABLE = re.compile(r'\b(?:FROM|JOIN)\s+"?(\w+)"?(?:\s+(?:AS\s+)?"?(\w+)"?)?', re.I)
+RE_EGALITE = re.compile(r'"?(\w+)"?\."?(\w+)"?\s*(?:=|IN\b|IS\b)', re.I)
+RE_ORDER_BY = re.compile(r'\bORDER BY\s+(.+?)(?:\bLIMIT\b|\bOFFSET\b|\bFOR\b|$)', re.I | re.S)
+RE_TRI = re.compile(r'"?(\w+)"?\."?(\w+)"?(\s+DESC)?', re.I)
+MOTS_RESERVES = {'WHERE', 'ON', 'JOIN', 'LEFT', 'RIGHT', 'INNER', 'OUTER', 'GROUP',
+                 'ORDER', 'LIMIT', 'WHERE', 'AND', 'OR', 'SET', 'VALUES'}
+
+
+# ============================================
+# CAPTURE DE LA CHARGE
+# ============================================
+
+def normaliser_sql(sql):
+    """Remplace les littéraux et listes IN pour regrouper les requêtes identiques"""
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'\b\d+(\.\d+)?\b', '?', sql)
+    sql = re.sub(r'\(\s*(?:\?|%\(\w+\)s|:\w+)(?:\s*,\s*(?:\?|%\(\w+\)s|:\w+))*\s*\)', '(...)', sql)
+    sql = re.sub(r'__\[POSTCOMPILE_\w+\]', '(...)', sql)
+    return re.sub(r'\s+', ' ', sql).strip()
+
+
+class CaptureRequetes:
+    """Context manager qui agrège les requêtes exécutées sur un engine"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.requetes = {}
+
+    def _avant(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('debut_requete', []).append(time.perf_counter())
+
+    def _apres(self, conn, cursor, statement, parameters, context, executemany):
+        duree = time.perf_counter() - conn.info['debut_requete'].pop()
+        cle = normaliser_sql(statement)
+        stats = self.requetes.get(cle)
+        if stats is None:
+            stats = self.requetes[cle] = {
+                'sql': statement,
+                'parametres': parameters if not executemany else None,
+                'nb': 0,
+                'duree_totale': 0.0
+            }
+        stats['nb'] += 1
+        stats['duree_totale'] += duree
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._avant)
+        event.listen(self.engine, 'after_cursor_execute', self._apres)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._avant)
+        event.remove(self.engine, 'after_cursor_execute', self._apres)
+        return False
+
+    def plus_couteuses(self, limite=30):
+        return sorted(self.requetes.values(), key=lambda r: r['duree_totale'], reverse=True)[:limite]
+
+
+def charge_reference(db, client_id=None):
+    """Benchmark représentatif des écrans principaux (listes, détails, compteurs)"""
+    from models import (Risque, Cartographie, Audit, Constatation, PlanAction,
+                        EvaluationRisque, KRI, MesureKRI, Notification, User)
+
+    filtre_client = {'client_id': client_id} if client_id else {}
+
+    cartos = Cartographie.query.filter_by(is_archived=False, **filtre_client).all()
+    for carto in cartos[:20]:
+        Risque.query.filter_by(cartographie_id=carto.id, is_archived=False).all()
+
+    risques = Risque.query.filter_by(is_archived=False, **filtre_client).limit(200).all()
+    for risque in risques:
+        EvaluationRisque.query.filter_by(risque_id=risque.id)\
+            .order_by(EvaluationRisque.created_at.desc()).first()
+        PlanAction.query.filter_by(risque_id=risque.id).count()
+
+    for kri in KRI.query.filter_by(**filtre_client).limit(200).all():
+        MesureKRI.query.filter_by(kri_id=kri.id).order_by(MesureKRI.date_mesure.desc()).limit(12).all()
+
+    Audit.query.filter_by(is_archived=False, **filtre_client).all()
+    Constatation.query.filter_by(is_archived=False, **filtre_client).count()
+    PlanAction.query.filter_by(is_archived=False, **filtre_client).all()
+
+    for user in User.query.filter_by(**filtre_client).limit(100).all():
+        Notification.query.filter_by(destinataire_id=user.id, est_lue=False).count()
+
+    db.session.rollback()
+
+
+# ============================================
+# ANALYSE
+# ============================================
+
+def extraire_predicats(sql):
+    """Retourne {table: {'egalites': [...], 'tri': [(col, desc)]}} pour une requête"""
+    alias = {}
+    for table, nom_alias in RE_TABLE.findall(sql):
+        alias[table] = table
+        if nom_alias and nom_alias.upper() not in MOTS_RESERVES:
+            alias[nom_alias] = table
+
+    resultat = defaultdict(lambda: {'egalites': [], 'tri': []})
+
+    partie_where = re.split(r'\bWHERE\b', sql, maxsplit=1, flags=re.I)
+    if len(partie_where) == 2:
+        clause = re.split(r'\b(?:GROUP BY|ORDER BY|LIMIT)\b', partie_where[1], maxsplit=1, flags=re.I)[0]
+        for nom, colonne in RE_EGALITE.findall(clause):
+            table = alias.get(nom)
+            if table and colonne not in resultat[table]['egalites']:
+                resultat[table]['egalites'].append(colonne)
+
+    tri = RE_ORDER_BY.search(sql)
+    if tri:
+        for nom, colonne, desc in RE_TRI.findall(tri.group(1)):
+            table = alias.get(nom)
+            if table:
+                resultat[table]['tri'].append((colonne, bool(desc)))
+
+    return dict(resultat)
+
+
+def index_existants(engine):
+    """{table: [colonnes...]} pour chaque index, PK et contrainte unique"""
+    inspecteur = inspect(engine)
+    existants = defaultdict(list)
+    for table in inspecteur.get_table_names():
+        pk = inspecteur.get_pk_constraint(table).get('constrained_columns') or []
+        if pk:
+            existants[table].append(pk)
+        for index in inspecteur.get_indexes(table):
+            existants[table].append([c for c in index.get('column_names') or [] if c])
+        for unique in inspecteur.get_unique_constraints(table):
+            existants[table].append(unique.get('column_names') or [])
+    return existants
+
+
+def est_couvert(colonnes, existants):
+    """Un index existant dont le préfixe contient les colonnes proposées"""
+    for index in existants:
+        if index[:len(colonnes)] == colonnes:
+            return True
+    return False
+
+
+def expliquer(engine, requetes):
+    """EXPLAIN (FORMAT JSON) sur PostgreSQL ; retourne {table: coût des Seq Scan}"""
+    if engine.dialect.name != 'postgresql':
+        logger.info("EXPLAIN ignoré (base %s, PostgreSQL requis)", engine.dialect.name)
+        return {}
+
+    scans = defaultdict(float)
+
+    def parcourir(noeud):
+        if noeud.get('Node Type') == 'Seq Scan':
+            scans[noeud.get('Relation Name')] += noeud.get('Total Cost', 0)
+        for enfant in noeud.get('Plans', []):
+            parcourir(enfant)
+
+    with engine.connect() as conn:
+        for requete in requetes:
+            if not requete['sql'].lstrip().upper().startswith('SELECT'):
+                continue
+            try:
+                curseur = conn.connection.cursor()
+                curseur.execute('EXPLAIN (FORMAT JSON) ' + requete['sql'], requete['parametres'])
+                plan = curseur.fetchone()[0]
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                parcourir(plan[0]['Plan'])
+            except Exception as e:
+                logger.warning("EXPLAIN impossible: %s", e)
+                conn.connection.rollback()
+    return dict(scans)
+
+
+def proposer_index(capture, engine, limite=30):
+    """Propose des index composites à partir de la charge capturée"""
+    existants = index_existants(engine)
+    tables_connues = set(existants.keys()) | set(inspect(engine).get_table_names())
+    requetes = capture.plus_couteuses(limite)
+    scans = expliquer(engine, requetes)
+
+    candidats = {}
+    for requete in requetes:
+        for table, predicats in extraire_predicats(requete['sql']).items():
+            if table not in tables_connues:
+                continue
+            colonnes = [c for c in predicats['egalites'] if c != 'id'][:3]
+            tri = predicats['tri'][0] if predicats['tri'] else None
+            if not colonnes:
+                continue
+            colonnes_index = colonnes + ([tri[0]] if tri and tri[0] not in colonnes else [])
+            if est_couvert(colonnes_index, existants[table]):
+                continue
+            cle = (table, tuple(colonnes), tri[0] if tri and tri[1] else None)
+            proposition = candidats.setdefault(cle, {
+                'table': table,
+                'colonnes': colonnes,
+                'tri_desc': cle[2],
+                'nb_requetes': 0,
+                'duree_totale': 0.0,
+                'cout_seq_scan': scans.get(table, 0.0)
+            })
+            proposition['nb_requetes'] += requete['nb']
+            proposition['duree_totale'] += requete['duree_totale']
+
+    return sorted(candidats.values(), key=lambda p: (p['cout_seq_scan'], p['duree_totale']), reverse=True)
+
+
+def propositions_pack(engine):
+    """Index du pack standard absents de la base"""
+    existants = index_existants(engine)
+    propositions = []
+    for table, colonnes, tri in INDEX_PACK:
+        if table not in existants:
+            continue
+        if est_couvert(colonnes + ([tri] if tri else []), existants[table]):
+            continue
+        propositions.append({'table': table, 'colonnes': colonnes, 'tri_desc': tri,
+                             'nb_requetes': 0, 'duree_totale': 0.0, 'cout_seq_scan': 0.0})
+    return propositions
+
+
+def nom_index(proposition):
+    colonnes = proposition['colonnes'] + ([proposition['tri_desc']] if proposition['tri_desc'] else [])
+    return f"ix_{proposition['table']}_{'_'.join(colonnes)}"[:63]
+
+
+def expression_index(proposition):
+    colonnes = list(proposition['colonnes'])
+    if proposition['tri_desc']:
+        colonnes.append(f"{proposition['tri_desc']} DESC")
+    return ', '.join(colonnes)
+
+
+# ============================================
+# MESURE ET APPLICATION
+# ============================================
+
+def rejouer(engine, requetes, repetitions=5):
+    """Rejoue les SELECT capturés ; retourne la durée totale en millisecondes"""
+    total = 0.0
+    with engine.connect() as conn:
+        for requete in requetes:
+            if not requete['sql'].lstrip().upper().startswith('SELECT') or requete['parametres'] is None:
+                continue
+            curseur = conn.connection.cursor()
+            for _ in range(repetitions):
+                debut = time.perf_counter()
+                curseur.execute(requete['sql'], requete['parametres'])
+                curseur.fetchall()
+                total += time.perf_counter() - debut
+    return round(total * 1000, 2)
+
+
+def appliquer(engine, propositions):
+    """Crée les index proposés (CONCURRENTLY sur PostgreSQL)"""
+    postgres = engine.dialect.name == 'postgresql'
+    options = {'isolation_level': 'AUTOCOMMIT'} if postgres else {}
+    with engine.connect().execution_options(**options) as conn:
+        for proposition in propositions:
+            sql = "CREATE INDEX {}IF NOT EXISTS {} ON {} ({})".format(
+                'CONCURRENTLY ' if postgres else '',
+                nom_index(proposition), proposition['table'], expression_index(proposition)
+            )
+            logger.info(sql)
+            conn.execute(text(sql))
+        if not postgres:
+            conn.commit()
+
+
+def generer_migration(propositions, dossier, timings=None):
+    """Écrit une révision Alembic (Flask-Migrate) créant les index proposés"""
+    os.makedirs(dossier, exist_ok=True)
+    revision = datetime.utcnow().strftime('%Y%m%d%H%M%S')
+    chemin = os.path.join(dossier, f'{revision}_index_composites_multi_tenant.py')
+
+    creations, suppressions = [], []
+    for proposition in propositions:
+        colonnes = [repr(c) for c in proposition['colonnes']]
+        if proposition['tri_desc']:
+            colonnes.append(f"sa.text({proposition['tri_desc'] + ' DESC'!r})")
+        creations.append(
+            f"    op.create_index({nom_index(proposition)!r}, {proposition['table']!r}, "
+            f"[{', '.join(colonnes)}], unique=False)"
+        )
+        suppressions.append(
+            f"    op.drop_index({nom_index(proposition)!r}, table_name={proposition['table']!r})"
+        )
+
+    entete_timings = ''
+    if timings:
+        entete_timings = (f"\nTemps de la charge capturée : avant {timings['avant_ms']} ms, "
+                          f"après {timings['apres_ms']} ms\n")
+
+    contenu = f'''"""Index composites multi-tenant (conseiller d'index)
+
+Revision ID: {revision}
+Revises:
+Create Date: {datetime.utcnow().isoformat()}
+{entete_timings}"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = {revision!r}
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+{chr(10).join(creations) or '    pass'}
+
+
+def downgrade():
+{chr(10).join(reversed(suppressions)) or '    pass'}
+'''
+    with open(chemin, 'w', encoding='utf-8') as f:
+        f.write(contenu)
+    return chemin
+
+
+# ============================================
+# POINT D'ENTRÉE
+# ============================================
+
+def main():
+    parser = argparse.ArgumentParser(description="Conseiller d'index multi-tenant")
+    parser.add_argument('--client', type=int, help='client_id utilisé pour le benchmark')
+    parser.add_argument('--rapport', action='store_true', help='Afficher la charge et les propositions')
+    parser.add_argument('--pack', action='store_true', help='Utiliser le pack d\'index standard')
+    parser.add_argument('--appliquer', action='store_true', help='Créer les index et mesurer avant/après')
+    parser.add_argument('--migration', metavar='DOSSIER', help='Générer une révision Alembic')
+    args = parser.parse_args()
+
+    from app import app
+    from models import db
+
+    with app.app_context():
+        engine = db.engine
+
+        with CaptureRequetes(engine) as capture:
+            charge_reference(db, args.client)
+
+        propositions = propositions_pack(engine) if args.pack else proposer_index(capture, engine)
+
+        if args.rapport or not (args.appliquer or args.migration):
+            print(f"\n📊 {len(capture.requetes)} requêtes distinctes capturées")
+            for requete in capture.plus_couteuses(10):
+                print(f"   {requete['nb']:>5} x {requete['duree_totale'] * 1000:8.1f} ms  "
+                      f"{normaliser_sql(requete['sql'])[:110]}")
+            print(f"\n💡 {len(propositions)} index proposés")
+            for proposition in propositions:
+                print(f"   {nom_index(proposition)} ON {proposition['table']} ({expression_index(proposition)})")
+
+        timings = None
+        if args.appliquer and propositions:
+            requetes = capture.plus_couteuses(100)
+            avant = rejouer(engine, requetes)
+            appliquer(engine, propositions)
+            apres = rejouer(engine, requetes)
+            timings = {'avant_ms': avant, 'apres_ms': apres}
+            print(f"\n⏱️ Charge rejouée : avant {avant} ms, après {apres} ms")
+
+        if args.migration and propositions:
+            chemin = generer_migration(propositions, args.migration, timings)
+            print(f"\n✅ Migration générée : {chemin}")
+
+
+if __name__ == '__main__':
+    main()
@@ -2,14 +2,267 @@
 """
 SERVICE D'ANALYSE HYBRIDE - Algorithmique + IA
 Toujours des suggestions (même sans API)
+
+Les données (risques, évaluations, dispositifs, incidents...) sont parcourues
+une seule fois pour construire un IndexAnalyse (dictionnaires par risque_id,
+compteurs, agrégats par campagne) ; toutes les règles, le score global, la
+maturité, le benchmark et les objectifs sont évalués sur cet index.
+Les entrées peuvent être des listes d'objets (modèles SQLAlchemy) ou des
+données en colonnes (DataFrame pandas, dict de listes / tableaux NumPy).
 """
 
 import os
 import json
 import re
+import threading
+import time
 from datetime import datetime, timedelta
-from collections import Counter
-import statistics
+from collections import Counter, namedtuple
+
+# Référence légère vers un risque (résultats mémorisables sans objet ORM)
+RisqueRef = namedtuple('RisqueRef', ['id', 'reference'])
+
+# Colonnes lues pour chaque source de données
+COLONNES = {
+    'risques': ('id', 'reference', 'categorie', 'type_risque'),
+    'evaluations': ('risque_id', 'niveau_risque', 'score_risque', 'date_confirmation',
+                    'impact_pre', 'probabilite_pre', 'impact_val', 'impact_conf',
+                    'commentaire_pre_evaluation', 'commentaire_validation',
+                    'commentaire_confirmation', 'campagne_nom'),
+    'dispositifs': ('risque_id', 'type_dispositif'),
+    'incidents': ('date_occurrence', 'gravite'),
+    'demandes_reevaluation': ('statut',),
+    'constats_audit': ('statut',),
+}
+
+MOTS_RISQUE = ('critique', 'urgent', 'grave', 'majeur', 'important', 'prioritaire')
+RE_MOT = re.compile(r'[^a-zA-Zàâäéèêëîïôöùûüÿçæœ]')
+
+
+def _valeur(v):
+    """NaN / NaT (colonnes pandas ou NumPy) -> None"""
+    return None if v is not None and v != v else v
+
+
+def _en_liste(colonne):
+    return colonne.tolist() if hasattr(colonne, 'tolist') else list(colonne)
+
+
+def _taille(source):
+    """Nombre de lignes d'une source (liste, DataFrame ou dict de colonnes)"""
+    if source is None:
+        return 0
+    if isinstance(source, dict):
+        return len(_en_liste(next(iter(source.values())))) if source else 0
+    return len(source)
+
+
+def _lignes(source, colonnes):
+    """
+    Tuples (dans l'ordre de `colonnes`) depuis une liste d'objets, un
+    DataFrame pandas ou un dict de colonnes (listes ou tableaux NumPy)
+    """
+    if source is None:
+        return
+    if hasattr(source, 'columns') and hasattr(source, 'itertuples'):
+        taille = len(source)
+        valeurs = [_en_liste(source[c]) if c in source.columns else [None] * taille for c in colonnes]
+    elif isinstance(source, dict):
+        taille = _taille(source)
+        valeurs = [_en_liste(source[c]) if c in source else [None] * taille for c in colonnes]
+    else:
+        for objet in source:
+            yield tuple(getattr(objet, c, None) for c in colonnes)
+        return
+    for ligne in zip(*valeurs):
+        yield tuple(_valeur(v) for v in ligne)
+
+
+def _long(texte, seuil):
+    return bool(texte) and len(texte) > seuil
+
+
+class IndexAnalyse:
+    """Index construit en un passage sur chaque source ; base de toutes les règles"""
+
+    def __init__(self, risques, evaluations, dispositifs, incidents,
+                 demandes_reevaluation=None, constats_audit=None, maintenant=None):
+        self.maintenant = maintenant or datetime.now()
+        self._indexer_risques(risques)
+        self._indexer_evaluations(evaluations)
+        self._indexer_dispositifs(dispositifs)
+        self._indexer_incidents(incidents)
+
+        self.demandes_fournies = _taille(demandes_reevaluation) > 0
+        self.demandes_en_attente = sum(
+            1 for (statut,) in _lignes(demandes_reevaluation, COLONNES['demandes_reevaluation'])
+            if statut == 'en_attente'
+        )
+        self.constats_fournis = _taille(constats_audit) > 0
+        self.constats_ouverts = sum(
+            1 for (statut,) in _lignes(constats_audit, COLONNES['constats_audit']) if statut != 'clos'
+        )
+
+    # ------------------------------------------------------------
+    # Construction
+    # ------------------------------------------------------------
+
+    def _indexer_risques(self, risques):
+        self.risques_par_id = {}
+        self.categories = Counter()
+        self.types_risque = set()
+        for risque_id, reference, categorie, type_risque in _lignes(risques, COLONNES['risques']):
+            self.risques_par_id[risque_id] = RisqueRef(risque_id, reference)
+            if categorie:
+                self.categories[categorie] += 1
+            if type_risque:
+                self.types_risque.add(type_risque)
+        self.total_risques = len(self.risques_par_id)
+
+    def _indexer_evaluations(self, evaluations):
+        self.nb_evaluations = 0
+        self.premiere_evaluation = {}       # risque_id -> (niveau, score), 1re évaluation rencontrée
+        self.nb_evaluees = 0
+        self.niveaux = Counter()
+        self.somme_qualite = 0.0
+        self.risque_ecart_phases = None
+        self.nb_commentaires = 0
+        self.nb_commentaires_risque = 0
+        self.campagnes = {}
+        self.scores_par_risque = {}
+        self.scores_risques = []
+
+        for (risque_id, niveau, score, date_confirmation, impact_pre, probabilite_pre, impact_val,
+             impact_conf, com_pre, com_val, com_conf, campagne_nom) in _lignes(evaluations, COLONNES['evaluations']):
+            self.nb_evaluations += 1
+            self.premiere_evaluation.setdefault(risque_id, (niveau, score))
+            if date_confirmation:
+                self.nb_evaluees += 1
+            if niveau:
+                self.niveaux[niveau] += 1
+
+            # Qualité (commentaires > 10 caractères)
+            qualite = (1 if impact_pre and probabilite_pre else 0) + _long(com_pre, 10) + _long(com_val, 10) + _long(com_conf, 10)
+            self.somme_qualite += qualite / 4 * 100
+
+            # Premier écart > 1 point entre phases
+            if self.risque_ecart_phases is None and impact_pre and impact_val and impact_conf:
+                if abs(impact_pre - impact_val) > 1 or abs(impact_val - impact_conf) > 1:
+                    self.risque_ecart_phases = risque_id
+
+            # Commentaires orientés risque
+            for texte in (com_pre, com_val, com_conf):
+                if texte:
+                    self.nb_commentaires += 1
+                    texte_min = texte.lower()
+                    if any(m in texte_min for m in MOTS_RISQUE):
+                        self.nb_commentaires_risque += 1
+
+            # Agrégats par campagne
+            campagne = campagne_nom or 'Sans campagne'
+            donnees = self.campagnes.get(campagne)
+            if donnees is None:
+                donnees = self.campagnes[campagne] = {
+                    'pre': [], 'validation': [], 'confirmation': [], 'total': 0, 'mots_cles': {},
+                    'qualite_moyenne': 0, 'taux_commentaires': 0,
+                    '_qualites': 0, '_evaluations': 0, '_confirmees': 0,
+                }
+            donnees['_evaluations'] += 1
+            if date_confirmation:
+                donnees['_confirmees'] += 1
+            if com_pre:
+                donnees['pre'].append(com_pre)
+                donnees['total'] += 1
+                mots_cles = donnees['mots_cles']
+                for mot in com_pre.lower().split():
+                    mot_propre = RE_MOT.sub('', mot)
+                    if len(mot_propre) > 4:
+                        mots_cles[mot_propre] = mots_cles.get(mot_propre, 0) + 1
+            if com_val:
+                donnees['validation'].append(com_val)
+                donnees['total'] += 1
+            if com_conf:
+                donnees['confirmation'].append(com_conf)
+                donnees['total'] += 1
+            donnees['_qualites'] += _long(com_pre, 20) + _long(com_val, 20) + _long(com_conf, 20)
+
+            # Scores par risque (tendances) et score moyen
+            scores = self.scores_par_risque.setdefault(risque_id, [])
+            if score:
+                scores.append(score)
+                self.scores_risques.append(score)
+
+        self.qualite_moyenne = self.somme_qualite / self.nb_evaluations if self.nb_evaluations else 0
+
+        for donnees in self.campagnes.values():
+            nb = donnees['_evaluations']
+            donnees['qualite_moyenne'] = round(donnees['_qualites'] / nb * 33.3, 1)
+            donnees['taux_commentaires'] = round(donnees['total'] / (nb * 3) * 100, 1)
+
+    def _indexer_dispositifs(self, dispositifs):
+        self.nb_dispositifs = 0
+        self.risques_avec_dispositif = set()
+        self.types_dispositifs = Counter()
+        types_par_risque = {}
+        redondants = set()
+        for risque_id, type_dispositif in _lignes(dispositifs, COLONNES['dispositifs']):
+            self.nb_dispositifs += 1
+            self.risques_avec_dispositif.add(risque_id)
+            types = types_par_risque.setdefault(risque_id, set())
+            if type_dispositif:
+                self.types_dispositifs[type_dispositif] += 1
+                if type_dispositif in types:
+                    redondants.add(risque_id)
+                types.add(type_dispositif)
+        # Premier risque (ordre d'apparition) ayant plusieurs dispositifs du même type
+        self.risque_dispositifs_redondants = next((r for r in types_par_risque if r in redondants), None)
+
+    def _indexer_incidents(self, incidents):
+        date_limite = self.maintenant - timedelta(days=365)
+        self.incidents_recents = 0
+        self.gravites_recentes = Counter()
+        for date_occurrence, gravite in _lignes(incidents, COLONNES['incidents']):
+            if date_occurrence is not None and date_occurrence >= date_limite:
+                self.incidents_recents += 1
+                if gravite:
+                    self.gravites_recentes[gravite] += 1
+
+    # ------------------------------------------------------------
+    # Indicateurs dérivés
+    # ------------------------------------------------------------
+
+    @property
+    def taux_evaluation(self):
+        return (self.nb_evaluees / self.total_risques * 100) if self.total_risques > 0 else 0
+
+    @property
+    def taux_couverture(self):
+        return (len(self.risques_avec_dispositif) / self.total_risques * 100) if self.total_risques > 0 else 0
+
+    @property
+    def score_moyen(self):
+        return sum(self.scores_risques) / len(self.scores_risques) if self.scores_risques else 0
+
+    def reference(self, risque_id):
+        risque = self.risques_par_id.get(risque_id)
+        return risque.reference if risque else 'N/A'
+
+    def risques_critiques_sans_dispositif(self):
+        """Risques dont la 1re évaluation est Critique/Élevé et sans dispositif (ordre des risques)"""
+        resultat = []
+        for risque_id, risque in self.risques_par_id.items():
+            evaluation = self.premiere_evaluation.get(risque_id)
+            if evaluation and evaluation[0] in ('Critique', 'Élevé') and risque_id not in self.risques_avec_dispositif:
+                resultat.append({'risque': risque, 'niveau': evaluation[0], 'score': evaluation[1]})
+        return resultat
+
+    def commentaires_par_campagne(self):
+        """Agrégats par campagne au format historique (sans les champs internes)"""
+        return {
+            campagne: {cle: valeur for cle, valeur in donnees.items() if not cle.startswith('_')}
+            for campagne, donnees in self.campagnes.items()
+        }
+
 
 # ============================================================
 # PARTIE 1 : SUGGESTIONS ALGORITHMIQUES (TOUJOURS DISPONIBLES)
@@ -17,36 +270,30 @@ import statistics
 
 class AnalyseAlgorithmique:
     """Moteur d'analyse algorithmique - Toujours disponible"""
-    
+
     @staticmethod
-    def generer_suggestions(risques, evaluations, dispositifs, incidents, 
-                           demandes_reevaluation=None, constats_audit=None):
+    def generer_suggestions(risques, evaluations, dispositifs, incidents,
+                           demandes_reevaluation=None, constats_audit=None, index=None):
         """
         Génère des suggestions basées sur des règles métier
         TOUJOURS disponible, même sans API
         """
+        if index is None:
+            index = IndexAnalyse(risques, evaluations, dispositifs, incidents,
+                                 demandes_reevaluation, constats_audit)
+
         suggestions = []
         alertes = []
         risques_proposes = []
-        
+
         # Variables pour les statistiques
-        total_risques = len(risques)
-        
+        total_risques = index.total_risques
+
         # ============================================================
         # 1. ANALYSE DES RISQUES CRITIQUES SANS DISPOSITIF
         # ============================================================
-        risques_critiques_sans_dispo = []
-        for r in risques:
-            eval = next((e for e in evaluations if e.risque_id == r.id), None)
-            if eval and eval.niveau_risque in ['Critique', 'Élevé']:
-                has_dispositif = any(d.risque_id == r.id for d in dispositifs)
-                if not has_dispositif:
-                    risques_critiques_sans_dispo.append({
-                        'risque': r,
-                        'niveau': eval.niveau_risque,
-                        'score': eval.score_risque
-                    })
-        
+        risques_critiques_sans_dispo = index.risques_critiques_sans_dispositif()
+
         if risques_critiques_sans_dispo:
             suggestions.append({
                 'id': 'sug_critiques_sans_dispo',
@@ -64,19 +311,19 @@ class AnalyseAlgorithmique:
                 'impact': 'Élevé',
                 'risques_concernes': [r['risque'] for r in risques_critiques_sans_dispo[:5]]
             })
-            
+
             alertes.append({
                 'niveau': 'rouge',
                 'message': f"🔴 {len(risques_critiques_sans_dispo)} risques critiques sans dispositif",
                 'detail': 'Action immédiate requise'
             })
-        
+
         # ============================================================
         # 2. ANALYSE DU TAUX D'ÉVALUATION
         # ============================================================
-        evaluees = len([e for e in evaluations if e.date_confirmation])
-        taux_evaluation = int((evaluees / total_risques * 100) if total_risques > 0 else 0)
-        
+        evaluees = index.nb_evaluees
+        taux_evaluation = int(index.taux_evaluation)
+
         if taux_evaluation < 50:
             suggestions.append({
                 'id': 'sug_taux_evaluation',
@@ -93,28 +340,24 @@ class AnalyseAlgorithmique:
                 'delai_suggere': '30 jours',
                 'impact': 'Élevé'
             })
-            
+
             if taux_evaluation < 30:
                 alertes.append({
                     'niveau': 'orange',
                     'message': f"🟠 Taux d'évaluation très faible ({taux_evaluation}%)",
                     'detail': f"{total_risques - evaluees} risques non évalués"
                 })
-        
+
         # ============================================================
         # 3. ANALYSE DES INCIDENTS RÉCENTS
         # ============================================================
-        date_limite = datetime.now() - timedelta(days=365)
-        incidents_recents = [i for i in incidents if i.date_occurrence >= date_limite]
-        
-        if incidents_recents:
-            gravites = Counter([i.gravite for i in incidents_recents if i.gravite])
-            critiques = gravites.get('critique', 0)
-            eleves = gravites.get('elevee', 0)
-            
+        if index.incidents_recents:
+            critiques = index.gravites_recentes.get('critique', 0)
+            eleves = index.gravites_recentes.get('elevee', 0)
+
             suggestions.append({
                 'id': 'sug_incidents_recents',
-                'titre': f"⚠️ {len(incidents_recents)} incident(s) récent(s)",
+                'titre': f"⚠️ {index.incidents_recents} incident(s) récent(s)",
                 'description': f'{critiques} critiques, {eleves} élevés. Une analyse approfondie est recommandée.',
                 'priorite': 'high' if critiques > 0 else 'medium',
                 'icone': 'fa-exclamation-triangle',
@@ -127,7 +370,7 @@ class AnalyseAlgorithmique:
                 'delai_suggere': '15 jours',
                 'impact': 'Élevé' if critiques > 0 else 'Moyen'
             })
-            
+
             if critiques > 0:
                 alertes.append({
                     'niveau': 'rouge',
@@ -140,18 +383,18 @@ class AnalyseAlgorithmique:
                     'message': f"🟠 {eleves} incident(s) élevé(s) récent(s)",
                     'detail': 'Surveillance renforcée nécessaire'
                 })
-        
+
         # ============================================================
         # 4. ANALYSE DE LA COUVERTURE DES DISPOSITIFS
         # ============================================================
-        risques_avec_dispositif = set([d.risque_id for d in dispositifs])
-        taux_couverture = int((len(risques_avec_dispositif) / total_risques * 100) if total_risques > 0 else 0)
-        
+        nb_risques_avec_dispositif = len(index.risques_avec_dispositif)
+        taux_couverture = int(index.taux_couverture)
+
         if taux_couverture < 40:
             suggestions.append({
                 'id': 'sug_couverture_dispositifs',
                 'titre': f"🛡️ Couverture dispositifs insuffisante ({taux_couverture}%)",
-                'description': f'{total_risques - len(risques_avec_dispositif)} risques sans dispositif de maîtrise.',
+                'description': f'{total_risques - nb_risques_avec_dispositif} risques sans dispositif de maîtrise.',
                 'priorite': 'high',
                 'icone': 'fa-shield-alt',
                 'categorie': 'dispositifs',
@@ -163,33 +406,20 @@ class AnalyseAlgorithmique:
                 'delai_suggere': '45 jours',
                 'impact': 'Élevé'
             })
-            
+
             if taux_couverture < 20:
                 alertes.append({
                     'niveau': 'orange',
                     'message': f"🟠 Couverture dispositifs très faible ({taux_couverture}%)",
                     'detail': 'Risques non maîtrisés'
                 })
-        
+
         # ============================================================
         # 5. ANALYSE DE LA QUALITÉ DES ÉVALUATIONS
         # ============================================================
-        if evaluations:
-            scores_qualite = []
-            for e in evaluations:
-                qualite = 0
-                if e.impact_pre and e.probabilite_pre:
-                    qualite += 1
-                if e.commentaire_pre_evaluation and len(e.commentaire_pre_evaluation) > 10:
-                    qualite += 1
-                if e.commentaire_validation and len(e.commentaire_validation) > 10:
-                    qualite += 1
-                if e.commentaire_confirmation and len(e.commentaire_confirmation) > 10:
-                    qualite += 1
-                scores_qualite.append(qualite / 4 * 100)
-            
-            qualite_moyenne = statistics.mean(scores_qualite) if scores_qualite else 0
-            
+        if index.nb_evaluations:
+            qualite_moyenne = index.qualite_moyenne
+
             if qualite_moyenne < 50:
                 suggestions.append({
                     'id': 'sug_qualite_evaluations',
@@ -206,22 +436,19 @@ class AnalyseAlgorithmique:
                     'delai_suggere': '60 jours',
                     'impact': 'Moyen'
                 })
-        
+
         # ============================================================
         # 6. ANALYSE DES CATÉGORIES
         # ============================================================
-        categories = {}
-        for r in risques:
-            if r.categorie:
-                categories[r.categorie] = categories.get(r.categorie, 0) + 1
-        
+        categories = index.categories
+
         if len(categories) < 3:
             categories_manquantes = ['Financier', 'Opérationnel', 'Réglementaire', 'Stratégique', 'Réputationnel']
-            categories_existantes = list(categories.keys())
+            categories_existantes = {cat.lower() for cat in categories}
             suggestions.append({
                 'id': 'sug_categories_manquantes',
                 'titre': f"🏷️ Diversifier les catégories de risques ({len(categories)} existantes)",
-                'description': f'Seulement {len(categories)} catégories couvertes. Ajoutez des risques dans : {", ".join([c for c in categories_manquantes if c.lower() not in [cat.lower() for cat in categories_existantes]][:3])}...',
+                'description': f'Seulement {len(categories)} catégories couvertes. Ajoutez des risques dans : {", ".join([c for c in categories_manquantes if c.lower() not in categories_existantes][:3])}...',
                 'priorite': 'medium',
                 'icone': 'fa-tags',
                 'categorie': 'couverture',
@@ -233,12 +460,12 @@ class AnalyseAlgorithmique:
                 'delai_suggere': '90 jours',
                 'impact': 'Moyen'
             })
-        
+
         # ============================================================
         # 7. ANALYSE DES DEMANDES DE RÉÉVALUATION
         # ============================================================
-        if demandes_reevaluation:
-            attente = len([d for d in demandes_reevaluation if d.statut == 'en_attente'])
+        if index.demandes_fournies:
+            attente = index.demandes_en_attente
             if attente > 0:
                 suggestions.append({
                     'id': 'sug_demandes_reevaluation',
@@ -255,86 +482,60 @@ class AnalyseAlgorithmique:
                     'delai_suggere': '15 jours',
                     'impact': 'Élevé'
                 })
-        
+
         # ============================================================
         # 8. ANALYSE DES ÉCARTS ENTRE PHASES
         # ============================================================
-        for e in evaluations:
-            if e.impact_pre and e.impact_val and e.impact_conf:
-                ecart_pre_val = abs(e.impact_pre - e.impact_val)
-                ecart_val_conf = abs(e.impact_val - e.impact_conf)
-                
-                if ecart_pre_val > 1 or ecart_val_conf > 1:
-                    risque_ref = e.risque.reference if hasattr(e.risque, 'reference') else 'N/A'
-                    suggestions.append({
-                        'id': 'sug_ecart_phases',
-                        'titre': f"📊 Écarts significatifs entre les phases d'évaluation",
-                        'description': f"Des écarts >1 point ont été détectés pour le risque {risque_ref}. Cela peut indiquer une incertitude.",
-                        'priorite': 'medium',
-                        'icone': 'fa-arrow-right-arrow-left',
-                        'categorie': 'evaluation',
-                        'actions': [
-                            'Analyser les raisons des écarts',
-                            'Vérifier la cohérence des évaluations',
-                            'Documenter les justifications'
-                        ],
-                        'delai_suggere': '30 jours',
-                        'impact': 'Moyen'
-                    })
-                    break
-        
+        if index.risque_ecart_phases is not None:
+            risque_ref = index.reference(index.risque_ecart_phases)
+            suggestions.append({
+                'id': 'sug_ecart_phases',
+                'titre': f"📊 Écarts significatifs entre les phases d'évaluation",
+                'description': f"Des écarts >1 point ont été détectés pour le risque {risque_ref}. Cela peut indiquer une incertitude.",
+                'priorite': 'medium',
+                'icone': 'fa-arrow-right-arrow-left',
+                'categorie': 'evaluation',
+                'actions': [
+                    'Analyser les raisons des écarts',
+                    'Vérifier la cohérence des évaluations',
+                    'Documenter les justifications'
+                ],
+                'delai_suggere': '30 jours',
+                'impact': 'Moyen'
+            })
+
         # ============================================================
         # 9. ANALYSE DES DISPOSITIFS REDONDANTS
         # ============================================================
-        dispositifs_par_risque = {}
-        for d in dispositifs:
-            if d.risque_id not in dispositifs_par_risque:
-                dispositifs_par_risque[d.risque_id] = []
-            dispositifs_par_risque[d.risque_id].append(d)
-
-        for risque_id, dispo_list in dispositifs_par_risque.items():
-            types = [d.type_dispositif for d in dispo_list if d.type_dispositif]
-            if len(types) > len(set(types)):
-                risque = next((r for r in risques if r.id == risque_id), None)
-                risque_ref = risque.reference if risque else 'N/A'
-                suggestions.append({
-                    'id': 'sug_dispositifs_redondants',
-                    'titre': f"🔄 Dispositifs potentiellement redondants pour {risque_ref}",
-                    'description': f"Plusieurs dispositifs du même type sont présents pour ce risque. Une consolidation pourrait être envisagée.",
-                    'priorite': 'low',
-                    'icone': 'fa-compress-arrows-alt',
-                    'categorie': 'dispositifs',
-                    'actions': [
-                        'Auditer les dispositifs redondants',
-                        'Consolider ou supprimer les doublons',
-                        'Optimiser les ressources'
-                    ],
-                    'delai_suggere': '60 jours',
-                    'impact': 'Faible'
-                })
-                break
-        
+        if index.risque_dispositifs_redondants is not None:
+            risque_ref = index.reference(index.risque_dispositifs_redondants)
+            suggestions.append({
+                'id': 'sug_dispositifs_redondants',
+                'titre': f"🔄 Dispositifs potentiellement redondants pour {risque_ref}",
+                'description': f"Plusieurs dispositifs du même type sont présents pour ce risque. Une consolidation pourrait être envisagée.",
+                'priorite': 'low',
+                'icone': 'fa-compress-arrows-alt',
+                'categorie': 'dispositifs',
+                'actions': [
+                    'Auditer les dispositifs redondants',
+                    'Consolider ou supprimer les doublons',
+                    'Optimiser les ressources'
+                ],
+                'delai_suggere': '60 jours',
+                'impact': 'Faible'
+            })
+
         # ============================================================
         # 10. ANALYSE DES COMMENTAIRES (NLP basique)
         # ============================================================
-        commentaires_texte = []
-        for e in evaluations:
-            if e.commentaire_pre_evaluation:
-                commentaires_texte.append(e.commentaire_pre_evaluation)
-            if e.commentaire_validation:
-                commentaires_texte.append(e.commentaire_validation)
-            if e.commentaire_confirmation:
-                commentaires_texte.append(e.commentaire_confirmation)
-
-        if commentaires_texte:
-            mots_risque = ['critique', 'urgent', 'grave', 'majeur', 'important', 'prioritaire']
-            risque_mentions = sum(1 for t in commentaires_texte if any(m in t.lower() for m in mots_risque))
-            
-            if risque_mentions > len(commentaires_texte) * 0.3:
+        if index.nb_commentaires:
+            risque_mentions = index.nb_commentaires_risque
+
+            if risque_mentions > index.nb_commentaires * 0.3:
                 suggestions.append({
                     'id': 'sug_commentaires_risque',
                     'titre': f"📝 Commentaires orientés risque",
-                    'description': f"Les commentaires utilisent fréquemment des termes de risque ({int(risque_mentions/len(commentaires_texte)*100)}%). Une analyse qualitative est recommandée.",
+                    'description': f"Les commentaires utilisent fréquemment des termes de risque ({int(risque_mentions/index.nb_commentaires*100)}%). Une analyse qualitative est recommandée.",
                     'priorite': 'low',
                     'icone': 'fa-comment-dots',
                     'categorie': 'qualite',
@@ -346,225 +547,137 @@ class AnalyseAlgorithmique:
                     'delai_suggere': '45 jours',
                     'impact': 'Faible'
                 })
-        
+
         # ============================================================
         # 11. ANALYSE DES COMMENTAIRES PAR CAMPAGNE (AMÉLIORÉ)
         # ============================================================
-        if evaluations:
-            commentaires_par_campagne = {}
-            qualite_par_campagne = {}
-            
-            for e in evaluations:
-                campagne = e.campagne_nom or 'Sans campagne'
-                
-                # Initialiser
-                if campagne not in commentaires_par_campagne:
-                    commentaires_par_campagne[campagne] = {
-                        'pre': [],
-                        'validation': [],
-                        'confirmation': [],
-                        'total': 0,
-                        'mots_cles': {},
-                        'qualite_moyenne': 0,
-                        'taux_commentaires': 0
+        commentaires_par_campagne = index.commentaires_par_campagne()
+        for campagne, data in commentaires_par_campagne.items():
+            # Suggestion si peu de commentaires
+            if data['total'] < 3:
+                suggestions.append({
+                    'id': f'sug_commentaires_campagne_{campagne[:10].replace(" ", "_")}',
+                    'titre': f"📝 Peu de commentaires dans la campagne '{campagne}'",
+                    'description': f"Seulement {data['total']} commentaires pour cette campagne. Des commentaires détaillés améliorent la qualité des évaluations.",
+                    'priorite': 'low',
+                    'icone': 'fa-comment-dots',
+                    'categorie': 'campagne',
+                    'actions': [
+                        f'Encourager les commentaires dans la campagne {campagne}',
+                        'Former les évaluateurs',
+                        'Mettre en place des modèles de commentaires'
+                    ],
+                    'delai_suggere': '30 jours',
+                    'impact': 'Faible',
+                    'campagne': campagne,
+                    'metriques': {
+                        'total_commentaires': data['total'],
+                        'taux_commentaires': data['taux_commentaires'],
+                        'qualite_moyenne': data['qualite_moyenne']
                     }
-                
-                # Récupérer les commentaires
-                if e.commentaire_pre_evaluation:
-                    commentaires_par_campagne[campagne]['pre'].append(e.commentaire_pre_evaluation)
-                    commentaires_par_campagne[campagne]['total'] += 1
-                    
-                    # Mots clés
-                    mots = e.commentaire_pre_evaluation.lower().split()
-                    for mot in mots:
-                        # Nettoyer le mot
-                        mot_propre = re.sub(r'[^a-zA-Zàâäéèêëîïôöùûüÿçæœ]', '', mot)
-                        if len(mot_propre) > 4:
-                            commentaires_par_campagne[campagne]['mots_cles'][mot_propre] = \
-                                commentaires_par_campagne[campagne]['mots_cles'].get(mot_propre, 0) + 1
-                
-                if e.commentaire_validation:
-                    commentaires_par_campagne[campagne]['validation'].append(e.commentaire_validation)
-                    commentaires_par_campagne[campagne]['total'] += 1
-                
-                if e.commentaire_confirmation:
-                    commentaires_par_campagne[campagne]['confirmation'].append(e.commentaire_confirmation)
-                    commentaires_par_campagne[campagne]['total'] += 1
-                
-                # Qualité des commentaires
-                qualite = 0
-                if e.commentaire_pre_evaluation and len(e.commentaire_pre_evaluation) > 20:
-                    qualite += 1
-                if e.commentaire_validation and len(e.commentaire_validation) > 20:
-                    qualite += 1
-                if e.commentaire_confirmation and len(e.commentaire_confirmation) > 20:
-                    qualite += 1
-                
-                if campagne not in qualite_par_campagne:
-                    qualite_par_campagne[campagne] = []
-                qualite_par_campagne[campagne].append(qualite)
-            
-            # Générer des suggestions basées sur les commentaires par campagne
-            for campagne, data in commentaires_par_campagne.items():
-                # Calculer la qualité moyenne
-                if campagne in qualite_par_campagne and qualite_par_campagne[campagne]:
-                    qualite_moyenne = (sum(qualite_par_campagne[campagne]) / 
-                                      len(qualite_par_campagne[campagne])) * 33.3
-                    commentaires_par_campagne[campagne]['qualite_moyenne'] = round(qualite_moyenne, 1)
-                
-                # Calculer le taux de commentaires
-                eval_campagne = len([e for e in evaluations if (e.campagne_nom or 'Sans campagne') == campagne])
-                if eval_campagne > 0:
-                    taux = (data['total'] / (eval_campagne * 3)) * 100
-                    commentaires_par_campagne[campagne]['taux_commentaires'] = round(taux, 1)
-                
-                # Suggestion si peu de commentaires
-                if data['total'] < 3:
-                    suggestions.append({
-                        'id': f'sug_commentaires_campagne_{campagne[:10].replace(" ", "_")}',
-                        'titre': f"📝 Peu de commentaires dans la campagne '{campagne}'",
-                        'description': f"Seulement {data['total']} commentaires pour cette campagne. Des commentaires détaillés améliorent la qualité des évaluations.",
-                        'priorite': 'low',
-                        'icone': 'fa-comment-dots',
-                        'categorie': 'campagne',
-                        'actions': [
-                            f'Encourager les commentaires dans la campagne {campagne}',
-                            'Former les évaluateurs',
-                            'Mettre en place des modèles de commentaires'
-                        ],
-                        'delai_suggere': '30 jours',
-                        'impact': 'Faible',
-                        'campagne': campagne,
-                        'metriques': {
-                            'total_commentaires': data['total'],
-                            'taux_commentaires': commentaires_par_campagne[campagne]['taux_commentaires'],
-                            'qualite_moyenne': commentaires_par_campagne[campagne]['qualite_moyenne']
-                        }
-                    })
-                
-                # Suggestion sur les mots clés récurrents
-                if data['mots_cles']:
-                    top_mots = sorted(data['mots_cles'].items(), key=lambda x: x[1], reverse=True)[:5]
-                    if top_mots and len(top_mots) >= 2:
-                        mots_cles_str = ', '.join([f"'{m[0]}'" for m in top_mots[:3]])
-                        suggestions.append({
-                            'id': f'sug_mots_cles_{campagne[:10].replace(" ", "_")}',
-                            'titre': f"🔑 Thèmes récurrents dans '{campagne}'",
-                            'description': f"Mots clés fréquents : {mots_cles_str}. Ces thèmes méritent une attention particulière.",
-                            'priorite': 'medium',
-                            'icone': 'fa-key',
-                            'categorie': 'campagne',
-                            'actions': [
-                                'Analyser ces thèmes en profondeur',
-                                'Créer des risques dédiés si nécessaire',
-                                'Documenter les tendances'
-                            ],
-                            'delai_suggere': '45 jours',
-                            'impact': 'Moyen',
-                            'campagne': campagne,
-                            'top_mots': top_mots[:5]
-                        })
-                
-                # Suggestion sur la qualité des commentaires
-                if commentaires_par_campagne[campagne]['qualite_moyenne'] < 40:
+                })
+
+            # Suggestion sur les mots clés récurrents
+            if data['mots_cles']:
+                top_mots = sorted(data['mots_cles'].items(), key=lambda x: x[1], reverse=True)[:5]
+                if top_mots and len(top_mots) >= 2:
+                    mots_cles_str = ', '.join([f"'{m[0]}'" for m in top_mots[:3]])
                     suggestions.append({
-                        'id': f'sug_qualite_comments_{campagne[:10].replace(" ", "_")}',
-                        'titre': f"📋 Qualité des commentaires insuffisante - '{campagne}'",
-                        'description': f"La qualité moyenne des commentaires est de {commentaires_par_campagne[campagne]['qualite_moyenne']}%. Les commentaires sont trop courts.",
+                        'id': f'sug_mots_cles_{campagne[:10].replace(" ", "_")}',
+                        'titre': f"🔑 Thèmes récurrents dans '{campagne}'",
+                        'description': f"Mots clés fréquents : {mots_cles_str}. Ces thèmes méritent une attention particulière.",
                         'priorite': 'medium',
-                        'icone': 'fa-pen-fancy',
+                        'icone': 'fa-key',
                         'categorie': 'campagne',
                         'actions': [
-                            f'Former les équipes de la campagne {campagne}',
-                            'Fournir des modèles de commentaires détaillés',
-                            'Organiser des ateliers d\'écriture'
+                            'Analyser ces thèmes en profondeur',
+                            'Créer des risques dédiés si nécessaire',
+                            'Documenter les tendances'
                         ],
-                        'delai_suggere': '30 jours',
+                        'delai_suggere': '45 jours',
                         'impact': 'Moyen',
                         'campagne': campagne,
-                        'qualite_actuelle': commentaires_par_campagne[campagne]['qualite_moyenne']
+                        'top_mots': top_mots[:5]
                     })
-        
+
+            # Suggestion sur la qualité des commentaires
+            if data['qualite_moyenne'] < 40:
+                suggestions.append({
+                    'id': f'sug_qualite_comments_{campagne[:10].replace(" ", "_")}',
+                    'titre': f"📋 Qualité des commentaires insuffisante - '{campagne}'",
+                    'description': f"La qualité moyenne des commentaires est de {data['qualite_moyenne']}%. Les commentaires sont trop courts.",
+                    'priorite': 'medium',
+                    'icone': 'fa-pen-fancy',
+                    'categorie': 'campagne',
+                    'actions': [
+                        f'Former les équipes de la campagne {campagne}',
+                        'Fournir des modèles de commentaires détaillés',
+                        'Organiser des ateliers d\'écriture'
+                    ],
+                    'delai_suggere': '30 jours',
+                    'impact': 'Moyen',
+                    'campagne': campagne,
+                    'qualite_actuelle': data['qualite_moyenne']
+                })
+
         # ============================================================
         # 12. ANALYSE DE LA MATURITÉ PAR CAMPAGNE
         # ============================================================
-        campagnes_eval = {}
-        for e in evaluations:
-            campagne_nom = e.campagne_nom or 'Sans campagne'
-            if campagne_nom not in campagnes_eval:
-                campagnes_eval[campagne_nom] = {'total': 0, 'confirmees': 0}
-            campagnes_eval[campagne_nom]['total'] += 1
-            if e.date_confirmation:
-                campagnes_eval[campagne_nom]['confirmees'] += 1
-
-        for campagne, data in campagnes_eval.items():
-            if data['total'] > 0:
-                taux = data['confirmees'] / data['total'] * 100
-                if taux < 50:
+        for campagne, donnees in index.campagnes.items():
+            taux = donnees['_confirmees'] / donnees['_evaluations'] * 100
+            if taux < 50:
+                suggestions.append({
+                    'id': f'sug_campagne_{campagne[:10].replace(" ", "_")}',
+                    'titre': f"📋 Campagne '{campagne}' - Taux de confirmation faible ({int(taux)}%)",
+                    'description': f"Seulement {int(taux)}% des évaluations de cette campagne sont confirmées.",
+                    'priorite': 'high' if taux < 30 else 'medium',
+                    'icone': 'fa-calendar-check',
+                    'categorie': 'campagne',
+                    'actions': [
+                        'Finaliser les évaluations en cours',
+                        'Prioriser les confirmations',
+                        'Organiser des sessions de validation'
+                    ],
+                    'delai_suggere': '30 jours',
+                    'impact': 'Élevé' if taux < 30 else 'Moyen',
+                    'campagne': campagne,
+                    'taux_actuel': round(taux, 1)
+                })
+
+        # ============================================================
+        # 13. ANALYSE DES TENDANCES DE SCORES
+        # ============================================================
+        if index.nb_evaluations >= 3:
+            for risque_id, scores in index.scores_par_risque.items():
+                if len(scores) >= 3 and scores[0] < scores[-1] and scores[-1] > scores[0] * 1.2:
+                    risque_ref = index.reference(risque_id)
                     suggestions.append({
-                        'id': f'sug_campagne_{campagne[:10].replace(" ", "_")}',
-                        'titre': f"📋 Campagne '{campagne}' - Taux de confirmation faible ({int(taux)}%)",
-                        'description': f"Seulement {int(taux)}% des évaluations de cette campagne sont confirmées.",
-                        'priorite': 'high' if taux < 30 else 'medium',
-                        'icone': 'fa-calendar-check',
-                        'categorie': 'campagne',
+                        'id': f'sug_tendance_hausse_{risque_id}',
+                        'titre': f"📈 Tendance haussière des scores pour {risque_ref}",
+                        'description': f"Le score du risque a augmenté de {scores[0]} à {scores[-1]}. Une analyse est recommandée.",
+                        'priorite': 'high',
+                        'icone': 'fa-chart-line',
+                        'categorie': 'evolution',
                         'actions': [
-                            'Finaliser les évaluations en cours',
-                            'Prioriser les confirmations',
-                            'Organiser des sessions de validation'
+                            'Analyser les causes de l\'augmentation',
+                            'Vérifier les contrôles en place',
+                            'Réévaluer le risque si nécessaire'
                         ],
-                        'delai_suggere': '30 jours',
-                        'impact': 'Élevé' if taux < 30 else 'Moyen',
-                        'campagne': campagne,
-                        'taux_actuel': round(taux, 1)
+                        'delai_suggere': '15 jours',
+                        'impact': 'Élevé'
                     })
-        
-        # ============================================================
-        # 13. ANALYSE DES TENDANCES DE SCORES
-        # ============================================================
-        if len(evaluations) >= 3:
-            scores_par_risque = {}
-            for e in evaluations:
-                if e.risque_id not in scores_par_risque:
-                    scores_par_risque[e.risque_id] = []
-                if e.score_risque:
-                    scores_par_risque[e.risque_id].append(e.score_risque)
-            
-            for risque_id, scores in scores_par_risque.items():
-                if len(scores) >= 3:
-                    if scores[0] < scores[-1] and scores[-1] > scores[0] * 1.2:
-                        risque = next((r for r in risques if r.id == risque_id), None)
-                        risque_ref = risque.reference if risque else 'N/A'
-                        suggestions.append({
-                            'id': f'sug_tendance_hausse_{risque_id}',
-                            'titre': f"📈 Tendance haussière des scores pour {risque_ref}",
-                            'description': f"Le score du risque a augmenté de {scores[0]} à {scores[-1]}. Une analyse est recommandée.",
-                            'priorite': 'high',
-                            'icone': 'fa-chart-line',
-                            'categorie': 'evolution',
-                            'actions': [
-                                'Analyser les causes de l\'augmentation',
-                                'Vérifier les contrôles en place',
-                                'Réévaluer le risque si nécessaire'
-                            ],
-                            'delai_suggere': '15 jours',
-                            'impact': 'Élevé'
-                        })
-                        break
-        
+                    break
+
         # ============================================================
         # 14. ANALYSE DE LA COUVERTURE PAR TYPE DE DISPOSITIF
         # ============================================================
-        types_dispositifs = {}
-        for d in dispositifs:
-            if d.type_dispositif:
-                types_dispositifs[d.type_dispositif] = types_dispositifs.get(d.type_dispositif, 0) + 1
+        types_dispositifs = index.types_dispositifs
 
         if types_dispositifs:
             preventif = types_dispositifs.get('Préventif', 0)
             detectif = types_dispositifs.get('Détectif', 0)
             correctif = types_dispositifs.get('Correctif', 0)
-            
+
             if preventif == 0 and (detectif > 0 or correctif > 0):
                 suggestions.append({
                     'id': 'sug_manque_preventif',
@@ -581,44 +694,42 @@ class AnalyseAlgorithmique:
                     'delai_suggere': '45 jours',
                     'impact': 'Élevé'
                 })
-        
+
         # ============================================================
         # 15. ANALYSE DES CONSTATS D'AUDIT
         # ============================================================
-        if constats_audit:
-            constats_ouverts = [c for c in constats_audit if c.statut != 'clos']
-            if constats_ouverts:
-                suggestions.append({
-                    'id': 'sug_constats_ouverts',
-                    'titre': f"📋 {len(constats_ouverts)} constat(s) d'audit ouvert(s)",
-                    'description': "Des constats d'audit sont encore ouverts. Leur traitement est prioritaire.",
-                    'priorite': 'high',
-                    'icone': 'fa-clipboard-list',
-                    'categorie': 'audit',
-                    'actions': [
-                        'Traiter les constats ouverts',
-                        'Planifier les actions correctives',
-                        'Suivre l\'avancement'
-                    ],
-                    'delai_suggere': '30 jours',
-                    'impact': 'Élevé'
-                })
-        
+        if index.constats_fournis and index.constats_ouverts:
+            suggestions.append({
+                'id': 'sug_constats_ouverts',
+                'titre': f"📋 {index.constats_ouverts} constat(s) d'audit ouvert(s)",
+                'description': "Des constats d'audit sont encore ouverts. Leur traitement est prioritaire.",
+                'priorite': 'high',
+                'icone': 'fa-clipboard-list',
+                'categorie': 'audit',
+                'actions': [
+                    'Traiter les constats ouverts',
+                    'Planifier les actions correctives',
+                    'Suivre l\'avancement'
+                ],
+                'delai_suggere': '30 jours',
+                'impact': 'Élevé'
+            })
+
         # ============================================================
         # 16. SUGGESTION DE RISQUES SUPPLÉMENTAIRES
         # ============================================================
         # Même si la cartographie n'est pas vide, proposer des risques
         # pour les catégories manquantes ou les types non couverts
-        
+
         if total_risques > 0:
-            categories_existantes = set([r.categorie for r in risques if r.categorie])
-            types_existants = set([r.type_risque for r in risques if r.type_risque])
+            categories_existantes = {cat.lower() for cat in categories}
+            types_existants = {typ.lower() for typ in index.types_risque}
 
             risques_supplementaires = []
 
             # 1. Catégories manquantes
             categories_importantes = ['Financier', 'Opérationnel', 'Réglementaire', 'Stratégique', 'Réputationnel', 'Informatique']
-            categories_manquantes = [c for c in categories_importantes if c.lower() not in [cat.lower() for cat in categories_existantes]]
+            categories_manquantes = [c for c in categories_importantes if c.lower() not in categories_existantes]
 
             if categories_manquantes:
                 for cat in categories_manquantes[:3]:
@@ -636,7 +747,7 @@ class AnalyseAlgorithmique:
 
             # 2. Types manquants
             types_importants = ['Inherent', 'Residuel', 'Cible', 'Externe', 'Interne']
-            types_manquants = [t for t in types_importants if t.lower() not in [typ.lower() for typ in types_existants]]
+            types_manquants = [t for t in types_importants if t.lower() not in types_existants]
 
             if types_manquants:
                 for typ in types_manquants[:2]:
@@ -683,13 +794,13 @@ class AnalyseAlgorithmique:
             # Ajouter aux risques proposés
             if risques_supplementaires:
                 risques_proposes = risques_supplementaires
-        
+
         # ============================================================
         # 17. SI CARTOGRAPHIE VIDE - PROPOSER DES RISQUES PAR DÉFAUT
         # ============================================================
         if total_risques == 0:
             risques_proposes = AnalyseAlgorithmique._generer_risques_par_defaut()
-            
+
             suggestions.append({
                 'id': 'sug_cartographie_vide',
                 'titre': '🚀 Démarrer votre cartographie des risques',
@@ -705,7 +816,7 @@ class AnalyseAlgorithmique:
                 'delai_suggere': '7 jours',
                 'impact': 'Critique'
             })
-        
+
         return {
             'suggestions': suggestions,
             'alertes': alertes,
@@ -714,11 +825,13 @@ class AnalyseAlgorithmique:
                 'total_risques': total_risques,
                 'taux_evaluation': taux_evaluation,
                 'taux_couverture': taux_couverture,
-                'incidents_recents': len(incidents_recents),
-                'commentaires_par_campagne': commentaires_par_campagne if evaluations else {}
+                'incidents_recents': index.incidents_recents,
+                'risques_evalues': evaluees,
+                'dispositifs_total': index.nb_dispositifs,
+                'commentaires_par_campagne': commentaires_par_campagne
             }
         }
-    
+
     @staticmethod
     def _generer_risques_par_defaut():
         """Génère des risques par défaut pour une cartographie vide"""
@@ -789,6 +902,8 @@ class AnalyseAlgorithmique:
         ]
 
 
+
+
 # ============================================================
 # PARTIE 2 : SERVICE HYBRIDE COMPLET
 # ============================================================
@@ -798,15 +913,101 @@ class AnalyseHybrideService:
     SERVICE HYBRIDE - Algorithmique + IA
     Toujours des suggestions disponibles
     """
-    
+
+    # Résultats mémorisés par (cartographie, version des données)
+    _cache = {}
+    _cache_time = {}
+    _verrou = threading.Lock()
+    CACHE_DURATION = 600  # secondes
+    CACHE_MAX = 256
+
+    @staticmethod
+    def version_cartographie(cartographie_id, client_id):
+        """
+        Empreinte des données analysées d'une cartographie (une requête) :
+        nombre de lignes et dernière modification de chaque source. Les
+        modifications de risques sans date (catégorie, type) sont couvertes
+        par la durée de vie du cache.
+        """
+        from sqlalchemy import select, func, literal, union_all
+        from models import (db, Risque, EvaluationRisque, DispositifMaitrise, Incident,
+                            DemandeReevaluation, Constatation)
+
+        risques = select(Risque.id).where(
+            Risque.cartographie_id == cartographie_id,
+            Risque.is_archived == False,
+            Risque.client_id == client_id
+        )
+
+        def empreinte(nom, modele, *conditions):
+            return (select(literal(nom).label('source'), func.count().label('nb'),
+                           func.max(modele.id).label('max_id'), func.max(modele.updated_at).label('maj'))
+                    .where(modele.risque_id.in_(risques), *conditions))
+
+        requete = union_all(
+            select(literal('risques').label('source'), func.count().label('nb'),
+                   func.max(Risque.id).label('max_id'), literal(None).label('maj'))
+            .where(Risque.id.in_(risques)),
+            empreinte('evaluations', EvaluationRisque),
+            empreinte('dispositifs', DispositifMaitrise, DispositifMaitrise.is_archived == False),
+            empreinte('incidents', Incident, Incident.is_archived == False),
+            empreinte('demandes', DemandeReevaluation),
+            empreinte('constats', Constatation),
+        )
+        lignes = sorted(tuple(ligne) for ligne in db.session.execute(requete))
+        # La fenêtre "incidents récents" glisse chaque jour
+        return (datetime.now().date().isoformat(),) + tuple(lignes)
+
+    @classmethod
+    def resultat_en_cache(cls, cartographie_id, version):
+        """Résultat mémorisé pour cette version des données, ou None"""
+        cle = (cartographie_id, version)
+        with cls._verrou:
+            if cle in cls._cache and time.monotonic() - cls._cache_time[cle] < cls.CACHE_DURATION:
+                return cls._cache[cle]
+        return None
+
+    @classmethod
+    def _memoriser(cls, cartographie_id, version, resultat):
+        cle = (cartographie_id, version)
+        with cls._verrou:
+            # Une seule version conservée par cartographie
+            for ancienne in [c for c in cls._cache if c[0] == cartographie_id]:
+                cls._cache.pop(ancienne, None)
+                cls._cache_time.pop(ancienne, None)
+            if len(cls._cache) >= cls.CACHE_MAX:
+                plus_ancienne = min(cls._cache_time, key=cls._cache_time.get)
+                cls._cache.pop(plus_ancienne, None)
+                cls._cache_time.pop(plus_ancienne, None)
+            cls._cache[cle] = resultat
+            cls._cache_time[cle] = time.monotonic()
+
+    @classmethod
+    def invalider(cls, cartographie_id=None):
+        """Vide le cache (d'une cartographie ou complet)"""
+        with cls._verrou:
+            for cle in [c for c in cls._cache if cartographie_id is None or c[0] == cartographie_id]:
+                cls._cache.pop(cle, None)
+                cls._cache_time.pop(cle, None)
+
     @staticmethod
     def analyser_complet(cartographie, risques, evaluations, dispositifs, incidents,
-                         demandes_reevaluation=None, constats_audit=None, 
-                         plans_action=None):
+                         demandes_reevaluation=None, constats_audit=None,
+                         plans_action=None, version=None):
         """
         Analyse complète avec système hybride
+        `version` (voir version_cartographie) active la mémorisation du résultat
         """
-        
+        cartographie_id = getattr(cartographie, 'id', cartographie)
+        if version is not None:
+            resultat = AnalyseHybrideService.resultat_en_cache(cartographie_id, version)
+            if resultat is not None:
+                return resultat
+
+        # 0. INDEX (un seul passage sur les données)
+        index = IndexAnalyse(risques, evaluations, dispositifs, incidents,
+                             demandes_reevaluation, constats_audit)
+
         # 1. ANALYSE ALGORITHMIQUE (TOUJOURS)
         resultat_algo = AnalyseAlgorithmique.generer_suggestions(
             risques=risques,
@@ -814,45 +1015,39 @@ class AnalyseHybrideService:
             dispositifs=dispositifs,
             incidents=incidents,
             demandes_reevaluation=demandes_reevaluation,
-            constats_audit=constats_audit
+            constats_audit=constats_audit,
+            index=index
         )
-        
+
         # 2. SUGGESTIONS IA (SIMULÉES SI API NON DISPONIBLE)
         suggestions_ia = []
         # Si vous avez une API OpenAI, décommentez cette partie
         # if AnalyseIA._is_available():
         #     suggestions_ia = AnalyseIA.generer_suggestions_ia(donnees) or []
-        
+
         # 3. FUSION
         suggestions = resultat_algo['suggestions']
-        
+
         # Ajouter les suggestions IA (sans doublons)
+        titres = {s['titre'] for s in suggestions}
         for ia_sug in suggestions_ia:
-            existe = any(s['titre'] == ia_sug.get('titre') for s in suggestions)
-            if not existe:
+            if ia_sug.get('titre') not in titres:
                 suggestions.append(ia_sug)
-        
+                titres.add(ia_sug.get('titre'))
+
         # 4. SCORE GLOBAL
-        score_global = AnalyseHybrideService._calculer_score_global(
-            risques, evaluations, dispositifs, incidents
-        )
-        
+        score_global = AnalyseHybrideService._calculer_score_global(index)
+
         # 5. INDICATEURS DE MATURITÉ
-        maturite = AnalyseHybrideService._calculer_maturite(
-            risques, evaluations, dispositifs, incidents
-        )
-        
+        maturite = AnalyseHybrideService._calculer_maturite(index)
+
         # 6. BENCHMARK
-        benchmark = AnalyseHybrideService._calculer_benchmark(
-            risques, evaluations, dispositifs, incidents
-        )
-        
+        benchmark = AnalyseHybrideService._calculer_benchmark(index)
+
         # 7. OBJECTIFS SMART
-        objectifs = AnalyseHybrideService._calculer_objectifs(
-            risques, evaluations, dispositifs, incidents
-        )
-        
-        return {
+        objectifs = AnalyseHybrideService._calculer_objectifs(index)
+
+        resultat = {
             'success': True,
             'score_global': score_global['score'],
             'niveau': score_global['niveau'],
@@ -868,11 +1063,15 @@ class AnalyseHybrideService:
             'benchmark': benchmark,
             'objectifs': objectifs
         }
-    
+
+        if version is not None:
+            AnalyseHybrideService._memoriser(cartographie_id, version, resultat)
+        return resultat
+
     @staticmethod
-    def _calculer_score_global(risques, evaluations, dispositifs, incidents):
+    def _calculer_score_global(index):
         """Calcule le score global"""
-        total_risques = len(risques)
+        total_risques = index.total_risques
         if total_risques == 0:
             return {
                 'score': 0,
@@ -880,51 +1079,42 @@ class AnalyseHybrideService:
                 'niveau_label': 'Faible',
                 'message': 'Cartographie vide - Commencez par ajouter des risques'
             }
-        
+
         score = 0
-        
+
         # Taux d'évaluation (30%)
-        evaluees = len([e for e in evaluations if e.date_confirmation])
-        taux_eval = (evaluees / total_risques * 100) if total_risques > 0 else 0
-        score += taux_eval * 0.3
-        
+        score += index.taux_evaluation * 0.3
+
         # Couverture dispositifs (25%)
-        risques_avec_dispo = set([d.risque_id for d in dispositifs])
-        taux_dispo = (len(risques_avec_dispo) / total_risques * 100) if total_risques > 0 else 0
-        score += min(taux_dispo * 0.25, 25)
-        
+        score += min(index.taux_couverture * 0.25, 25)
+
         # Incidents (20%)
-        date_limite = datetime.now() - timedelta(days=365)
-        incidents_recents = len([i for i in incidents if i.date_occurrence >= date_limite])
+        incidents_recents = index.incidents_recents
         if incidents_recents == 0:
             score += 20
         else:
             score += max(0, 20 - (incidents_recents * 2))
-        
+
         # Diversité des catégories (15%)
-        categories = set([r.categorie for r in risques if r.categorie])
-        if len(categories) >= 5:
+        nb_categories = len(index.categories)
+        if nb_categories >= 5:
             score += 15
-        elif len(categories) >= 3:
+        elif nb_categories >= 3:
             score += 10
-        elif len(categories) >= 1:
+        elif nb_categories >= 1:
             score += 5
-        
+
         # Niveaux de risque (10%)
-        niveaux = {}
-        for e in evaluations:
-            if e.niveau_risque:
-                niveaux[e.niveau_risque] = niveaux.get(e.niveau_risque, 0) + 1
-        critiques = niveaux.get('Critique', 0)
+        critiques = index.niveaux.get('Critique', 0)
         if critiques == 0:
             score += 10
         elif critiques <= 2:
             score += 5
         else:
             score += 2
-        
+
         score_final = int(min(100, score))
-        
+
         if score_final >= 80:
             return {'score': score_final, 'niveau': 'excellent', 'niveau_label': 'Excellent', 'message': 'Cartographie très mature'}
         elif score_final >= 60:
@@ -933,93 +1123,52 @@ class AnalyseHybrideService:
             return {'score': score_final, 'niveau': 'moyen', 'niveau_label': 'Moyen', 'message': 'Cartographie perfectible - Des actions sont nécessaires'}
         else:
             return {'score': score_final, 'niveau': 'faible', 'niveau_label': 'Faible', 'message': 'Cartographie immature - Une refonte est recommandée'}
-    
+
     @staticmethod
-    def _calculer_maturite(risques, evaluations, dispositifs, incidents):
+    def _calculer_maturite(index):
         """Calcule les indicateurs de maturité"""
-        total_risques = len(risques)
-        if total_risques == 0:
+        if index.total_risques == 0:
             return {}
-        
-        # Taux d'évaluation
-        evaluees = len([e for e in evaluations if e.date_confirmation])
-        taux_evaluation = (evaluees / total_risques * 100) if total_risques > 0 else 0
-        
-        # Couverture dispositifs
-        risques_avec_dispo = set([d.risque_id for d in dispositifs])
-        taux_couverture = (len(risques_avec_dispo) / total_risques * 100) if total_risques > 0 else 0
-        
-        # Incidents récents
-        date_limite = datetime.now() - timedelta(days=365)
-        incidents_recents = len([i for i in incidents if i.date_occurrence >= date_limite])
-        
-        # Qualité des évaluations
-        qualite_moyenne = 0
-        if evaluations:
-            scores_qualite = []
-            for e in evaluations:
-                qualite = 0
-                if e.impact_pre and e.probabilite_pre:
-                    qualite += 1
-                if e.commentaire_pre_evaluation and len(e.commentaire_pre_evaluation) > 10:
-                    qualite += 1
-                if e.commentaire_validation and len(e.commentaire_validation) > 10:
-                    qualite += 1
-                if e.commentaire_confirmation and len(e.commentaire_confirmation) > 10:
-                    qualite += 1
-                scores_qualite.append(qualite / 4 * 100)
-            qualite_moyenne = statistics.mean(scores_qualite) if scores_qualite else 0
-        
-        # Catégories
-        categories = set([r.categorie for r in risques if r.categorie])
-        
+
         return {
             'evaluation': {
-                'score': min(100, taux_evaluation * 1.2),
+                'score': min(100, index.taux_evaluation * 1.2),
                 'label': 'Évaluations',
                 'couleur': '#3b82f6'
             },
             'dispositifs': {
-                'score': min(100, taux_couverture * 1.3),
+                'score': min(100, index.taux_couverture * 1.3),
                 'label': 'Dispositifs',
                 'couleur': '#10b981'
             },
             'incidents': {
-                'score': max(0, 100 - incidents_recents * 5),
+                'score': max(0, 100 - index.incidents_recents * 5),
                 'label': 'Incidents',
                 'couleur': '#ef4444'
             },
             'qualite': {
-                'score': qualite_moyenne,
+                'score': index.qualite_moyenne,
                 'label': 'Qualité',
                 'couleur': '#8b5cf6'
             },
             'couverture': {
-                'score': min(100, len(categories) * 20),
+                'score': min(100, len(index.categories) * 20),
                 'label': 'Couverture',
                 'couleur': '#f59e0b'
             }
         }
-    
+
     @staticmethod
-    def _calculer_benchmark(risques, evaluations, dispositifs, incidents):
+    def _calculer_benchmark(index):
         """Calcule le benchmark sectoriel"""
-        total_risques = len(risques)
-        if total_risques == 0:
+        if index.total_risques == 0:
             return {}
-        
-        evaluees = len([e for e in evaluations if e.date_confirmation])
-        taux_evaluation = (evaluees / total_risques * 100) if total_risques > 0 else 0
-        
-        risques_avec_dispo = set([d.risque_id for d in dispositifs])
-        taux_couverture = (len(risques_avec_dispo) / total_risques * 100) if total_risques > 0 else 0
-        
-        date_limite = datetime.now() - timedelta(days=365)
-        incidents_recents = len([i for i in incidents if i.date_occurrence >= date_limite])
-        
-        scores_risques = [e.score_risque for e in evaluations if e.score_risque]
-        score_moyen = statistics.mean(scores_risques) if scores_risques else 0
-        
+
+        taux_evaluation = index.taux_evaluation
+        taux_couverture = index.taux_couverture
+        incidents_recents = index.incidents_recents
+        score_moyen = index.score_moyen
+
         return {
             'taux_evaluation': {
                 'actuel': round(taux_evaluation, 1),
@@ -1042,42 +1191,18 @@ class AnalyseHybrideService:
                 'ecart': round(score_moyen - 12, 1)
             }
         }
-    
+
     @staticmethod
-    def _calculer_objectifs(risques, evaluations, dispositifs, incidents):
+    def _calculer_objectifs(index):
         """Calcule les objectifs SMART"""
-        total_risques = len(risques)
-        if total_risques == 0:
+        if index.total_risques == 0:
             return []
-        
-        evaluees = len([e for e in evaluations if e.date_confirmation])
-        taux_evaluation = (evaluees / total_risques * 100) if total_risques > 0 else 0
-        
-        risques_avec_dispo = set([d.risque_id for d in dispositifs])
-        taux_couverture = (len(risques_avec_dispo) / total_risques * 100) if total_risques > 0 else 0
-        
-        nb_risques_critiques = 0
-        for e in evaluations:
-            if e.niveau_risque == 'Critique':
-                nb_risques_critiques += 1
-        
-        # Qualité des évaluations
-        qualite_moyenne = 0
-        if evaluations:
-            scores_qualite = []
-            for e in evaluations:
-                qualite = 0
-                if e.impact_pre and e.probabilite_pre:
-                    qualite += 1
-                if e.commentaire_pre_evaluation and len(e.commentaire_pre_evaluation) > 10:
-                    qualite += 1
-                if e.commentaire_validation and len(e.commentaire_validation) > 10:
-                    qualite += 1
-                if e.commentaire_confirmation and len(e.commentaire_confirmation) > 10:
-                    qualite += 1
-                scores_qualite.append(qualite / 4 * 100)
-            qualite_moyenne = statistics.mean(scores_qualite) if scores_qualite else 0
-        
+
+        taux_evaluation = index.taux_evaluation
+        taux_couverture = index.taux_couverture
+        nb_risques_critiques = index.niveaux.get('Critique', 0)
+        qualite_moyenne = index.qualite_moyenne
+
         objectifs = [
             {
                 'titre': 'Atteindre 80% de taux d\'évaluation',
@@ -1108,5 +1233,5 @@ class AnalyseHybrideService:
                 'statut': 'termine' if qualite_moyenne >= 80 else 'en_cours'
             }
         ]
-        
+
         return objectifs
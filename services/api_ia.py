@@ -5,14 +5,17 @@ import os
 import json
 from typing import Optional, Dict, Any
 
-try:
-    import openai
-    from openai import OpenAI
-    OPENAI_AVAILABLE = True
-except ImportError:
-    OPENAI_AVAILABLE = False
+from chargement_differe import ModuleParesseux, module_disponible
+
+# Le SDK OpenAI n'est importé qu'au premier appel réel
+OPENAI_AVAILABLE = module_disponible('openai')
+if OPENAI_AVAILABLE:
+    openai = ModuleParesseux('openai')
+else:
     print("⚠️ OpenAI non disponible")
 
+from services.ia_cache_service import IACacheService
+
 class APIIntegration:
     """Intégration avec les APIs IA externes"""
     
@@ -28,7 +31,7 @@ class APIIntegration:
         Returns:
             Dict avec les résultats de l'analyse ou None en cas d'erreur
         """
-        if not OPENAI_AVAILABLE:
+        if not OPENAI_AVAILABLE and not IACacheService.mode_factice():
             print("❌ OpenAI non disponible")
             return None
         
@@ -36,11 +39,11 @@ class APIIntegration:
             # Utiliser la clé fournie ou celle de l'environnement
             api_key = api_key or os.getenv('OPENAI_API_KEY')
             
-            if not api_key:
+            if not api_key and not IACacheService.mode_factice():
                 print("❌ Clé API OpenAI manquante")
                 return None
             
-            client = OpenAI(api_key=api_key)
+            client = IACacheService.get_client_openai(api_key)
             
             # Construire le prompt
             prompt = f"""
@@ -68,24 +71,30 @@ class APIIntegration:
             - score_confiance (nombre)
             """
             
-            response = client.chat.completions.create(
-                model="gpt-4-turbo-preview",  # ou "gpt-3.5-turbo" pour un coût réduit
-                messages=[
-                    {
-                        "role": "system", 
-                        "content": "Tu es un expert en audit et contrôle interne. Tu fournis des analyses précises et des recommandations pratiques."
-                    },
-                    {
-                        "role": "user", 
-                        "content": prompt
-                    }
-                ],
-                temperature=0.7,
-                max_tokens=1500,
-                response_format={"type": "json_object"}
-            )
-            
-            result_text = response.choices[0].message.content
+            modele = "gpt-4-turbo-preview"  # ou "gpt-3.5-turbo" pour un coût réduit
+            messages = [
+                {
+                    "role": "system", 
+                    "content": "Tu es un expert en audit et contrôle interne. Tu fournis des analyses précises et des recommandations pratiques."
+                },
+                {
+                    "role": "user", 
+                    "content": prompt
+                }
+            ]
+            parametres = {'temperature': 0.7, 'max_tokens': 1500, 'response_format': 'json_object'}
+            
+            def appel():
+                response = client.chat.completions.create(
+                    model=modele,
+                    messages=messages,
+                    temperature=0.7,
+                    max_tokens=1500,
+                    response_format={"type": "json_object"}
+                )
+                return response.choices[0].message.content
+            
+            result_text = IACacheService.obtenir_ou_calculer('openai', modele, messages, appel, parametres)
             
             try:
                 result = json.loads(result_text)
@@ -119,7 +128,8 @@ class APIIntegration:
             genai.configure(api_key=api_key)
             
             # Sélectionner un modèle
-            model = genai.GenerativeModel('gemini-pro')
+            nom_modele = 'gemini-pro'
+            model = genai.GenerativeModel(nom_modele)
             
             prompt = f"""
             Analyse cet audit et fournis des recommandations:
@@ -129,13 +139,16 @@ class APIIntegration:
             Fournis une réponse en JSON.
             """
             
-            response = model.generate_content(prompt)
+            response_text = IACacheService.obtenir_ou_calculer(
+                'gemini', nom_modele, prompt,
+                lambda: model.generate_content(prompt).text
+            )
             
             # Essayer d'extraire du JSON de la réponse
             import re
             
             # Chercher du JSON dans la réponse
-            json_match = re.search(r'\{.*\}', response.text, re.DOTALL)
+            json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
             
             if json_match:
                 try:
@@ -143,9 +156,9 @@ class APIIntegration:
                     return result
                 except json.JSONDecodeError:
                     # Si échec, retourner la réponse textuelle
-                    return {'reponse_textuelle': response.text}
+                    return {'reponse_textuelle': response_text}
             else:
-                return {'reponse_textuelle': response.text}
+                return {'reponse_textuelle': response_text}
                 
         except ImportError:
             print("❌ Google Generative AI non installé")
@@ -160,15 +173,13 @@ class APIIntegration:
         Analyser avec Anthropic Claude
         """
         try:
-            import anthropic
-            
             api_key = api_key or os.getenv('ANTHROPIC_API_KEY')
             
-            if not api_key:
+            if not api_key and not IACacheService.mode_factice():
                 print("❌ Clé API Anthropic manquante")
                 return None
             
-            client = anthropic.Anthropic(api_key=api_key)
+            client = IACacheService.get_client_anthropic(api_key)
             
             prompt = f"""
             Analyse cet audit et fournis des recommandations:
@@ -178,21 +189,30 @@ class APIIntegration:
             Fournis une réponse en JSON.
             """
             
-            response = client.messages.create(
-                model="claude-3-opus-20240229",  # ou "claude-3-sonnet-20240229" pour un coût réduit
-                max_tokens=1000,
-                temperature=0.7,
-                system="Tu es un expert en audit et contrôle interne.",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ]
-            )
+            modele = "claude-3-opus-20240229"  # ou "claude-3-sonnet-20240229" pour un coût réduit
+            systeme = "Tu es un expert en audit et contrôle interne."
+            messages = [
+                {
+                    "role": "user",
+                    "content": prompt
+                }
+            ]
+            
+            def appel():
+                response = client.messages.create(
+                    model=modele,
+                    max_tokens=1000,
+                    temperature=0.7,
+                    system=systeme,
+                    messages=messages
+                )
+                return response.content[0].text
             
             # Traiter la réponse
-            result_text = response.content[0].text
+            result_text = IACacheService.obtenir_ou_calculer(
+                'anthropic', modele, [{'role': 'system', 'content': systeme}] + messages, appel,
+                {'temperature': 0.7, 'max_tokens': 1000}
+            )
             
             try:
                 # Essayer d'extraire du JSON
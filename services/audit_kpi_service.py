@@ -0,0 +1,169 @@
+# services/audit_kpi_service.py
+"""
+Indicateurs d'avancement des audits calculés par lot.
+
+Progression, taux de réalisation des recommandations et des plans, score
+global et couleur sont obtenus pour une liste d'audits en une requête
+groupée (comptage par audit et par statut), au lieu de charger les
+constatations / recommandations / plans de chaque audit.
+
+Les résultats ne sont conservés que le temps de la requête (dans g) :
+precharger calcule la liste d'audits d'une page en un lot, puis chaque
+audit.kpi du template lit ce lot. Une requête suivante, quel que soit le
+worker, recalcule à partir de la base. Une écriture sur une constatation,
+une recommandation ou un plan d'action retire l'audit du lot de la requête.
+"""
+from flask import g, has_request_context
+from sqlalchemy import event, select, func, literal, union_all, inspect
+
+from models import db, Constatation, Recommandation, PlanAction
+
+
+# Points attribués à une constatation selon son statut (sur 100)
+POINTS_CONSTATATION = {'clos': 100, 'en_action': 50, 'a_valider': 25}
+
+POIDS_SCORE = {'progression': 0.4, 'recommandations': 0.4, 'plans': 0.2}
+
+SOURCES = {
+    'constatations': Constatation,
+    'recommandations': Recommandation,
+    'plans_action': PlanAction,
+}
+
+
+def couleur_pour_score(score):
+    """Couleur Bootstrap en fonction du score"""
+    if score >= 80:
+        return 'success'
+    elif score >= 60:
+        return 'info'
+    elif score >= 40:
+        return 'warning'
+    return 'danger'
+
+
+def _kpi_depuis_comptages(comptages):
+    """comptages : {'constatations': {statut: n}, 'recommandations': {...}, 'plans_action': {...}}"""
+    constatations = comptages.get('constatations', {})
+    recommandations = comptages.get('recommandations', {})
+    plans = comptages.get('plans_action', {})
+
+    nb_constatations = sum(constatations.values())
+    nb_recommandations = sum(recommandations.values())
+    nb_plans = sum(plans.values())
+
+    progression = 0
+    if nb_constatations:
+        points = sum(POINTS_CONSTATATION.get(statut, 0) * n for statut, n in constatations.items())
+        progression = round(points / (nb_constatations * 100) * 100, 2)
+
+    taux_recommandations = round(recommandations.get('termine', 0) / nb_recommandations * 100, 2) if nb_recommandations else 0
+    taux_plans = round(plans.get('termine', 0) / nb_plans * 100, 2) if nb_plans else 0
+
+    score = 0
+    if nb_constatations or nb_recommandations or nb_plans:
+        score = min(round(
+            progression * POIDS_SCORE['progression'] +
+            taux_recommandations * POIDS_SCORE['recommandations'] +
+            taux_plans * POIDS_SCORE['plans'], 2), 100)
+
+    return {
+        'progression_globale': progression,
+        'taux_realisation_recommandations': taux_recommandations,
+        'taux_realisation_plans': taux_plans,
+        'score_global': score,
+        'couleur_progression': couleur_pour_score(score),
+        'nb_constatations': nb_constatations,
+        'nb_recommandations': nb_recommandations,
+        'nb_plans_action': nb_plans,
+    }
+
+
+KPI_VIDE = _kpi_depuis_comptages({})
+
+
+class AuditKPIService:
+    """Calcul groupé des indicateurs d'audit, mémorisé pour la requête en cours"""
+
+    @staticmethod
+    def _memoire():
+        """Indicateurs déjà calculés dans cette requête ({} hors requête : pas de mémoire)"""
+        if not has_request_context():
+            return {}
+        return g.setdefault('kpi_audits', {})
+
+    @classmethod
+    def calculer(cls, audit_ids, force_refresh=False):
+        """{audit_id: kpi} pour une liste d'ids ; une seule requête pour les ids pas encore calculés"""
+        ids = {i for i in audit_ids if i is not None}
+        memoire = cls._memoire()
+        resultat = {} if force_refresh else {i: memoire[i] for i in ids if i in memoire}
+
+        manquants = ids - resultat.keys()
+        if manquants:
+            calcules = cls._calculer_sql(manquants)
+            memoire.update(calcules)
+            resultat.update(calcules)
+
+        return resultat
+
+    @classmethod
+    def pour_audit(cls, audit):
+        """Indicateurs d'un audit (objet Audit ou id)"""
+        audit_id = audit if isinstance(audit, int) else getattr(audit, 'id', None)
+        if audit_id is None:
+            return dict(KPI_VIDE)
+        return cls.calculer([audit_id])[audit_id]
+
+    @classmethod
+    def precharger(cls, audits):
+        """Calcule en un lot les indicateurs d'une liste d'audits ; retourne {audit_id: kpi}"""
+        return cls.calculer([a.id for a in audits])
+
+    @staticmethod
+    def _calculer_sql(audit_ids):
+        requetes = [
+            select(literal(nom).label('source'), modele.audit_id, modele.statut, func.count().label('nb'))
+            .where(modele.audit_id.in_(audit_ids))
+            .group_by(modele.audit_id, modele.statut)
+            for nom, modele in SOURCES.items()
+        ]
+
+        comptages = {audit_id: {nom: {} for nom in SOURCES} for audit_id in audit_ids}
+        for source, audit_id, statut, nb in db.session.execute(union_all(*requetes)):
+            comptages[audit_id][source][statut] = nb
+
+        return {audit_id: _kpi_depuis_comptages(c) for audit_id, c in comptages.items()}
+
+    @classmethod
+    def invalider(cls, *audit_ids):
+        """Oublie les indicateurs calculés dans cette requête (tous si aucun id)"""
+        memoire = cls._memoire()
+        if not audit_ids:
+            memoire.clear()
+        for audit_id in audit_ids:
+            memoire.pop(audit_id, None)
+
+
+# ============================================
+# INVALIDATION
+# ============================================
+
+def _audits_concernes(target):
+    """audit_id courant et, en cas de déplacement, l'ancien"""
+    ids = {target.audit_id}
+    historique = inspect(target).attrs.audit_id.history
+    ids.update(historique.deleted or ())
+    return {i for i in ids if i is not None}
+
+
+def _enregistrer_invalidation(modele):
+    def invalider(mapper, connection, target):
+        AuditKPIService.invalider(*_audits_concernes(target))
+
+    for evenement in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(modele, evenement, invalider)
+
+
+for _modele in SOURCES.values():
+    _enregistrer_invalidation(_modele)
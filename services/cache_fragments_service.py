@@ -0,0 +1,344 @@
+# services/cache_fragments_service.py
+"""
+Cache des fragments de templates rendus.
+
+Les pages lourdes (détail de cartographie, tableaux de bord d'audit...)
+entourent leurs sections coûteuses d'une balise Jinja :
+
+    {% fragment 'cartographie_detail', cartographie.id, version_fragment %}
+        ... matrices, tableaux ...
+    {% endfragment %}
+
+Le HTML rendu est conservé sous une clé composée du nom, du client, de la
+langue, de l'entité, des droits de l'utilisateur et d'une version des
+données. La vue calcule cette version par une seule requête (CacheFragments.version)
+et, si le fragment est déjà en cache (CacheFragments.obtenir), saute les
+requêtes qui ne servent qu'au fragment.
+
+La version combine une empreinte en base (nombre de lignes, dernier id,
+dernière modification par source) et un compteur de générations par table
+et par client incrémenté par les hooks SQLAlchemy (modèles sans colonne de
+modification). Les générations sont dans Redis si configuré, sinon dans la
+table generations_fragments, écrite dans la transaction de la modification :
+tous les workers voient la même version. Les fragments sont dans Redis ou
+dans la mémoire du processus (un fragment d'une version dépassée n'est
+plus jamais lu).
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from flask import g, has_request_context
+from flask_login import current_user
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+from sqlalchemy import event, select, func, literal, union_all, cast, null
+from sqlalchemy.orm import object_session
+
+from models import db, User, GenerationFragment
+from services.ecriture_sql import inserer_ou_mettre_a_jour
+
+try:
+    from flask_wtf.csrf import generate_csrf
+except ImportError:
+    generate_csrf = None
+
+# Les jetons CSRF sont propres à la session : remplacés à la lecture
+MARQUEUR_CSRF = '\x00csrf_token\x00'
+
+G = GenerationFragment.__table__
+
+# Clé des lignes sans client dans generations_fragments
+GENERATION_SANS_CLIENT = 0
+
+
+class CacheFragments:
+    """Stockage des fragments, clés et versions des données"""
+
+    _fragments = OrderedDict()
+    _fragments_time = {}
+    _verrou = threading.Lock()
+    CACHE_DURATION = 300  # secondes
+    CACHE_MAX = 500
+    _redis = None
+    PREFIXE_REDIS = 'fragment:'
+    PREFIXE_GENERATION = 'fragment_gen:'
+
+    _langue = None
+    actif = True
+
+    @classmethod
+    def init_app(cls, app, langue=None):
+        """Enregistre la balise {% fragment %} ; `langue` renvoie la langue de la requête"""
+        app.jinja_env.add_extension(ExtensionFragments)
+        cls._langue = langue
+        cls.actif = app.config.get('CACHE_FRAGMENTS', True)
+
+    @classmethod
+    def configurer_redis(cls, client_redis):
+        """Partage fragments et générations entre workers"""
+        cls._redis = client_redis
+
+    # ============================================
+    # CLÉS
+    # ============================================
+
+    @classmethod
+    def cle(cls, nom, entite_id=None, version=None):
+        client_id = None
+        droits = None
+        if has_request_context() and current_user and current_user.is_authenticated:
+            client_id = current_user.client_id
+            droits = cls._empreinte_droits(current_user)
+        langue = cls._langue() if cls._langue and has_request_context() else None
+        empreinte = hashlib.sha1(repr((version, droits)).encode('utf-8')).hexdigest()
+        return f"{nom}:{client_id}:{langue}:{entite_id}:{empreinte}"
+
+    @staticmethod
+    def _empreinte_droits(utilisateur):
+        """Rôle et permissions effectives (les fragments peuvent afficher des actions selon les droits)"""
+        profil = getattr(utilisateur, '_profil', None)
+        if profil is not None:
+            permissions = profil['permissions_effectives']
+        else:
+            permissions = User.permissions_effectives_pour(
+                utilisateur.role, getattr(utilisateur, 'is_client_admin', False), utilisateur.permissions
+            )
+        actives = sorted(p for p, valeur in permissions.items() if valeur)
+        return (utilisateur.role, bool(getattr(utilisateur, 'is_client_admin', False)), tuple(actives))
+
+    # ============================================
+    # LECTURE / ÉCRITURE
+    # ============================================
+
+    @classmethod
+    def obtenir(cls, nom, entite_id=None, version=None):
+        """
+        Fragment en cache ou None. Un fragment trouvé ici est réservé à la
+        requête : la balise du template le réutilise même s'il expire entre-temps.
+        """
+        if not cls.actif:
+            return None
+        cle = cls.cle(nom, entite_id, version)
+        html = cls._lire(cle)
+        if html is not None and has_request_context():
+            g.setdefault('fragments_servis', {})[cle] = html
+        return html
+
+    @classmethod
+    def _lire(cls, cle):
+        if cls._redis is not None:
+            try:
+                brut = cls._redis.get(f"{cls.PREFIXE_REDIS}{cle}")
+                return brut.decode('utf-8') if brut is not None else None
+            except Exception as e:
+                print(f"⚠️ Cache Redis des fragments indisponible: {e}")
+                return None
+        with cls._verrou:
+            if cle in cls._fragments and time.monotonic() - cls._fragments_time[cle] < cls.CACHE_DURATION:
+                cls._fragments.move_to_end(cle)
+                return cls._fragments[cle]
+        return None
+
+    @classmethod
+    def _ecrire(cls, cle, html):
+        if cls._redis is not None:
+            try:
+                cls._redis.setex(f"{cls.PREFIXE_REDIS}{cle}", cls.CACHE_DURATION, html.encode('utf-8'))
+            except Exception as e:
+                print(f"⚠️ Cache Redis des fragments indisponible: {e}")
+            return
+        with cls._verrou:
+            cls._fragments[cle] = html
+            cls._fragments.move_to_end(cle)
+            cls._fragments_time[cle] = time.monotonic()
+            while len(cls._fragments) > cls.CACHE_MAX:
+                ancienne, _ = cls._fragments.popitem(last=False)
+                cls._fragments_time.pop(ancienne, None)
+
+    @classmethod
+    def rendre(cls, nom, entite_id, version, caller):
+        """Appelée par la balise {% fragment %}"""
+        if not cls.actif:
+            return caller()
+        cle = cls.cle(nom, entite_id, version)
+        html = g.get('fragments_servis', {}).get(cle) if has_request_context() else None
+        if html is None:
+            html = cls._lire(cle)
+        if html is None:
+            html = str(caller())
+            jeton = cls._jeton_csrf()
+            cls._ecrire(cle, html.replace(jeton, MARQUEUR_CSRF) if jeton else html)
+            return Markup(html)
+        if MARQUEUR_CSRF in html:
+            html = html.replace(MARQUEUR_CSRF, cls._jeton_csrf() or '')
+        return Markup(html)
+
+    @staticmethod
+    def _jeton_csrf():
+        if generate_csrf is None or not has_request_context():
+            return None
+        try:
+            return generate_csrf()
+        except Exception:
+            return None
+
+    @classmethod
+    def invalider(cls, prefixe=None):
+        """Supprime les fragments dont la clé commence par `prefixe` (tous si None)"""
+        with cls._verrou:
+            for cle in [c for c in cls._fragments if prefixe is None or c.startswith(prefixe)]:
+                cls._fragments.pop(cle, None)
+                cls._fragments_time.pop(cle, None)
+        if cls._redis is not None:
+            try:
+                for cle in cls._redis.scan_iter(f"{cls.PREFIXE_REDIS}{prefixe or ''}*"):
+                    cls._redis.delete(cle)
+            except Exception as e:
+                print(f"⚠️ Invalidation Redis des fragments impossible: {e}")
+
+    # ============================================
+    # VERSIONS DES DONNÉES
+    # ============================================
+
+    @classmethod
+    def version(cls, client_id, *sources):
+        """
+        Version des données d'un fragment en une requête. Chaque source est
+        (modele, condition, ...) : nombre de lignes, dernier id et dernière
+        modification, plus la génération du modèle pour ce client et la date
+        du jour (échéances, retards).
+        """
+        tables = sorted({source[0].__table__.name for source in sources})
+        requetes = []
+        for rang, (modele, *conditions) in enumerate(sources):
+            modification = getattr(modele, 'updated_at', None)
+            requetes.append(
+                select(
+                    literal(rang).label('rang'),
+                    func.count().label('nb'),
+                    func.max(modele.id).label('max_id'),
+                    func.max(modification).label('maj') if modification is not None
+                    else cast(null(), db.DateTime).label('maj'),
+                ).select_from(modele).where(*conditions)
+            )
+        if tables and cls._redis is None:
+            # Générations en base : leur somme suffit, les compteurs ne font que croître
+            requetes.append(
+                select(
+                    literal(-1).label('rang'),
+                    func.count().label('nb'),
+                    func.sum(G.c.generation).label('max_id'),
+                    cast(null(), db.DateTime).label('maj'),
+                ).where(G.c.table_nom.in_(tables), G.c.client_id == cls._cle_client(client_id))
+            )
+        empreinte = ()
+        if requetes:
+            lignes = db.session.execute(union_all(*requetes) if len(requetes) > 1 else requetes[0])
+            empreinte = tuple(sorted((rang, nb, max_id, str(maj)) for rang, nb, max_id, maj in lignes))
+        generations = cls.generations(client_id, *tables) if cls._redis is not None else ()
+        return (datetime.now().date().isoformat(), empreinte, generations)
+
+    @classmethod
+    def generations(cls, client_id, *tables):
+        """Générations Redis des tables pour ce client"""
+        tables = sorted(tables)
+        try:
+            valeurs = cls._redis.mget([f"{cls.PREFIXE_GENERATION}{t}:{client_id}" for t in tables])
+            return tuple(int(v or 0) for v in valeurs)
+        except Exception as e:
+            print(f"⚠️ Générations Redis des fragments indisponibles: {e}")
+            return None
+
+    @classmethod
+    def incrementer(cls, table, client_id):
+        try:
+            cls._redis.incr(f"{cls.PREFIXE_GENERATION}{table}:{client_id}")
+        except Exception as e:
+            print(f"⚠️ Générations Redis des fragments indisponibles: {e}")
+
+    @classmethod
+    def incrementer_en_base(cls, connection, cles):
+        """Incrémente les générations (table, client) dans la transaction de `connection`"""
+        maintenant = datetime.utcnow()
+        inserer_ou_mettre_a_jour(
+            connection, G,
+            [{'table_nom': table, 'client_id': cls._cle_client(client_id), 'generation': 1,
+              'updated_at': maintenant} for table, client_id in cles],
+            ['table_nom', 'client_id'],
+            maj={'generation': G.c.generation + 1},
+        )
+
+    @staticmethod
+    def _cle_client(client_id):
+        return GENERATION_SANS_CLIENT if client_id is None else client_id
+
+    @classmethod
+    def surveiller(cls, *modeles):
+        """Incrémente la génération (table, client) à chaque écriture ORM de ces modèles"""
+        for modele in modeles:
+            for evenement in ('after_insert', 'after_update', 'after_delete'):
+                event.listen(modele, evenement, _incrementer_generation)
+
+
+# ============================================
+# HOOKS
+# ============================================
+
+def _incrementer_generation(mapper, connection, target):
+    cle = (mapper.local_table.name, getattr(target, 'client_id', None))
+    session = object_session(target)
+    if CacheFragments._redis is None:
+        # Sans Redis : compteur en base, écrit après le flush (_incrementer_apres_flush)
+        if session is not None:
+            session.info.setdefault('generations_fragments_base', set()).add(cle)
+        return
+    CacheFragments.incrementer(*cle)
+    # À nouveau au commit : une requête concurrente entre le flush et le
+    # commit a pu mettre en cache un fragment des données précédentes
+    if session is not None:
+        session.info.setdefault('generations_fragments', set()).add(cle)
+
+
+@event.listens_for(db.session, 'after_flush_postexec')
+def _incrementer_apres_flush(session, flush_context):
+    cles = session.info.pop('generations_fragments_base', None)
+    if cles:
+        CacheFragments.incrementer_en_base(session.connection(), cles)
+
+
+@event.listens_for(db.session, 'after_commit')
+@event.listens_for(db.session, 'after_rollback')
+def _incrementer_fin_transaction(session):
+    session.info.pop('generations_fragments_base', None)
+    cles = session.info.pop('generations_fragments', None)
+    for cle in cles or ():
+        CacheFragments.incrementer(*cle)
+
+
+# ============================================
+# BALISE JINJA
+# ============================================
+
+class ExtensionFragments(Extension):
+    """{% fragment nom, entite_id, version %} ... {% endfragment %}"""
+
+    tags = {'fragment'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        arguments = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            arguments.append(parser.parse_expression())
+        while len(arguments) < 3:
+            arguments.append(nodes.Const(None))
+        corps = parser.parse_statements(['name:endfragment'], drop_needle=True)
+        return nodes.CallBlock(
+            self.call_method('_rendre', arguments[:3]), [], [], corps
+        ).set_lineno(lineno)
+
+    def _rendre(self, nom, entite_id, version, caller):
+        return CacheFragments.rendre(nom, entite_id, version, caller)
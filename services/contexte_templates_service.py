@@ -0,0 +1,151 @@
+# services/contexte_templates_service.py
+"""
+Contexte commun des templates, calculé une fois par requête.
+
+Les fonctions qui alimentaient @app.context_processor sont déclarées comme
+fournisseurs :
+
+    @contexte_templates.fournisseur
+    def inject_lang():
+        return {...}
+
+Un seul context processor les exécute dans l'ordre de déclaration (une
+clé redéfinie par un fournisseur suivant l'emporte, comme avec Flask) et
+conserve le résultat dans g : les render_template suivants de la même
+requête (e-mails, fragments, partiels) le réutilisent.
+
+Les valeurs partagées entre fournisseurs sont mémorisées par requête
+(@ContexteTemplates.par_requete) et la liste des clients actifs est
+gardée en cache, invalidée par les écritures sur Client.
+"""
+import threading
+import time
+from collections import namedtuple
+from functools import wraps
+
+from flask import g, has_request_context
+from sqlalchemy import event, select
+from sqlalchemy.orm import object_session
+
+from models import db, Client
+
+
+# Colonnes du client utilisées par les sélecteurs de client des templates
+ClientResume = namedtuple('ClientResume', ('id', 'nom', 'reference'))
+
+
+class ContexteTemplates:
+    """Fournisseurs de contexte des templates, mémorisés par requête"""
+
+    _clients_actifs = None
+    _clients_actifs_time = 0.0
+    _verrou = threading.Lock()
+    CACHE_DURATION = 300  # secondes (borne l'obsolescence entre workers)
+
+    def __init__(self, app=None):
+        self._fournisseurs = []
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.context_processor(self.contexte)
+
+    def fournisseur(self, fonction):
+        """Décorateur : ajoute la fonction aux fournisseurs de contexte"""
+        self._fournisseurs.append(fonction)
+        return fonction
+
+    def contexte(self):
+        """Context processor unique : fusion des fournisseurs, une fois par requête"""
+        if not has_request_context():
+            return self._calculer()
+        contexte = g.get('contexte_templates')
+        if contexte is None:
+            contexte = g.contexte_templates = self._calculer()
+        return contexte
+
+    def _calculer(self):
+        contexte = {}
+        for fournisseur in self._fournisseurs:
+            contexte.update(fournisseur())
+        return contexte
+
+    @staticmethod
+    def invalider_requete():
+        """À appeler si une vue modifie la session (client visualisé...) puis rend un template"""
+        if has_request_context():
+            g.pop('contexte_templates', None)
+            g.pop('valeurs_par_requete', None)
+
+    # ============================================
+    # VALEURS MÉMORISÉES PAR REQUÊTE
+    # ============================================
+
+    @staticmethod
+    def par_requete(fonction):
+        """Mémorise le résultat d'une fonction sans argument pour la requête en cours"""
+        @wraps(fonction)
+        def wrapper():
+            if not has_request_context():
+                return fonction()
+            valeurs = g.setdefault('valeurs_par_requete', {})
+            if fonction.__name__ not in valeurs:
+                valeurs[fonction.__name__] = fonction()
+            return valeurs[fonction.__name__]
+        return wrapper
+
+    # ============================================
+    # CLIENTS ACTIFS (CACHE)
+    # ============================================
+
+    @classmethod
+    def clients_actifs(cls):
+        """Clients actifs triés par nom (ClientResume), en cache"""
+        with cls._verrou:
+            if cls._clients_actifs is not None and time.monotonic() - cls._clients_actifs_time < cls.CACHE_DURATION:
+                return cls._clients_actifs
+
+        lignes = db.session.execute(
+            select(Client.id, Client.nom, Client.reference)
+            .where(Client.is_active == True)
+            .order_by(Client.nom)
+        ).all()
+        clients = tuple(ClientResume(*ligne) for ligne in lignes)
+
+        with cls._verrou:
+            cls._clients_actifs = clients
+            cls._clients_actifs_time = time.monotonic()
+        return clients
+
+    @classmethod
+    def client_actif(cls, client_id):
+        """ClientResume du client s'il est actif, sinon None"""
+        return next((client for client in cls.clients_actifs() if client.id == client_id), None)
+
+    @classmethod
+    def invalider_clients(cls):
+        with cls._verrou:
+            cls._clients_actifs = None
+
+
+# ============================================
+# INVALIDATION
+# ============================================
+
+def _invalider_clients(mapper, connection, target):
+    ContexteTemplates.invalider_clients()
+    # À nouveau au commit : une requête concurrente a pu relire l'état précédent
+    session = object_session(target)
+    if session is not None:
+        session.info['clients_modifies'] = True
+
+
+@event.listens_for(db.session, 'after_commit')
+@event.listens_for(db.session, 'after_rollback')
+def _invalider_fin_transaction(session):
+    if session.info.pop('clients_modifies', None):
+        ContexteTemplates.invalider_clients()
+
+
+for _evenement in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(Client, _evenement, _invalider_clients)
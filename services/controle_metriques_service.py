@@ -0,0 +1,382 @@
+# services/controle_metriques_service.py
+"""
+Agrégats des contrôles de second niveau (C2N) par référentiel et par campagne.
+
+Les tableaux de bord C2N additionnaient exécutions, taux de conformité et
+non-conformités en chargeant toutes les lignes du client à chaque affichage.
+Les agrégats sont désormais stockés dans metriques_controle et recalculés,
+pour les seuls référentiels / campagnes concernés, à la fin de chaque flush
+qui touche une planification, une exécution, une validation ou une
+non-conformité. Le retard des planifications dépend de la date du jour : il
+est compté à la lecture par une requête groupée.
+"""
+from datetime import datetime, date
+
+from sqlalchemy import event, inspect, select, delete, func, case, literal, or_
+from sqlalchemy.orm import object_session
+
+from models import (db, MetriqueControle, ReferentielControle, PlanificationControle,
+                    ExecutionControle, ValidationControle, NonConformiteC2N, CampagneControle)
+from services.ecriture_sql import inserer_ou_mettre_a_jour
+
+
+M = MetriqueControle.__table__
+R = ReferentielControle.__table__
+P = PlanificationControle.__table__
+E = ExecutionControle.__table__
+V = ValidationControle.__table__
+N = NonConformiteC2N.__table__
+C = CampagneControle.__table__
+
+STATUTS_REALISES = ('valide', 'rejete')
+CRITICITES = {'mineur': 'nb_nc_mineures', 'majeur': 'nb_nc_majeures', 'critique': 'nb_nc_critiques'}
+
+COLONNES_METRIQUES = [
+    'nb_planifications', 'nb_realisees', 'nb_a_valider',
+    'nb_executions', 'volume_previsionnel', 'volume_controle', 'nb_conformes', 'nb_anomalies',
+    'somme_taux', 'nb_taux', 'nb_validations',
+    'nb_non_conformites', 'nb_nc_ouvertes', 'nb_nc_mineures', 'nb_nc_majeures', 'nb_nc_critiques',
+]
+
+
+def _ligne_vide(niveau, cle_id, client_id):
+    ligne = {colonne: 0 for colonne in COLONNES_METRIQUES}
+    ligne.update(niveau=niveau, cle_id=cle_id, client_id=client_id, updated_at=datetime.utcnow())
+    return ligne
+
+
+def _somme(condition, valeur=1):
+    return func.coalesce(func.sum(case((condition, valeur), else_=0)), 0)
+
+
+def _non_archivee():
+    return or_(P.c.is_archived == False, P.c.is_archived.is_(None))
+
+
+# ============================================
+# AGRÉGATS PAR EXÉCUTION
+# ============================================
+
+def _agregats_executions(connection, execution_ids):
+    """{execution_id: {colonnes d'exécution, de validation et de NC}}"""
+    agregats = {}
+    if not execution_ids:
+        return agregats
+
+    for ligne in connection.execute(
+        select(E.c.id, E.c.volume_previsionnel, E.c.volume_controle, E.c.nb_conformes,
+               E.c.nb_anomalies, E.c.taux_conformite)
+        .where(E.c.id.in_(execution_ids))
+    ):
+        taux = ligne.taux_conformite or 0
+        agregats[ligne.id] = {
+            'nb_executions': 1,
+            'volume_previsionnel': ligne.volume_previsionnel or 0,
+            'volume_controle': ligne.volume_controle or 0,
+            'nb_conformes': ligne.nb_conformes or 0,
+            'nb_anomalies': ligne.nb_anomalies or 0,
+            'somme_taux': taux if taux > 0 else 0,
+            'nb_taux': 1 if taux > 0 else 0,
+            'nb_validations': 0,
+            'nb_non_conformites': 0,
+            'nb_nc_ouvertes': 0,
+            **{colonne: 0 for colonne in CRITICITES.values()},
+        }
+
+    for execution_id, nb in connection.execute(
+        select(V.c.execution_id, func.count())
+        .where(V.c.execution_id.in_(agregats.keys()))
+        .group_by(V.c.execution_id)
+    ):
+        agregats[execution_id]['nb_validations'] = nb
+
+    colonnes_criticite = [_somme(N.c.niveau_criticite == niveau).label(colonne)
+                          for niveau, colonne in CRITICITES.items()]
+    for ligne in connection.execute(
+        select(N.c.execution_id, func.count().label('nb'),
+               _somme(or_(N.c.statut != 'ferme', N.c.statut.is_(None))).label('ouvertes'),
+               *colonnes_criticite)
+        .where(N.c.execution_id.in_(agregats.keys()))
+        .group_by(N.c.execution_id)
+    ):
+        cible = agregats[ligne.execution_id]
+        cible['nb_non_conformites'] = ligne.nb
+        cible['nb_nc_ouvertes'] = ligne.ouvertes
+        for colonne in CRITICITES.values():
+            cible[colonne] = getattr(ligne, colonne)
+
+    return agregats
+
+
+def _ajouter(ligne, agregat):
+    for colonne, valeur in agregat.items():
+        ligne[colonne] += valeur
+
+
+def _remplacer(connection, niveau, cle_ids, lignes):
+    """Écrit les agrégats recalculés (upsert) et retire ceux des entités supprimées"""
+    inserer_ou_mettre_a_jour(connection, M, lignes, ['niveau', 'cle_id'])
+    disparues = set(cle_ids) - {ligne['cle_id'] for ligne in lignes}
+    if disparues:
+        connection.execute(delete(M).where(M.c.niveau == niveau, M.c.cle_id.in_(disparues)))
+
+
+class ControleMetriquesService:
+    """Maintenance et lecture des agrégats C2N"""
+
+    # ============================================
+    # RECALCUL
+    # ============================================
+
+    @staticmethod
+    def recalculer_referentiels(connection, referentiel_ids):
+        """Recalcule les agrégats des référentiels donnés"""
+        referentiel_ids = {i for i in referentiel_ids if i is not None}
+        if not referentiel_ids:
+            return 0
+
+        lignes = {
+            ref_id: _ligne_vide('referentiel', ref_id, client_id)
+            for ref_id, client_id in connection.execute(
+                select(R.c.id, R.c.client_id).where(R.c.id.in_(referentiel_ids))
+            )
+        }
+
+        executions_par_referentiel = {}
+        for ligne in connection.execute(
+            select(P.c.referentiel_id, P.c.statut, P.c.execution_id)
+            .where(P.c.referentiel_id.in_(lignes.keys()), _non_archivee())
+        ):
+            cible = lignes[ligne.referentiel_id]
+            cible['nb_planifications'] += 1
+            if ligne.statut in STATUTS_REALISES:
+                cible['nb_realisees'] += 1
+            elif ligne.statut == 'soumis':
+                cible['nb_a_valider'] += 1
+            if ligne.execution_id:
+                executions_par_referentiel.setdefault(ligne.referentiel_id, set()).add(ligne.execution_id)
+
+        agregats = _agregats_executions(
+            connection, set().union(*executions_par_referentiel.values()) if executions_par_referentiel else set()
+        )
+        for ref_id, execution_ids in executions_par_referentiel.items():
+            for execution_id in execution_ids:
+                if execution_id in agregats:
+                    _ajouter(lignes[ref_id], agregats[execution_id])
+
+        _remplacer(connection, 'referentiel', referentiel_ids, list(lignes.values()))
+        return len(lignes)
+
+    @staticmethod
+    def recalculer_campagnes(connection, campagne_ids):
+        """Recalcule les agrégats des campagnes données (fiche + exécution C2N liée)"""
+        campagne_ids = {i for i in campagne_ids if i is not None}
+        if not campagne_ids:
+            return 0
+
+        campagnes = connection.execute(
+            select(C.c.id, C.c.client_id, C.c.is_archived, C.c.execution_c2n_id,
+                   C.c.nb_dossiers_prevus, C.c.nb_dossiers_controles, C.c.nb_conformes,
+                   C.c.nb_anomalies, C.c.taux_conformite,
+                   P.c.id.label('planification_id'), P.c.statut.label('planification_statut'),
+                   P.c.execution_id.label('planification_execution_id'))
+            .select_from(C.outerjoin(P, P.c.id == C.c.planification_c2n_id))
+            .where(C.c.id.in_(campagne_ids))
+        ).all()
+        campagnes = [c for c in campagnes if not c.is_archived]
+
+        agregats = _agregats_executions(connection, {
+            c.execution_c2n_id or c.planification_execution_id for c in campagnes
+        } - {None})
+
+        lignes = []
+        for campagne in campagnes:
+            ligne = _ligne_vide('campagne', campagne.id, campagne.client_id)
+            if campagne.planification_id:
+                ligne['nb_planifications'] = 1
+                ligne['nb_realisees'] = 1 if campagne.planification_statut in STATUTS_REALISES else 0
+                ligne['nb_a_valider'] = 1 if campagne.planification_statut == 'soumis' else 0
+
+            agregat = agregats.get(campagne.execution_c2n_id or campagne.planification_execution_id)
+            if agregat:
+                _ajouter(ligne, agregat)
+
+            # Les résultats saisis sur la fiche de campagne priment sur ceux de l'exécution
+            if campagne.nb_dossiers_controles:
+                taux = float(campagne.taux_conformite or 0)
+                ligne.update(
+                    volume_previsionnel=campagne.nb_dossiers_prevus or 0,
+                    volume_controle=campagne.nb_dossiers_controles,
+                    nb_conformes=campagne.nb_conformes or 0,
+                    nb_anomalies=campagne.nb_anomalies or 0,
+                    somme_taux=taux,
+                    nb_taux=1 if taux > 0 else 0,
+                )
+            lignes.append(ligne)
+
+        _remplacer(connection, 'campagne', campagne_ids, lignes)
+        return len(lignes)
+
+    @classmethod
+    def reconstruire(cls, client_id=None):
+        """Recalcule tous les agrégats (ou ceux d'un client)"""
+        connection = db.session.connection()
+        requete_refs = select(R.c.id)
+        requete_campagnes = select(C.c.id)
+        if client_id:
+            requete_refs = requete_refs.where(R.c.client_id == client_id)
+            requete_campagnes = requete_campagnes.where(C.c.client_id == client_id)
+
+        nb = cls.recalculer_referentiels(connection, connection.execute(requete_refs).scalars().all())
+        nb += cls.recalculer_campagnes(connection, connection.execute(requete_campagnes).scalars().all())
+        db.session.commit()
+        return nb
+
+    @staticmethod
+    def est_vide():
+        return db.session.execute(select(literal(1)).select_from(M).limit(1)).first() is None
+
+    # ============================================
+    # LECTURE
+    # ============================================
+
+    @staticmethod
+    def par_referentiel(client_id=None, referentiel_ids=None):
+        """{referentiel_id: MetriqueControle}"""
+        requete = MetriqueControle.query.filter_by(niveau='referentiel')
+        if client_id:
+            requete = requete.filter_by(client_id=client_id)
+        if referentiel_ids is not None:
+            requete = requete.filter(MetriqueControle.cle_id.in_(referentiel_ids))
+        return {m.cle_id: m for m in requete.all()}
+
+    @staticmethod
+    def pour_campagne(campagne_id):
+        return db.session.get(MetriqueControle, ('campagne', campagne_id))
+
+    @staticmethod
+    def totaux(client_id=None, metier=None):
+        """
+        Somme des agrégats référentiels (un seul SELECT), filtrable par métier.
+        Périmètre des agrégats : référentiels non archivés et exécutions
+        rattachées à une de leurs planifications non archivées (les exécutions
+        autonomes n'y figurent pas ; le tableau de bord C2N compte à part).
+        """
+        requete = select(*[func.coalesce(func.sum(M.c[colonne]), 0).label(colonne)
+                           for colonne in COLONNES_METRIQUES]).where(M.c.niveau == 'referentiel')
+        if client_id:
+            requete = requete.where(M.c.client_id == client_id)
+        referentiels_actifs = select(R.c.id).where(or_(R.c.is_archived == False, R.c.is_archived.is_(None)))
+        if metier:
+            referentiels_actifs = referentiels_actifs.where(R.c.metier == metier)
+        requete = requete.where(M.c.cle_id.in_(referentiels_actifs))
+
+        totaux = dict(db.session.execute(requete).one()._mapping)
+        totaux['taux_conformite'] = round(totaux['somme_taux'] / totaux['nb_taux'], 1) if totaux['nb_taux'] else 0
+        totaux['repartition_criticite'] = {niveau: totaux[colonne] for niveau, colonne in CRITICITES.items()}
+        return totaux
+
+    @staticmethod
+    def en_retard_par_referentiel(client_id=None, referentiel_ids=None):
+        """{referentiel_id: nb de planifications en retard à la date du jour}"""
+        requete = (
+            select(P.c.referentiel_id, func.count())
+            .where(P.c.date_prevue < date.today(), P.c.statut.notin_(STATUTS_REALISES), _non_archivee())
+            .group_by(P.c.referentiel_id)
+        )
+        if client_id:
+            requete = requete.where(P.c.client_id == client_id)
+        if referentiel_ids is not None:
+            requete = requete.where(P.c.referentiel_id.in_(referentiel_ids))
+        return dict(db.session.execute(requete).all())
+
+    @staticmethod
+    def non_conformites_par_execution(execution_ids):
+        """{execution_id: nb de non-conformités} en une requête (listes de planifications)"""
+        execution_ids = {i for i in execution_ids if i}
+        if not execution_ids:
+            return {}
+        return dict(db.session.execute(
+            select(N.c.execution_id, func.count())
+            .where(N.c.execution_id.in_(execution_ids))
+            .group_by(N.c.execution_id)
+        ).all())
+
+
+# ============================================
+# MAINTENANCE À CHAQUE FLUSH
+# ============================================
+
+def _valeurs(target, attribut):
+    """Valeur courante et, si elle a changé, valeur précédente"""
+    historique = inspect(target).attrs[attribut].history
+    valeurs = {getattr(target, attribut)}
+    valeurs.update(historique.deleted or ())
+    return valeurs
+
+
+def _a_recalculer(session):
+    return session.info.setdefault('c2n_metriques', {'referentiels': set(), 'campagnes': set(),
+                                                     'executions': set(), 'planifications': set()})
+
+
+def _marquer(cle, *attributs):
+    def marquer(mapper, connection, target):
+        session = object_session(target)
+        if session is None:
+            return
+        cibles = _a_recalculer(session)[cle]
+        for attribut in attributs:
+            cibles.update(_valeurs(target, attribut))
+    return marquer
+
+
+_SUIVIS = [
+    (ReferentielControle, 'referentiels', ('id',)),
+    (PlanificationControle, 'referentiels', ('referentiel_id',)),
+    (PlanificationControle, 'planifications', ('id',)),
+    (ExecutionControle, 'executions', ('id',)),
+    (ValidationControle, 'executions', ('execution_id',)),
+    (NonConformiteC2N, 'executions', ('execution_id',)),
+    (CampagneControle, 'campagnes', ('id',)),
+]
+
+for _modele, _cle, _attributs in _SUIVIS:
+    for _evenement in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(_modele, _evenement, _marquer(_cle, *_attributs))
+
+
+@event.listens_for(db.session, 'after_flush_postexec')
+def _recalculer_apres_flush(session, flush_context):
+    cibles = session.info.pop('c2n_metriques', None)
+    if not cibles:
+        return
+
+    connection = session.connection()
+    executions = cibles['executions'] - {None}
+    planifications = cibles['planifications'] - {None}
+    referentiels = set(cibles['referentiels'])
+    campagnes = set(cibles['campagnes'])
+
+    # Une planification peut changer d'exécution : on suit l'ancienne et la nouvelle
+    if planifications:
+        executions.update(connection.execute(
+            select(P.c.execution_id).where(P.c.id.in_(planifications), P.c.execution_id.isnot(None))
+        ).scalars())
+    if executions:
+        referentiels.update(connection.execute(
+            select(P.c.referentiel_id).where(P.c.execution_id.in_(executions))
+        ).scalars())
+        planifications.update(connection.execute(
+            select(P.c.id).where(P.c.execution_id.in_(executions))
+        ).scalars())
+    if executions or planifications:
+        conditions = []
+        if executions:
+            conditions.append(C.c.execution_c2n_id.in_(executions))
+        if planifications:
+            conditions.append(C.c.planification_c2n_id.in_(planifications))
+        campagnes.update(connection.execute(select(C.c.id).where(or_(*conditions))).scalars())
+
+    ControleMetriquesService.recalculer_referentiels(connection, referentiels)
+    ControleMetriquesService.recalculer_campagnes(connection, campagnes)
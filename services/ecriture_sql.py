@@ -0,0 +1,67 @@
+# services/ecriture_sql.py
+"""
+Écriture idempotente des lignes de projection (état courant des risques,
+métriques de contrôle, références d'anomalies, versions de cache...).
+
+inserer_ou_mettre_a_jour remplace le couple « DELETE puis INSERT » : deux
+transactions qui réécrivent la même clé en parallèle ne se heurtent plus à
+la contrainte de clé primaire (la seconde met la ligne à jour).
+
+    inserer_ou_mettre_a_jour(connection, T, lignes, ['niveau', 'cle_id'])
+    inserer_ou_mettre_a_jour(connection, V, [{'client_id': 3, 'version': 1}], ['client_id'],
+                             maj={'version': V.c.version + 1})
+
+PostgreSQL et SQLite : INSERT ... ON CONFLICT DO UPDATE. Autres bases :
+UPDATE puis INSERT dans un point de sauvegarde, UPDATE à nouveau si une
+transaction concurrente a inséré la ligne entre-temps.
+"""
+from sqlalchemy import and_, insert, update
+from sqlalchemy.exc import IntegrityError
+
+
+def inserer_ou_mettre_a_jour(connection, table, lignes, cles, maj=None):
+    """
+    Insère les lignes ou met à jour celles dont la clé `cles` existe déjà.
+    Sans `maj`, les colonnes fournies écrasent la ligne existante ; avec `maj`
+    ({colonne: expression}), ces colonnes reçoivent l'expression à la place
+    (ex. compteur incrémenté). Une seule ligne par clé est écrite (la dernière).
+    """
+    if not lignes:
+        return
+    uniques = {}
+    for ligne in lignes:
+        uniques[tuple(ligne[cle] for cle in cles)] = ligne
+    # Ordre des clés stable : verrous pris dans le même ordre par toutes les transactions
+    lignes = [uniques[cle] for cle in sorted(uniques, key=lambda cle: tuple((v is None, v) for v in cle))]
+    maj = maj or {}
+
+    dialecte = connection.dialect.name
+    if dialecte in ('postgresql', 'sqlite'):
+        if dialecte == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert as insert_dialecte
+        else:
+            from sqlalchemy.dialects.sqlite import insert as insert_dialecte
+        requete = insert_dialecte(table)
+        colonnes = [nom for nom in lignes[0] if nom not in cles]
+        valeurs = {nom: maj.get(nom, requete.excluded[nom]) for nom in colonnes}
+        valeurs.update({nom: expression for nom, expression in maj.items() if nom not in valeurs})
+        if valeurs:
+            requete = requete.on_conflict_do_update(index_elements=cles, set_=valeurs)
+        else:
+            requete = requete.on_conflict_do_nothing(index_elements=cles)
+        connection.execute(requete, lignes)
+        return
+
+    for ligne in lignes:
+        condition = and_(*[table.c[cle] == ligne[cle] for cle in cles])
+        valeurs = {nom: valeur for nom, valeur in ligne.items() if nom not in cles}
+        valeurs.update(maj)
+        if valeurs and connection.execute(update(table).where(condition).values(valeurs)).rowcount:
+            continue
+        try:
+            with connection.begin_nested():
+                connection.execute(insert(table).values(ligne))
+        except IntegrityError:
+            # Ligne insérée en parallèle
+            if valeurs:
+                connection.execute(update(table).where(condition).values(valeurs))
@@ -0,0 +1,390 @@
+# services/feuille_version_service.py
+"""
+Versions des feuilles de travail stockées en points de reprise + deltas.
+
+Une version sur INTERVALLE_REPRISE (1, 21, 41...) garde l'instantané
+complet dans contenu_snapshot / tests_snapshot, au format historique :
+les versions existantes sont donc toutes des points de reprise valides.
+Les autres versions ne stockent qu'un patch JSON (RFC 6902 : add, remove,
+replace) par rapport à la version précédente :
+
+    contenu_snapshot = {'_delta': {'base': <numéro précédent>, 'patch': [...]}}
+    tests_snapshot = None
+
+Une version est reconstruite depuis le point de reprise le plus proche
+(au plus INTERVALLE_REPRISE lignes lues) ; les versions reconstruites sont
+gardées dans un cache LRU (une version ne change jamais une fois écrite).
+"""
+import copy
+import json
+import threading
+from collections import OrderedDict
+
+from sqlalchemy import event, select, func
+
+from models import db, FeuilleTravailVersion
+
+
+INTERVALLE_REPRISE = 20
+
+# Au-delà de cette part de la taille complète, le delta n'est pas rentable
+RATIO_DELTA_MAX = 0.5
+
+CLE_DELTA = '_delta'
+
+
+# ============================================
+# PATCH JSON
+# ============================================
+
+def _echapper(cle):
+    return str(cle).replace('~', '~0').replace('/', '~1')
+
+
+def _desechapper(segment):
+    return segment.replace('~1', '/').replace('~0', '~')
+
+
+def calculer_patch(avant, apres, chemin=''):
+    """Opérations JSON Patch transformant `avant` en `apres`"""
+    if isinstance(avant, dict) and isinstance(apres, dict):
+        operations = []
+        for cle in avant:
+            if cle not in apres:
+                operations.append({'op': 'remove', 'path': f"{chemin}/{_echapper(cle)}"})
+        for cle, valeur in apres.items():
+            sous_chemin = f"{chemin}/{_echapper(cle)}"
+            if cle not in avant:
+                operations.append({'op': 'add', 'path': sous_chemin, 'value': valeur})
+            else:
+                operations.extend(calculer_patch(avant[cle], valeur, sous_chemin))
+        return operations
+
+    if isinstance(avant, list) and isinstance(apres, list):
+        operations = []
+        commun = min(len(avant), len(apres))
+        for i in range(commun):
+            operations.extend(calculer_patch(avant[i], apres[i], f"{chemin}/{i}"))
+        # Suppressions de la fin vers le début pour garder les index valides
+        for i in range(len(avant) - 1, commun - 1, -1):
+            operations.append({'op': 'remove', 'path': f"{chemin}/{i}"})
+        for i in range(commun, len(apres)):
+            operations.append({'op': 'add', 'path': f"{chemin}/{i}", 'value': apres[i]})
+        return operations
+
+    if type(avant) is type(apres) and avant == apres:
+        return []
+    return [{'op': 'replace', 'path': chemin, 'value': apres}]
+
+
+def appliquer_patch(document, operations):
+    """Nouveau document obtenu en appliquant `operations` (le document d'origine n'est pas modifié)"""
+    document = copy.deepcopy(document)
+    for operation in operations:
+        valeur = copy.deepcopy(operation.get('value'))
+        if operation['path'] == '':
+            document = valeur
+            continue
+
+        segments = [_desechapper(s) for s in operation['path'].split('/')[1:]]
+        parent = document
+        for segment in segments[:-1]:
+            parent = parent[int(segment)] if isinstance(parent, list) else parent[segment]
+        dernier = segments[-1]
+
+        if isinstance(parent, list):
+            index = len(parent) if dernier == '-' else int(dernier)
+            if operation['op'] == 'add':
+                parent.insert(index, valeur)
+            elif operation['op'] == 'remove':
+                del parent[index]
+            else:
+                parent[index] = valeur
+        else:
+            if operation['op'] == 'remove':
+                del parent[dernier]
+            else:
+                parent[dernier] = valeur
+    return document
+
+
+def _taille(valeur):
+    return len(json.dumps(valeur, default=str)) if valeur is not None else 0
+
+
+# ============================================
+# SERVICE
+# ============================================
+
+class VersionsFeuilleService:
+    """Création, reconstruction et comparaison des versions de feuilles de travail"""
+
+    _cache = OrderedDict()
+    _verrou = threading.Lock()
+    CACHE_MAX = 256
+
+    @staticmethod
+    def est_delta(version):
+        return isinstance(version.contenu_snapshot, dict) and CLE_DELTA in version.contenu_snapshot
+
+    @staticmethod
+    def instantane(feuille, tests):
+        """État courant d'une feuille (format des versions, sérialisé JSON)"""
+        return json.loads(json.dumps({
+            'contenu': {
+                'titre': feuille.titre,
+                'description': feuille.description,
+                'type_feuille': feuille.type_feuille,
+                'statut': feuille.statut,
+                'contenu': feuille.contenu
+            },
+            'tests': [t.to_dict() for t in tests],
+        }, default=str))
+
+    @staticmethod
+    def est_point_de_reprise(numero):
+        return (numero - 1) % INTERVALLE_REPRISE == 0
+
+    # ============================================
+    # ÉCRITURE
+    # ============================================
+
+    @classmethod
+    def creer_version(cls, feuille, tests, commentaire='', version_type='modification',
+                      created_by=None, numero=None):
+        """Ajoute (sans commit) la version suivante de la feuille ; retourne la version"""
+        if numero is None:
+            dernier = db.session.execute(
+                select(func.max(FeuilleTravailVersion.version_numero))
+                .where(FeuilleTravailVersion.feuille_travail_id == feuille.id)
+            ).scalar()
+            numero = (dernier or 0) + 1
+
+        etat = cls.instantane(feuille, tests)
+        version = FeuilleTravailVersion(
+            feuille_travail_id=feuille.id,
+            version_numero=numero,
+            version_commentaire=commentaire,
+            version_type=version_type,
+            created_by=created_by
+        )
+
+        precedent = None
+        if numero > 1 and not cls.est_point_de_reprise(numero):
+            precedent = cls._numero_precedent(feuille.id, numero)
+        delta = cls._delta(feuille.id, precedent, etat) if precedent else None
+
+        if delta is not None:
+            version.contenu_snapshot = {CLE_DELTA: {'base': precedent, 'patch': delta}}
+            version.tests_snapshot = None
+        else:
+            version.contenu_snapshot = etat['contenu']
+            version.tests_snapshot = etat['tests']
+
+        db.session.add(version)
+        # Mise en cache au commit seulement : une version annulée ne doit pas y rester
+        db.session.info.setdefault('versions_feuille_creees', []).append((feuille.id, numero, etat))
+        return version
+
+    @staticmethod
+    def _numero_precedent(feuille_id, numero):
+        return db.session.execute(
+            select(func.max(FeuilleTravailVersion.version_numero))
+            .where(FeuilleTravailVersion.feuille_travail_id == feuille_id,
+                   FeuilleTravailVersion.version_numero < numero)
+        ).scalar()
+
+    @classmethod
+    def _delta(cls, feuille_id, numero_base, etat):
+        """Patch depuis la version de base, ou None si un instantané complet est préférable"""
+        base = cls.reconstruire(feuille_id, numero_base)
+        if base is None:
+            return None
+        patch = calculer_patch(base, etat)
+        if _taille(patch) > _taille(etat) * RATIO_DELTA_MAX:
+            return None
+        return patch
+
+    # ============================================
+    # LECTURE
+    # ============================================
+
+    @classmethod
+    def etat_version(cls, version):
+        """{'contenu': {...}, 'tests': [...]} d'une version (objet FeuilleTravailVersion)"""
+        if not cls.est_delta(version):
+            return {'contenu': version.contenu_snapshot or {}, 'tests': version.tests_snapshot or []}
+        return cls.reconstruire(version.feuille_travail_id, version.version_numero)
+
+    @classmethod
+    def reconstruire(cls, feuille_id, numero):
+        """État complet de la version `numero` (None si elle n'existe pas)"""
+        etat = cls._en_cache(feuille_id, numero)
+        if etat is not None:
+            return copy.deepcopy(etat)
+
+        # Lignes depuis le point de reprise prévu ; on recule si la plage n'en contient pas
+        debut = numero - (numero - 1) % INTERVALLE_REPRISE
+        while True:
+            lignes = db.session.execute(
+                select(FeuilleTravailVersion.version_numero,
+                       FeuilleTravailVersion.contenu_snapshot,
+                       FeuilleTravailVersion.tests_snapshot)
+                .where(FeuilleTravailVersion.feuille_travail_id == feuille_id,
+                       FeuilleTravailVersion.version_numero.between(debut, numero))
+                .order_by(FeuilleTravailVersion.version_numero)
+            ).all()
+            if not lignes or lignes[-1].version_numero != numero:
+                return None
+
+            # Départ : dernière version en cache ou dernier instantané complet de la plage
+            depart = None
+            for i in range(len(lignes) - 1, -1, -1):
+                ligne = lignes[i]
+                etat = cls._en_cache(feuille_id, ligne.version_numero)
+                if etat is not None:
+                    depart = i
+                    break
+                if not (isinstance(ligne.contenu_snapshot, dict) and CLE_DELTA in ligne.contenu_snapshot):
+                    etat = {'contenu': ligne.contenu_snapshot or {}, 'tests': ligne.tests_snapshot or []}
+                    depart = i
+                    break
+            if depart is not None:
+                break
+            if debut <= 1:
+                return None
+            debut = max(1, debut - INTERVALLE_REPRISE)
+
+        for ligne in lignes[depart + 1:]:
+            etat = appliquer_patch(etat, ligne.contenu_snapshot[CLE_DELTA]['patch'])
+        cls._memoriser(feuille_id, numero, etat)
+        return copy.deepcopy(etat)
+
+    @classmethod
+    def historique(cls, feuille_id):
+        """[(version, état)] de toutes les versions, par numéro croissant, en un passage"""
+        versions = FeuilleTravailVersion.query.filter_by(
+            feuille_travail_id=feuille_id
+        ).order_by(FeuilleTravailVersion.version_numero).all()
+
+        resultat = []
+        etat = None
+        for version in versions:
+            if cls.est_delta(version):
+                if etat is None:
+                    etat = cls.reconstruire(feuille_id, version.version_numero)
+                else:
+                    etat = appliquer_patch(etat, version.contenu_snapshot[CLE_DELTA]['patch'])
+            else:
+                etat = {'contenu': version.contenu_snapshot or {}, 'tests': version.tests_snapshot or []}
+            resultat.append((version, etat))
+        return resultat
+
+    @classmethod
+    def comparer(cls, feuille_id, numero_de, numero_a):
+        """Différences entre deux versions (patch et résumé), None si une version manque"""
+        avant = cls.reconstruire(feuille_id, numero_de)
+        apres = cls.reconstruire(feuille_id, numero_a)
+        if avant is None or apres is None:
+            return None
+
+        champs_modifies = sorted(
+            champ for champ in set(avant['contenu']) | set(apres['contenu'])
+            if avant['contenu'].get(champ) != apres['contenu'].get(champ)
+        )
+        tests_avant = {t.get('id'): t for t in avant['tests']}
+        tests_apres = {t.get('id'): t for t in apres['tests']}
+
+        return {
+            'de': numero_de,
+            'a': numero_a,
+            'champs_modifies': champs_modifies,
+            'tests_ajoutes': [i for i in tests_apres if i not in tests_avant],
+            'tests_supprimes': [i for i in tests_avant if i not in tests_apres],
+            'tests_modifies': [i for i in tests_apres if i in tests_avant and tests_avant[i] != tests_apres[i]],
+            'patch': calculer_patch(avant, apres),
+        }
+
+    # ============================================
+    # CACHE
+    # ============================================
+
+    @classmethod
+    def _en_cache(cls, feuille_id, numero):
+        with cls._verrou:
+            etat = cls._cache.get((feuille_id, numero))
+            if etat is not None:
+                cls._cache.move_to_end((feuille_id, numero))
+            return etat
+
+    @classmethod
+    def _memoriser(cls, feuille_id, numero, etat):
+        with cls._verrou:
+            cls._cache[(feuille_id, numero)] = copy.deepcopy(etat)
+            cls._cache.move_to_end((feuille_id, numero))
+            while len(cls._cache) > cls.CACHE_MAX:
+                cls._cache.popitem(last=False)
+
+    @classmethod
+    def invalider(cls, feuille_id=None):
+        with cls._verrou:
+            for cle in [c for c in cls._cache if feuille_id is None or c[0] == feuille_id]:
+                del cls._cache[cle]
+
+    # ============================================
+    # MIGRATION
+    # ============================================
+
+    @classmethod
+    def compacter(cls, feuille_id=None):
+        """
+        Convertit les instantanés complets hors points de reprise en deltas.
+        Retourne {'feuilles', 'versions_converties', 'octets_avant', 'octets_apres'}.
+        """
+        requete = select(FeuilleTravailVersion.feuille_travail_id).distinct()
+        if feuille_id:
+            requete = requete.where(FeuilleTravailVersion.feuille_travail_id == feuille_id)
+        feuille_ids = db.session.execute(requete).scalars().all()
+
+        rapport = {'feuilles': 0, 'versions_converties': 0, 'octets_avant': 0, 'octets_apres': 0}
+        for fid in feuille_ids:
+            cls.invalider(fid)
+            precedent = None
+            for version, etat in cls.historique(fid):
+                taille = _taille(version.contenu_snapshot) + _taille(version.tests_snapshot)
+                rapport['octets_avant'] += taille
+
+                if (precedent is not None and not cls.est_delta(version)
+                        and not cls.est_point_de_reprise(version.version_numero)):
+                    numero_base, etat_base = precedent
+                    patch = calculer_patch(etat_base, etat)
+                    if _taille(patch) <= _taille(etat) * RATIO_DELTA_MAX:
+                        version.contenu_snapshot = {CLE_DELTA: {'base': numero_base, 'patch': patch}}
+                        version.tests_snapshot = None
+                        rapport['versions_converties'] += 1
+                        taille = _taille(version.contenu_snapshot)
+
+                rapport['octets_apres'] += taille
+                precedent = (version.version_numero, etat)
+
+            db.session.commit()
+            rapport['feuilles'] += 1
+        return rapport
+
+
+@event.listens_for(FeuilleTravailVersion, 'after_delete')
+def _invalider_version_supprimee(mapper, connection, target):
+    VersionsFeuilleService.invalider(target.feuille_travail_id)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _memoriser_versions_creees(session):
+    for feuille_id, numero, etat in session.info.pop('versions_feuille_creees', None) or ():
+        VersionsFeuilleService._memoriser(feuille_id, numero, etat)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _invalider_versions_annulees(session):
+    # reconstruire() a pu mettre en cache des versions lues avant le flush annulé
+    for feuille_id in {creee[0] for creee in session.info.pop('versions_feuille_creees', None) or ()}:
+        VersionsFeuilleService.invalider(feuille_id)
@@ -0,0 +1,287 @@
+# services/hierarchie_service.py
+"""
+Hiérarchies maintenues en table de fermeture (HierarchieFermeture).
+
+- Arbre 'processus' : Processus.processus_parent_id
+- Arbre 'organisation' : Pays -> Pôle -> Direction -> Service
+
+Ancêtres, descendants, fils d'Ariane et comptages de sous-arbres se font
+en une seule requête. La table est maintenue par des hooks SQLAlchemy
+(insertion, déplacement, suppression) dans la transaction de l'écriture ;
+`reconstruire()` la recalcule entièrement à partir des clés parentes.
+"""
+from sqlalchemy import event, inspect, select, insert, delete, literal, tuple_, and_, or_, func
+from sqlalchemy.orm import aliased
+
+from models import db, HierarchieFermeture, Processus, Pays, Pole, Direction, Service
+
+
+# type de noeud -> (modèle, attribut de la clé parente, type du parent)
+NOEUDS = {
+    'processus': (Processus, 'processus_parent_id', 'processus'),
+    'pays': (Pays, None, None),
+    'pole': (Pole, 'pays_id', 'pays'),
+    'direction': (Direction, 'pole_id', 'pole'),
+    'service': (Service, 'direction_id', 'direction'),
+}
+
+ARBRES = {
+    'processus': ['processus'],
+    'organisation': ['pays', 'pole', 'direction', 'service'],
+}
+
+T = HierarchieFermeture.__table__
+
+
+def _actif(modele):
+    """Condition 'non archivé' tolérante aux valeurs NULL"""
+    return or_(modele.is_archived == False, modele.is_archived.is_(None))
+
+
+class HierarchieService:
+    """Lecture et maintenance des hiérarchies en table de fermeture"""
+
+    # ============================================
+    # MAINTENANCE (appelée depuis les hooks)
+    # ============================================
+
+    @staticmethod
+    def inserer_noeud(conn, type_noeud, noeud_id, parent_id=None, client_id=None):
+        conn.execute(insert(T).values(
+            type_ancetre=type_noeud, ancetre_id=noeud_id,
+            type_descendant=type_noeud, descendant_id=noeud_id,
+            profondeur=0, client_id=client_id
+        ))
+        if parent_id:
+            HierarchieService.rattacher(conn, type_noeud, noeud_id, parent_id, client_id)
+
+    @staticmethod
+    def rattacher(conn, type_noeud, noeud_id, parent_id, client_id=None):
+        """Relie le sous-arbre du noeud à tous les ancêtres de son nouveau parent"""
+        type_parent = NOEUDS[type_noeud][2]
+
+        if type_parent == type_noeud:
+            cycle = conn.execute(select(literal(1)).where(
+                T.c.type_ancetre == type_noeud, T.c.ancetre_id == noeud_id,
+                T.c.type_descendant == type_parent, T.c.descendant_id == parent_id
+            )).first()
+            if cycle:
+                raise ValueError(f"Cycle interdit : {type_noeud} {parent_id} est un descendant de {noeud_id}")
+
+        a = T.alias('a')
+        d = T.alias('d')
+        conn.execute(insert(T).from_select(
+            ['type_ancetre', 'ancetre_id', 'type_descendant', 'descendant_id', 'profondeur', 'client_id'],
+            select(
+                a.c.type_ancetre, a.c.ancetre_id, d.c.type_descendant, d.c.descendant_id,
+                a.c.profondeur + d.c.profondeur + 1, d.c.client_id
+            ).where(
+                a.c.type_descendant == type_parent, a.c.descendant_id == parent_id,
+                d.c.type_ancetre == type_noeud, d.c.ancetre_id == noeud_id
+            )
+        ))
+
+    @staticmethod
+    def detacher(conn, type_noeud, noeud_id):
+        """Supprime les liens entre les ancêtres stricts du noeud et son sous-arbre"""
+        sous_arbre = select(T.c.type_descendant, T.c.descendant_id).where(
+            T.c.type_ancetre == type_noeud, T.c.ancetre_id == noeud_id
+        )
+        ancetres = select(T.c.type_ancetre, T.c.ancetre_id).where(
+            T.c.type_descendant == type_noeud, T.c.descendant_id == noeud_id, T.c.profondeur > 0
+        )
+        cibles = [tuple(ligne) for ligne in conn.execute(sous_arbre)]
+        sources = [tuple(ligne) for ligne in conn.execute(ancetres)]
+        if cibles and sources:
+            conn.execute(delete(T).where(
+                tuple_(T.c.type_descendant, T.c.descendant_id).in_(cibles),
+                tuple_(T.c.type_ancetre, T.c.ancetre_id).in_(sources)
+            ))
+
+    @staticmethod
+    def supprimer_noeud(conn, type_noeud, noeud_id):
+        """Retire le noeud ; ses descendants deviennent un sous-arbre détaché"""
+        HierarchieService.detacher(conn, type_noeud, noeud_id)
+        conn.execute(delete(T).where(or_(
+            and_(T.c.type_ancetre == type_noeud, T.c.ancetre_id == noeud_id),
+            and_(T.c.type_descendant == type_noeud, T.c.descendant_id == noeud_id)
+        )))
+
+    @staticmethod
+    def reconstruire(arbre=None):
+        """Recalcule la table de fermeture à partir des clés parentes ; retourne le nb de lignes"""
+        arbres = [arbre] if arbre else list(ARBRES.keys())
+        types = [t for a in arbres for t in ARBRES[a]]
+
+        parents = {}
+        clients = {}
+        for type_noeud in types:
+            modele, attribut_parent, type_parent = NOEUDS[type_noeud]
+            colonne_parent = getattr(modele, attribut_parent) if attribut_parent else literal(None)
+            for noeud_id, parent_id, client_id in db.session.execute(
+                select(modele.id, colonne_parent, modele.client_id)
+            ):
+                cle = (type_noeud, noeud_id)
+                parents[cle] = (type_parent, parent_id) if parent_id else None
+                clients[cle] = client_id
+
+        lignes = []
+        for cle in parents:
+            profondeur = 0
+            courant = cle
+            vus = set()
+            while courant is not None and courant not in vus:
+                vus.add(courant)
+                lignes.append({
+                    'type_ancetre': courant[0], 'ancetre_id': courant[1],
+                    'type_descendant': cle[0], 'descendant_id': cle[1],
+                    'profondeur': profondeur, 'client_id': clients[cle]
+                })
+                courant = parents.get(courant)
+                profondeur += 1
+
+        db.session.execute(delete(T).where(T.c.type_descendant.in_(types)))
+        if lignes:
+            db.session.execute(insert(T), lignes)
+        db.session.commit()
+        return len(lignes)
+
+    @staticmethod
+    def est_vide():
+        return db.session.execute(select(literal(1)).select_from(T).limit(1)).first() is None
+
+    # ============================================
+    # LECTURE (une requête chacune)
+    # ============================================
+
+    @staticmethod
+    def ancetres(type_noeud, noeud_id, inclure_soi=False):
+        """[(type, id, profondeur)] du plus proche au plus lointain"""
+        requete = select(T.c.type_ancetre, T.c.ancetre_id, T.c.profondeur).where(
+            T.c.type_descendant == type_noeud, T.c.descendant_id == noeud_id
+        )
+        if not inclure_soi:
+            requete = requete.where(T.c.profondeur > 0)
+        return [tuple(l) for l in db.session.execute(requete.order_by(T.c.profondeur))]
+
+    @staticmethod
+    def descendants(type_noeud, noeud_id, type_descendant=None, profondeur_max=None, inclure_soi=False):
+        """[(type, id, profondeur)] du sous-arbre du noeud"""
+        requete = select(T.c.type_descendant, T.c.descendant_id, T.c.profondeur).where(
+            T.c.type_ancetre == type_noeud, T.c.ancetre_id == noeud_id
+        )
+        if not inclure_soi:
+            requete = requete.where(T.c.profondeur > 0)
+        if type_descendant:
+            requete = requete.where(T.c.type_descendant == type_descendant)
+        if profondeur_max is not None:
+            requete = requete.where(T.c.profondeur <= profondeur_max)
+        return [tuple(l) for l in db.session.execute(requete.order_by(T.c.profondeur))]
+
+    @staticmethod
+    def ids_descendants(type_noeud, noeud_id, type_descendant=None, inclure_soi=True):
+        """Ids du sous-arbre (ex. tous les sous-processus d'un processus)"""
+        return [noeud[1] for noeud in HierarchieService.descendants(
+            type_noeud, noeud_id, type_descendant or type_noeud, inclure_soi=inclure_soi
+        )]
+
+    @staticmethod
+    def chemin_noms(type_noeud, noeud_id, types=None):
+        """Noms de la racine jusqu'au noeud (fil d'Ariane), ou [] si non indexé"""
+        requete = select(T.c.type_ancetre, T.c.profondeur).where(
+            T.c.type_descendant == type_noeud, T.c.descendant_id == noeud_id
+        )
+        noms = []
+        for type_ancetre in ARBRES['processus'] + ARBRES['organisation']:
+            modele = NOEUDS[type_ancetre][0]
+            requete = requete.outerjoin(modele.__table__, and_(
+                T.c.type_ancetre == type_ancetre, modele.__table__.c.id == T.c.ancetre_id
+            ))
+            noms.append(modele.__table__.c.nom)
+        requete = requete.add_columns(func.coalesce(*noms).label('nom'))
+        if types:
+            requete = requete.where(T.c.type_ancetre.in_(types))
+
+        lignes = db.session.execute(requete.order_by(T.c.profondeur.desc())).all()
+        return [ligne.nom for ligne in lignes]
+
+    @staticmethod
+    def compter_organisation(type_racine, ids):
+        """
+        Comptage des pôles / directions / services actifs sous chaque racine,
+        pour une liste de pays ou de pôles, en une requête groupée.
+        Retourne {id: {'poles': n, 'directions': n, 'services': n}}.
+        """
+        resultat = {i: {'poles': 0, 'directions': 0, 'services': 0} for i in ids}
+        if not ids:
+            return resultat
+
+        direction_service = aliased(Direction)
+        pole_direction = aliased(Pole)
+
+        condition_direction = and_(
+            T.c.type_descendant == 'direction', Direction.is_active == True, _actif(Direction)
+        )
+        if type_racine == 'pays':
+            # Comme Pays.nb_directions : seulement les directions des pôles non archivés
+            condition_direction = and_(condition_direction, _actif(pole_direction))
+
+        requete = (
+            select(T.c.ancetre_id, T.c.type_descendant, func.count())
+            .select_from(T)
+            .outerjoin(Pole, and_(T.c.type_descendant == 'pole', Pole.id == T.c.descendant_id))
+            .outerjoin(Direction, and_(T.c.type_descendant == 'direction', Direction.id == T.c.descendant_id))
+            .outerjoin(pole_direction, pole_direction.id == Direction.pole_id)
+            .outerjoin(Service, and_(T.c.type_descendant == 'service', Service.id == T.c.descendant_id))
+            .outerjoin(direction_service, direction_service.id == Service.direction_id)
+            .where(
+                T.c.type_ancetre == type_racine,
+                T.c.ancetre_id.in_(ids),
+                T.c.profondeur > 0,
+                or_(
+                    and_(T.c.type_descendant == 'pole', _actif(Pole)),
+                    condition_direction,
+                    and_(T.c.type_descendant == 'service', Service.is_active == True, _actif(Service),
+                         direction_service.is_active == True, _actif(direction_service))
+                )
+            )
+            .group_by(T.c.ancetre_id, T.c.type_descendant)
+        )
+
+        cles = {'pole': 'poles', 'direction': 'directions', 'service': 'services'}
+        for racine_id, type_descendant, nb in db.session.execute(requete):
+            resultat[racine_id][cles[type_descendant]] = nb
+        return resultat
+
+
+# ============================================
+# HOOKS DE MAINTENANCE
+# ============================================
+
+def _enregistrer_hooks(type_noeud):
+    modele, attribut_parent, _ = NOEUDS[type_noeud]
+
+    @event.listens_for(modele, 'after_insert')
+    def apres_insertion(mapper, connection, target):
+        parent_id = getattr(target, attribut_parent) if attribut_parent else None
+        HierarchieService.inserer_noeud(connection, type_noeud, target.id, parent_id, target.client_id)
+
+    @event.listens_for(modele, 'after_update')
+    def apres_modification(mapper, connection, target):
+        if not attribut_parent:
+            return
+        historique = inspect(target).attrs[attribut_parent].history
+        if not historique.has_changes():
+            return
+        HierarchieService.detacher(connection, type_noeud, target.id)
+        nouveau_parent = getattr(target, attribut_parent)
+        if nouveau_parent:
+            HierarchieService.rattacher(connection, type_noeud, target.id, nouveau_parent)
+
+    @event.listens_for(modele, 'after_delete')
+    def apres_suppression(mapper, connection, target):
+        HierarchieService.supprimer_noeud(connection, type_noeud, target.id)
+
+
+for _type_noeud in NOEUDS:
+    _enregistrer_hooks(_type_noeud)
@@ -0,0 +1,271 @@
+# services/historique_evaluations_service.py
+"""
+Analyse de l'historique des évaluations de risques en colonnes.
+
+Les évaluations sont lues en une requête (risque_id, date, score, phase,
+impact, probabilité...) et rangées dans des tableaux NumPy triés par
+(risque_id, created_at). Chaque risque est un segment contigu : dernière
+évaluation, premier / dernier score d'une période, nombre d'évaluations
+récentes sont obtenus pour tous les risques à la fois, sans parcourir
+risque.evaluations en Python.
+
+Les fonctions de utils (calculer_score_risque_moyen,
+analyser_tendances_risques, calculer_indice_severite,
+generer_tableau_bordeaux) et les indicateurs de portefeuille sur 6 mois
+s'appuient sur HistoriqueEvaluations et retournent les mêmes structures.
+
+Une évaluation est « validée » dès sa phase de validation
+(date_validation ou date_confirmation renseignée) ; impact et probabilité
+sont les valeurs finales de la hiérarchie triphasée (confirmation, puis
+validation, puis pré-évaluation), comme EvaluationRisque.get_valeurs_finales.
+"""
+from datetime import datetime, timedelta
+
+from chargement_differe import ModuleParesseux
+
+np = ModuleParesseux('numpy')
+
+VARIATION_SIGNIFICATIVE = 2   # points de score entre première et dernière évaluation
+SCORE_CRITIQUE = 16
+NOUVEAU_RISQUE_JOURS = 30
+SCORE_CLOTURE = 5             # score d'une évaluation qui « clôt » un risque
+TAILLE_LOT_IDS = 1000         # identifiants par clause IN
+
+# Niveau de la dernière évaluation confirmée -> catégorie du tableau de Bordeaux
+CATEGORIES_BORDEAUX = {
+    'Critique': 'actions_prioritaires',     # Risques Critiques
+    'Élevé': 'surveillance_renforcee',      # Risques Élevés
+    'Moyen': 'surveillance_courante',       # Risques Moyens
+    'Faible': 'actions_limitees',           # Risques Faibles
+}
+
+COLONNES = ('id', 'risque_id', 'created_at', 'date_validation', 'date_confirmation',
+            'score', 'niveau', 'impact', 'probabilite')
+
+
+EPOQUE = datetime(1970, 1, 1)
+UNE_MICROSECONDE = timedelta(microseconds=1)
+NAT = -2 ** 63  # valeur entière de NaT
+
+
+def _dates(valeurs):
+    """Dates naïves (ou None) -> datetime64[us] ; plus rapide que la conversion d'objets de NumPy"""
+    return np.array(
+        [NAT if v is None else (v - EPOQUE) // UNE_MICROSECONDE for v in valeurs], dtype=np.int64
+    ).view('datetime64[us]')
+
+
+def _flottants(valeurs):
+    return np.array([np.nan if v is None else v for v in valeurs], dtype=float)
+
+
+class HistoriqueEvaluations:
+    """Évaluations en colonnes NumPy, triées par (risque_id, created_at)"""
+
+    def __init__(self, colonnes, risques=None):
+        """
+        `colonnes` : dict de listes (voir COLONNES). `risques` : dict de
+        listes 'id' / 'created_at' des risques non archivés (indicateurs de
+        portefeuille), facultatif.
+        """
+        ids = np.asarray(colonnes['id'], dtype=np.int64)
+        risque_ids = np.asarray(colonnes['risque_id'], dtype=np.int64)
+        created_at = _dates(colonnes['created_at'])
+        # Dates égales : la plus petite id en dernier, comme max() sur risque.evaluations
+        ordre = np.lexsort((-ids, created_at, risque_ids))
+
+        self.ids = ids[ordre]
+        self.risque_ids = risque_ids[ordre]
+        self.created_at = created_at[ordre]
+        self.date_confirmation = _dates(colonnes['date_confirmation'])[ordre]
+        self.validees = (~np.isnat(_dates(colonnes['date_validation'])[ordre])) | ~np.isnat(self.date_confirmation)
+        self.scores = _flottants(colonnes['score'])[ordre]
+        self.niveaux = np.asarray(colonnes['niveau'], dtype=object)[ordre]
+        self.impacts = _flottants(colonnes['impact'])[ordre]
+        self.probabilites = _flottants(colonnes['probabilite'])[ordre]
+
+        self.risques_ids = None
+        self.risques_created_at = None
+        if risques is not None:
+            self.risques_ids = np.asarray(risques['id'], dtype=np.int64)
+            self.risques_created_at = _dates(risques['created_at'])
+
+    def __len__(self):
+        return len(self.ids)
+
+    # ============================================
+    # CHARGEMENT
+    # ============================================
+
+    @classmethod
+    def charger(cls, risque_ids=None, client_id=None, avec_risques=False):
+        """
+        Évaluations des risques non archivés (de la liste, du client ou
+        toutes) : une requête, par lots de TAILLE_LOT_IDS identifiants.
+        """
+        from sqlalchemy import select, func
+        from models import db, Risque, EvaluationRisque as E
+
+        conditions = [Risque.is_archived == False]
+        if client_id is not None:
+            conditions.append(Risque.client_id == client_id)
+        requete = (
+            select(E.id, E.risque_id, E.created_at, E.date_validation, E.date_confirmation,
+                   E.score_risque, E.niveau_risque,
+                   func.coalesce(E.impact_conf, E.impact_val, E.impact_pre),
+                   func.coalesce(E.probabilite_conf, E.probabilite_val, E.probabilite_pre))
+            .join(Risque, Risque.id == E.risque_id)
+            .where(*conditions)
+        )
+        requete_risques = select(Risque.id, Risque.created_at).where(*conditions)
+
+        if risque_ids is None:
+            lignes = db.session.execute(requete).all()
+            lignes_risques = db.session.execute(requete_risques).all() if avec_risques else None
+        else:
+            risque_ids = list(risque_ids)
+            lignes = []
+            lignes_risques = [] if avec_risques else None
+            for debut in range(0, len(risque_ids), TAILLE_LOT_IDS):
+                lot = risque_ids[debut:debut + TAILLE_LOT_IDS]
+                lignes.extend(db.session.execute(requete.where(E.risque_id.in_(lot))).all())
+                if avec_risques:
+                    lignes_risques.extend(db.session.execute(requete_risques.where(Risque.id.in_(lot))).all())
+
+        colonnes = dict(zip(COLONNES, zip(*lignes))) if lignes else {c: () for c in COLONNES}
+        risques = None
+        if avec_risques:
+            risques = dict(zip(('id', 'created_at'), zip(*lignes_risques))) if lignes_risques \
+                else {'id': (), 'created_at': ()}
+        return cls(colonnes, risques)
+
+    @classmethod
+    def pour_risques(cls, risques):
+        """Historique des risques donnés (objets), archivés exclus"""
+        return cls.charger(risque_ids=[r.id for r in risques if not getattr(r, 'is_archived', False)])
+
+    # ============================================
+    # SEGMENTS PAR RISQUE
+    # ============================================
+
+    def _dernieres(self, masque):
+        """Indices de la dernière ligne (par created_at) de chaque risque parmi les lignes du masque"""
+        indices = np.flatnonzero(masque)
+        risques = self.risque_ids[indices]
+        return indices[np.r_[risques[1:] != risques[:-1], True]] if len(indices) else indices
+
+    def _premieres_et_nombres(self, masque):
+        """(indices de la première ligne, nombre de lignes) de chaque risque parmi les lignes du masque"""
+        indices = np.flatnonzero(masque)
+        if not len(indices):
+            return indices, indices
+        risques = self.risque_ids[indices]
+        debuts = np.flatnonzero(np.r_[True, risques[1:] != risques[:-1]])
+        return indices[debuts], np.diff(np.r_[debuts, len(indices)])
+
+    # ============================================
+    # INDICATEURS
+    # ============================================
+
+    def score_moyen(self):
+        """Moyenne des scores de la dernière évaluation validée de chaque risque"""
+        scores = self.scores[self._dernieres(self.validees)]
+        scores = scores[~np.isnan(scores)]
+        return float(scores.mean()) if len(scores) else 0
+
+    def tendances(self, periode_jours=90, maintenant=None):
+        """Structure de analyser_tendances_risques, sur les évaluations validées de la période"""
+        maintenant = np.datetime64(maintenant or datetime.now(), 'us')
+        limite = maintenant - np.timedelta64(periode_jours, 'D')
+        masque = self.validees & (self.created_at >= limite)
+
+        premieres, nombres = self._premieres_et_nombres(masque)
+        dernieres = self._dernieres(masque)
+        premier_score = self.scores[premieres]
+        dernier_score = self.scores[dernieres]
+        multiples = nombres >= 2
+
+        anciennete_jours = (maintenant - self.created_at[premieres]) // np.timedelta64(1, 'D')
+        return {
+            'risques_critiques': int(np.count_nonzero(dernier_score >= SCORE_CRITIQUE)),
+            'risques_en_hausse': int(np.count_nonzero(multiples & (dernier_score > premier_score + VARIATION_SIGNIFICATIVE))),
+            'risques_en_baisse': int(np.count_nonzero(multiples & (dernier_score < premier_score - VARIATION_SIGNIFICATIVE))),
+            'risques_stables': int(np.count_nonzero(
+                multiples
+                & ~(dernier_score > premier_score + VARIATION_SIGNIFICATIVE)
+                & ~(dernier_score < premier_score - VARIATION_SIGNIFICATIVE)
+            )),
+            'nouveaux_risques': int(np.count_nonzero((nombres == 1) & (anciennete_jours <= NOUVEAU_RISQUE_JOURS))),
+        }
+
+    def indice_severite(self):
+        """Moyenne de impact x probabilité / 25 de la dernière évaluation de chaque risque, en %"""
+        dernieres = self._dernieres(np.ones(len(self), dtype=bool))
+        severites = self.impacts[dernieres] * self.probabilites[dernieres] / 25.0
+        severites = severites[~np.isnan(severites)]
+        return round(float(severites.mean()) * 100, 2) if len(severites) else 0
+
+    def dernieres_confirmees(self):
+        """{risque_id: (evaluation_id, score, niveau)} de la dernière évaluation confirmée (par date_confirmation)"""
+        indices = np.flatnonzero(~np.isnat(self.date_confirmation))
+        if not len(indices):
+            return {}
+        # Tri stable par (risque, date_confirmation) : à date égale, l'ordre created_at est conservé
+        indices = indices[np.lexsort((self.date_confirmation[indices], self.risque_ids[indices]))]
+        risques = self.risque_ids[indices]
+        dernieres = indices[np.r_[risques[1:] != risques[:-1], True]]
+        return {
+            int(self.risque_ids[i]): (int(self.ids[i]), None if np.isnan(self.scores[i]) else int(self.scores[i]),
+                                      self.niveaux[i])
+            for i in dernieres
+        }
+
+    def portefeuille(self, depuis):
+        """Nouveaux risques, risques clôturés et taux de rotation depuis une date (avec_risques=True)"""
+        depuis = np.datetime64(depuis, 'us')
+        total = len(self.risques_ids)
+        nouveaux = int(np.count_nonzero(self.risques_created_at >= depuis))
+        clotures = len(np.unique(self.risque_ids[(self.created_at >= depuis) & (self.scores <= SCORE_CLOTURE)]))
+        return {
+            'total': total,
+            'nouveaux': nouveaux,
+            'clotures': clotures,
+            'taux_rotation': round((nouveaux / total) * 100, 1) if total > 0 else 0,
+        }
+
+
+def tableau_bordeaux(risques, historique=None):
+    """
+    Tableau de Bordeaux (structure de utils.generer_tableau_bordeaux) :
+    risques non archivés classés par niveau de leur dernière évaluation
+    confirmée, triés par score décroissant.
+    """
+    from models import EvaluationRisque
+
+    tableau = {categorie: [] for categorie in CATEGORIES_BORDEAUX.values()}
+    risques = [r for r in risques if not getattr(r, 'is_archived', False)]
+    historique = historique if historique is not None else HistoriqueEvaluations.pour_risques(risques)
+    confirmees = historique.dernieres_confirmees()
+
+    retenues = {risque_id: ligne for risque_id, ligne in confirmees.items() if ligne[2] in CATEGORIES_BORDEAUX}
+    ids = [ligne[0] for ligne in retenues.values()]
+    evaluations = {}
+    for debut in range(0, len(ids), TAILLE_LOT_IDS):
+        for evaluation in EvaluationRisque.query.filter(EvaluationRisque.id.in_(ids[debut:debut + TAILLE_LOT_IDS])):
+            evaluations[evaluation.id] = evaluation
+
+    for risque in risques:
+        ligne = retenues.get(risque.id)
+        if ligne is None:
+            continue
+        evaluation_id, score, niveau = ligne
+        tableau[CATEGORIES_BORDEAUX[niveau]].append({
+            'risque': risque,
+            'score': score if score is not None else 0,
+            'evaluation': evaluations.get(evaluation_id),
+            'niveau': niveau
+        })
+
+    for categorie in tableau:
+        tableau[categorie].sort(key=lambda x: x['score'], reverse=True)
+    return tableau
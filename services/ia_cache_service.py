@@ -0,0 +1,416 @@
+# services/ia_cache_service.py
+"""
+Cache des réponses IA adressé par contenu.
+
+- Clé = SHA-256(fournisseur, modèle, prompt normalisé, paramètres)
+- Stockage en base (table reponses_ia_cache) avec TTL et cloisonnement par client
+- Déduplication des appels identiques en cours (un seul appel au fournisseur)
+- Mode asynchrone : soumission d'une tâche + polling de son statut
+- Réutilisation des clients OpenAI / Anthropic au lieu d'un client par appel
+- Fournisseur factice local (IA_FOURNISSEUR=factice) pour les tests sans réseau
+"""
+import os
+import re
+import json
+import uuid
+import hashlib
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+# Durée de vie par défaut d'une réponse en cache (7 jours)
+DUREE_CACHE_DEFAUT = int(os.environ.get('IA_CACHE_TTL', 7 * 24 * 3600))
+NB_WORKERS_TACHES = int(os.environ.get('IA_TACHES_WORKERS', 4))
+# Délai maximum d'attente d'un appel identique déjà en cours
+DELAI_ATTENTE_APPEL = 120
+
+
+# ============================================
+# FOURNISSEUR FACTICE (TESTS LOCAUX)
+# ============================================
+
+class FournisseurIAFactice:
+    """
+    Fournisseur IA local et déterministe, compatible avec l'interface
+    `client.chat.completions.create(...)` d'OpenAI.
+    Activé avec IA_FOURNISSEUR=factice ; compte les appels reçus.
+    """
+
+    def __init__(self, reponse=None, latence=0.0):
+        self.reponse = reponse
+        self.latence = latence
+        self.nb_appels = 0
+        self._verrou = threading.Lock()
+        # Interface OpenAI : client.chat.completions.create
+        self.chat = type('Chat', (), {'completions': self})()
+        # Interface Anthropic : client.messages.create
+        self.messages = self
+
+    def create(self, **kwargs):
+        import time
+
+        with self._verrou:
+            self.nb_appels += 1
+        if self.latence:
+            time.sleep(self.latence)
+
+        contenu_prompt = json.dumps(kwargs.get('messages', []), ensure_ascii=False, sort_keys=True)
+        if self.reponse is not None:
+            texte = self.reponse if isinstance(self.reponse, str) else json.dumps(self.reponse, ensure_ascii=False)
+        else:
+            texte = json.dumps({
+                'fournisseur': 'factice',
+                'empreinte_prompt': hashlib.sha256(contenu_prompt.encode('utf-8')).hexdigest()[:16],
+                'score_confiance': 50
+            })
+
+        message = type('Message', (), {'content': texte})()
+        choix = type('Choix', (), {'message': message})()
+        bloc = type('Bloc', (), {'text': texte})()
+        return type('Reponse', (), {'choices': [choix], 'content': [bloc]})()
+
+
+# ============================================
+# SERVICE DE CACHE
+# ============================================
+
+class _AppelEnCours:
+    """Appel fournisseur en cours, partagé entre les requêtes identiques"""
+
+    def __init__(self):
+        self.termine = threading.Event()
+        self.resultat = None
+        self.erreur = None
+
+
+class IACacheService:
+    """Cache, déduplication et exécution asynchrone des appels IA"""
+
+    _clients = {}
+    _en_cours = {}
+    _verrou = threading.Lock()
+    _executor = None
+    _operations = {}
+    _contexte = threading.local()
+    fournisseur_factice = None
+
+    # ------------------------------------------
+    # Clés
+    # ------------------------------------------
+    @staticmethod
+    def normaliser_prompt(prompt):
+        """Normalise un prompt (texte ou liste de messages) pour le hachage"""
+        if isinstance(prompt, (list, dict)):
+            prompt = json.dumps(prompt, ensure_ascii=False, sort_keys=True)
+        return re.sub(r'\s+', ' ', str(prompt or '')).strip()
+
+    @staticmethod
+    def calculer_cle(fournisseur, modele, prompt, parametres=None):
+        """Retourne (cle, prompt_hash) pour un appel IA"""
+        prompt_hash = hashlib.sha256(
+            IACacheService.normaliser_prompt(prompt).encode('utf-8')
+        ).hexdigest()
+        materiel = json.dumps({
+            'fournisseur': fournisseur,
+            'modele': modele,
+            'prompt': prompt_hash,
+            'parametres': parametres or {}
+        }, sort_keys=True, default=str)
+        return hashlib.sha256(materiel.encode('utf-8')).hexdigest(), prompt_hash
+
+    @classmethod
+    def _client_id_courant(cls):
+        """client_id de la tâche en cours ou de l'utilisateur connecté, si disponible"""
+        client_id = getattr(cls._contexte, 'client_id', None)
+        if client_id is not None:
+            return client_id
+        try:
+            from flask import has_request_context
+            from flask_login import current_user
+            if has_request_context() and current_user.is_authenticated:
+                return getattr(current_user, 'client_id', None)
+        except Exception:
+            pass
+        return None
+
+    # ------------------------------------------
+    # Clients fournisseurs réutilisés
+    # ------------------------------------------
+    @staticmethod
+    def mode_factice():
+        return os.environ.get('IA_FOURNISSEUR', '').lower() == 'factice'
+
+    @classmethod
+    def get_fournisseur_factice(cls):
+        with cls._verrou:
+            if cls.fournisseur_factice is None:
+                cls.fournisseur_factice = FournisseurIAFactice()
+            return cls.fournisseur_factice
+
+    @classmethod
+    def get_client_openai(cls, api_key):
+        """Client OpenAI partagé par clé API (thread-safe côté SDK)"""
+        if cls.mode_factice():
+            return cls.get_fournisseur_factice()
+
+        cle = ('openai', hashlib.sha256((api_key or '').encode('utf-8')).hexdigest())
+        with cls._verrou:
+            client = cls._clients.get(cle)
+            if client is None:
+                from openai import OpenAI
+                client = OpenAI(api_key=api_key)
+                cls._clients[cle] = client
+            return client
+
+    @classmethod
+    def get_client_anthropic(cls, api_key):
+        """Client Anthropic partagé par clé API"""
+        if cls.mode_factice():
+            return cls.get_fournisseur_factice()
+
+        cle = ('anthropic', hashlib.sha256((api_key or '').encode('utf-8')).hexdigest())
+        with cls._verrou:
+            client = cls._clients.get(cle)
+            if client is None:
+                import anthropic
+                client = anthropic.Anthropic(api_key=api_key)
+                cls._clients[cle] = client
+            return client
+
+    # ------------------------------------------
+    # Lecture / écriture du cache
+    # ------------------------------------------
+    @staticmethod
+    def lire(cle, client_id=None):
+        """Retourne la réponse en cache non expirée, ou None"""
+        from models import db, ReponseIACache
+
+        table = ReponseIACache.__table__
+        maintenant = datetime.utcnow()
+        try:
+            # Connexion dédiée : ne touche pas à la session ORM de l'appelant
+            with db.engine.begin() as conn:
+                ligne = conn.execute(
+                    db.select(table.c.id, table.c.reponse, table.c.expires_at)
+                    .where(table.c.cle == cle, table.c.client_id.is_(None) if client_id is None
+                           else table.c.client_id == client_id)
+                ).first()
+                if ligne is None:
+                    return None
+                if ligne.expires_at is not None and ligne.expires_at <= maintenant:
+                    conn.execute(table.delete().where(table.c.id == ligne.id))
+                    return None
+                conn.execute(
+                    table.update().where(table.c.id == ligne.id)
+                    .values(nb_hits=table.c.nb_hits + 1, last_hit_at=maintenant)
+                )
+                return ligne.reponse
+        except Exception as e:
+            print(f"⚠️ Lecture cache IA impossible: {e}")
+            return None
+
+    @staticmethod
+    def ecrire(cle, prompt_hash, fournisseur, modele, reponse, client_id=None, ttl=None):
+        """Enregistre (ou remplace) une réponse dans le cache"""
+        from models import db, ReponseIACache
+
+        table = ReponseIACache.__table__
+        ttl = DUREE_CACHE_DEFAUT if ttl is None else ttl
+        maintenant = datetime.utcnow()
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(table.delete().where(
+                    table.c.cle == cle,
+                    table.c.client_id.is_(None) if client_id is None else table.c.client_id == client_id
+                ))
+                conn.execute(table.insert().values(
+                    cle=cle,
+                    prompt_hash=prompt_hash,
+                    fournisseur=fournisseur,
+                    modele=modele,
+                    reponse=reponse,
+                    client_id=client_id,
+                    nb_hits=0,
+                    created_at=maintenant,
+                    expires_at=maintenant + timedelta(seconds=ttl) if ttl else None
+                ))
+        except Exception as e:
+            print(f"⚠️ Écriture cache IA impossible: {e}")
+
+    @staticmethod
+    def purger_expires():
+        """Supprime les réponses expirées ; retourne le nombre de lignes supprimées"""
+        from models import db, ReponseIACache
+
+        table = ReponseIACache.__table__
+        with db.engine.begin() as conn:
+            resultat = conn.execute(table.delete().where(
+                table.c.expires_at.isnot(None),
+                table.c.expires_at <= datetime.utcnow()
+            ))
+            return resultat.rowcount or 0
+
+    @staticmethod
+    def invalider(client_id=None, fournisseur=None):
+        """Vide le cache d'un client et/ou d'un fournisseur"""
+        from models import db, ReponseIACache
+
+        table = ReponseIACache.__table__
+        requete = table.delete()
+        if client_id is not None:
+            requete = requete.where(table.c.client_id == client_id)
+        if fournisseur:
+            requete = requete.where(table.c.fournisseur == fournisseur)
+        with db.engine.begin() as conn:
+            return conn.execute(requete).rowcount or 0
+
+    # ------------------------------------------
+    # Point d'entrée principal
+    # ------------------------------------------
+    @classmethod
+    def obtenir_ou_calculer(cls, fournisseur, modele, prompt, appel, parametres=None,
+                            client_id=None, ttl=None):
+        """
+        Retourne la réponse en cache ou exécute `appel()` une seule fois.
+
+        Args:
+            fournisseur: openai, gemini, anthropic...
+            modele: nom du modèle
+            prompt: texte ou liste de messages envoyés au fournisseur
+            appel: fonction sans argument qui interroge le fournisseur et
+                   retourne une valeur sérialisable en JSON
+            parametres: paramètres influençant la réponse (température, max_tokens...)
+            client_id: client propriétaire (par défaut celui de l'utilisateur connecté)
+            ttl: durée de vie en secondes (0 = pas d'expiration)
+        """
+        if client_id is None:
+            client_id = cls._client_id_courant()
+
+        cle, prompt_hash = cls.calculer_cle(fournisseur, modele, prompt, parametres)
+
+        reponse = cls.lire(cle, client_id)
+        if reponse is not None:
+            return reponse
+
+        # Déduplication des appels identiques en cours dans ce processus
+        cle_vol = (cle, client_id)
+        with cls._verrou:
+            en_cours = cls._en_cours.get(cle_vol)
+            proprietaire = en_cours is None
+            if proprietaire:
+                en_cours = _AppelEnCours()
+                cls._en_cours[cle_vol] = en_cours
+
+        if not proprietaire:
+            if en_cours.termine.wait(DELAI_ATTENTE_APPEL) and en_cours.erreur is None:
+                return en_cours.resultat
+            # Appel initial en échec ou trop long : on tente nous-mêmes
+            return appel()
+
+        try:
+            resultat = appel()
+            en_cours.resultat = resultat
+            if resultat is not None:
+                cls.ecrire(cle, prompt_hash, fournisseur, modele, resultat, client_id, ttl)
+            return resultat
+        except Exception as e:
+            en_cours.erreur = e
+            raise
+        finally:
+            en_cours.termine.set()
+            with cls._verrou:
+                cls._en_cours.pop(cle_vol, None)
+
+    # ------------------------------------------
+    # Mode asynchrone
+    # ------------------------------------------
+    @classmethod
+    def enregistrer_operation(cls, nom, fonction):
+        """Déclare une opération IA exécutable en tâche de fond : fonction(**parametres)"""
+        cls._operations[nom] = fonction
+
+    @classmethod
+    def operations_disponibles(cls):
+        return sorted(cls._operations.keys())
+
+    @classmethod
+    def _get_executor(cls):
+        with cls._verrou:
+            if cls._executor is None:
+                cls._executor = ThreadPoolExecutor(
+                    max_workers=NB_WORKERS_TACHES,
+                    thread_name_prefix='taches-ia'
+                )
+            return cls._executor
+
+    @classmethod
+    def soumettre_tache(cls, operation, parametres=None, client_id=None, user_id=None):
+        """Crée une TacheIA et l'exécute en arrière-plan ; retourne la tâche"""
+        from flask import current_app
+        from models import db, TacheIA
+
+        if operation not in cls._operations:
+            raise ValueError(f"Opération IA inconnue: {operation}")
+
+        if client_id is None:
+            client_id = cls._client_id_courant()
+
+        tache = TacheIA(
+            id=str(uuid.uuid4()),
+            operation=operation,
+            statut='en_attente',
+            parametres=parametres or {},
+            client_id=client_id,
+            created_by=user_id
+        )
+        db.session.add(tache)
+        db.session.commit()
+
+        app = current_app._get_current_object()
+        cls._get_executor().submit(cls._executer_tache, app, tache.id, client_id)
+        return tache
+
+    @classmethod
+    def _executer_tache(cls, app, tache_id, client_id):
+        from models import db, TacheIA
+
+        with app.app_context():
+            tache = db.session.get(TacheIA, tache_id)
+            if tache is None:
+                return
+            tache.statut = 'en_cours'
+            tache.started_at = datetime.utcnow()
+            db.session.commit()
+
+            cls._contexte.client_id = client_id
+            try:
+                fonction = cls._operations[tache.operation]
+                resultat = fonction(**(tache.parametres or {}))
+                tache.resultat = resultat
+                tache.statut = 'termine'
+            except Exception as e:
+                db.session.rollback()
+                tache = db.session.get(TacheIA, tache_id)
+                tache.statut = 'erreur'
+                tache.erreur = str(e)
+                app.logger.error(f"Erreur tâche IA {tache_id}: {e}")
+            finally:
+                cls._contexte.client_id = None
+                tache.finished_at = datetime.utcnow()
+                db.session.commit()
+
+    @staticmethod
+    def statut_tache(tache_id, client_id=None, user_id=None, super_admin=False):
+        """
+        Retourne la tâche si le demandeur peut la lire, sinon None : tâche de
+        son client, ou tâche sans client qu'il a lui-même soumise (les
+        super-administrateurs voient tout).
+        """
+        from models import db, TacheIA
+
+        tache = db.session.get(TacheIA, tache_id)
+        if tache is None or super_admin:
+            return tache
+        if tache.client_id is None:
+            return tache if user_id is not None and tache.created_by == user_id else None
+        return tache if tache.client_id == client_id else None
@@ -2,17 +2,19 @@
 import os
 import json
 import random
-from openai import OpenAI
 from flask import current_app
 from models import PlanQualiteFonction, ActionAmeliorationQualite
 from datetime import datetime, timedelta
+from services.ia_cache_service import IACacheService
 
 # Initialisation du client OpenAI (si la clé est disponible)
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 client = None
-if OPENAI_API_KEY and OPENAI_API_KEY != "mode-simulation" and not OPENAI_API_KEY.startswith("sk-proj-"):
+if IACacheService.mode_factice():
+    client = IACacheService.get_fournisseur_factice()
+elif OPENAI_API_KEY and OPENAI_API_KEY != "mode-simulation" and not OPENAI_API_KEY.startswith("sk-proj-"):
     try:
-        client = OpenAI(api_key=OPENAI_API_KEY)
+        client = IACacheService.get_client_openai(OPENAI_API_KEY)
         print("✅ OpenAI client initialisé avec succès")
     except Exception as e:
         print(f"⚠️ Erreur initialisation OpenAI: {e}")
@@ -28,6 +30,17 @@ class IAQualiteService:
         """Vérifie si l'IA est disponible"""
         return client is not None
 
+    @staticmethod
+    def _completion(prompt, modele="gpt-3.5-turbo", **parametres):
+        """Appel chat OpenAI passant par le cache des réponses IA ; retourne le texte"""
+        messages = [{"role": "user", "content": prompt}]
+
+        def appel():
+            response = client.chat.completions.create(model=modele, messages=messages, **parametres)
+            return response.choices[0].message.content
+
+        return IACacheService.obtenir_ou_calculer('openai', modele, messages, appel, parametres)
+
     # ============================================
     # 1. DESCRIPTION
     # ============================================
@@ -48,13 +61,8 @@ class IAQualiteService:
 
                 La description doit être concise et expliquer la valeur ajoutée du plan.
                 """
-                response = client.chat.completions.create(
-                    model="gpt-3.5-turbo",
-                    messages=[{"role": "user", "content": prompt}],
-                    temperature=0.7,
-                    max_tokens=150
-                )
-                return response.choices[0].message.content.strip()
+                contenu = IAQualiteService._completion(prompt, temperature=0.7, max_tokens=150)
+                return contenu.strip()
             except Exception as e:
                 current_app.logger.error(f"Erreur IA génération description: {e}")
         
@@ -86,13 +94,10 @@ class IAQualiteService:
 
                 Rends UNIQUEMENT une liste JSON valide de 3 chaînes de caractères. Exemple : ["Objectif 1", "Objectif 2", "Objectif 3"]
                 """
-                response = client.chat.completions.create(
-                    model="gpt-3.5-turbo",
-                    messages=[{"role": "user", "content": prompt}],
-                    temperature=0.6,
-                    response_format={"type": "json_object"}
+                contenu = IAQualiteService._completion(
+                    prompt, temperature=0.6, response_format={"type": "json_object"}
                 )
-                data = json.loads(response.choices[0].message.content)
+                data = json.loads(contenu)
                 if isinstance(data, list):
                     return data
                 return list(data.values())[0] if data else []
@@ -129,13 +134,10 @@ class IAQualiteService:
                 Chaque indicateur doit avoir : un nom, une cible, une unité.
                 Rends UNIQUEMENT une liste JSON valide au format : [{{"nom": "...", "cible": "...", "unite": "..."}}, ...]
                 """
-                response = client.chat.completions.create(
-                    model="gpt-3.5-turbo",
-                    messages=[{"role": "user", "content": prompt}],
-                    temperature=0.6,
-                    response_format={"type": "json_object"}
+                contenu = IAQualiteService._completion(
+                    prompt, temperature=0.6, response_format={"type": "json_object"}
                 )
-                data = json.loads(response.choices[0].message.content)
+                data = json.loads(contenu)
                 if isinstance(data, list):
                     return data
                 return list(data.values())[0] if data else []
@@ -1,11 +1,15 @@
 # services/incident_ia_service.py
 import json
-import openai
 from datetime import datetime, timedelta
 from flask import current_app
 
+from chargement_differe import ModuleParesseux
+
+openai = ModuleParesseux('openai')
+
 # IMPORTANT: Ajouter cet import pour accéder au modèle Incident
 from models import Incident
+from services.ia_cache_service import IACacheService
 
 class IncidentIAService:
     """Service d'analyse IA pour les incidents"""
@@ -31,7 +35,7 @@ class IncidentIAService:
         
         try:
             # Appel API OpenAI (ou simulation)
-            response = IncidentIAService._appel_api_ia(prompt)
+            response = IncidentIAService._appel_api_ia(prompt, client_id=incident.client_id)
             
             # Stocker l'analyse
             incident.analyse_ia = json.dumps(response)
@@ -165,16 +169,31 @@ class IncidentIAService:
         return {'suggestions': suggestions, 'total_analyses': len(incidents)}
     
     @staticmethod
-    def _appel_api_ia(prompt):
-        """Appel à l'API OpenAI (simulé pour l'exemple)"""
+    def _appel_api_ia(prompt, client_id=None):
+        """Appel à l'API IA via le cache des réponses (simulé pour l'exemple)"""
+        if IACacheService.mode_factice():
+            fournisseur = IACacheService.get_fournisseur_factice()
+            messages = [{"role": "user", "content": prompt}]
+            texte = IACacheService.obtenir_ou_calculer(
+                'factice', 'factice', messages,
+                lambda: fournisseur.create(messages=messages).choices[0].message.content,
+                client_id=client_id
+            )
+            return json.loads(texte)
+        
         # Simulation - à remplacer par un vrai appel API
-        return {
-            'classification': {'type': 'technique', 'gravite': 'moyenne'},
-            'causes_probables': ['Défaut de configuration', 'Erreur humaine'],
-            'recommandations': ['Vérifier les logs', 'Mettre à jour la documentation'],
-            'delai_estime': '2-4 heures',
-            'score_confiance': 85
-        }
+        # (le passage par le cache garantit un seul appel par prompt identique)
+        return IACacheService.obtenir_ou_calculer(
+            'simulation', 'simulation', prompt,
+            lambda: {
+                'classification': {'type': 'technique', 'gravite': 'moyenne'},
+                'causes_probables': ['Défaut de configuration', 'Erreur humaine'],
+                'recommandations': ['Vérifier les logs', 'Mettre à jour la documentation'],
+                'delai_estime': '2-4 heures',
+                'score_confiance': 85
+            },
+            client_id=client_id
+        )
     
     @staticmethod
     def _get_analyse_fallback(incident):
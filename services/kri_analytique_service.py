@@ -0,0 +1,435 @@
+# services/kri_analytique_service.py
+"""
+Statistiques et tendances de tous les KRI d'un client en un passage.
+
+Les mesures du client sont lues par une seule requête triée (kri_id,
+date_mesure) puis rangées dans des tableaux NumPy. Chaque KRI est un
+segment contigu de ces tableaux : moyennes, écarts-types, extrema, pentes
+de régression, variation et état des seuils sont calculés pour tous les
+KRI à la fois (ufunc.reduceat), sans boucle Python par indicateur.
+
+Les mesures collectées purgées par la rétention (SeriesTemporellesKRI)
+restent comptées par leurs agrégats journaliers : chaque journée agrégée
+est un point de la série (sa moyenne) qui pèse son nombre de mesures dans
+le nombre, la moyenne, l'écart-type et les extrema.
+
+Les résultats sont gardés en cache par client et servis tant que la
+version du client (VersionAnalytiqueKRI, incrémentée dans la transaction
+de chaque écriture sur MesureKRI ou KRI) n'a pas changé : une écriture
+faite dans un worker invalide le cache de tous les autres.
+
+Les fonctions de utils calculer_statistiques_kri et calculer_tendance_kri
+s'appuient sur analyser_series pour un seul KRI : mêmes règles de calcul
+dans les deux cas.
+"""
+import threading
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import event, inspect, select, func, or_
+from sqlalchemy.orm import object_session
+
+from chargement_differe import ModuleParesseux
+from models import db, KRI, MesureKRI, VersionAnalytiqueKRI, AgregatMesureKRI
+from services.ecriture_sql import inserer_ou_mettre_a_jour
+
+np = ModuleParesseux('numpy')
+
+V = VersionAnalytiqueKRI.__table__
+VERSION_SANS_CLIENT = 0   # KRI sans client
+VERSION_GLOBALE = -1      # invalidation de tous les clients
+
+PERIODE_TENDANCE_JOURS = 30
+
+# Seuils de pente (unités de valeur par mesure)
+PENTE_TENDANCE = 0.1          # calculer_tendance_kri : hausse / baisse
+PENTE_STABLE = 0.01           # calculer_tendance_kri_detaille : stable en deçà
+PENTE_SIGNIFICATIVE = 0.05    # calculer_tendance_kri_detaille : hausse / baisse au-delà
+VARIATION_FORTE = 10          # % de variation première -> dernière mesure
+
+ETATS_KRI = ('inconnu', 'normal', 'alerte', 'critique')
+ETATS_KPI = ('inconnu', 'dans_cible', 'sous_performance', 'hors_cible')
+
+
+# ============================================
+# CALCUL VECTORISÉ
+# ============================================
+
+def analyser_series(kri_ids, dates, valeurs, maintenant=None, periode_jours=PERIODE_TENDANCE_JOURS,
+                    cumuls=None):
+    """
+    Statistiques par KRI de séries triées par (kri_id, date).
+
+    kri_ids, dates, valeurs : séquences de même longueur. Retourne un dict
+    de tableaux alignés sur 'kri_id' (un élément par KRI présent).
+    cumuls : tableaux alignés sur les points quand certains résument
+    plusieurs mesures (voir series_avec_agregats) ; None si chaque point
+    est une mesure.
+    """
+    kri_ids = np.asarray(kri_ids, dtype=np.int64)
+    valeurs = np.asarray(valeurs, dtype=np.float64)
+    dates = np.asarray(dates, dtype='datetime64[s]')
+    if cumuls is None:
+        cumuls = {'nb': np.ones(valeurs.size), 'somme': valeurs, 'somme_carres': valeurs * valeurs,
+                  'min': valeurs, 'max': valeurs, 'derniere_valeur': valeurs, 'derniere_date': dates}
+
+    if kri_ids.size == 0:
+        vide = np.empty(0)
+        return {
+            'kri_id': np.empty(0, dtype=np.int64), 'nb_mesures': np.empty(0, dtype=np.int64),
+            'moyenne': vide, 'ecart_type': vide, 'min': vide, 'max': vide,
+            'premiere_valeur': vide, 'derniere_valeur': vide,
+            'derniere_date': np.empty(0, dtype='datetime64[s]'), 'periode_couverte': np.empty(0, dtype=np.int64),
+            'pente': vide, 'pourcentage_changement': vide,
+            'tendance_detaillee': np.empty(0, dtype=object), 'tendance': np.empty(0, dtype=object),
+        }
+
+    ids, debuts, nb_points = np.unique(kri_ids, return_index=True, return_counts=True)
+    fins = debuts + nb_points - 1
+    groupe = np.repeat(np.arange(ids.size), nb_points)
+
+    poids = cumuls['nb']
+    nb = np.add.reduceat(poids, debuts)
+    moyenne = np.add.reduceat(cumuls['somme'], debuts) / nb
+    ecarts = valeurs - moyenne[groupe]
+    # Dispersion interne du point (nulle pour une mesure) + écart de sa moyenne à celle du KRI
+    dispersion = cumuls['somme_carres'] - cumuls['somme'] * valeurs + poids * ecarts * ecarts
+    ecart_type = np.sqrt(np.maximum(np.add.reduceat(dispersion, debuts) / nb, 0))
+    pente = _pentes(ecarts, debuts, nb_points, groupe)
+
+    # Journée agrégée en tête de série : sa moyenne tient lieu de première valeur
+    premiere = valeurs[debuts]
+    derniere = cumuls['derniere_valeur'][fins]
+    derniere_date = np.asarray(cumuls['derniere_date'], dtype='datetime64[s]')[fins]
+    changement = np.divide((derniere - premiere) * 100, premiere,
+                           out=np.zeros_like(premiere), where=premiere != 0)
+
+    tendance_detaillee = np.select(
+        [nb_points < 2,
+         np.abs(pente) < PENTE_STABLE,
+         (pente > PENTE_SIGNIFICATIVE) & (changement > VARIATION_FORTE),
+         pente > PENTE_SIGNIFICATIVE,
+         (pente < -PENTE_SIGNIFICATIVE) & (changement < -VARIATION_FORTE),
+         pente < -PENTE_SIGNIFICATIVE],
+        ['stable', 'stable', 'hausse_forte', 'hausse_moderee', 'baisse_forte', 'baisse_moderee'],
+        default='stable',
+    ).astype(object)
+
+    return {
+        'kri_id': ids,
+        'nb_mesures': nb.astype(np.int64),
+        'moyenne': moyenne,
+        'ecart_type': ecart_type,
+        'min': np.minimum.reduceat(cumuls['min'], debuts),
+        'max': np.maximum.reduceat(cumuls['max'], debuts),
+        'premiere_valeur': premiere,
+        'derniere_valeur': derniere,
+        'derniere_date': derniere_date,
+        'periode_couverte': ((derniere_date - dates[debuts]) // np.timedelta64(1, 'D')).astype(np.int64),
+        'pente': pente,
+        'pourcentage_changement': changement,
+        'tendance_detaillee': tendance_detaillee,
+        'tendance': _tendances_recentes(ids, kri_ids, dates, valeurs, maintenant, periode_jours),
+    }
+
+
+def series_avec_agregats(mesures, agregats):
+    """
+    Mesures brutes (kri_id, date, valeur) et agrégats journaliers (lignes
+    de agregats_journaliers) en une série triée par (kri_id, date) :
+    (kri_ids, dates, valeurs, cumuls) pour analyser_series.
+    """
+    mesures = list(mesures)
+    agregats = list(agregats)
+    if not agregats:
+        kri_ids, dates, valeurs = zip(*mesures) if mesures else ((), (), ())
+        return kri_ids, dates, valeurs, None
+
+    kri_ids = np.array([m[0] for m in mesures] + [a.kri_id for a in agregats], dtype=np.int64)
+    dates = np.array([m[1] for m in mesures] + [a.debut for a in agregats], dtype='datetime64[s]')
+    brutes = np.array([m[2] for m in mesures], dtype=np.float64)
+    nb = np.r_[np.ones(brutes.size), [a.nb_mesures for a in agregats]]
+    somme = np.r_[brutes, [a.somme for a in agregats]]
+    cumuls = {
+        'nb': nb,
+        'somme': somme,
+        'somme_carres': np.r_[brutes * brutes, [a.somme_carres for a in agregats]],
+        'min': np.r_[brutes, [a.valeur_min for a in agregats]],
+        'max': np.r_[brutes, [a.valeur_max for a in agregats]],
+        'derniere_valeur': np.r_[brutes, [a.derniere_valeur for a in agregats]],
+        'derniere_date': np.r_[dates[:brutes.size],
+                               np.array([a.derniere_date or a.debut for a in agregats], dtype='datetime64[s]')],
+    }
+    ordre = np.lexsort((dates, kri_ids))
+    return kri_ids[ordre], dates[ordre], (somme / nb)[ordre], {cle: t[ordre] for cle, t in cumuls.items()}
+
+
+def agregats_journaliers(*conditions):
+    """Agrégats journaliers des mesures purgées par la rétention, triés par (kri_id, début)"""
+    return db.session.execute(
+        select(AgregatMesureKRI.kri_id, AgregatMesureKRI.debut, AgregatMesureKRI.nb_mesures,
+               AgregatMesureKRI.valeur_min, AgregatMesureKRI.valeur_max, AgregatMesureKRI.somme,
+               AgregatMesureKRI.somme_carres, AgregatMesureKRI.derniere_valeur, AgregatMesureKRI.derniere_date)
+        .where(AgregatMesureKRI.granularite == 'jour', AgregatMesureKRI.nb_mesures > 0, *conditions)
+        .order_by(AgregatMesureKRI.kri_id, AgregatMesureKRI.debut)
+    ).all()
+
+
+def _pentes(ecarts, debuts, nb, groupe):
+    """Pente de la régression valeur ~ rang de la mesure, pour chaque segment"""
+    # Rang centré dans le segment : somme(x.y) / somme(x²) (équivalent à polyfit degré 1)
+    rang = np.arange(ecarts.size) - debuts[groupe] - (nb[groupe] - 1) / 2
+    covariance = np.add.reduceat(rang * ecarts, debuts)
+    variance = nb * (nb * nb - 1) / 12.0
+    return np.divide(covariance, variance, out=np.zeros(nb.size), where=nb > 1)
+
+
+def _tendances_recentes(ids, kri_ids, dates, valeurs, maintenant, periode_jours):
+    """Tendance 'hausse' / 'baisse' / 'stable' sur les mesures des `periode_jours` derniers jours"""
+    tendances = np.full(ids.size, 'stable', dtype=object)
+    limite = np.datetime64((maintenant or datetime.now()) - timedelta(days=periode_jours), 's')
+    recentes = dates >= limite
+    if recentes.sum() < 2:
+        return tendances
+
+    ids_recents, debuts, nb = np.unique(kri_ids[recentes], return_index=True, return_counts=True)
+    valeurs_recentes = valeurs[recentes]
+    groupe = np.repeat(np.arange(ids_recents.size), nb)
+    moyenne = np.add.reduceat(valeurs_recentes, debuts) / nb
+    pente = _pentes(valeurs_recentes - moyenne[groupe], debuts, nb, groupe)
+
+    position = np.searchsorted(ids, ids_recents)
+    tendances[position[(nb >= 2) & (pente > PENTE_TENDANCE)]] = 'hausse'
+    tendances[position[(nb >= 2) & (pente < -PENTE_TENDANCE)]] = 'baisse'
+    return tendances
+
+
+def etats_seuils(derniere_valeur, seuil_alerte, seuil_critique, sens_inferieur, est_kri):
+    """
+    État de la dernière valeur pour chaque KRI (même règle que KRI.get_etat_alerte).
+    Seuils absents : NaN ; valeur absente : NaN -> 'inconnu'.
+    """
+    valeur = np.asarray(derniere_valeur, dtype=np.float64)
+    alerte = np.asarray(seuil_alerte, dtype=np.float64)
+    critique = np.asarray(seuil_critique, dtype=np.float64)
+    inferieur = np.asarray(sens_inferieur, dtype=bool)
+
+    with np.errstate(invalid='ignore'):
+        depasse_critique = ~np.isnan(critique) & np.where(inferieur, valeur <= critique, valeur >= critique)
+        depasse_alerte = ~np.isnan(alerte) & np.where(inferieur, valeur <= alerte, valeur >= alerte)
+    niveau = np.select([np.isnan(valeur), depasse_critique, depasse_alerte], [0, 3, 2], default=1)
+
+    libelles_kri = np.array(ETATS_KRI, dtype=object)
+    libelles_kpi = np.array(ETATS_KPI, dtype=object)
+    return np.where(np.asarray(est_kri, dtype=bool), libelles_kri[niveau], libelles_kpi[niveau])
+
+
+# ============================================
+# RÉSULTATS
+# ============================================
+
+class ResultatsKRI:
+    """Statistiques de tous les KRI d'un client (tableaux alignés + accès par kri_id)"""
+
+    def __init__(self, colonnes):
+        self.colonnes = colonnes
+        self._index = {int(kri_id): i for i, kri_id in enumerate(colonnes['kri_id'])}
+
+    def __contains__(self, kri_id):
+        return kri_id in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def get(self, kri_id, defaut=None):
+        """Statistiques d'un KRI (dict de valeurs Python), `defaut` s'il n'a pas de mesure"""
+        i = self._index.get(kri_id)
+        if i is None:
+            return defaut
+        c = self.colonnes
+        derniere_date = c['derniere_date'][i]
+        return {
+            'nb_mesures': int(c['nb_mesures'][i]),
+            'moyenne': round(float(c['moyenne'][i]), 2),
+            'ecart_type': round(float(c['ecart_type'][i]), 2) if c['nb_mesures'][i] > 1 else 0,
+            'min': round(float(c['min'][i]), 2),
+            'max': round(float(c['max'][i]), 2),
+            'derniere_valeur': float(c['derniere_valeur'][i]),
+            'derniere_date': derniere_date.item(),
+            'periode_couverte': int(c['periode_couverte'][i]),
+            'pente': float(c['pente'][i]),
+            'pourcentage_changement': round(float(c['pourcentage_changement'][i]), 2),
+            'tendance_detaillee': c['tendance_detaillee'][i],
+            'tendance': c['tendance'][i],
+            'etat': c['etat'][i] if 'etat' in c else None,
+        }
+
+    def tendance(self, kri_id):
+        i = self._index.get(kri_id)
+        return 'stable' if i is None else self.colonnes['tendance'][i]
+
+
+# ============================================
+# SERVICE
+# ============================================
+
+class AnalytiqueKRI:
+    """Analyse en lot des KRI d'un client, en cache tant que sa version partagée n'a pas changé"""
+
+    _cache = {}
+    _verrou = threading.Lock()
+
+    @classmethod
+    def calculer(cls, client_id=None, actifs_seulement=True):
+        """
+        ResultatsKRI de tous les KRI du client (tous les clients si None).
+        Le cache local n'est servi que le jour même et si la version partagée
+        du client n'a pas bougé (lecture par clé primaire) ; sinon trois
+        requêtes : les mesures (une ligne par mesure, triées), les agrégats
+        journaliers des mesures purgées et les seuils.
+        """
+        cle = (client_id, actifs_seulement)
+        # Version lue avant les données : un résultat en cache n'est jamais plus ancien que sa version.
+        # Le jour en fait partie : la période de tendance glisse même sans nouvelle mesure.
+        version = (date.today(),) + cls.version(client_id)
+        with cls._verrou:
+            en_cache = cls._cache.get(cle)
+            if en_cache is not None and en_cache[0] == version:
+                return en_cache[1]
+
+        resultats = cls._calculer(client_id, actifs_seulement)
+
+        with cls._verrou:
+            cls._cache[cle] = (version, resultats)
+        return resultats
+
+    @staticmethod
+    def version(client_id=None):
+        """Version partagée des données KRI du client (de tous les clients si None)"""
+        requete = select(func.coalesce(func.sum(V.c.version), 0), func.count())
+        if client_id is not None:
+            requete = requete.where(V.c.client_id.in_((client_id, VERSION_GLOBALE)))
+        return tuple(db.session.execute(requete).one())
+
+    @staticmethod
+    def _calculer(client_id, actifs_seulement):
+        conditions_kri = []
+        if client_id is not None:
+            conditions_kri.append(KRI.client_id == client_id)
+        if actifs_seulement:
+            conditions_kri.append(KRI.est_actif == True)
+
+        requete = (
+            select(MesureKRI.kri_id, MesureKRI.date_mesure, MesureKRI.valeur)
+            .join(KRI, KRI.id == MesureKRI.kri_id)
+            .where(*conditions_kri, MesureKRI.date_mesure.isnot(None), MesureKRI.valeur.isnot(None))
+            .order_by(MesureKRI.kri_id, MesureKRI.date_mesure)
+        )
+        if client_id is not None:
+            # Mesures du client (ou sans client renseigné) sur les KRI du client
+            requete = requete.where(or_(MesureKRI.client_id == client_id, MesureKRI.client_id.is_(None)))
+
+        conditions_agregats = []
+        if conditions_kri:
+            conditions_agregats.append(AgregatMesureKRI.kri_id.in_(select(KRI.id).where(*conditions_kri)))
+        if client_id is not None:
+            conditions_agregats.append(
+                or_(AgregatMesureKRI.client_id == client_id, AgregatMesureKRI.client_id.is_(None)))
+
+        kri_ids, dates, valeurs, cumuls = series_avec_agregats(
+            db.session.execute(requete).all(), agregats_journaliers(*conditions_agregats)
+        )
+        colonnes = analyser_series(kri_ids, dates, valeurs, cumuls=cumuls)
+
+        # Seuils des KRI présents, alignés sur colonnes['kri_id']
+        seuils = {
+            ligne.id: ligne for ligne in db.session.execute(
+                select(KRI.id, KRI.seuil_alerte, KRI.seuil_critique, KRI.sens_evaluation_seuil, KRI.type_indicateur)
+                .where(*conditions_kri)
+            )
+        }
+        lignes_seuils = [seuils.get(int(kri_id)) for kri_id in colonnes['kri_id']]
+        colonnes['etat'] = etats_seuils(
+            colonnes['derniere_valeur'],
+            [_nan(s.seuil_alerte if s else None) for s in lignes_seuils],
+            [_nan(s.seuil_critique if s else None) for s in lignes_seuils],
+            [bool(s and s.sens_evaluation_seuil == 'inferieur') for s in lignes_seuils],
+            [bool(s and s.type_indicateur == 'kri') for s in lignes_seuils],
+        )
+        return ResultatsKRI(colonnes)
+
+    @staticmethod
+    def incrementer(connection, client_ids):
+        """Incrémente la version des clients donnés (None : KRI sans client)"""
+        maintenant = datetime.utcnow()
+        inserer_ou_mettre_a_jour(
+            connection, V,
+            [{'client_id': VERSION_SANS_CLIENT if c is None else c, 'version': 1, 'updated_at': maintenant}
+             for c in client_ids],
+            ['client_id'],
+            maj={'version': V.c.version + 1},
+        )
+
+    @classmethod
+    def invalider(cls, client_id=None):
+        """
+        Invalide les résultats du client dans tous les workers ; ceux de tous
+        les clients si None (écritures en masse hors événements ORM).
+        """
+        with db.engine.begin() as connection:
+            cls.incrementer(connection, [VERSION_GLOBALE if client_id is None else client_id])
+
+
+def _nan(valeur):
+    return float('nan') if valeur is None else float(valeur)
+
+
+# ============================================
+# INVALIDATION
+# ============================================
+
+def _clients_modifies(session):
+    return session.info.setdefault('kri_analytique_modifies', {'kri': set(), 'clients': set()})
+
+
+def _marquer_mesure(mapper, connection, target):
+    session = object_session(target)
+    if session is None:
+        return
+    kri_ids = _clients_modifies(session)['kri']
+    kri_ids.add(target.kri_id)
+    # Mesure rattachée à un autre KRI : l'ancien client change aussi
+    kri_ids.update(inspect(target).attrs.kri_id.history.deleted or ())
+
+
+def _marquer_kri(mapper, connection, target):
+    session = object_session(target)
+    if session is None:
+        return
+    clients = _clients_modifies(session)['clients']
+    clients.add(target.client_id)
+    clients.update(inspect(target).attrs.client_id.history.deleted or ())
+
+
+for _evenement in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(MesureKRI, _evenement, _marquer_mesure)
+    event.listen(KRI, _evenement, _marquer_kri)
+
+
+@event.listens_for(db.session, 'after_flush_postexec')
+def _incrementer_apres_flush(session, flush_context):
+    modifies = session.info.pop('kri_analytique_modifies', None)
+    if not modifies:
+        return
+    connection = session.connection()
+    clients = modifies['clients']
+    kri_ids = [kri_id for kri_id in modifies['kri'] if kri_id is not None]
+    if kri_ids:
+        # Client du KRI : la mesure peut ne pas avoir de client renseigné
+        clients.update(connection.execute(select(KRI.client_id).where(KRI.id.in_(kri_ids))).scalars())
+    if clients:
+        AnalytiqueKRI.incrementer(connection, clients)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _abandonner_apres_rollback(session):
+    session.info.pop('kri_analytique_modifies', None)
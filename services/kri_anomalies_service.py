@@ -0,0 +1,511 @@
+# services/kri_anomalies_service.py
+"""
+Détection en ligne des valeurs anormales collectées pour les KRI.
+
+SourceKRILink.valider_valeur ne contrôle que des bornes fixes. Chaque valeur
+extraite par CollecteEngine est aussi comparée, avant de devenir une
+MesureKRI, à trois références tenues à jour par KRI dans etats_anomalie_kri :
+
+- z-score glissant sur les FENETRE dernières valeurs acceptées ;
+- z-score sur la moyenne et la variance exponentielles (EWMA) ;
+- z-score sur la référence du créneau saisonnier : heure du jour pour les
+  sources collectées plusieurs fois par jour, jour de semaine sinon.
+
+Le score retenu est le plus petit des z-scores disponibles : une valeur n'est
+anormale que si aucune référence ne l'explique (le pic habituel du lundi
+n'est pas signalé). Les valeurs anormales n'alimentent pas les références ;
+à la RUPTURE-ième anomalie consécutive, le KRI est considéré comme ayant
+changé de niveau et ses références repartent de la valeur courante.
+
+Les calculs portent sur des tableaux NumPy (un KRI par ligne) : une collecte
+évalue tous les KRI de la source en un seul pas, le backtest rejoue
+l'historique des mesures de tous les KRI pas à pas, avec le même code.
+
+Configuration par liaison, dans `validation_regles['anomalies']` :
+{'actif': True, 'seuil': 4.0, 'bloquer': False, 'saison': 'heure' | 'jour_semaine' | 'aucune'}.
+Avec 'bloquer', une valeur anormale reste en collecte « avertissement » sans
+créer de mesure KRI.
+"""
+from datetime import datetime
+
+from sqlalchemy import select, literal
+
+from chargement_differe import ModuleParesseux
+from models import db, KRI, MesureKRI, EtatAnomalieKRI, SourceKRILink, SourceDonnee
+from services.ecriture_sql import inserer_ou_mettre_a_jour
+
+np = ModuleParesseux('numpy')
+
+
+K = KRI.__table__
+M = MesureKRI.__table__
+S = EtatAnomalieKRI.__table__
+L = SourceKRILink.__table__
+SD = SourceDonnee.__table__
+
+FENETRE = 30           # valeurs de la fenêtre glissante
+ALPHA = 0.1            # lissage de la moyenne et de la variance exponentielles
+ALPHA_SAISON = 0.3     # lissage des références saisonnières
+MIN_VALEURS = 10       # valeurs acceptées avant toute détection
+MIN_CRENEAU = 3        # valeurs d'un créneau avant d'utiliser sa référence
+RUPTURE = 5            # anomalies consécutives traitées comme un changement de niveau
+SEUIL_DEFAUT = 4.0
+ECART_MIN = 1e-6       # écart-type plancher relatif (séries constantes)
+
+SAISONS = ('heure', 'jour_semaine', 'aucune')
+HEURE, JOUR_SEMAINE, AUCUNE = range(len(SAISONS))
+NB_CRENEAUX = 24
+
+TAILLE_LOT = 1000
+
+
+# ============================================
+# CALCUL (un KRI par ligne)
+# ============================================
+
+def etat_vide(nb):
+    """Références vides pour nb KRI"""
+    return {
+        'nb': np.zeros(nb, dtype=np.int64),
+        'consecutives': np.zeros(nb, dtype=np.int64),
+        'fenetre': np.full((nb, FENETRE), np.nan),
+        'ewma_moyenne': np.full(nb, np.nan),
+        'ewma_variance': np.full(nb, np.nan),
+        'saison_moyenne': np.full((nb, NB_CRENEAUX), np.nan),
+        'saison_variance': np.full((nb, NB_CRENEAUX), np.nan),
+        'saison_nb': np.zeros((nb, NB_CRENEAUX), dtype=np.int64),
+    }
+
+
+def creneaux(dates, saisons):
+    """Créneau saisonnier de chaque date (datetime64) selon le code saison de sa ligne (-1 sans saison)"""
+    dates = np.asarray(dates, dtype='datetime64[s]')
+    jours = dates.astype('datetime64[D]')
+    heures = (dates - jours).astype('timedelta64[h]').astype(np.int64)
+    jours_semaine = (jours.astype(np.int64) + 3) % 7  # 1970-01-01 était un jeudi
+    return np.select([saisons == HEURE, saisons == JOUR_SEMAINE], [heures, jours_semaine], -1)
+
+
+def _z(x, moyenne, ecart_type):
+    return np.abs(x - moyenne) / np.maximum(ecart_type, ECART_MIN * (1 + np.abs(moyenne)))
+
+
+def scores(etat, x, creneau):
+    """(score retenu, z-scores fenêtre / EWMA / saison) ; nan tant qu'une référence manque"""
+    fenetre = etat['fenetre']
+    presentes = ~np.isnan(fenetre)
+    n = presentes.sum(axis=1)
+    moyenne = np.where(presentes, fenetre, 0.0).sum(axis=1) / np.maximum(n, 1)
+    ecarts = np.where(presentes, fenetre - moyenne[:, None], 0.0)
+    ecart_type = np.sqrt((ecarts ** 2).sum(axis=1) / np.maximum(n - 1, 1))
+    z_fenetre = np.where(n >= MIN_VALEURS, _z(x, moyenne, ecart_type), np.nan)
+
+    z_ewma = np.where(etat['nb'] >= MIN_VALEURS,
+                      _z(x, etat['ewma_moyenne'], np.sqrt(etat['ewma_variance'])), np.nan)
+
+    lignes = np.arange(len(x))
+    colonnes = np.maximum(creneau, 0)
+    nb_creneau = np.where(creneau >= 0, etat['saison_nb'][lignes, colonnes], 0)
+    z_saison = np.where(
+        nb_creneau >= MIN_CRENEAU,
+        _z(x, etat['saison_moyenne'][lignes, colonnes], np.sqrt(etat['saison_variance'][lignes, colonnes])),
+        np.nan
+    )
+
+    z = np.stack([z_fenetre, z_ewma, z_saison])
+    retenu = np.where(np.isnan(z), np.inf, z).min(axis=0)
+    return np.where(np.isinf(retenu), np.nan, retenu), z
+
+
+def _reinitialiser(etat, lignes):
+    etat['nb'][lignes] = 0
+    etat['fenetre'][lignes] = np.nan
+    etat['ewma_moyenne'][lignes] = np.nan
+    etat['ewma_variance'][lignes] = np.nan
+    _reinitialiser_saison(etat, lignes)
+
+
+def _reinitialiser_saison(etat, lignes):
+    etat['saison_moyenne'][lignes] = np.nan
+    etat['saison_variance'][lignes] = np.nan
+    etat['saison_nb'][lignes] = 0
+
+
+def _lisser(moyenne, variance, nb, x, alpha):
+    """Moyenne et variance exponentielles après x (la première valeur initialise)"""
+    premiere = nb == 0
+    moyenne = np.where(premiere, x, moyenne)
+    variance = np.where(premiere, 0.0, variance)
+    ecart = x - moyenne
+    return moyenne + alpha * ecart, (1 - alpha) * (variance + alpha * ecart ** 2)
+
+
+def _absorber(etat, x, creneau, lignes):
+    """Ajoute x aux références des lignes données (écritures en place : l'état peut être une vue)"""
+    if not len(lignes):
+        return
+    x = x[lignes]
+    etat['fenetre'][lignes] = np.concatenate([etat['fenetre'][lignes, 1:], x[:, None]], axis=1)
+    etat['ewma_moyenne'][lignes], etat['ewma_variance'][lignes] = _lisser(
+        etat['ewma_moyenne'][lignes], etat['ewma_variance'][lignes], etat['nb'][lignes], x, ALPHA
+    )
+    etat['nb'][lignes] += 1
+
+    saisonnieres = creneau[lignes] >= 0
+    lignes, x, colonnes = lignes[saisonnieres], x[saisonnieres], creneau[lignes][saisonnieres]
+    etat['saison_moyenne'][lignes, colonnes], etat['saison_variance'][lignes, colonnes] = _lisser(
+        etat['saison_moyenne'][lignes, colonnes], etat['saison_variance'][lignes, colonnes],
+        etat['saison_nb'][lignes, colonnes], x, ALPHA_SAISON
+    )
+    etat['saison_nb'][lignes, colonnes] += 1
+
+
+def pas(etat, x, creneau, seuils):
+    """
+    Évalue une valeur par ligne puis met à jour les références : les valeurs
+    normales sont absorbées, les anormales écartées sauf à la RUPTURE-ième
+    consécutive qui réinitialise les références de la ligne.
+    Retourne (anomalies, scores, z-scores).
+    """
+    retenus, z = scores(etat, x, creneau)
+    anomalies = retenus > seuils  # nan (références incomplètes) : jamais anormal
+    consecutives = np.where(anomalies, etat['consecutives'] + 1, 0)
+    ruptures = np.flatnonzero(consecutives >= RUPTURE)
+    _reinitialiser(etat, ruptures)
+    consecutives[ruptures] = 0
+    etat['consecutives'][:] = consecutives
+    absorbees = ~anomalies
+    absorbees[ruptures] = True
+    _absorber(etat, x, creneau, np.flatnonzero(absorbees))
+    return anomalies, retenus, z
+
+
+def rejouer(groupes, dates, valeurs, saisons, seuils=SEUIL_DEFAUT):
+    """
+    Rejoue des séries triées par (groupe, date) comme si leurs valeurs
+    arrivaient une à une. `saisons` et `seuils` : un code saison (et un seuil)
+    par groupe, dans l'ordre de np.unique(groupes), ou une valeur commune.
+
+    Les séries sont rangées par longueur décroissante : au pas t, les séries
+    encore en cours forment un préfixe des lignes, traité en une fois.
+    Retourne (identifiants des lignes, anomalies, scores dans l'ordre des
+    valeurs, références finales par ligne).
+    """
+    groupes = np.asarray(groupes)
+    valeurs = np.asarray(valeurs, dtype=float)
+    identifiants, debuts, tailles = np.unique(groupes, return_index=True, return_counts=True)
+    nb_series = len(identifiants)
+    saisons = np.broadcast_to(np.asarray(saisons), (nb_series,))
+    seuils = np.broadcast_to(np.asarray(seuils, dtype=float), (nb_series,))
+
+    ordre = np.argsort(-tailles, kind='stable')
+    rang = np.empty(nb_series, dtype=np.int64)
+    rang[ordre] = np.arange(nb_series)
+    ligne_serie = np.repeat(np.arange(nb_series), tailles)
+    lignes = rang[ligne_serie]
+    positions = np.arange(len(valeurs)) - np.repeat(debuts, tailles)
+
+    longueur = int(tailles.max()) if nb_series else 0
+    matrice = np.full((nb_series, longueur), np.nan)
+    matrice[lignes, positions] = valeurs
+    creneaux_matrice = np.full((nb_series, longueur), -1, dtype=np.int64)
+    creneaux_matrice[lignes, positions] = creneaux(dates, saisons[ligne_serie])
+    seuils = seuils[ordre]
+
+    etat = etat_vide(nb_series)
+    anomalies = np.zeros((nb_series, longueur), dtype=bool)
+    resultats = np.full((nb_series, longueur), np.nan)
+    tailles_triees = tailles[ordre]
+    for t in range(longueur):
+        en_cours = int(np.count_nonzero(tailles_triees > t))
+        vue = {cle: tableau[:en_cours] for cle, tableau in etat.items()}
+        anomalies[:en_cours, t], resultats[:en_cours, t], _ = pas(
+            vue, matrice[:en_cours, t], creneaux_matrice[:en_cours, t], seuils[:en_cours]
+        )
+    return identifiants[ordre], anomalies[lignes, positions], resultats[lignes, positions], etat
+
+
+# ============================================
+# PERSISTANCE DES RÉFÉRENCES
+# ============================================
+
+def _flottants(valeurs, taille):
+    tableau = np.full(taille, np.nan)
+    valeurs = [np.nan if v is None else v for v in (valeurs or [])][-taille:]
+    if valeurs:
+        tableau[taille - len(valeurs):] = valeurs
+    return tableau
+
+
+def _liste(tableau):
+    """Liste JSON (None à la place de nan)"""
+    return [None if v != v else float(v) for v in tableau.tolist()]
+
+
+def _charger(etat, j, ligne):
+    """Recopie dans la ligne j les références enregistrées"""
+    etat['nb'][j] = ligne.nb_valeurs or 0
+    etat['consecutives'][j] = ligne.nb_consecutives or 0
+    etat['fenetre'][j] = _flottants(ligne.fenetre, FENETRE)
+    etat['ewma_moyenne'][j] = np.nan if ligne.ewma_moyenne is None else ligne.ewma_moyenne
+    etat['ewma_variance'][j] = np.nan if ligne.ewma_variance is None else ligne.ewma_variance
+    etat['saison_moyenne'][j] = _flottants(ligne.saison_moyenne, NB_CRENEAUX)
+    etat['saison_variance'][j] = _flottants(ligne.saison_variance, NB_CRENEAUX)
+    etat['saison_nb'][j] = np.nan_to_num(_flottants(ligne.saison_nb, NB_CRENEAUX)).astype(np.int64)
+
+
+def _ligne(etat, j, kri_id, client_id, saison, valeur, date, score):
+    fenetre = etat['fenetre'][j]
+    return {
+        'kri_id': kri_id,
+        'client_id': client_id,
+        'saison': SAISONS[saison],
+        'nb_valeurs': int(etat['nb'][j]),
+        'nb_consecutives': int(etat['consecutives'][j]),
+        'fenetre': _liste(fenetre[~np.isnan(fenetre)]),
+        'ewma_moyenne': _liste(etat['ewma_moyenne'][j:j + 1])[0],
+        'ewma_variance': _liste(etat['ewma_variance'][j:j + 1])[0],
+        'saison_moyenne': _liste(etat['saison_moyenne'][j]),
+        'saison_variance': _liste(etat['saison_variance'][j]),
+        'saison_nb': etat['saison_nb'][j].tolist(),
+        'derniere_valeur': valeur,
+        'derniere_date': date,
+        'dernier_score': None if score is None or score != score else float(score),
+        'updated_at': datetime.utcnow(),
+    }
+
+
+def _enregistrer(connection, lignes):
+    inserer_ou_mettre_a_jour(connection, S, lignes, ['kri_id'])
+
+
+def _saison_par_defaut(frequence):
+    """Heure du jour pour les sources collectées plus d'une fois par jour, jour de semaine sinon"""
+    return HEURE if frequence is not None and frequence < 86400 else JOUR_SEMAINE
+
+
+def _configuration(regles):
+    regles = (regles or {}).get('anomalies') or {}
+    return {
+        'actif': bool(regles.get('actif', True)),
+        'seuil': float(regles.get('seuil') or SEUIL_DEFAUT),
+        'bloquer': bool(regles.get('bloquer', False)),
+        'saison': SAISONS.index(regles['saison']) if regles.get('saison') in SAISONS else None,
+    }
+
+
+class DetecteurAnomaliesKRI:
+    """Détection des valeurs collectées anormales et backtest sur l'historique des mesures"""
+
+    @staticmethod
+    def configuration(link):
+        """Paramètres de détection de la liaison (validation_regles['anomalies'])"""
+        return _configuration(link.validation_regles)
+
+    # ============================================
+    # COLLECTE
+    # ============================================
+
+    @staticmethod
+    def evaluer_collecte(source, valeurs, date=None):
+        """
+        Évalue en un pas les valeurs extraites d'une collecte ([(link, valeur)])
+        et met à jour les références des KRI (dans la transaction de la
+        collecte). Retourne {link.id: détection} pour les liaisons surveillées.
+        """
+        date = date or datetime.utcnow()
+        surveilles = []
+        for link, valeur in valeurs:
+            configuration = _configuration(link.validation_regles)
+            if configuration['actif'] and valeur is not None:
+                surveilles.append((link, float(valeur), configuration))
+        if not surveilles:
+            return {}
+
+        # Une ligne de références par KRI : les valeurs de plusieurs liaisons
+        # vers le même KRI sont évaluées l'une après l'autre, comme dans rejouer
+        par_kri = {}
+        for entree in surveilles:
+            par_kri.setdefault(entree[0].kri_id, []).append(entree)
+        kri_ids = sorted(par_kri, key=lambda kri_id: -len(par_kri[kri_id]))
+        connection = db.session.connection()
+        lignes = {
+            ligne.id: ligne for ligne in connection.execute(
+                select(K.c.id, K.c.client_id, S.c.saison, S.c.nb_valeurs, S.c.nb_consecutives, S.c.fenetre,
+                       S.c.ewma_moyenne, S.c.ewma_variance, S.c.saison_moyenne, S.c.saison_variance, S.c.saison_nb)
+                .select_from(K.outerjoin(S, S.c.kri_id == K.c.id))
+                .where(K.c.id.in_(kri_ids))
+            )
+        }
+
+        etat = etat_vide(len(kri_ids))
+        saisons = np.empty(len(kri_ids), dtype=np.int64)
+        for j, kri_id in enumerate(kri_ids):
+            ligne = lignes.get(kri_id)
+            enregistree = SAISONS.index(ligne.saison) if ligne is not None and ligne.saison in SAISONS else None
+            if ligne is not None and ligne.nb_valeurs is not None:
+                _charger(etat, j, ligne)
+            # Plusieurs liaisons configurées : la saison la plus fréquente (cf. _parametres)
+            configurees = [configuration['saison'] for _, _, configuration in par_kri[kri_id]
+                           if configuration['saison'] is not None]
+            saisons[j] = next(s for s in (min(configurees, default=None), enregistree,
+                                          _saison_par_defaut(source.frequence_rafraichissement)) if s is not None)
+            if enregistree is not None and saisons[j] != enregistree:
+                _reinitialiser_saison(etat, [j])
+
+        creneaux_collecte = creneaux(np.full(len(kri_ids), np.datetime64(date, 's')), saisons)
+        tailles = np.array([len(par_kri[kri_id]) for kri_id in kri_ids])
+        detections = {}
+        dernieres = {}
+        for t in range(int(tailles[0])):
+            en_cours = int(np.count_nonzero(tailles > t))
+            entrees = [par_kri[kri_id][t] for kri_id in kri_ids[:en_cours]]
+            vue = {cle: tableau[:en_cours] for cle, tableau in etat.items()}
+            x = np.array([valeur for _, valeur, _ in entrees])
+            seuils = np.array([configuration['seuil'] for _, _, configuration in entrees])
+            anomalies, retenus, z = pas(vue, x, creneaux_collecte[:en_cours], seuils)
+
+            for j, (link, valeur, configuration) in enumerate(entrees):
+                score = None if np.isnan(retenus[j]) else round(float(retenus[j]), 2)
+                anomalie = bool(anomalies[j])
+                detections[link.id] = {
+                    'anomalie': anomalie,
+                    'bloquer': anomalie and configuration['bloquer'],
+                    'score': score,
+                    'seuil': configuration['seuil'],
+                    'z': {nom: None if np.isnan(v) else round(float(v), 2)
+                          for nom, v in zip(('fenetre', 'ewma', 'saison'), z[:, j])},
+                    'message': f"Valeur {valeur} inhabituelle (score {score} > {configuration['seuil']})"
+                               if anomalie else '',
+                }
+                dernieres[j] = (valeur, retenus[j])
+
+        enregistrements = []
+        for j, kri_id in enumerate(kri_ids):
+            ligne = lignes.get(kri_id)
+            valeur, score = dernieres[j]
+            enregistrements.append(_ligne(etat, j, kri_id, ligne.client_id if ligne else None,
+                                          saisons[j], valeur, date, score))
+        _enregistrer(connection, enregistrements)
+        return detections
+
+    # ============================================
+    # BACKTEST SUR L'HISTORIQUE
+    # ============================================
+
+    @staticmethod
+    def _parametres(connection, kri_ids, seuil=None):
+        """{kri_id: (code saison, seuil)} d'après les liaisons actives des KRI"""
+        parametres = {}
+        for ligne in connection.execute(
+            select(L.c.kri_id, L.c.validation_regles, SD.c.frequence_rafraichissement)
+            .select_from(L.join(SD, SD.c.id == L.c.source_id))
+            .where(L.c.kri_id.in_(kri_ids), L.c.est_actif == True)
+        ):
+            configuration = _configuration(ligne.validation_regles)
+            saison = configuration['saison']
+            if saison is None:
+                saison = _saison_par_defaut(ligne.frequence_rafraichissement)
+            precedent = parametres.get(ligne.kri_id)
+            if precedent:
+                # Plusieurs sources : la plus fréquente et le seuil le plus strict
+                saison, configuration['seuil'] = min(saison, precedent[0]), min(configuration['seuil'], precedent[1])
+            parametres[ligne.kri_id] = (saison, seuil or configuration['seuil'])
+        return parametres
+
+    @classmethod
+    def _rejouer_lot(cls, connection, kri_ids, seuil=None, depuis=None):
+        conditions = [M.c.kri_id.in_(kri_ids), M.c.date_mesure.isnot(None), M.c.valeur.isnot(None)]
+        if depuis is not None:
+            conditions.append(M.c.date_mesure >= depuis)
+        mesures = connection.execute(
+            select(M.c.kri_id, M.c.id, M.c.valeur, M.c.date_mesure, K.c.client_id)
+            .select_from(M.join(K, K.c.id == M.c.kri_id))
+            .where(*conditions)
+            .order_by(M.c.kri_id, M.c.date_mesure, M.c.id)
+        ).all()
+        if not mesures:
+            return None
+
+        groupes, ids, valeurs, dates, clients = zip(*mesures)
+        groupes = np.array(groupes, dtype=np.int64)
+        dates = np.array(dates, dtype='datetime64[s]')
+        identifiants, debuts, tailles = np.unique(groupes, return_index=True, return_counts=True)
+
+        # Sans liaison active : saison déduite de l'intervalle moyen entre mesures
+        ecarts = (dates[debuts + tailles - 1] - dates[debuts]).astype(np.int64) / np.maximum(tailles - 1, 1)
+        parametres = cls._parametres(connection, identifiants.tolist(), seuil)
+        saisons = np.array([parametres[i][0] if i in parametres else _saison_par_defaut(e)
+                            for i, e in zip(identifiants.tolist(), ecarts.tolist())])
+        seuils = np.array([parametres[i][1] if i in parametres else (seuil or SEUIL_DEFAUT)
+                           for i in identifiants.tolist()])
+
+        lignes, anomalies, retenus, etat = rejouer(groupes, dates, valeurs, saisons, seuils)
+        return {
+            'mesures': mesures, 'ids': ids, 'identifiants': identifiants, 'debuts': debuts, 'tailles': tailles,
+            'saisons': saisons, 'lignes': lignes, 'anomalies': anomalies, 'scores': retenus, 'etat': etat,
+        }
+
+    @classmethod
+    def backtester(cls, kri_ids=None, seuil=None, depuis=None):
+        """
+        Rejoue l'historique des mesures des KRI (tous les KRI liés à une source
+        si None) avec les paramètres de leurs liaisons, ou `seuil` imposé.
+        Retourne {kri_id: {'nb_mesures', 'nb_anomalies', 'taux_anomalies', 'anomalies'}}.
+        """
+        connection = db.session.connection()
+        if kri_ids is None:
+            kri_ids = connection.execute(select(L.c.kri_id).distinct()).scalars().all()
+        kri_ids = sorted(set(kri_ids))
+
+        rapport = {}
+        for debut in range(0, len(kri_ids), TAILLE_LOT):
+            lot = cls._rejouer_lot(connection, kri_ids[debut:debut + TAILLE_LOT], seuil, depuis)
+            if lot is None:
+                continue
+            fins = lot['debuts'] + lot['tailles']
+            for kri_id, premier, fin in zip(lot['identifiants'].tolist(), lot['debuts'].tolist(), fins.tolist()):
+                signalees = premier + np.flatnonzero(lot['anomalies'][premier:fin])
+                rapport[kri_id] = {
+                    'nb_mesures': fin - premier,
+                    'nb_anomalies': len(signalees),
+                    'taux_anomalies': round(len(signalees) / (fin - premier) * 100, 2),
+                    'anomalies': [{
+                        'mesure_id': lot['ids'][i],
+                        'date_mesure': lot['mesures'][i].date_mesure,
+                        'valeur': lot['mesures'][i].valeur,
+                        'score': round(float(lot['scores'][i]), 2),
+                    } for i in signalees.tolist()],
+                }
+        return rapport
+
+    @classmethod
+    def initialiser(cls, kri_ids=None):
+        """Reconstruit les références des KRI liés à une source en rejouant leur historique"""
+        connection = db.session.connection()
+        if kri_ids is None:
+            kri_ids = connection.execute(select(L.c.kri_id).distinct()).scalars().all()
+        kri_ids = sorted(set(kri_ids))
+
+        nb = 0
+        for debut in range(0, len(kri_ids), TAILLE_LOT):
+            lot = cls._rejouer_lot(connection, kri_ids[debut:debut + TAILLE_LOT])
+            if lot is None:
+                continue
+            rang = {kri_id: j for j, kri_id in enumerate(lot['lignes'].tolist())}
+            enregistrements = []
+            for k, kri_id in enumerate(lot['identifiants'].tolist()):
+                derniere = lot['debuts'][k] + lot['tailles'][k] - 1
+                mesure = lot['mesures'][derniere]
+                enregistrements.append(_ligne(
+                    lot['etat'], rang[kri_id], kri_id, mesure.client_id, lot['saisons'][k],
+                    mesure.valeur, mesure.date_mesure, lot['scores'][derniere]
+                ))
+            _enregistrer(connection, enregistrements)
+            nb += len(enregistrements)
+        db.session.commit()
+        return nb
+
+    @staticmethod
+    def est_vide():
+        return db.session.execute(select(literal(1)).select_from(S).limit(1)).first() is None
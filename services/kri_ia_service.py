@@ -3,7 +3,11 @@ import os
 import json
 from datetime import datetime
 from typing import Dict, List, Optional
-import openai
+
+from chargement_differe import ModuleParesseux
+from services.ia_cache_service import IACacheService
+
+openai = ModuleParesseux('openai')
 
 class KRIIAService:
     """Service IA pour générer des KRI pertinents"""
@@ -12,12 +16,14 @@ class KRIIAService:
         self.api_key = os.environ.get("OPENAI_API_KEY")
         self.mode_simulation = False
         
-        if not self.api_key or self.api_key.startswith("mode-simulation"):
+        if IACacheService.mode_factice():
+            self.client = IACacheService.get_fournisseur_factice()
+        elif not self.api_key or self.api_key.startswith("mode-simulation"):
             self.mode_simulation = True
             print("🔧 Mode simulation pour KRI IA")
         else:
             try:
-                self.client = openai.OpenAI(api_key=self.api_key)
+                self.client = IACacheService.get_client_openai(self.api_key)
                 print("✅ Service KRI IA initialisé")
             except Exception as e:
                 print(f"⚠️ Erreur initialisation OpenAI: {e}")
@@ -45,39 +51,46 @@ class KRIIAService:
     def _generer_kri_reel(self, risque_data: Dict) -> List[Dict]:
         """Génération réelle avec OpenAI"""
         prompt = self._construire_prompt_kri(risque_data)
-        
-        response = self.client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
+        modele = "gpt-3.5-turbo"
+        messages = [
+            {
+                "role": "system",
+                "content": """Tu es un expert en gestion des risques et indicateurs (KRI/KPI). 
+                Tu dois générer des indicateurs KRI pertinents pour surveiller des risques.
+                Réponds uniquement au format JSON suivant :
                 {
-                    "role": "system",
-                    "content": """Tu es un expert en gestion des risques et indicateurs (KRI/KPI). 
-                    Tu dois générer des indicateurs KRI pertinents pour surveiller des risques.
-                    Réponds uniquement au format JSON suivant :
-                    {
-                        "kris": [
-                            {
-                                "nom": "Nom du KRI",
-                                "description": "Description détaillée",
-                                "formule_calcul": "Formule de calcul",
-                                "unite_mesure": "Unité de mesure",
-                                "categorie": "catégorie",
-                                "seuil_alerte": 0.0,
-                                "seuil_critique": 0.0,
-                                "sens_evaluation_seuil": "superieur",
-                                "frequence_mesure": "mensuel",
-                                "justification": "Pourquoi cet indicateur est pertinent"
-                            }
-                        ]
-                    }"""
-                },
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.7,
-            max_tokens=1500
-        )
+                    "kris": [
+                        {
+                            "nom": "Nom du KRI",
+                            "description": "Description détaillée",
+                            "formule_calcul": "Formule de calcul",
+                            "unite_mesure": "Unité de mesure",
+                            "categorie": "catégorie",
+                            "seuil_alerte": 0.0,
+                            "seuil_critique": 0.0,
+                            "sens_evaluation_seuil": "superieur",
+                            "frequence_mesure": "mensuel",
+                            "justification": "Pourquoi cet indicateur est pertinent"
+                        }
+                    ]
+                }"""
+            },
+            {"role": "user", "content": prompt}
+        ]
         
-        resultat = response.choices[0].message.content
+        def appel():
+            response = self.client.chat.completions.create(
+                model=modele,
+                messages=messages,
+                temperature=0.7,
+                max_tokens=1500
+            )
+            return response.choices[0].message.content
+        
+        resultat = IACacheService.obtenir_ou_calculer(
+            'openai', modele, messages, appel,
+            {'temperature': 0.7, 'max_tokens': 1500}
+        )
         
         try:
             # Essayer d'extraire le JSON
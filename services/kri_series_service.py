@@ -0,0 +1,212 @@
+# services/kri_series_service.py
+"""
+Séries temporelles des KRI pour les graphiques côté navigateur.
+
+Les mesures d'un KRI (fenêtre de dates optionnelle) sont lues en une
+requête triée puis réduites à un nombre de points cible :
+
+- 'lttb' (Largest-Triangle-Three-Buckets) : conserve la forme visuelle
+  de la courbe, un point par intervalle ;
+- 'minmax' : le minimum et le maximum de chaque intervalle (pics et
+  creux garantis, utile pour les seuils).
+
+Les périodes dont les mesures collectées ont été purgées par la rétention
+sont lues dans les agrégats horaires ou journaliers (SeriesTemporellesKRI).
+
+Le résultat (tableaux JSON, lignes de seuils) est gardé en cache sous la
+version partagée des données KRI du client (VersionAnalytiqueKRI,
+incrémentée dans la transaction de chaque écriture sur MesureKRI ou KRI) ;
+l'ETag est dérivé de cette version. Une écriture faite dans un autre
+worker ou par le planificateur de collectes change la version : une page
+qui revalide son graphique reçoit un 304 tant qu'elle n'a pas changé.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+from sqlalchemy import select, or_
+
+from chargement_differe import ModuleParesseux
+from models import db, MesureKRI
+from services.kri_analytique_service import AnalytiqueKRI, VERSION_SANS_CLIENT
+from services.series_temporelles_service import SeriesTemporellesKRI
+
+np = ModuleParesseux('numpy')
+
+METHODES = ('lttb', 'minmax')
+POINTS_DEFAUT = 500
+POINTS_MAX = 5000
+
+
+# ============================================
+# ÉCHANTILLONNAGE
+# ============================================
+
+def lttb(x, y, nb_points):
+    """Indices des points retenus par Largest-Triangle-Three-Buckets"""
+    n = len(x)
+    if nb_points >= n or nb_points < 3:
+        return np.arange(n)
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    # nb_points - 2 intervalles entre le premier et le dernier point
+    bornes = np.linspace(1, n - 1, nb_points - 1).astype(np.int64)
+    indices = np.empty(nb_points, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = n - 1
+
+    a = 0
+    for i in range(nb_points - 2):
+        debut, fin = bornes[i], bornes[i + 1]
+        # Moyenne de l'intervalle suivant (le dernier point pour le dernier intervalle)
+        fin_suivant = bornes[i + 2] if i + 2 < len(bornes) else n
+        x_moyen = x[fin:fin_suivant].mean()
+        y_moyen = y[fin:fin_suivant].mean()
+
+        aires = np.abs(
+            (x[a] - x_moyen) * (y[debut:fin] - y[a])
+            - (x[a] - x[debut:fin]) * (y_moyen - y[a])
+        )
+        a = debut + int(aires.argmax())
+        indices[i + 1] = a
+    return indices
+
+
+def min_max(y, nb_points):
+    """Indices du minimum et du maximum de chaque intervalle, dans l'ordre chronologique"""
+    n = len(y)
+    nb_intervalles = max(nb_points // 2, 1)
+    if nb_points >= n or nb_intervalles >= n:
+        return np.arange(n)
+
+    y = np.asarray(y, dtype=float)
+    # Intervalles contigus : extrema par ufunc.reduceat, puis première position atteignant chacun
+    intervalles = np.arange(n) * nb_intervalles // n
+    debuts = np.flatnonzero(np.r_[True, intervalles[1:] != intervalles[:-1]])
+    tailles = np.diff(np.r_[debuts, n])
+    retenus = [[0, n - 1]]
+    for extremum in (np.minimum, np.maximum):
+        valeurs = np.repeat(extremum.reduceat(y, debuts), tailles)
+        positions = np.flatnonzero(y == valeurs)
+        _, premieres = np.unique(intervalles[positions], return_index=True)
+        retenus.append(positions[premieres])
+    return np.unique(np.concatenate(retenus))
+
+
+# ============================================
+# SERVICE
+# ============================================
+
+class SeriesKRI:
+    """Séries échantillonnées des KRI, en cache avec leur ETag"""
+
+    _cache = OrderedDict()
+    _verrou = threading.Lock()
+    CACHE_MAX = 500
+
+    @classmethod
+    def serie(cls, kri, client_id=None, debut=None, fin=None, points=POINTS_DEFAUT, methode='lttb'):
+        """
+        (données, etag) de la série du KRI. `client_id` restreint aux mesures
+        du client (ou sans client renseigné) ; None pour toutes.
+        """
+        points = min(max(int(points), 3), POINTS_MAX)
+        if methode not in METHODES:
+            raise ValueError(f"Méthode d'échantillonnage inconnue : {methode}")
+
+        cle = (kri.id, client_id, debut, fin, points, methode)
+        version = AnalytiqueKRI.version(VERSION_SANS_CLIENT if kri.client_id is None else kri.client_id)
+        etag = hashlib.sha1(repr((cle, version)).encode('utf-8')).hexdigest()
+        with cls._verrou:
+            en_cache = cls._cache.get(cle)
+            if en_cache is not None and en_cache[0] == version:
+                cls._cache.move_to_end(cle)
+                return en_cache[1], etag
+
+        donnees = cls._calculer(kri, client_id, debut, fin, points, methode)
+
+        with cls._verrou:
+            cls._cache[cle] = (version, donnees)
+            cls._cache.move_to_end(cle)
+            while len(cls._cache) > cls.CACHE_MAX:
+                cls._cache.popitem(last=False)
+        return donnees, etag
+
+    @staticmethod
+    def _calculer(kri, client_id, debut, fin, points, methode):
+        conditions = [MesureKRI.kri_id == kri.id, MesureKRI.date_mesure.isnot(None)]
+        if client_id is not None:
+            conditions.append(or_(MesureKRI.client_id == client_id, MesureKRI.client_id.is_(None)))
+        if debut is not None:
+            conditions.append(MesureKRI.date_mesure >= debut)
+        if fin is not None:
+            conditions.append(MesureKRI.date_mesure <= fin)
+
+        lignes = db.session.execute(
+            select(MesureKRI.date_mesure, MesureKRI.valeur)
+            .where(*conditions)
+            .order_by(MesureKRI.date_mesure)
+        ).all()
+
+        nb_mesures = len(lignes)
+        lignes = list(lignes)
+
+        # Périodes dont les mesures collectées ont été purgées : agrégats (rétention)
+        agregats = SeriesTemporellesKRI.agregats(
+            kri.id, debut, fin, SeriesTemporellesKRI.granularite_pour(debut), client_id
+        )
+        for debut_periode, nb, minimum, maximum, moyenne, _ in agregats:
+            nb_mesures += nb
+            if methode == 'minmax':
+                lignes.extend(((debut_periode, minimum), (debut_periode, maximum)))
+            else:
+                lignes.append((debut_periode, moyenne))
+
+        if lignes:
+            dates, valeurs = zip(*lignes)
+            dates = np.array(dates, dtype='datetime64[s]')
+            valeurs = np.array(valeurs, dtype=float)
+            if agregats:
+                ordre = np.argsort(dates, kind='stable')
+                dates, valeurs = dates[ordre], valeurs[ordre]
+        else:
+            dates = np.array([], dtype='datetime64[s]')
+            valeurs = np.array([], dtype=float)
+
+        secondes = dates.astype(np.int64)
+        if methode == 'lttb':
+            indices = lttb(secondes, valeurs, points)
+        else:
+            indices = min_max(valeurs, points)
+        dates, secondes, valeurs = dates[indices], secondes[indices], valeurs[indices]
+
+        return {
+            'kri': {
+                'id': kri.id,
+                'nom': kri.nom,
+                'unite_mesure': kri.unite_mesure
+            },
+            'dates': np.datetime_as_string(dates, unit='D').tolist(),
+            'horodatages': (secondes * 1000).tolist(),
+            'valeurs': valeurs.tolist(),
+            'seuils': {
+                'alerte': kri.seuil_alerte,
+                'critique': kri.seuil_critique,
+                'cible': kri.seuil_cible,
+                'sens': kri.sens_evaluation_seuil
+            },
+            'nb_mesures': nb_mesures,
+            'nb_points': len(indices),
+            'methode': methode,
+            'echantillonne': len(indices) < nb_mesures,
+            'agregats': len(agregats)
+        }
+
+    @classmethod
+    def invalider(cls, kri_id=None):
+        """Supprime les séries du KRI (toutes si None)"""
+        with cls._verrou:
+            for cle in [c for c in cls._cache if kri_id is None or c[0] == kri_id]:
+                cls._cache.pop(cle, None)
+
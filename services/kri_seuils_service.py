@@ -0,0 +1,337 @@
+# services/kri_seuils_service.py
+"""
+Détection des franchissements de seuil des KRI à l'arrivée des mesures.
+
+Les alertes de seuil étaient découvertes par des balayages périodiques qui
+relisaient la dernière mesure de tous les KRI : alertes en retard d'un
+intervalle, coût proportionnel au nombre de KRI, et une nouvelle alerte à
+chaque passage tant que le seuil restait dépassé.
+
+L'état de chaque KRI (normal, alerte, critique) est désormais conservé dans
+etats_seuil_kri et réévalué à la fin de chaque flush qui ajoute ou supprime
+une mesure (saisie, import, CollecteEngine) ou modifie les seuils du KRI.
+Seul un changement d'état vers un niveau plus grave crée une Alerte et une
+notification en attente pour le responsable de la mesure, dans la même
+transaction (table notifications_seuil_kri : rien n'est perdu si le
+processus s'arrête, rien n'est envoyé si la transaction est annulée). La
+tâche planifiée `vider_notifications` les envoie, regroupées par
+destinataire, depuis n'importe quel processus.
+"""
+from datetime import datetime
+
+from sqlalchemy import event, inspect, select, update, insert, delete, func, literal
+from sqlalchemy.orm import object_session
+
+from models import db, KRI, MesureKRI, EtatSeuilKRI, NotificationSeuilKRI, Alerte, Notification
+from services.kri_analytique_service import etats_seuils, ETATS_KRI, ETATS_KPI
+
+
+K = KRI.__table__
+M = MesureKRI.__table__
+S = EtatSeuilKRI.__table__
+N = NotificationSeuilKRI.__table__
+A = Alerte.__table__
+
+# Gravité des états (mêmes rangs pour les libellés KRI et KPI) : inconnu 0, normal 1, alerte 2, critique 3
+GRAVITE = {etat: rang for etats in (ETATS_KRI, ETATS_KPI) for rang, etat in enumerate(etats)}
+GRAVITE_ALERTE = 2
+
+# gravité -> (type d'alerte, gravité de l'alerte, libellé du seuil, seuil franchi)
+ALERTES = {
+    2: ('kri_alerte', 'moyenne', "seuil d'alerte", 'seuil_alerte'),
+    3: ('kri_critique', 'haute', 'seuil critique', 'seuil_critique'),
+}
+
+# Champs du KRI dont la modification impose une réévaluation
+CHAMPS_SEUILS = ('seuil_alerte', 'seuil_critique', 'sens_evaluation_seuil', 'type_indicateur', 'est_actif')
+
+TAILLE_LOT = 1000
+LOT_NOTIFICATIONS = 500
+
+
+def _nan(valeur):
+    return float('nan') if valeur is None else valeur
+
+
+def _dernieres_mesures(connection, kri_ids):
+    """{kri_id: dernière mesure (id, valeur, date_mesure)}"""
+    rang = func.row_number().over(
+        partition_by=M.c.kri_id, order_by=(M.c.date_mesure.desc(), M.c.id.desc())
+    ).label('rang')
+    mesures = (
+        select(M.c.kri_id, M.c.id, M.c.valeur, M.c.date_mesure, rang)
+        .where(M.c.kri_id.in_(kri_ids))
+        .subquery()
+    )
+    return {ligne.kri_id: ligne for ligne in connection.execute(select(mesures).where(mesures.c.rang == 1))}
+
+
+class EvaluateurSeuilsKRI:
+    """États de seuil des KRI et notifications de franchissement"""
+
+    # ============================================
+    # ÉVALUATION
+    # ============================================
+
+    @staticmethod
+    def evaluer(connection, kri_ids, emettre=True):
+        """
+        Réévalue l'état des KRI actifs donnés sur leur dernière mesure et
+        enregistre les changements. Avec `emettre`, une aggravation crée une
+        Alerte et une notification en attente pour le responsable de la
+        mesure. Retourne la liste des changements d'état.
+        """
+        kri_ids = sorted({i for i in kri_ids if i is not None})
+        if not kri_ids:
+            return []
+
+        kris = connection.execute(
+            select(K.c.id, K.c.client_id, K.c.nom, K.c.unite_mesure, K.c.seuil_alerte, K.c.seuil_critique,
+                   K.c.sens_evaluation_seuil, K.c.type_indicateur, K.c.responsable_mesure_id)
+            .where(K.c.id.in_(kri_ids), K.c.est_actif == True)
+        ).all()
+        if not kris:
+            return []
+
+        ids = [kri.id for kri in kris]
+        mesures = _dernieres_mesures(connection, ids)
+        precedents = dict(connection.execute(select(S.c.kri_id, S.c.etat).where(S.c.kri_id.in_(ids))).all())
+        etats = etats_seuils(
+            [_nan(mesures[kri.id].valeur) if kri.id in mesures else float('nan') for kri in kris],
+            [_nan(kri.seuil_alerte) for kri in kris],
+            [_nan(kri.seuil_critique) for kri in kris],
+            [kri.sens_evaluation_seuil == 'inferieur' for kri in kris],
+            [kri.type_indicateur == 'kri' for kri in kris],
+        )
+
+        maintenant = datetime.utcnow()
+        changements = []
+        for kri, etat in zip(kris, etats):
+            etat = str(etat)
+            precedent = precedents.get(kri.id)
+            if etat == precedent:
+                continue
+
+            mesure = mesures.get(kri.id)
+            valeurs = {
+                'etat': etat,
+                'mesure_id': mesure.id if mesure else None,
+                'valeur': mesure.valeur if mesure else None,
+                'date_mesure': mesure.date_mesure if mesure else None,
+                'depuis': maintenant,
+                'updated_at': maintenant,
+            }
+            if precedent is None:
+                connection.execute(insert(S).values(kri_id=kri.id, client_id=kri.client_id, **valeurs))
+            elif not connection.execute(
+                # Compare-and-set : une transaction concurrente a pu enregistrer ce changement
+                update(S).where(S.c.kri_id == kri.id, S.c.etat == precedent).values(**valeurs)
+            ).rowcount:
+                continue
+
+            gravite = GRAVITE[etat]
+            aggravation = gravite >= GRAVITE_ALERTE and gravite > GRAVITE.get(precedent, 0)
+            changement = {
+                'kri_id': kri.id,
+                'client_id': kri.client_id,
+                'nom': kri.nom,
+                'unite_mesure': kri.unite_mesure or '',
+                'destinataire_id': kri.responsable_mesure_id,
+                'precedent': precedent,
+                'etat': etat,
+                'valeur': valeurs['valeur'],
+                'date_mesure': valeurs['date_mesure'],
+                'seuil_alerte': kri.seuil_alerte,
+                'seuil_critique': kri.seuil_critique,
+                'aggravation': aggravation,
+            }
+            changements.append(changement)
+
+            if emettre and aggravation:
+                type_alerte, gravite_alerte, libelle, seuil = ALERTES[gravite]
+                connection.execute(insert(A).values(
+                    type=type_alerte,
+                    gravite=gravite_alerte,
+                    titre=f"KRI {kri.nom} - {libelle.capitalize()} dépassé",
+                    description=f"Le KRI {kri.nom} a atteint la valeur {changement['valeur']}, "
+                                f"dépassant le {libelle} de {changement[seuil]}",
+                    entite_type='kri',
+                    entite_id=kri.id,
+                    est_lue=False,
+                    created_by=None,  # Système (pas d'auteur : l'écriture de la mesure ne doit pas dépendre d'un compte)
+                    created_at=maintenant,
+                    client_id=kri.client_id,
+                ))
+                if kri.responsable_mesure_id:
+                    connection.execute(insert(N).values(
+                        kri_id=kri.id,
+                        client_id=kri.client_id,
+                        destinataire_id=kri.responsable_mesure_id,
+                        nom=kri.nom,
+                        unite_mesure=kri.unite_mesure,
+                        precedent=precedent,
+                        etat=etat,
+                        valeur=changement['valeur'],
+                        date_mesure=changement['date_mesure'],
+                        seuil_alerte=kri.seuil_alerte,
+                        seuil_critique=kri.seuil_critique,
+                        created_at=maintenant,
+                    ))
+        return changements
+
+    @classmethod
+    def initialiser(cls):
+        """Fixe l'état de tous les KRI actifs sans émettre d'alerte (mise en service, resynchronisation)"""
+        connection = db.session.connection()
+        kri_ids = connection.execute(select(K.c.id).where(K.c.est_actif == True)).scalars().all()
+        nb = 0
+        for debut in range(0, len(kri_ids), TAILLE_LOT):
+            nb += len(cls.evaluer(connection, kri_ids[debut:debut + TAILLE_LOT], emettre=False))
+        db.session.commit()
+        return nb
+
+    @classmethod
+    def reevaluer(cls, kri_ids):
+        """Réévalue des KRI hors flush (seuils modifiés en masse) ; notifications en attente jusqu'au commit"""
+        return cls.evaluer(db.session.connection(), kri_ids)
+
+    @staticmethod
+    def est_vide():
+        return db.session.execute(select(literal(1)).select_from(S).limit(1)).first() is None
+
+    # ============================================
+    # NOTIFICATIONS
+    # ============================================
+
+    @staticmethod
+    def vider_notifications():
+        """
+        Envoie les notifications en attente, une par destinataire ; retourne
+        le nombre envoyé. Les lignes d'un destinataire sont supprimées dans la
+        transaction de sa notification : un autre processus qui les a déjà
+        prises (suppression concurrente) fait abandonner ce destinataire.
+        """
+        from services.notification_service import NotificationService
+
+        lignes = db.session.execute(select(N).order_by(N.c.id).limit(LOT_NOTIFICATIONS)).all()
+        if not lignes:
+            return 0
+
+        changements = [{
+            'id': ligne.id,
+            'kri_id': ligne.kri_id,
+            'nom': ligne.nom,
+            'unite_mesure': ligne.unite_mesure or '',
+            'destinataire_id': ligne.destinataire_id,
+            'etat': ligne.etat,
+            'valeur': ligne.valeur,
+            'date_mesure': ligne.date_mesure,
+            'seuil_alerte': ligne.seuil_alerte,
+            'seuil_critique': ligne.seuil_critique,
+        } for ligne in lignes]
+
+        # Dédoublonnage : un seul état par KRI et par destinataire, le plus récent
+        par_destinataire = {}
+        for changement in changements:
+            par_destinataire.setdefault(changement['destinataire_id'], {})[changement['kri_id']] = changement
+
+        ids = {}
+        for changement in changements:
+            ids.setdefault(changement['destinataire_id'], []).append(changement['id'])
+
+        nb = 0
+        for destinataire_id, par_kri in par_destinataire.items():
+            if db.session.execute(
+                delete(N).where(N.c.id.in_(ids[destinataire_id]))
+            ).rowcount != len(ids[destinataire_id]):
+                db.session.rollback()
+                continue
+
+            lot = sorted(par_kri.values(), key=lambda c: (-GRAVITE[c['etat']], c['nom']))
+            critique = any(GRAVITE[c['etat']] == 3 for c in lot)
+            donnees = [{
+                'kri_id': c['kri_id'],
+                'nom': c['nom'],
+                'valeur': c['valeur'],
+                'etat': c['etat'],
+                'seuil_alerte': c['seuil_alerte'],
+                'seuil_critique': c['seuil_critique'],
+                'date_mesure': c['date_mesure'].isoformat() if c['date_mesure'] else None,
+            } for c in lot]
+
+            if len(lot) == 1:
+                c = lot[0]
+                notification = NotificationService.create(
+                    destinataire_id=destinataire_id,
+                    type_notif=Notification.TYPE_KRI_ALERTE,
+                    titre=f"Alerte KRI: {c['nom']}",
+                    message=f"Valeur: {c['valeur']} {c['unite_mesure']} - État: {c['etat']}",
+                    urgence=Notification.URGENCE_URGENT if critique else Notification.URGENCE_IMPORTANT,
+                    entite_type='kri',
+                    entite_id=c['kri_id'],
+                    actions=[
+                        {'url': f"/kri/{c['kri_id']}", 'label': 'Voir le KRI', 'icon': 'chart-line'},
+                        {'url': f"/kri/{c['kri_id']}/mesures/nouvelle", 'label': 'Ajouter mesure', 'icon': 'plus'}
+                    ],
+                    donnees=donnees[0]
+                )
+            else:
+                notification = NotificationService.create(
+                    destinataire_id=destinataire_id,
+                    type_notif=Notification.TYPE_KRI_ALERTE,
+                    titre=f"{len(lot)} KRI ont franchi un seuil",
+                    message='; '.join(f"{c['nom']}: {c['valeur']} {c['unite_mesure']} ({c['etat']})" for c in lot),
+                    urgence=Notification.URGENCE_URGENT if critique else Notification.URGENCE_IMPORTANT,
+                    entite_type='kri',
+                    actions=[{'url': '/kri', 'label': 'Voir les KRI', 'icon': 'chart-line'}],
+                    donnees={'kri': donnees}
+                )
+            if notification:
+                nb += 1
+            # Destinataire en pause ou introuvable : la notification n'est pas créée, l'attente est purgée
+            db.session.commit()
+        return nb
+
+
+# ============================================
+# ÉVALUATION À CHAQUE FLUSH
+# ============================================
+
+def _kri_a_evaluer(session):
+    return session.info.setdefault('kri_seuils_a_evaluer', set())
+
+
+def _marquer_mesure(mapper, connection, target):
+    session = object_session(target)
+    if session is None:
+        return
+    cibles = _kri_a_evaluer(session)
+    cibles.add(target.kri_id)
+    # Mesure rattachée à un autre KRI : l'ancien est aussi réévalué
+    cibles.update(inspect(target).attrs.kri_id.history.deleted or ())
+
+
+def _marquer_kri(mapper, connection, target):
+    etat = inspect(target)
+    if any(etat.attrs[champ].history.has_changes() for champ in CHAMPS_SEUILS):
+        session = object_session(target)
+        if session is not None:
+            _kri_a_evaluer(session).add(target.id)
+
+
+for _evenement in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(MesureKRI, _evenement, _marquer_mesure)
+event.listen(KRI, 'after_update', _marquer_kri)
+
+
+@event.listens_for(db.session, 'after_flush_postexec')
+def _evaluer_apres_flush(session, flush_context):
+    kri_ids = session.info.pop('kri_seuils_a_evaluer', None)
+    if not kri_ids:
+        return
+    EvaluateurSeuilsKRI.evaluer(session.connection(), kri_ids)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _abandonner_apres_rollback(session):
+    session.info.pop('kri_seuils_a_evaluer', None)
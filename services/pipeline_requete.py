@@ -0,0 +1,181 @@
+# services/pipeline_requete.py
+"""
+Pipeline unique des traitements avant requête.
+
+Les middlewares (langue, client, permissions, limites de formule...) ne
+sont plus enregistrés un par un avec @app.before_request : chacun est une
+étape du pipeline, exécutée dans l'ordre de déclaration par un seul hook.
+
+    @pipeline_requete.etape('permissions', endpoints=ENDPOINTS_PROTEGES)
+    def verifier_permissions_endpoint():
+        ...
+
+Les endpoints concernés / exemptés de chaque étape sont résolus une fois
+au démarrage (preparer) : chaque endpoint a son plan, la liste des étapes
+qui le concernent. La durée de chaque étape est mesurée (en-tête
+Server-Timing optionnel, cumuls par étape exposés par mesures()).
+"""
+import threading
+import time
+
+from flask import g, request
+
+
+class Etape:
+    """Traitement du pipeline et endpoints qu'il concerne"""
+
+    __slots__ = ('nom', 'fonction', 'endpoints', 'exemptes', 'prefixes_exemptes', 'methodes')
+
+    def __init__(self, nom, fonction, endpoints=None, exemptes=(), prefixes_exemptes=(), methodes=None):
+        self.nom = nom
+        self.fonction = fonction
+        # Ensemble d'endpoints, prédicat (endpoint -> bool) ou None pour tous
+        self.endpoints = endpoints if endpoints is None or callable(endpoints) else frozenset(endpoints)
+        self.exemptes = frozenset(exemptes)
+        self.prefixes_exemptes = tuple(prefixes_exemptes)
+        self.methodes = frozenset(methodes) if methodes else None
+
+    def concerne(self, endpoint):
+        if endpoint in self.exemptes:
+            return False
+        if endpoint and self.prefixes_exemptes and endpoint.startswith(self.prefixes_exemptes):
+            return False
+        if self.endpoints is None:
+            return True
+        if callable(self.endpoints):
+            return bool(self.endpoints(endpoint))
+        return endpoint in self.endpoints
+
+
+class PipelineRequete:
+    """Exécute les étapes avant requête, dans l'ordre, avec mesure des durées"""
+
+    def __init__(self, app=None):
+        self._etapes = []
+        self._plans = {}
+        self._mesures = {}
+        self._echeances = {}
+        self._verrou = threading.Lock()
+        self.server_timing = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.before_request(self.executer)
+        app.after_request(self._ajouter_server_timing)
+        self.server_timing = app.config.get('PIPELINE_SERVER_TIMING', False)
+
+    # ============================================
+    # DÉCLARATION
+    # ============================================
+
+    def etape(self, nom, endpoints=None, exemptes=(), prefixes_exemptes=(), methodes=None):
+        """Décorateur : ajoute la fonction à la fin du pipeline"""
+        def decorator(fonction):
+            if any(e.nom == nom for e in self._etapes):
+                raise ValueError(f"Étape '{nom}' déjà déclarée dans le pipeline")
+            self._etapes.append(Etape(nom, fonction, endpoints, exemptes, prefixes_exemptes, methodes))
+            self._plans.clear()
+            return fonction
+        return decorator
+
+    def preparer(self, app):
+        """Calcule le plan de chaque endpoint connu (après l'enregistrement des routes)"""
+        with self._verrou:
+            self._plans = {endpoint: self._calculer_plan(endpoint)
+                           for endpoint in list(app.view_functions) + [None]}
+        print(f"✅ Pipeline de requête : {len(self._etapes)} étapes, {len(self._plans)} endpoints préparés")
+
+    def _calculer_plan(self, endpoint):
+        return tuple(etape for etape in self._etapes if etape.concerne(endpoint))
+
+    def plan(self, endpoint):
+        plan = self._plans.get(endpoint)
+        if plan is None:
+            plan = self._calculer_plan(endpoint)
+            with self._verrou:
+                self._plans[endpoint] = plan
+        return plan
+
+    # ============================================
+    # EXÉCUTION
+    # ============================================
+
+    def executer(self):
+        """Hook before_request unique ; s'arrête à la première étape qui retourne une réponse"""
+        durees = g.durees_pipeline = []
+        methode = request.method
+        for etape in self.plan(request.endpoint):
+            if etape.methodes is not None and methode not in etape.methodes:
+                continue
+            debut = time.perf_counter()
+            try:
+                reponse = etape.fonction()
+            finally:
+                duree = time.perf_counter() - debut
+                durees.append((etape.nom, duree))
+                self._enregistrer(etape.nom, duree)
+            if reponse is not None:
+                return reponse
+        return None
+
+    def _enregistrer(self, nom, duree):
+        with self._verrou:
+            mesure = self._mesures.get(nom)
+            if mesure is None:
+                self._mesures[nom] = [1, duree, duree]
+            else:
+                mesure[0] += 1
+                mesure[1] += duree
+                if duree > mesure[2]:
+                    mesure[2] = duree
+
+    def _ajouter_server_timing(self, response):
+        durees = g.get('durees_pipeline')
+        if self.server_timing and durees:
+            response.headers['Server-Timing'] = ', '.join(
+                f"{nom};dur={duree * 1000:.2f}" for nom, duree in durees
+            )
+        return response
+
+    # ============================================
+    # INSTRUMENTATION
+    # ============================================
+
+    def mesures(self):
+        """Cumuls par étape, dans l'ordre du pipeline (durées en millisecondes)"""
+        with self._verrou:
+            copie = {nom: list(valeurs) for nom, valeurs in self._mesures.items()}
+        resultat = []
+        for etape in self._etapes:
+            nb, total, maximum = copie.get(etape.nom, (0, 0.0, 0.0))
+            resultat.append({
+                'etape': etape.nom,
+                'appels': nb,
+                'total_ms': round(total * 1000, 3),
+                'moyenne_ms': round(total * 1000 / nb, 3) if nb else 0.0,
+                'max_ms': round(maximum * 1000, 3),
+                'endpoints': sum(1 for plan in self._plans.values() if etape in plan),
+            })
+        return resultat
+
+    def reinitialiser_mesures(self):
+        with self._verrou:
+            self._mesures.clear()
+
+    # ============================================
+    # TRAITEMENTS PÉRIODIQUES
+    # ============================================
+
+    def periodique(self, nom, cle, intervalle):
+        """
+        True au plus une fois par `intervalle` secondes pour (nom, cle) dans
+        ce processus : remplace les compteurs / horodatages écrits en session.
+        """
+        maintenant = time.monotonic()
+        with self._verrou:
+            derniere = self._echeances.get((nom, cle))
+            if derniere is not None and maintenant - derniere < intervalle:
+                return False
+            self._echeances[(nom, cle)] = maintenant
+            return True
@@ -0,0 +1,321 @@
+# services/questionnaire_resultats_service.py
+"""
+Moteur de résultats des questionnaires.
+
+- Statistiques par question (distribution des choix, moyenne / min / max /
+  écart-type / médiane des valeurs numériques, nombre de réponses texte)
+  obtenues par requêtes groupées sur l'ensemble du questionnaire, au lieu
+  d'une requête par question.
+- Export des réponses brutes (une ligne par répondant, une colonne par
+  question) en CSV streamé ou en xlsx write-only, par lots de répondants.
+"""
+import csv
+import io
+import math
+import statistics
+from collections import defaultdict
+from datetime import datetime
+
+from sqlalchemy import select, func, case, and_
+
+from models import (db, QuestionnaireCategorie, Question, OptionQuestion,
+                    ReponseQuestionnaire, ReponseQuestion, ReponseOption)
+
+
+TYPES_CHOIX = ('radio', 'select', 'checkbox')
+TYPES_NUMERIQUES = ('number',)
+
+TYPE_DISPLAY_MAP = {
+    'text': 'Texte court',
+    'textarea': 'Texte long',
+    'radio': 'Choix unique',
+    'checkbox': 'Choix multiple',
+    'select': 'Liste déroulante',
+    'date': 'Date',
+    'email': 'Email',
+    'number': 'Nombre',
+    'range': 'Échelle',
+    'rating': 'Évaluation',
+    'yesno': 'Oui/Non'
+}
+
+COLONNES_REPONDANT = ['Session ID', 'Statut', 'Date début', 'Date fin', 'Durée (s)', 'Email', 'Nom', 'IP']
+
+TAILLE_LOT_EXPORT = 500
+
+
+class ResultatsQuestionnaireService:
+    """Statistiques et exports des réponses d'un questionnaire"""
+
+    # ============================================
+    # STATISTIQUES
+    # ============================================
+
+    @staticmethod
+    def _filtre_reponses(questionnaire_id, date_debut=None, date_fin=None):
+        conditions = [ReponseQuestionnaire.questionnaire_id == questionnaire_id]
+        if date_debut:
+            conditions.append(func.date(ReponseQuestionnaire.date_debut) >= date_debut)
+        if date_fin:
+            conditions.append(func.date(ReponseQuestionnaire.date_debut) <= date_fin)
+        return and_(*conditions)
+
+    @staticmethod
+    def questions_ordonnees(questionnaire_id):
+        """[(categorie, question)] dans l'ordre d'affichage, en une requête"""
+        return db.session.execute(
+            select(QuestionnaireCategorie, Question)
+            .join(Question, Question.categorie_id == QuestionnaireCategorie.id)
+            .where(QuestionnaireCategorie.questionnaire_id == questionnaire_id)
+            .order_by(QuestionnaireCategorie.ordre, QuestionnaireCategorie.id, Question.ordre, Question.id)
+        ).all()
+
+    @classmethod
+    def statistiques(cls, questionnaire):
+        """(stats, questions_stats) au format attendu par questionnaire/stats.html"""
+        filtre = cls._filtre_reponses(questionnaire.id)
+
+        total_reponses, reponses_completes = db.session.execute(
+            select(func.count(), func.coalesce(func.sum(case((ReponseQuestionnaire.statut == 'complet', 1), else_=0)), 0))
+            .where(filtre)
+        ).one()
+
+        stats = {
+            'total_reponses': total_reponses,
+            'reponses_completes': reponses_completes,
+            'taux_completion': (reponses_completes / total_reponses * 100) if total_reponses > 0 else 0
+        }
+
+        agregats = cls._agregats_par_question(filtre)
+
+        questions_stats = []
+        for categorie, question in cls.questions_ordonnees(questionnaire.id):
+            agregat = agregats.get(question.id, {})
+            total = agregat.get('total', 0)
+            details = None
+
+            if total > 0:
+                if question.type in TYPES_CHOIX:
+                    details = agregat.get('distribution') or None
+                elif question.type in TYPES_NUMERIQUES:
+                    details = agregat.get('numerique')
+
+            questions_stats.append({
+                'question_id': question.id,
+                'question': question.texte[:100] + ('...' if len(question.texte) > 100 else ''),
+                'type': question.type,
+                'type_display': TYPE_DISPLAY_MAP.get(question.type, question.type),
+                'total_reponses': total,
+                'details': details
+            })
+
+        return stats, questions_stats
+
+    @classmethod
+    def _agregats_par_question(cls, filtre):
+        """
+        {question_id: {'total', 'distribution', 'numerique'}}
+
+        Une requête groupée par (question, valeur de choix) : les questions à
+        choix sont ventilées par valeur, les autres donnent une seule ligne
+        portant le total et les agrégats numériques.
+        """
+        cle_valeur = case((Question.type.in_(TYPES_CHOIX), ReponseQuestion.valeur_texte), else_=None)
+        valeur = case((Question.type.in_(TYPES_NUMERIQUES), ReponseQuestion.valeur_numerique), else_=None)
+
+        lignes = db.session.execute(
+            select(
+                ReponseQuestion.question_id, cle_valeur.label('valeur'),
+                func.count(), func.count(valeur), func.avg(valeur),
+                func.min(valeur), func.max(valeur), func.sum(valeur * valeur)
+            )
+            .join(ReponseQuestionnaire, ReponseQuestionnaire.id == ReponseQuestion.reponse_questionnaire_id)
+            .join(Question, Question.id == ReponseQuestion.question_id)
+            .where(filtre)
+            .group_by(ReponseQuestion.question_id, cle_valeur)
+        ).all()
+
+        agregats = defaultdict(lambda: {'total': 0, 'distribution': {}, 'numerique': None})
+        for question_id, valeur_choix, nb, nb_num, moyenne, minimum, maximum, somme_carres in lignes:
+            agregat = agregats[question_id]
+            agregat['total'] += nb
+            if valeur_choix:
+                agregat['distribution'][valeur_choix] = nb
+            if nb_num:
+                variance = max((somme_carres or 0) / nb_num - moyenne * moyenne, 0)
+                agregat['numerique'] = {
+                    'moyenne': moyenne,
+                    'min': minimum,
+                    'max': maximum,
+                    'ecart_type': math.sqrt(variance),
+                    'nb_valeurs': nb_num,
+                }
+
+        cls._ajouter_options_cochees(agregats, filtre)
+        cls._ajouter_medianes(agregats, filtre)
+        return agregats
+
+    @staticmethod
+    def _ajouter_options_cochees(agregats, filtre):
+        """Cases à cocher enregistrées en ReponseOption : comptage par option"""
+        lignes = db.session.execute(
+            select(ReponseQuestion.question_id, OptionQuestion.texte, func.count())
+            .join(ReponseOption, ReponseOption.reponse_question_id == ReponseQuestion.id)
+            .join(OptionQuestion, OptionQuestion.id == ReponseOption.option_id)
+            .join(Question, Question.id == ReponseQuestion.question_id)
+            .join(ReponseQuestionnaire, ReponseQuestionnaire.id == ReponseQuestion.reponse_questionnaire_id)
+            .where(filtre, Question.type == 'checkbox')
+            .group_by(ReponseQuestion.question_id, OptionQuestion.texte)
+        ).all()
+
+        options_par_question = defaultdict(dict)
+        for question_id, texte, nb in lignes:
+            options_par_question[question_id][texte] = nb
+        for question_id, distribution in options_par_question.items():
+            agregats[question_id]['distribution'] = distribution
+
+    @staticmethod
+    def _ajouter_medianes(agregats, filtre):
+        questions_num = [qid for qid, a in agregats.items() if a['numerique']]
+        if not questions_num:
+            return
+
+        valeur = ReponseQuestion.valeur_numerique
+        base = (
+            select(ReponseQuestion.question_id)
+            .join(ReponseQuestionnaire, ReponseQuestionnaire.id == ReponseQuestion.reponse_questionnaire_id)
+            .where(filtre, ReponseQuestion.question_id.in_(questions_num), valeur.isnot(None))
+        )
+
+        if db.engine.dialect.name == 'postgresql':
+            requete = base.add_columns(func.percentile_cont(0.5).within_group(valeur)).group_by(ReponseQuestion.question_id)
+            for question_id, mediane in db.session.execute(requete):
+                agregats[question_id]['numerique']['median'] = mediane
+            return
+
+        # Autres bases : seules les valeurs numériques des questions concernées sont lues
+        valeurs = defaultdict(list)
+        for question_id, v in db.session.execute(base.add_columns(valeur)):
+            valeurs[question_id].append(v)
+        for question_id, liste in valeurs.items():
+            agregats[question_id]['numerique']['median'] = statistics.median(liste)
+
+    # ============================================
+    # EXPORT DES RÉPONSES BRUTES
+    # ============================================
+
+    @classmethod
+    def lignes_reponses(cls, questionnaire, date_debut=None, date_fin=None, taille_lot=TAILLE_LOT_EXPORT):
+        """
+        Générateur : en-tête puis une ligne par répondant.
+        Les réponses sont lues par lots de répondants (une requête par lot).
+        """
+        questions = cls.questions_ordonnees(questionnaire.id)
+        index_question = {question.id: i for i, (_, question) in enumerate(questions)}
+        types_question = {question.id: question.type for _, question in questions}
+
+        yield COLONNES_REPONDANT + [f"{categorie.titre} - {question.texte[:50]}" for categorie, question in questions]
+
+        filtre = cls._filtre_reponses(questionnaire.id, date_debut, date_fin)
+        dernier_id = 0
+        while True:
+            # Colonnes seulement : rien n'est ajouté à l'identity map de la session
+            repondants = db.session.execute(
+                select(
+                    ReponseQuestionnaire.id, ReponseQuestionnaire.session_id, ReponseQuestionnaire.statut,
+                    ReponseQuestionnaire.date_debut, ReponseQuestionnaire.date_fin, ReponseQuestionnaire.duree,
+                    ReponseQuestionnaire.email_repondant, ReponseQuestionnaire.nom_repondant,
+                    ReponseQuestionnaire.ip_address
+                )
+                .where(filtre, ReponseQuestionnaire.id > dernier_id)
+                .order_by(ReponseQuestionnaire.id)
+                .limit(taille_lot)
+            ).all()
+            if not repondants:
+                break
+
+            ids = [r.id for r in repondants]
+            valeurs = cls._valeurs_par_repondant(ids, index_question, types_question)
+
+            for reponse in repondants:
+                ligne = [
+                    reponse.session_id or '',
+                    reponse.statut or '',
+                    reponse.date_debut.strftime('%Y-%m-%d %H:%M:%S') if reponse.date_debut else '',
+                    reponse.date_fin.strftime('%Y-%m-%d %H:%M:%S') if reponse.date_fin else '',
+                    reponse.duree or '',
+                    reponse.email_repondant or '',
+                    reponse.nom_repondant or '',
+                    reponse.ip_address or '',
+                ]
+                yield ligne + valeurs.get(reponse.id, [''] * len(questions))
+
+            dernier_id = ids[-1]
+
+    @staticmethod
+    def _valeurs_par_repondant(ids_repondants, index_question, types_question):
+        lignes = db.session.execute(
+            select(
+                ReponseQuestion.reponse_questionnaire_id, ReponseQuestion.question_id,
+                ReponseQuestion.valeur_texte, ReponseQuestion.valeur_numerique,
+                ReponseQuestion.valeur_date, OptionQuestion.texte
+            )
+            .outerjoin(ReponseOption, ReponseOption.reponse_question_id == ReponseQuestion.id)
+            .outerjoin(OptionQuestion, OptionQuestion.id == ReponseOption.option_id)
+            .where(ReponseQuestion.reponse_questionnaire_id.in_(ids_repondants))
+            .order_by(ReponseQuestion.id, ReponseOption.id)
+        ).all()
+
+        valeurs = {}
+        options = defaultdict(list)
+        for repondant_id, question_id, texte, nombre, date, option in lignes:
+            if question_id not in index_question:
+                continue
+            ligne = valeurs.setdefault(repondant_id, [''] * len(index_question))
+            i = index_question[question_id]
+            if texte:
+                ligne[i] = texte
+            elif nombre is not None:
+                ligne[i] = nombre
+            elif date:
+                ligne[i] = date.strftime('%Y-%m-%d')
+            if option and types_question[question_id] == 'checkbox':
+                options[(repondant_id, i)].append(option)
+
+        for (repondant_id, i), textes in options.items():
+            valeurs[repondant_id][i] = ', '.join(textes)
+        return valeurs
+
+    @classmethod
+    def flux_csv(cls, questionnaire, date_debut=None, date_fin=None, delimiter=','):
+        """Générateur de morceaux CSV (à passer à une Response streamée)"""
+        tampon = io.StringIO()
+        writer = csv.writer(tampon, delimiter=delimiter)
+        yield '\ufeff'  # BOM pour l'ouverture directe dans Excel
+        for i, ligne in enumerate(cls.lignes_reponses(questionnaire, date_debut, date_fin)):
+            writer.writerow(ligne)
+            if i % 200 == 0:
+                yield tampon.getvalue()
+                tampon.seek(0)
+                tampon.truncate(0)
+        yield tampon.getvalue()
+
+    @classmethod
+    def fichier_xlsx(cls, questionnaire, date_debut=None, date_fin=None):
+        """Classeur xlsx en mode write-only (mémoire bornée) ; retourne un fichier temporaire"""
+        import tempfile
+        from openpyxl import Workbook
+
+        classeur = Workbook(write_only=True)
+        feuille = classeur.create_sheet('Réponses')
+        for ligne in cls.lignes_reponses(questionnaire, date_debut, date_fin):
+            feuille.append(ligne)
+
+        fichier = tempfile.TemporaryFile(suffix='.xlsx')
+        classeur.save(fichier)
+        fichier.seek(0)
+        return fichier
+
+    @staticmethod
+    def nom_fichier(questionnaire, extension):
+        return f"reponses_{questionnaire.code}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{extension}"
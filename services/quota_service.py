@@ -0,0 +1,345 @@
+# services/quota_service.py
+"""
+Compteurs d'usage par client pour les limites des formules d'abonnement.
+
+Chaque ressource limitée par FormuleAbonnement (max_utilisateurs,
+max_risques, ...) a un compteur par client dans compteurs_usage_client.
+Les compteurs sont ajustés par des hooks SQLAlchemy (insertion, archivage /
+désactivation, changement de client, suppression) dans la transaction de
+l'écriture. Les écritures en masse (query.update / delete) ne passent pas
+par ces hooks : `reconcilier()` recale les compteurs sur les vrais
+comptages, au démarrage si la table est vide puis périodiquement.
+
+À l'insertion, les limites de la formule sont relues sur la connexion du
+flush et l'incrément du compteur est conditionnel (valeur < limite) : deux
+créations concurrentes ne peuvent pas dépasser la limite, la seconde lève
+LimiteFormuleAtteinte et son flush est annulé. Le refus est aussi gardé
+pour la requête (QuotaService.refus) : l'application répond par un refus
+même si un try/except de la vue a intercepté l'exception. Un changement de formule
+fait dans un autre worker s'applique donc dès la création suivante ; les
+vérifications préalables des vues ne gardent les limites que le temps de
+la requête.
+"""
+from datetime import datetime
+
+from flask import g, has_request_context
+from sqlalchemy import event, inspect, select, update, insert, func, literal
+
+from models import (db, CompteurUsageClient, Client, FormuleAbonnement,
+                    User, Risque, Audit, Processus, ProcessusActivite)
+
+
+# ressource -> (modèle, attribut filtrant, valeur comptée, limite de la formule)
+RESSOURCES = {
+    'utilisateurs': (User, 'is_active', True, 'max_utilisateurs'),
+    'risques': (Risque, 'is_archived', False, 'max_risques'),
+    'audits': (Audit, 'is_archived', False, 'max_audits'),
+    'processus': (Processus, None, None, 'max_processus'),
+    'logigrammes': (ProcessusActivite, None, None, 'max_logigrammes'),
+}
+
+# Colonnes dénormalisées historiques de Client, tenues à jour à la réconciliation
+COLONNES_CLIENT = {
+    'utilisateurs': 'nb_utilisateurs',
+    'risques': 'nb_risques',
+    'audits': 'nb_audits',
+}
+
+T = CompteurUsageClient.__table__
+
+
+class LimiteFormuleAtteinte(Exception):
+    """Création refusée : le client a atteint la limite de sa formule pour la ressource"""
+
+    def __init__(self, client_id, ressource, limite):
+        self.client_id = client_id
+        self.ressource = ressource
+        self.limite = limite
+        super().__init__(f"Limite de {ressource} atteinte ({limite})")
+
+
+def _condition_sql(ressource):
+    modele, attribut, valeur, _ = RESSOURCES[ressource]
+    if attribut is None:
+        return literal(True)
+    return getattr(modele, attribut) == valeur
+
+
+def _est_compte(ressource, valeur_attribut):
+    _, attribut, valeur, _ = RESSOURCES[ressource]
+    return attribut is None or valeur_attribut == valeur
+
+
+def _ancienne_valeur(target, attribut):
+    historique = inspect(target).attrs[attribut].history
+    if historique.has_changes():
+        return historique.deleted[0] if historique.deleted else None
+    return getattr(target, attribut)
+
+
+class QuotaService:
+    """Lecture O(1) et maintenance des compteurs d'usage par client"""
+
+    # ============================================
+    # LECTURE
+    # ============================================
+
+    @staticmethod
+    def usage(client_id):
+        """{ressource: valeur} pour un client (comptage direct si le compteur manque)"""
+        valeurs = dict(db.session.execute(
+            select(T.c.ressource, T.c.valeur).where(T.c.client_id == client_id)
+        ).all())
+        for ressource in RESSOURCES:
+            if ressource not in valeurs:
+                valeurs[ressource] = QuotaService.compter(client_id, ressource)
+        return valeurs
+
+    @staticmethod
+    def usage_clients(client_ids=None):
+        """{client_id: {ressource: valeur}} pour plusieurs clients en une requête"""
+        requete = select(T.c.client_id, T.c.ressource, T.c.valeur)
+        if client_ids is not None:
+            if not client_ids:
+                return {}
+            requete = requete.where(T.c.client_id.in_(client_ids))
+
+        resultat = {cid: {r: 0 for r in RESSOURCES} for cid in (client_ids or [])}
+        for client_id, ressource, valeur in db.session.execute(requete):
+            resultat.setdefault(client_id, {r: 0 for r in RESSOURCES})[ressource] = valeur
+        return resultat
+
+    @staticmethod
+    def compter(client_id, ressource):
+        """Comptage réel (sans passer par le compteur)"""
+        modele = RESSOURCES[ressource][0]
+        return db.session.execute(
+            select(func.count()).select_from(modele)
+            .where(modele.client_id == client_id, _condition_sql(ressource))
+        ).scalar() or 0
+
+    @staticmethod
+    def valeur(client_id, ressource):
+        """Compteur d'une ressource pour un client (comptage direct s'il manque)"""
+        valeur = db.session.execute(
+            select(T.c.valeur).where(T.c.client_id == client_id, T.c.ressource == ressource)
+        ).scalar()
+        return QuotaService.compter(client_id, ressource) if valeur is None else valeur
+
+    @staticmethod
+    def limite(formule, ressource):
+        return getattr(formule, RESSOURCES[ressource][3], None) if formule else None
+
+    @staticmethod
+    def limites(client_id, connection=None):
+        """
+        {ressource: limite} de la formule du client ({} sans formule). Sur
+        `connection` (flush d'une insertion) : toujours relues ; sinon
+        gardées pour le reste de la requête.
+        """
+        if not client_id:
+            return {}
+        memoire = g.setdefault('limites_formule', {}) if connection is None and has_request_context() else {}
+        if client_id in memoire:
+            return memoire[client_id]
+
+        F = FormuleAbonnement.__table__
+        colonnes = [F.c[limite] for _, _, _, limite in RESSOURCES.values()]
+        ligne = (connection or db.session).execute(
+            select(*colonnes)
+            .select_from(Client.__table__.join(F, F.c.id == Client.__table__.c.formule_id))
+            .where(Client.__table__.c.id == client_id)
+        ).first()
+        limites = dict(zip(RESSOURCES, ligne)) if ligne else {}
+        memoire[client_id] = limites
+        return limites
+
+    @staticmethod
+    def refus():
+        """Retire et retourne le refus (LimiteFormuleAtteinte) survenu pendant la requête, sinon None"""
+        return g.pop('limite_formule_atteinte', None) if has_request_context() else None
+
+    @classmethod
+    def limite_atteinte(cls, client, ressource):
+        """True si le client (objet ou id) a atteint la limite de sa formule pour la ressource"""
+        client_id = getattr(client, 'id', client)
+        limite = cls.limites(client_id).get(ressource)
+        if limite is None:
+            return False
+        return cls.valeur(client_id, ressource) >= limite
+
+    @classmethod
+    def stats_usage(cls, formule, client_id=None, ressources=None, usage=None):
+        """Statistiques 'current / limit / percent' au format des pages d'usage"""
+        if usage is None:
+            usage = cls.usage(client_id) if client_id else {}
+        stats = {}
+        for ressource in ressources or RESSOURCES:
+            limite = cls.limite(formule, ressource) or 0
+            courant = usage.get(ressource, 0)
+            stats[ressource] = {
+                'current': courant,
+                'limit': limite,
+                'percent': min((courant / limite) * 100, 100) if limite > 0 else 0
+            }
+        return stats
+
+    # ============================================
+    # MAINTENANCE
+    # ============================================
+
+    @staticmethod
+    def ajuster(connection, client_id, ressource, delta, limite=None):
+        """
+        Incrément atomique du compteur ; le crée depuis un comptage réel s'il
+        manque. Avec `limite`, l'incrément n'a lieu que si le compteur reste
+        dans la limite, sinon LimiteFormuleAtteinte.
+        """
+        if not client_id or not delta:
+            return
+        maintenant = datetime.utcnow()
+        conditions = [T.c.client_id == client_id, T.c.ressource == ressource]
+        if limite is not None:
+            conditions.append(T.c.valeur + delta <= limite)
+        resultat = connection.execute(
+            update(T).where(*conditions).values(valeur=T.c.valeur + delta, updated_at=maintenant)
+        )
+        if resultat.rowcount:
+            return
+
+        existe = connection.execute(
+            select(literal(1)).where(T.c.client_id == client_id, T.c.ressource == ressource)
+        ).first() is not None
+        if existe:
+            raise LimiteFormuleAtteinte(client_id, ressource, limite)
+
+        # Compteur absent : comptage réel (la ligne écrite dans ce flush y est déjà)
+        modele = RESSOURCES[ressource][0]
+        valeur = connection.execute(
+            select(func.count()).select_from(modele)
+            .where(modele.client_id == client_id, _condition_sql(ressource))
+        ).scalar() or 0
+        if limite is not None and valeur > limite:
+            raise LimiteFormuleAtteinte(client_id, ressource, limite)
+        connection.execute(insert(T).values(
+            client_id=client_id, ressource=ressource, valeur=valeur,
+            updated_at=maintenant, reconcilie_at=maintenant
+        ))
+
+    @staticmethod
+    def initialiser_client(connection, client_id):
+        maintenant = datetime.utcnow()
+        connection.execute(insert(T), [
+            {'client_id': client_id, 'ressource': r, 'valeur': 0,
+             'updated_at': maintenant, 'reconcilie_at': maintenant}
+            for r in RESSOURCES
+        ])
+
+    @staticmethod
+    def reconcilier(client_id=None):
+        """Recale les compteurs sur les comptages réels ; retourne le nb de compteurs corrigés"""
+        maintenant = datetime.utcnow()
+        reels = {}
+        for ressource, (modele, _, _, _) in RESSOURCES.items():
+            requete = (
+                select(modele.client_id, func.count())
+                .where(modele.client_id.isnot(None), _condition_sql(ressource))
+                .group_by(modele.client_id)
+            )
+            if client_id:
+                requete = requete.where(modele.client_id == client_id)
+            for cid, nb in db.session.execute(requete):
+                reels[(cid, ressource)] = nb
+
+        requete_clients = select(Client.id)
+        if client_id:
+            requete_clients = requete_clients.where(Client.id == client_id)
+        client_ids = db.session.execute(requete_clients).scalars().all()
+
+        requete_existants = select(T.c.client_id, T.c.ressource, T.c.valeur)
+        if client_id:
+            requete_existants = requete_existants.where(T.c.client_id == client_id)
+        existants = {(cid, r): v for cid, r, v in db.session.execute(requete_existants)}
+
+        corrections = 0
+        nouveaux = []
+        for cid in client_ids:
+            for ressource in RESSOURCES:
+                cle = (cid, ressource)
+                valeur = reels.get(cle, 0)
+                if cle not in existants:
+                    nouveaux.append({'client_id': cid, 'ressource': ressource, 'valeur': valeur,
+                                     'updated_at': maintenant, 'reconcilie_at': maintenant})
+                elif existants[cle] != valeur:
+                    db.session.execute(
+                        update(T).where(T.c.client_id == cid, T.c.ressource == ressource)
+                        .values(valeur=valeur, updated_at=maintenant)
+                    )
+                    corrections += 1
+        if nouveaux:
+            db.session.execute(insert(T), nouveaux)
+
+        requete_date = update(T).values(reconcilie_at=maintenant)
+        if client_id:
+            requete_date = requete_date.where(T.c.client_id == client_id)
+        db.session.execute(requete_date)
+
+        # Colonnes historiques de Client (affichées dans l'administration)
+        for cid in client_ids:
+            db.session.execute(
+                update(Client.__table__).where(Client.__table__.c.id == cid).values(**{
+                    colonne: reels.get((cid, ressource), 0) for ressource, colonne in COLONNES_CLIENT.items()
+                })
+            )
+
+        db.session.commit()
+        return corrections + len(nouveaux)
+
+    @staticmethod
+    def est_vide():
+        return db.session.execute(select(literal(1)).select_from(T).limit(1)).first() is None
+
+
+# ============================================
+# HOOKS DE MAINTENANCE
+# ============================================
+
+def _enregistrer_hooks(ressource):
+    modele, attribut, _, _ = RESSOURCES[ressource]
+
+    @event.listens_for(modele, 'after_insert')
+    def apres_insertion(mapper, connection, target):
+        if _est_compte(ressource, getattr(target, attribut) if attribut else None):
+            limite = QuotaService.limites(target.client_id, connection).get(ressource)
+            try:
+                QuotaService.ajuster(connection, target.client_id, ressource, 1, limite)
+            except LimiteFormuleAtteinte as e:
+                if has_request_context():
+                    g.limite_formule_atteinte = e
+                raise
+
+    @event.listens_for(modele, 'after_update')
+    def apres_modification(mapper, connection, target):
+        ancien_client = _ancienne_valeur(target, 'client_id')
+        ancien_compte = _est_compte(ressource, _ancienne_valeur(target, attribut) if attribut else None)
+        nouveau_compte = _est_compte(ressource, getattr(target, attribut) if attribut else None)
+        if (ancien_client, ancien_compte) == (target.client_id, nouveau_compte):
+            return
+        if ancien_compte:
+            QuotaService.ajuster(connection, ancien_client, ressource, -1)
+        if nouveau_compte:
+            QuotaService.ajuster(connection, target.client_id, ressource, 1)
+
+    @event.listens_for(modele, 'after_delete')
+    def apres_suppression(mapper, connection, target):
+        if _est_compte(ressource, _ancienne_valeur(target, attribut) if attribut else None):
+            QuotaService.ajuster(connection, _ancienne_valeur(target, 'client_id'), ressource, -1)
+
+
+@event.listens_for(Client, 'after_insert')
+def _initialiser_compteurs_client(mapper, connection, target):
+    QuotaService.initialiser_client(connection, target.id)
+
+
+for _ressource in RESSOURCES:
+    _enregistrer_hooks(_ressource)
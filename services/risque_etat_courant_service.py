@@ -0,0 +1,201 @@
+# services/risque_etat_courant_service.py
+"""
+État courant des risques (projection risque_etat_courant).
+
+Le niveau, le score et les valeurs finales « courantes » d'un risque étaient
+recalculés à chaque lecture : max(risque.evaluations) en Python, sous-requête
+max(created_at) jointe plusieurs fois dans le tableau de bord, une requête
+par risque dans les exports. La projection garde une ligne par risque avec
+l'évaluation retenue — la plus récente des évaluations confirmées ou
+validées, à défaut la plus récente saisie — et ses valeurs finales
+(confirmation > validation > pré-évaluation, comme get_valeurs_finales).
+
+Elle est recalculée pour les seuls risques concernés à la fin de chaque
+flush qui écrit une évaluation ou un risque, donc dans la même transaction.
+"""
+from datetime import datetime
+
+from sqlalchemy import event, inspect, select, delete, literal
+from sqlalchemy.orm import object_session
+
+from models import db, RisqueEtatCourant, EvaluationRisque, Risque
+from services.ecriture_sql import inserer_ou_mettre_a_jour
+
+
+T = RisqueEtatCourant.__table__
+E = EvaluationRisque.__table__
+R = Risque.__table__
+
+TAILLE_LOT = 1000
+
+
+def _final(*valeurs):
+    """Première valeur renseignée (0 compte comme non renseigné, comme get_valeurs_finales)"""
+    for valeur in valeurs:
+        if valeur:
+            return valeur
+    return valeurs[-1]
+
+
+def _cle_chronologique(evaluation):
+    return (evaluation.created_at or datetime.min, evaluation.id)
+
+
+def _ligne(risque_id, client_id, evaluations):
+    ligne = {
+        'risque_id': risque_id,
+        'client_id': client_id,
+        'evaluation_id': None,
+        'derniere_evaluation_id': None,
+        'phase': None,
+        'nb_evaluations': len(evaluations),
+        'impact': None,
+        'probabilite': None,
+        'niveau_maitrise': None,
+        'score_risque': None,
+        'niveau_risque': None,
+        'date_evaluation': None,
+        'updated_at': datetime.utcnow(),
+    }
+    if not evaluations:
+        return ligne
+
+    derniere = max(evaluations, key=_cle_chronologique)
+    validees = [e for e in evaluations if e.date_confirmation or e.date_validation]
+    retenue = max(validees, key=_cle_chronologique) if validees else derniere
+
+    ligne.update(
+        evaluation_id=retenue.id,
+        derniere_evaluation_id=derniere.id,
+        phase='confirmee' if retenue.date_confirmation else
+              'validee' if retenue.date_validation else
+              'pre_evaluation',
+        impact=_final(retenue.impact_conf, retenue.impact_val, retenue.impact_pre),
+        probabilite=_final(retenue.probabilite_conf, retenue.probabilite_val, retenue.probabilite_pre),
+        niveau_maitrise=_final(retenue.niveau_maitrise_conf, retenue.niveau_maitrise_val,
+                               retenue.niveau_maitrise_pre),
+        score_risque=retenue.score_risque,
+        niveau_risque=retenue.niveau_risque,
+        date_evaluation=retenue.date_confirmation or retenue.date_validation or retenue.created_at,
+    )
+    return ligne
+
+
+class RisqueEtatCourantService:
+    """Maintenance et lecture de l'état courant des risques"""
+
+    # ============================================
+    # RECALCUL
+    # ============================================
+
+    @staticmethod
+    def recalculer(connection, risque_ids):
+        """Recalcule l'état courant des risques donnés (les risques supprimés perdent leur ligne)"""
+        risque_ids = {i for i in risque_ids if i is not None}
+        if not risque_ids:
+            return 0
+
+        nb = 0
+        risque_ids = sorted(risque_ids)
+        for debut in range(0, len(risque_ids), TAILLE_LOT):
+            lot = risque_ids[debut:debut + TAILLE_LOT]
+            clients = dict(connection.execute(select(R.c.id, R.c.client_id).where(R.c.id.in_(lot))).all())
+
+            evaluations = {risque_id: [] for risque_id in clients}
+            for evaluation in connection.execute(
+                select(E.c.id, E.c.risque_id, E.c.created_at, E.c.date_validation, E.c.date_confirmation,
+                       E.c.impact_pre, E.c.impact_val, E.c.impact_conf,
+                       E.c.probabilite_pre, E.c.probabilite_val, E.c.probabilite_conf,
+                       E.c.niveau_maitrise_pre, E.c.niveau_maitrise_val, E.c.niveau_maitrise_conf,
+                       E.c.score_risque, E.c.niveau_risque)
+                .where(E.c.risque_id.in_(clients.keys()))
+            ):
+                evaluations[evaluation.risque_id].append(evaluation)
+
+            lignes = [_ligne(risque_id, clients[risque_id], evaluations[risque_id]) for risque_id in clients]
+            inserer_ou_mettre_a_jour(connection, T, lignes, ['risque_id'])
+            supprimes = set(lot) - clients.keys()
+            if supprimes:
+                connection.execute(delete(T).where(T.c.risque_id.in_(supprimes)))
+            nb += len(lignes)
+        return nb
+
+    @classmethod
+    def reconstruire(cls, client_id=None):
+        """Recalcule l'état courant de tous les risques (ou de ceux d'un client)"""
+        connection = db.session.connection()
+        requete = select(R.c.id)
+        if client_id:
+            requete = requete.where(R.c.client_id == client_id)
+        nb = cls.recalculer(connection, connection.execute(requete).scalars().all())
+        db.session.commit()
+        return nb
+
+    @staticmethod
+    def est_vide():
+        return db.session.execute(select(literal(1)).select_from(T).limit(1)).first() is None
+
+    # ============================================
+    # LECTURE
+    # ============================================
+
+    @staticmethod
+    def par_risque(risque_ids):
+        """{risque_id: RisqueEtatCourant} en une requête"""
+        risque_ids = {i for i in risque_ids if i}
+        if not risque_ids:
+            return {}
+        return {
+            etat.risque_id: etat
+            for etat in RisqueEtatCourant.query.filter(RisqueEtatCourant.risque_id.in_(risque_ids)).all()
+        }
+
+    @staticmethod
+    def evaluations_retenues(etats):
+        """{risque_id: EvaluationRisque retenue} en une requête (auteurs et commentaires des exports)"""
+        ids = {etat.evaluation_id: etat.risque_id for etat in etats if etat.evaluation_id}
+        if not ids:
+            return {}
+        return {
+            ids[evaluation.id]: evaluation
+            for evaluation in EvaluationRisque.query.filter(EvaluationRisque.id.in_(ids.keys())).all()
+        }
+
+
+# ============================================
+# MAINTENANCE À CHAQUE FLUSH
+# ============================================
+
+def _marquer(attribut):
+    def marquer(mapper, connection, target):
+        session = object_session(target)
+        if session is None:
+            return
+        cibles = session.info.setdefault('risques_etat_courant', set())
+        cibles.add(getattr(target, attribut))
+        # Une évaluation rattachée à un autre risque : l'ancien est aussi recalculé
+        cibles.update(inspect(target).attrs[attribut].history.deleted or ())
+    return marquer
+
+
+for _modele, _attribut in ((EvaluationRisque, 'risque_id'), (Risque, 'id')):
+    for _evenement in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(_modele, _evenement, _marquer(_attribut))
+
+
+@event.listens_for(db.session, 'after_flush_postexec')
+def _recalculer_apres_flush(session, flush_context):
+    risque_ids = session.info.pop('risques_etat_courant', None)
+    if not risque_ids:
+        return
+
+    RisqueEtatCourantService.recalculer(session.connection(), risque_ids)
+
+    # Les états déjà chargés dans la session sont relus à leur prochain accès
+    for objet in list(session.identity_map.values()):
+        if not inspect(objet).persistent:
+            continue
+        if isinstance(objet, RisqueEtatCourant) and objet.risque_id in risque_ids:
+            session.expire(objet)
+        elif isinstance(objet, Risque) and objet.id in risque_ids:
+            session.expire(objet, ['etat_courant'])
@@ -0,0 +1,286 @@
+# services/series_temporelles_service.py
+"""
+Stockage des séries de mesures KRI collectées automatiquement.
+
+Chaque exécution de CollecteEngine ajoute une CollecteDonnee et une
+MesureKRI par KRI lié ; les sources à haute fréquence font croître ces
+tables sans limite. Politique de rétention (flask appliquer-retention-kri) :
+
+- les mesures brutes issues d'une collecte sont conservées
+  KRI_RETENTION_BRUTE_JOURS jours, puis résumées en agrégats horaires et
+  journaliers (AgregatMesureKRI : nombre, min, max, somme, somme des
+  carrés, dernière valeur) et supprimées avec leur collecte ;
+- les agrégats horaires sont conservés KRI_RETENTION_HORAIRE_JOURS jours,
+  les journaliers sans limite.
+
+Les mesures saisies à la main et les collectes qui portent une alerte ne
+sont jamais purgées. Les séries sur de longues périodes (SeriesKRI)
+complètent les mesures brutes par les agrégats.
+
+Les données brutes d'une collecte (réponse complète de la source) sont
+compressées (gzip) et rangées dans le stockage par contenu dès qu'elles
+dépassent COLLECTE_TAILLE_MAX_INLINE octets : des réponses identiques
+d'une exécution à l'autre n'occupent qu'une place.
+"""
+import gzip
+import io
+import json
+from datetime import datetime, timedelta
+
+from flask import current_app, has_app_context
+from sqlalchemy import select, delete, exists, or_, tuple_
+
+from chargement_differe import ModuleParesseux
+from models import db, MesureKRI, CollecteDonnee, AlerteCollecte, AgregatMesureKRI
+from services.stockage_service import StockageService
+
+np = ModuleParesseux('numpy')
+
+RETENTION_BRUTE_JOURS = 90
+RETENTION_HORAIRE_JOURS = 365
+RETENTION_MIN_JOURS = 31  # les tendances sur 30 jours restent calculées sur les mesures brutes
+TAILLE_MAX_INLINE = 2048
+TAILLE_LOT = 5000
+
+ENTITE_DONNEES_BRUTES = 'collecte_donnee'
+GRANULARITES = {'heure': 'datetime64[h]', 'jour': 'datetime64[D]'}
+
+
+class SeriesTemporellesKRI:
+    """Archivage des données brutes, agrégats et rétention des mesures collectées"""
+
+    @staticmethod
+    def _config(cle, defaut):
+        if has_app_context():
+            return current_app.config.get(cle, defaut)
+        return defaut
+
+    @classmethod
+    def retention_brute(cls):
+        jours = int(cls._config('KRI_RETENTION_BRUTE_JOURS', RETENTION_BRUTE_JOURS))
+        return timedelta(days=max(jours, RETENTION_MIN_JOURS))
+
+    @classmethod
+    def retention_horaire(cls):
+        jours = int(cls._config('KRI_RETENTION_HORAIRE_JOURS', RETENTION_HORAIRE_JOURS))
+        return max(timedelta(days=jours), cls.retention_brute())
+
+    # ============================================
+    # DONNÉES BRUTES DES COLLECTES
+    # ============================================
+
+    @classmethod
+    def archiver_donnees_brutes(cls, collecte, donnees_brutes, client_id=None):
+        """
+        Renseigne collecte.donnees_brutes : telles quelles si elles sont
+        petites, sinon une référence vers leur version compressée dans le
+        stockage par contenu. La collecte doit avoir un id (flush). Sans commit.
+        """
+        if donnees_brutes is None:
+            collecte.donnees_brutes = None
+            return
+        contenu = json.dumps(donnees_brutes, ensure_ascii=False, default=str).encode('utf-8')
+        if len(contenu) <= int(cls._config('COLLECTE_TAILLE_MAX_INLINE', TAILLE_MAX_INLINE)):
+            collecte.donnees_brutes = donnees_brutes
+            return
+
+        # mtime fixe : même contenu, même archive (dédoublonnage par empreinte)
+        compresse = gzip.compress(contenu, mtime=0)
+        reference = StockageService.enregistrer(
+            io.BytesIO(compresse), ENTITE_DONNEES_BRUTES, collecte.id,
+            client_id=client_id, nom_fichier=f'collecte_{collecte.id}.json.gz'
+        )
+        collecte.donnees_brutes = {
+            'objet': reference.sha256,
+            'compression': 'gzip',
+            'taille': len(contenu),
+            'taille_compressee': len(compresse),
+        }
+
+    @staticmethod
+    def lire_donnees_brutes(collecte):
+        """Données brutes d'une collecte, décompressées si elles ont été archivées"""
+        donnees = collecte.donnees_brutes
+        if not (isinstance(donnees, dict) and donnees.get('compression') == 'gzip' and 'objet' in donnees):
+            return donnees
+        compresse = b''.join(StockageService.backend().lire(donnees['objet']))
+        return json.loads(gzip.decompress(compresse).decode('utf-8'))
+
+    # ============================================
+    # AGRÉGATS
+    # ============================================
+
+    @staticmethod
+    def agreger(kri_ids, client_ids, dates, valeurs, granularite):
+        """
+        Agrégats (dicts) par (kri_id, début de période) des mesures données,
+        calculés en une passe NumPy.
+        """
+        if len(kri_ids) == 0:
+            return []
+        kri_ids = np.asarray(kri_ids, dtype=np.int64)
+        client_ids = np.asarray([-1 if c is None else c for c in client_ids], dtype=np.int64)
+        dates = np.asarray(dates, dtype='datetime64[s]')
+        valeurs = np.asarray(valeurs, dtype=float)
+        periodes = dates.astype(GRANULARITES[granularite])
+
+        ordre = np.lexsort((dates, kri_ids))
+        kri_ids, client_ids = kri_ids[ordre], client_ids[ordre]
+        dates, valeurs, periodes = dates[ordre], valeurs[ordre], periodes[ordre]
+
+        nouveau = np.r_[True, (kri_ids[1:] != kri_ids[:-1]) | (periodes[1:] != periodes[:-1])]
+        debuts = np.flatnonzero(nouveau)
+        fins = np.r_[debuts[1:], len(valeurs)] - 1
+
+        nb = np.diff(np.r_[debuts, len(valeurs)])
+        minimums = np.minimum.reduceat(valeurs, debuts)
+        maximums = np.maximum.reduceat(valeurs, debuts)
+        sommes = np.add.reduceat(valeurs, debuts)
+        sommes_carres = np.add.reduceat(valeurs * valeurs, debuts)
+
+        return [
+            {
+                'kri_id': int(kri_ids[d]),
+                'granularite': granularite,
+                'debut': periodes[d].astype('datetime64[s]').item(),
+                'client_id': None if client_ids[f] < 0 else int(client_ids[f]),
+                'nb_mesures': int(nb[i]),
+                'valeur_min': float(minimums[i]),
+                'valeur_max': float(maximums[i]),
+                'somme': float(sommes[i]),
+                'somme_carres': float(sommes_carres[i]),
+                'derniere_valeur': float(valeurs[f]),
+                'derniere_date': dates[f].item(),
+            }
+            for i, (d, f) in enumerate(zip(debuts, fins))
+        ]
+
+    @staticmethod
+    def _fusionner(lignes):
+        """Ajoute les agrégats aux existants (une requête de lecture pour tout le lot)"""
+        if not lignes:
+            return 0
+        cles = [(l['kri_id'], l['granularite'], l['debut']) for l in lignes]
+        existants = {
+            (a.kri_id, a.granularite, a.debut): a
+            for a in AgregatMesureKRI.query.filter(
+                tuple_(AgregatMesureKRI.kri_id, AgregatMesureKRI.granularite, AgregatMesureKRI.debut).in_(cles)
+            )
+        }
+        for cle, ligne in zip(cles, lignes):
+            agregat = existants.get(cle)
+            if agregat is None:
+                db.session.add(AgregatMesureKRI(**ligne))
+                continue
+            agregat.nb_mesures += ligne['nb_mesures']
+            agregat.valeur_min = min(agregat.valeur_min, ligne['valeur_min'])
+            agregat.valeur_max = max(agregat.valeur_max, ligne['valeur_max'])
+            agregat.somme += ligne['somme']
+            agregat.somme_carres += ligne['somme_carres']
+            if agregat.derniere_date is None or ligne['derniere_date'] >= agregat.derniere_date:
+                agregat.derniere_valeur = ligne['derniere_valeur']
+                agregat.derniere_date = ligne['derniere_date']
+        return len(lignes)
+
+    @staticmethod
+    def agregats(kri_id, debut=None, fin=None, granularite='jour', client_id=None):
+        """(debut, nb, min, max, moyenne, derniere_valeur) des agrégats d'un KRI, par date"""
+        conditions = [AgregatMesureKRI.kri_id == kri_id, AgregatMesureKRI.granularite == granularite]
+        if client_id is not None:
+            conditions.append(or_(AgregatMesureKRI.client_id == client_id, AgregatMesureKRI.client_id.is_(None)))
+        if debut is not None:
+            conditions.append(AgregatMesureKRI.debut >= debut)
+        if fin is not None:
+            conditions.append(AgregatMesureKRI.debut <= fin)
+        return db.session.execute(
+            select(
+                AgregatMesureKRI.debut, AgregatMesureKRI.nb_mesures,
+                AgregatMesureKRI.valeur_min, AgregatMesureKRI.valeur_max,
+                AgregatMesureKRI.somme / AgregatMesureKRI.nb_mesures,
+                AgregatMesureKRI.derniere_valeur,
+            ).where(*conditions).order_by(AgregatMesureKRI.debut)
+        ).all()
+
+    @classmethod
+    def granularite_pour(cls, debut, maintenant=None):
+        """Agrégats horaires tant qu'ils sont conservés pour toute la période, sinon journaliers"""
+        maintenant = maintenant or datetime.utcnow()
+        if debut is not None and debut >= maintenant - cls.retention_horaire():
+            return 'heure'
+        return 'jour'
+
+    # ============================================
+    # RÉTENTION
+    # ============================================
+
+    @classmethod
+    def appliquer_retention(cls, maintenant=None, taille_lot=TAILLE_LOT):
+        """
+        Résume puis supprime les mesures collectées plus anciennes que la
+        rétention brute, puis les agrégats horaires expirés. Commit par lot.
+        """
+        maintenant = maintenant or datetime.utcnow()
+        # Limites au début du jour : les heures et jours agrégés sont complets
+        limite_brute = datetime.combine((maintenant - cls.retention_brute()).date(), datetime.min.time())
+        limite_horaire = datetime.combine((maintenant - cls.retention_horaire()).date(), datetime.min.time())
+        rapport = {'mesures': 0, 'collectes': 0, 'agregats': 0, 'agregats_horaires_supprimes': 0}
+
+        sans_alerte = ~exists().where(AlerteCollecte.collecte_id == CollecteDonnee.id)
+        while True:
+            lignes = db.session.execute(
+                select(CollecteDonnee.id, MesureKRI.id, MesureKRI.kri_id, MesureKRI.client_id,
+                       MesureKRI.date_mesure, MesureKRI.valeur)
+                .join(MesureKRI, MesureKRI.id == CollecteDonnee.mesure_kri_id)
+                .where(MesureKRI.date_mesure < limite_brute, sans_alerte)
+                .order_by(CollecteDonnee.id)
+                .limit(taille_lot)
+            ).all()
+            if not lignes:
+                break
+            collecte_ids, mesure_ids, kri_ids, client_ids, dates, valeurs = zip(*lignes)
+
+            for granularite in GRANULARITES:
+                lignes_agregats = cls.agreger(kri_ids, client_ids, dates, valeurs, granularite)
+                if granularite == 'heure':
+                    # Heures déjà expirées : seul l'agrégat journalier est conservé
+                    lignes_agregats = [l for l in lignes_agregats if l['debut'] >= limite_horaire]
+                rapport['agregats'] += cls._fusionner(lignes_agregats)
+
+            cls._supprimer_collectes(collecte_ids)
+            db.session.execute(delete(MesureKRI).where(MesureKRI.id.in_(mesure_ids)))
+            db.session.commit()
+            rapport['mesures'] += len(mesure_ids)
+            rapport['collectes'] += len(collecte_ids)
+
+        # Collectes sans mesure (valeur refusée à la validation)
+        while True:
+            collecte_ids = db.session.execute(
+                select(CollecteDonnee.id)
+                .where(CollecteDonnee.mesure_kri_id.is_(None),
+                       CollecteDonnee.date_collecte < limite_brute, sans_alerte)
+                .limit(taille_lot)
+            ).scalars().all()
+            if not collecte_ids:
+                break
+            cls._supprimer_collectes(collecte_ids)
+            db.session.commit()
+            rapport['collectes'] += len(collecte_ids)
+
+        rapport['agregats_horaires_supprimes'] = db.session.execute(
+            delete(AgregatMesureKRI).where(
+                AgregatMesureKRI.granularite == 'heure', AgregatMesureKRI.debut < limite_horaire
+            )
+        ).rowcount
+        db.session.commit()
+
+        # Les suppressions en masse ne passent pas par les événements ORM
+        from services.kri_analytique_service import AnalytiqueKRI
+        from services.kri_series_service import SeriesKRI
+        AnalytiqueKRI.invalider()
+        SeriesKRI.invalider()
+        return rapport
+
+    @staticmethod
+    def _supprimer_collectes(collecte_ids):
+        StockageService.liberer_lot(ENTITE_DONNEES_BRUTES, collecte_ids)
+        db.session.execute(delete(CollecteDonnee).where(CollecteDonnee.id.in_(collecte_ids)))
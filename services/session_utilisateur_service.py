@@ -0,0 +1,261 @@
+# services/session_utilisateur_service.py
+"""
+Profil de session des utilisateurs connectés et suivi des sessions par lot.
+
+Le user_loader ne charge plus la ligne User complète (permissions et
+préférences JSON, relations) à chaque requête : un profil compact (id,
+rôle, client, drapeaux d'administration, permissions effectives, langue)
+est lu en une requête étroite et exposé par UtilisateurSession. L'objet
+User n'est chargé que lorsqu'une vue lit ou modifie un autre attribut.
+
+Avec Redis, le profil est partagé entre workers et invalidé partout à
+chaque modification de l'utilisateur ou de son client. Sans Redis, il est
+relu à chaque requête : un cache propre au processus servirait un compte
+désactivé ou des permissions retirées aux autres workers.
+
+Les ouvertures et fermetures de UserSession sont écrites immédiatement,
+dans leur propre transaction.
+"""
+import json
+from datetime import datetime
+
+from sqlalchemy import event, select, update, insert, inspect
+from sqlalchemy.orm import object_session
+
+from models import db, User, Client, UserSession
+
+
+# Colonnes de User recopiées dans le profil
+CHAMPS_PROFIL = (
+    'id', 'username', 'role', 'client_id', 'is_active', 'is_client_admin',
+    'is_operateur', 'can_manage_users', 'can_view_users_list', 'force_password_change',
+)
+
+LANGUE_DEFAUT = 'fr'
+
+
+class UtilisateurSession:
+    """
+    current_user construit depuis le profil de session.
+    Tout attribut hors profil (ou toute écriture) charge l'objet User de
+    la requête et lui est délégué ; SQLAlchemy reçoit alors l'état de cet
+    objet (session.add, refresh, relations).
+    """
+
+    def __init__(self, profil):
+        object.__setattr__(self, '_profil', profil)
+        object.__setattr__(self, '_utilisateur', None)
+
+    # Interface Flask-Login
+    is_authenticated = True
+    is_anonymous = False
+
+    def get_id(self):
+        return str(self._profil['id'])
+
+    @property
+    def utilisateur(self):
+        """Objet User complet (chargé à la première demande)"""
+        if self._utilisateur is None:
+            utilisateur = db.session.get(User, self._profil['id'])
+            if utilisateur is None:
+                raise AttributeError(f"Utilisateur {self._profil['id']} introuvable")
+            object.__setattr__(self, '_utilisateur', utilisateur)
+        return self._utilisateur
+
+    @property
+    def est_hydrate(self):
+        return self._utilisateur is not None
+
+    def __getattr__(self, nom):
+        # Appelé seulement si l'attribut n'est pas défini sur la classe
+        if nom.startswith('__') or nom in ('_profil', '_utilisateur'):
+            raise AttributeError(nom)
+        if self._utilisateur is None and nom in self._profil:
+            return self._profil[nom]
+        return getattr(self.utilisateur, nom)
+
+    def __setattr__(self, nom, valeur):
+        setattr(self.utilisateur, nom, valeur)
+
+    def __delattr__(self, nom):
+        delattr(self.utilisateur, nom)
+
+    @property
+    def is_active(self):
+        if self._utilisateur is not None:
+            return self._utilisateur.is_active
+        return self._profil['is_active'] is not False
+
+    def has_permission(self, permission):
+        if self._utilisateur is not None:
+            return self._utilisateur.has_permission(permission)
+        if self._profil['role'] == 'super_admin':
+            return True
+        return self._profil['permissions_effectives'].get(permission, False)
+
+    def get_role_display_name(self):
+        return User.get_role_display_name(self)
+
+    def __eq__(self, autre):
+        if isinstance(autre, (UtilisateurSession, User)):
+            return self.id == autre.id
+        return NotImplemented
+
+    def __ne__(self, autre):
+        egal = self.__eq__(autre)
+        return egal if egal is NotImplemented else not egal
+
+    def __hash__(self):
+        return hash((User, self._profil['id']))
+
+    def __repr__(self):
+        return f'<UtilisateurSession {self._profil["id"]} {self._profil["username"]}>'
+
+
+class SessionUtilisateurService:
+    """Profils de session (partagés dans Redis) et suivi des sessions UserSession"""
+
+    _redis = None
+    PREFIXE_REDIS = 'profil_session:'
+    CACHE_DURATION = 600  # secondes (filet de sécurité si une invalidation Redis échoue)
+
+    @classmethod
+    def configurer_redis(cls, client_redis):
+        """Partage les profils entre workers (invalidation immédiate partout)"""
+        cls._redis = client_redis
+
+    # ============================================
+    # PROFILS
+    # ============================================
+
+    @classmethod
+    def profil(cls, user_id):
+        """Profil compact d'un utilisateur (None s'il n'existe pas)"""
+        if cls._redis is not None:
+            try:
+                brut = cls._redis.get(f"{cls.PREFIXE_REDIS}{user_id}")
+                if brut:
+                    return json.loads(brut)
+            except Exception as e:
+                print(f"⚠️ Cache Redis des profils indisponible: {e}")
+
+        profil = cls._charger_profil(user_id)
+        if profil is None or cls._redis is None:
+            return profil
+
+        try:
+            cls._redis.setex(f"{cls.PREFIXE_REDIS}{user_id}", cls.CACHE_DURATION, json.dumps(profil))
+        except Exception as e:
+            print(f"⚠️ Cache Redis des profils indisponible: {e}")
+        return profil
+
+    @staticmethod
+    def _charger_profil(user_id):
+        colonnes = [getattr(User, champ) for champ in CHAMPS_PROFIL]
+        ligne = db.session.execute(
+            select(*colonnes, User.permissions, Client.nom, Client.langue)
+            .outerjoin(Client, Client.id == User.client_id)
+            .where(User.id == user_id)
+        ).first()
+        if ligne is None:
+            return None
+
+        profil = dict(zip(CHAMPS_PROFIL, ligne[:len(CHAMPS_PROFIL)]))
+        permissions, client_nom, langue = ligne[len(CHAMPS_PROFIL):]
+        profil['permissions_effectives'] = User.permissions_effectives_pour(
+            profil['role'], profil['is_client_admin'], permissions
+        )
+        profil['client_nom'] = client_nom
+        profil['langue'] = langue or LANGUE_DEFAUT
+        return profil
+
+    @classmethod
+    def invalider(cls, *user_ids):
+        """Invalide les profils donnés (tous si aucun id)"""
+        if cls._redis is None:
+            return
+        try:
+            if user_ids:
+                cls._redis.delete(*[f"{cls.PREFIXE_REDIS}{user_id}" for user_id in user_ids])
+            else:
+                for cle in cls._redis.scan_iter(f"{cls.PREFIXE_REDIS}*"):
+                    cls._redis.delete(cle)
+        except Exception as e:
+            print(f"⚠️ Invalidation Redis des profils impossible: {e}")
+
+    # ============================================
+    # SUIVI DES SESSIONS
+    # ============================================
+
+    @staticmethod
+    def enregistrer_ouverture(user_id, session_id, client_id=None, ip_address=None, user_agent=None):
+        """Ouvre la session de l'utilisateur (une seule active : les précédentes sont fermées)"""
+        T = UserSession.__table__
+        try:
+            # Transaction propre : la fermeture, traitée par n'importe quel worker, trouve toujours la ligne
+            with db.engine.begin() as connection:
+                connection.execute(
+                    update(T).where(T.c.user_id == user_id, T.c.is_active == True).values(is_active=False)
+                )
+                connection.execute(insert(T).values(
+                    user_id=user_id,
+                    session_id=session_id,
+                    client_id=client_id,
+                    ip_address=ip_address,
+                    user_agent=user_agent,
+                    login_time=datetime.utcnow(),
+                    is_active=True,
+                ))
+        except Exception as e:
+            print(f"❌ Erreur ouverture de session utilisateur: {e}")
+
+    @staticmethod
+    def enregistrer_fermeture(session_id):
+        if not session_id:
+            return
+        T = UserSession.__table__
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(
+                    update(T).where(T.c.session_id == session_id, T.c.is_active == True)
+                    .values(is_active=False, logout_time=datetime.utcnow())
+                )
+        except Exception as e:
+            print(f"❌ Erreur fermeture de session utilisateur: {e}")
+
+
+# ============================================
+# INVALIDATION
+# ============================================
+
+def _invalider_utilisateur(mapper, connection, target):
+    SessionUtilisateurService.invalider(target.id)
+    # Invalider à nouveau au commit : une requête concurrente entre le
+    # flush et le commit a pu remettre en cache l'état précédent
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('profils_session_modifies', set()).add(target.id)
+
+
+def _invalider_client(mapper, connection, target):
+    # Nom / langue du client recopiés dans les profils de ses utilisateurs
+    etat = inspect(target)
+    if not (etat.attrs.nom.history.has_changes() or etat.attrs.langue.history.has_changes()):
+        return
+    user_ids = connection.execute(select(User.id).where(User.client_id == target.id)).scalars().all()
+    if user_ids:
+        SessionUtilisateurService.invalider(*user_ids)
+
+
+@event.listens_for(db.session, 'after_commit')
+@event.listens_for(db.session, 'after_rollback')
+def _invalider_fin_transaction(session):
+    ids = session.info.pop('profils_session_modifies', None)
+    if ids:
+        SessionUtilisateurService.invalider(*ids)
+
+
+for _evenement in ('after_update', 'after_delete'):
+    event.listen(User, _evenement, _invalider_utilisateur)
+event.listen(Client, 'after_update', _invalider_client)
@@ -0,0 +1,528 @@
+# services/stockage_service.py
+"""
+Stockage des pièces jointes adressé par contenu.
+
+Chaque fichier est lu par blocs (taille limitée), haché en SHA-256 au fil
+de la lecture et stocké une seule fois sous son empreinte : le même
+document joint à plusieurs risques, KRI ou incidents n'occupe qu'une place.
+Les entités pointent vers l'objet par une ReferenceObjet ; ObjetStocke
+tient le compteur de références, les objets qui n'en ont plus sont purgés
+après un délai de grâce.
+
+Le backend est interchangeable : système de fichiers local par défaut,
+S3 compatible (AWS, MinIO...) si STOCKAGE_BACKEND = 's3' et boto3 installé.
+Les téléchargements acceptent les requêtes partielles (Range).
+"""
+import hashlib
+import mimetypes
+import os
+import tempfile
+from datetime import datetime, timedelta
+from urllib.parse import quote
+
+from flask import current_app, request, send_file, Response, abort
+from sqlalchemy import select, update, insert, delete, func
+from sqlalchemy.exc import IntegrityError
+
+from models import db, ObjetStocke, ReferenceObjet
+
+# Valeur de chemin_fichier pour un fichier stocké par contenu
+PREFIXE_OBJET = 'objet://'
+
+TAILLE_BLOC = 1024 * 1024  # 1 Mio
+
+
+class FichierTropVolumineux(ValueError):
+    """Le flux dépasse la taille autorisée (le fichier n'est pas conservé)"""
+
+    def __init__(self, taille_max):
+        self.taille_max = taille_max
+        super().__init__(f"Fichier trop volumineux (max {taille_max // (1024 * 1024)} Mo)")
+
+
+def chemin_objet(sha256):
+    return f"{PREFIXE_OBJET}{sha256}"
+
+
+def sha_depuis_chemin(chemin):
+    """Empreinte d'un chemin 'objet://<sha>' (None pour un chemin de fichier classique)"""
+    if chemin and chemin.startswith(PREFIXE_OBJET):
+        return chemin[len(PREFIXE_OBJET):]
+    return None
+
+
+# ============================================
+# BACKENDS
+# ============================================
+
+class StockageLocal:
+    """Objets rangés sous racine/ab/cd/<sha256>"""
+
+    nom = 'local'
+
+    def __init__(self, racine):
+        self.racine = racine
+
+    def chemin_local(self, sha256):
+        return os.path.join(self.racine, sha256[:2], sha256[2:4], sha256)
+
+    def dossier_temporaire(self):
+        # Même système de fichiers que les objets : os.replace reste atomique
+        dossier = os.path.join(self.racine, 'tmp')
+        os.makedirs(dossier, exist_ok=True)
+        return dossier
+
+    def existe(self, sha256):
+        return os.path.exists(self.chemin_local(sha256))
+
+    def deposer(self, sha256, chemin_temporaire):
+        destination = self.chemin_local(sha256)
+        if os.path.exists(destination):
+            os.remove(chemin_temporaire)
+            return False
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        os.replace(chemin_temporaire, destination)
+        return True
+
+    def lire(self, sha256, debut=0, fin=None):
+        """Générateur des octets [debut, fin] (fin incluse)"""
+        with open(self.chemin_local(sha256), 'rb') as fichier:
+            fichier.seek(debut)
+            reste = None if fin is None else fin - debut + 1
+            while reste is None or reste > 0:
+                bloc = fichier.read(TAILLE_BLOC if reste is None else min(TAILLE_BLOC, reste))
+                if not bloc:
+                    break
+                if reste is not None:
+                    reste -= len(bloc)
+                yield bloc
+
+    def supprimer(self, sha256):
+        chemin = self.chemin_local(sha256)
+        if os.path.exists(chemin):
+            os.remove(chemin)
+
+
+class StockageS3:
+    """Objets dans un bucket S3 compatible (endpoint_url pour MinIO)"""
+
+    nom = 's3'
+
+    def __init__(self, bucket, endpoint_url=None, prefixe='objets/', **options):
+        import boto3  # ImportError gérée par StockageService
+        from botocore.exceptions import ClientError
+
+        self.bucket = bucket
+        self.prefixe = prefixe
+        self.client = boto3.client('s3', endpoint_url=endpoint_url, **options)
+        self._erreur_client = ClientError
+
+    def _cle(self, sha256):
+        return f"{self.prefixe}{sha256[:2]}/{sha256}"
+
+    def chemin_local(self, sha256):
+        return None
+
+    def dossier_temporaire(self):
+        return tempfile.gettempdir()
+
+    def existe(self, sha256):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._cle(sha256))
+            return True
+        except self._erreur_client:
+            return False
+
+    def deposer(self, sha256, chemin_temporaire):
+        try:
+            if self.existe(sha256):
+                return False
+            self.client.upload_file(chemin_temporaire, self.bucket, self._cle(sha256))
+            return True
+        finally:
+            os.remove(chemin_temporaire)
+
+    def lire(self, sha256, debut=0, fin=None):
+        options = {}
+        if debut or fin is not None:
+            options['Range'] = f"bytes={debut}-{'' if fin is None else fin}"
+        corps = self.client.get_object(Bucket=self.bucket, Key=self._cle(sha256), **options)['Body']
+        try:
+            yield from corps.iter_chunks(TAILLE_BLOC)
+        finally:
+            corps.close()
+
+    def supprimer(self, sha256):
+        self.client.delete_object(Bucket=self.bucket, Key=self._cle(sha256))
+
+
+# ============================================
+# SERVICE
+# ============================================
+
+class StockageService:
+    """Dépôt, téléchargement et comptabilité des objets stockés"""
+
+    _backend = None
+    DELAI_PURGE = timedelta(hours=24)
+
+    @classmethod
+    def backend(cls):
+        if cls._backend is None:
+            cls._backend = cls._creer_backend(current_app.config)
+        return cls._backend
+
+    @classmethod
+    def configurer(cls, backend):
+        """Force le backend (ex. MinIO local pour les essais)"""
+        cls._backend = backend
+
+    @staticmethod
+    def _creer_backend(config):
+        if config.get('STOCKAGE_BACKEND') == 's3':
+            try:
+                return StockageS3(
+                    bucket=config['STOCKAGE_S3_BUCKET'],
+                    endpoint_url=config.get('STOCKAGE_S3_ENDPOINT'),
+                    aws_access_key_id=config.get('STOCKAGE_S3_ACCESS_KEY'),
+                    aws_secret_access_key=config.get('STOCKAGE_S3_SECRET_KEY'),
+                    region_name=config.get('STOCKAGE_S3_REGION'),
+                )
+            except ImportError:
+                print("⚠️ boto3 non installé : stockage local utilisé")
+            except Exception as e:
+                print(f"⚠️ Stockage S3 indisponible ({e}) : stockage local utilisé")
+        return StockageLocal(config.get('STOCKAGE_RACINE', 'uploads/objets'))
+
+    # ============================================
+    # DÉPÔT / LIBÉRATION
+    # ============================================
+
+    @classmethod
+    def enregistrer(cls, fichier, entite_type, entite_id, client_id=None, created_by=None,
+                    nom_fichier=None, taille_max=None):
+        """
+        Stocke le contenu de `fichier` (FileStorage ou flux binaire) et ajoute
+        une référence pour l'entité. Ne commite pas : la référence suit la
+        transaction de l'entité. Retourne la ReferenceObjet.
+        Lève FichierTropVolumineux au-delà de taille_max.
+        """
+        backend = cls.backend()
+        if taille_max is None:
+            taille_max = current_app.config.get('STOCKAGE_TAILLE_MAX') or current_app.config.get('MAX_CONTENT_LENGTH')
+        nom_fichier = nom_fichier or getattr(fichier, 'filename', None) or 'fichier'
+        flux = getattr(fichier, 'stream', fichier)
+
+        empreinte = hashlib.sha256()
+        taille = 0
+        descripteur, chemin_temporaire = tempfile.mkstemp(dir=backend.dossier_temporaire())
+        try:
+            with os.fdopen(descripteur, 'wb') as sortie:
+                while True:
+                    bloc = flux.read(TAILLE_BLOC)
+                    if not bloc:
+                        break
+                    taille += len(bloc)
+                    if taille_max and taille > taille_max:
+                        raise FichierTropVolumineux(taille_max)
+                    empreinte.update(bloc)
+                    sortie.write(bloc)
+            sha256 = empreinte.hexdigest()
+            backend.deposer(sha256, chemin_temporaire)
+        finally:
+            if os.path.exists(chemin_temporaire):
+                os.remove(chemin_temporaire)
+
+        type_mime = getattr(fichier, 'mimetype', None) or mimetypes.guess_type(nom_fichier)[0]
+        cls._ajouter_reference_objet(sha256, taille, type_mime, backend.nom)
+
+        reference = ReferenceObjet(
+            sha256=sha256,
+            client_id=client_id,
+            entite_type=entite_type,
+            entite_id=entite_id,
+            nom_fichier=nom_fichier,
+            created_by=created_by,
+        )
+        db.session.add(reference)
+        return reference
+
+    @staticmethod
+    def _ajouter_reference_objet(sha256, taille, type_mime, backend):
+        T = ObjetStocke.__table__
+        maintenant = datetime.utcnow()
+        incrementer = (
+            update(T).where(T.c.sha256 == sha256)
+            .values(nb_references=T.c.nb_references + 1, updated_at=maintenant)
+        )
+        if db.session.execute(incrementer).rowcount:
+            return
+        try:
+            with db.session.begin_nested():
+                db.session.execute(insert(T).values(
+                    sha256=sha256, taille=taille, type_mime=type_mime, backend=backend,
+                    nb_references=1, created_at=maintenant, updated_at=maintenant,
+                ))
+        except IntegrityError:
+            # Même contenu déposé en parallèle
+            db.session.execute(incrementer)
+
+    @staticmethod
+    def references(entite_type, entite_id):
+        return db.session.execute(
+            select(ReferenceObjet)
+            .where(ReferenceObjet.entite_type == entite_type, ReferenceObjet.entite_id == entite_id)
+            .order_by(ReferenceObjet.id)
+        ).scalars().all()
+
+    @classmethod
+    def liberer(cls, entite_type, entite_id, nom_fichier=None):
+        """
+        Retire les références d'une entité (celle d'un seul fichier si précisé).
+        Les objets restent sur le backend jusqu'à purger_orphelins. Sans commit.
+        """
+        R = ReferenceObjet.__table__
+        conditions = [R.c.entite_type == entite_type, R.c.entite_id == entite_id]
+        if nom_fichier:
+            conditions.append(R.c.nom_fichier == nom_fichier)
+        return cls._retirer_references(conditions)
+
+    @classmethod
+    def liberer_lot(cls, entite_type, entite_ids):
+        """Retire les références de plusieurs entités du même type. Sans commit."""
+        if not entite_ids:
+            return 0
+        R = ReferenceObjet.__table__
+        return cls._retirer_references([R.c.entite_type == entite_type, R.c.entite_id.in_(list(entite_ids))])
+
+    @staticmethod
+    def _retirer_references(conditions):
+        R = ReferenceObjet.__table__
+        shas = db.session.execute(select(R.c.sha256).where(*conditions)).scalars().all()
+        if not shas:
+            return 0
+        db.session.execute(delete(R).where(*conditions))
+
+        comptes = {}
+        for sha in shas:
+            comptes[sha] = comptes.get(sha, 0) + 1
+        T = ObjetStocke.__table__
+        maintenant = datetime.utcnow()
+        for sha, nombre in comptes.items():
+            db.session.execute(
+                update(T).where(T.c.sha256 == sha)
+                .values(nb_references=T.c.nb_references - nombre, updated_at=maintenant)
+            )
+        return len(shas)
+
+    @classmethod
+    def purger_orphelins(cls, delai=None):
+        """Supprime les objets sans référence depuis plus de `delai` ; retourne (nombre, octets)"""
+        delai = cls.DELAI_PURGE if delai is None else delai
+        limite = datetime.utcnow() - delai
+        backend = cls.backend()
+        orphelins = db.session.execute(
+            select(ObjetStocke.sha256, ObjetStocke.taille)
+            .where(ObjetStocke.nb_references <= 0, ObjetStocke.updated_at < limite)
+        ).all()
+
+        nombre, octets = 0, 0
+        for sha256, taille in orphelins:
+            # Condition répétée : une référence a pu être ajoutée entre-temps
+            supprime = db.session.execute(
+                delete(ObjetStocke.__table__)
+                .where(ObjetStocke.sha256 == sha256, ObjetStocke.nb_references <= 0)
+            ).rowcount
+            if not supprime:
+                continue
+            db.session.commit()
+            try:
+                backend.supprimer(sha256)
+            except Exception as e:
+                print(f"⚠️ Suppression de l'objet {sha256[:12]} impossible: {e}")
+            nombre += 1
+            octets += taille or 0
+        return nombre, octets
+
+    # ============================================
+    # PIÈCES À CHEMIN_FICHIER (FichierRisque, FichierKRI)
+    # ============================================
+
+    @classmethod
+    def joindre(cls, piece, fichier, entite_type, created_by=None, taille_max=None):
+        """
+        Stocke `fichier` pour une pièce jointe à colonne chemin_fichier :
+        la pièce est ajoutée à la session, référencée sous son id et
+        chemin_fichier reçoit 'objet://<sha256>'. Sans commit.
+        """
+        piece.chemin_fichier = PREFIXE_OBJET  # provisoire, l'id est nécessaire à la référence
+        db.session.add(piece)
+        db.session.flush()
+        reference = cls.enregistrer(
+            fichier, entite_type, piece.id,
+            client_id=getattr(piece, 'client_id', None),
+            created_by=created_by, nom_fichier=piece.nom_fichier, taille_max=taille_max,
+        )
+        piece.chemin_fichier = chemin_objet(reference.sha256)
+        piece.taille = db.session.get(ObjetStocke, reference.sha256).taille
+        return reference
+
+    @classmethod
+    def detacher(cls, piece, entite_type):
+        """Libère le contenu d'une pièce (ancien chemin disque : fichier supprimé)"""
+        if sha_depuis_chemin(piece.chemin_fichier):
+            cls.liberer(entite_type, piece.id)
+        elif piece.chemin_fichier and os.path.exists(piece.chemin_fichier):
+            os.remove(piece.chemin_fichier)
+
+    # ============================================
+    # TÉLÉCHARGEMENT
+    # ============================================
+
+    @classmethod
+    def reponse(cls, sha256, nom_fichier, as_attachment=True, type_mime=None):
+        """Réponse HTTP de l'objet, avec ETag (empreinte) et requêtes Range"""
+        backend = cls.backend()
+        chemin = backend.chemin_local(sha256)
+        if chemin is not None:
+            if not os.path.exists(chemin):
+                abort(404)
+            return send_file(
+                os.path.abspath(chemin),
+                mimetype=type_mime or mimetypes.guess_type(nom_fichier)[0],
+                as_attachment=as_attachment,
+                download_name=nom_fichier,
+                conditional=True,
+                etag=sha256,
+            )
+
+        objet = db.session.get(ObjetStocke, sha256)
+        if objet is None:
+            abort(404)
+
+        entetes = {
+            'Accept-Ranges': 'bytes',
+            'ETag': f'"{sha256}"',
+            'Content-Disposition': "{}; filename*=UTF-8''{}".format(
+                'attachment' if as_attachment else 'inline', quote(nom_fichier)
+            ),
+        }
+        if request.if_none_match.contains(sha256):
+            return Response(status=304, headers=entetes)
+
+        mimetype = type_mime or objet.type_mime or 'application/octet-stream'
+        if request.range is not None:
+            plage = request.range.range_for_length(objet.taille)
+            if plage is None:
+                entetes['Content-Range'] = f"bytes */{objet.taille}"
+                return Response(status=416, headers=entetes)
+            debut, fin = plage
+            entetes['Content-Range'] = f"bytes {debut}-{fin - 1}/{objet.taille}"
+            entetes['Content-Length'] = str(fin - debut)
+            return Response(backend.lire(sha256, debut, fin - 1), status=206,
+                            mimetype=mimetype, headers=entetes, direct_passthrough=True)
+
+        entetes['Content-Length'] = str(objet.taille)
+        return Response(backend.lire(sha256), mimetype=mimetype, headers=entetes, direct_passthrough=True)
+
+    @classmethod
+    def envoyer(cls, chemin_fichier, nom_fichier, as_attachment=True):
+        """Téléchargement d'un chemin_fichier, stocké par contenu ou ancien chemin disque"""
+        sha256 = sha_depuis_chemin(chemin_fichier)
+        if sha256:
+            return cls.reponse(sha256, nom_fichier, as_attachment=as_attachment)
+        if not chemin_fichier or not os.path.exists(chemin_fichier):
+            abort(404)
+        return send_file(os.path.abspath(chemin_fichier), as_attachment=as_attachment,
+                         download_name=nom_fichier, conditional=True)
+
+    # ============================================
+    # COMPTABILITÉ PAR CLIENT
+    # ============================================
+
+    @staticmethod
+    def usage_clients(client_id=None):
+        """
+        Octets logiques (somme des fichiers référencés) et physiques (objets
+        distincts) par client : {client_id: {...}}.
+        """
+        R, O = ReferenceObjet, ObjetStocke
+        logique = select(
+            R.client_id, func.count(R.id), func.coalesce(func.sum(O.taille), 0)
+        ).join(O, O.sha256 == R.sha256).group_by(R.client_id)
+
+        distincts = select(R.client_id, R.sha256).distinct().subquery()
+        physique = select(
+            distincts.c.client_id, func.count(), func.coalesce(func.sum(O.taille), 0)
+        ).join(O, O.sha256 == distincts.c.sha256).group_by(distincts.c.client_id)
+
+        if client_id is not None:
+            logique = logique.where(R.client_id == client_id)
+            physique = physique.where(distincts.c.client_id == client_id)
+
+        usage = {}
+        for cid, nb_fichiers, octets in db.session.execute(logique):
+            usage[cid] = {
+                'nb_fichiers': nb_fichiers,
+                'octets_logiques': int(octets),
+                'nb_objets': 0,
+                'octets_physiques': 0,
+            }
+        for cid, nb_objets, octets in db.session.execute(physique):
+            ligne = usage.setdefault(cid, {'nb_fichiers': 0, 'octets_logiques': 0})
+            ligne['nb_objets'] = nb_objets
+            ligne['octets_physiques'] = int(octets)
+        for ligne in usage.values():
+            ligne['octets_economises'] = ligne['octets_logiques'] - ligne['octets_physiques']
+        return usage
+
+    @classmethod
+    def usage_client(cls, client_id):
+        return cls.usage_clients(client_id).get(client_id, {
+            'nb_fichiers': 0, 'octets_logiques': 0, 'nb_objets': 0,
+            'octets_physiques': 0, 'octets_economises': 0,
+        })
+
+    # ============================================
+    # REPRISE DES FICHIERS EXISTANTS
+    # ============================================
+
+    @classmethod
+    def importer_fichier(cls, chemin, entite_type, entite_id, client_id=None, created_by=None, nom_fichier=None):
+        """Range un fichier disque existant dans le stockage (sans commit ni suppression)"""
+        with open(chemin, 'rb') as flux:
+            return cls.enregistrer(
+                flux, entite_type, entite_id,
+                client_id=client_id, created_by=created_by,
+                nom_fichier=nom_fichier or os.path.basename(chemin), taille_max=0,
+            )
+
+    @classmethod
+    def migrer_pieces(cls, modele, entite_type):
+        """
+        Range dans le stockage les pièces d'un modèle à chemin_fichier encore
+        sur disque, puis supprime les anciens fichiers. Retourne un rapport.
+        """
+        rapport = {'fichiers': 0, 'manquants': 0, 'octets_avant': 0}
+        anciens = []
+        pieces = modele.query.filter(~modele.chemin_fichier.startswith(PREFIXE_OBJET)).all()
+        for piece in pieces:
+            if not piece.chemin_fichier or not os.path.exists(piece.chemin_fichier):
+                rapport['manquants'] += 1
+                continue
+            rapport['octets_avant'] += os.path.getsize(piece.chemin_fichier)
+            reference = cls.importer_fichier(
+                piece.chemin_fichier, entite_type, piece.id,
+                client_id=piece.client_id, created_by=piece.uploaded_by, nom_fichier=piece.nom_fichier,
+            )
+            anciens.append(piece.chemin_fichier)
+            piece.chemin_fichier = chemin_objet(reference.sha256)
+            rapport['fichiers'] += 1
+        db.session.commit()
+
+        for chemin in anciens:
+            try:
+                os.remove(chemin)
+            except OSError as e:
+                print(f"⚠️ Ancien fichier {chemin} non supprimé: {e}")
+        return rapport
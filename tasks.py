@@ -79,6 +79,9 @@ class CollecteScheduler:
             engine = CollecteEngine(self.app, self.db)
             resultat = engine.collecter_source(source_id)
             
+            if resultat.get('anomalies'):
+                logger.warning(f"⚠️ Source {source.nom}: {len(resultat['anomalies'])} valeur(s) anormale(s)")
+            
             if resultat['erreurs']:
                 logger.warning(f"⚠️ Source {source.nom}: {len(resultat['erreurs'])} erreur(s)")
             else:
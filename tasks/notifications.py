@@ -1,7 +1,7 @@
 # tasks/notifications.py
 from apscheduler.schedulers.background import BackgroundScheduler
 from datetime import datetime, timedelta
-from models import db, PlanAction, Recommandation, KRI, MesureKRI, Notification
+from models import db, PlanAction, Recommandation, Notification
 from services.notification_service import NotificationService
 from flask import current_app
 
@@ -35,12 +35,8 @@ def check_echeances_et_alertes():
                             entite_id=reco.id
                         )
             
-            # Vérifier les KRI (dernière mesure > seuil)
-            kris = KRI.query.filter_by(est_actif=True).all()
-            for kri in kris:
-                derniere_mesure = kri.get_derniere_mesure()
-                if derniere_mesure:
-                    NotificationService.notify_kri_alert(kri, derniere_mesure)
+            # Les KRI ne sont plus balayés : les franchissements de seuil sont
+            # détectés à chaque nouvelle mesure (services/kri_seuils_service.py)
             
             db.session.commit()
             print("✅ Vérification des échéances terminée")
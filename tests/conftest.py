@@ -0,0 +1,37 @@
+# tests/conftest.py
+"""
+Application Flask minimale pour les tests : base SQLite dans un fichier
+temporaire (partagée entre threads), seules les tables utiles créées.
+
+Lancement : python -m pytest tests
+"""
+import os
+import sys
+
+import pytest
+from flask import Flask
+
+RACINE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RACINE)
+
+from models import (db, ReponseIACache, TacheIA, KRI, MesureKRI, VersionAnalytiqueKRI,  # noqa: E402
+                    AgregatMesureKRI, Risque, EvaluationRisque, RisqueEtatCourant, GenerationFragment)
+
+TABLES = [ReponseIACache, TacheIA, KRI, MesureKRI, VersionAnalytiqueKRI, AgregatMesureKRI, Risque, EvaluationRisque,
+          RisqueEtatCourant, GenerationFragment]
+
+
+@pytest.fixture
+def app(tmp_path):
+    application = Flask(__name__)
+    application.config.update(
+        TESTING=True,
+        SQLALCHEMY_DATABASE_URI=f"sqlite:///{tmp_path / 'tests.db'}",
+        SQLALCHEMY_TRACK_MODIFICATIONS=False,
+    )
+    db.init_app(application)
+    with application.app_context():
+        db.metadata.create_all(db.engine, tables=[modele.__table__ for modele in TABLES])
+        yield application
+        db.session.remove()
+        db.engine.dispose()
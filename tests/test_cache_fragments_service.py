@@ -0,0 +1,56 @@
+# tests/test_cache_fragments_service.py
+"""Versions des fragments sans Redis : générations partagées en base"""
+import pytest
+from sqlalchemy import event
+
+from models import db, Risque, GenerationFragment
+from services.cache_fragments_service import CacheFragments, _incrementer_generation
+
+
+@pytest.fixture
+def risques_surveilles(app):
+    CacheFragments.surveiller(Risque)
+    yield
+    for evenement in ('after_insert', 'after_update', 'after_delete'):
+        event.remove(Risque, evenement, _incrementer_generation)
+
+
+def version(client_id=1):
+    return CacheFragments.version(client_id, (Risque, Risque.client_id == client_id))
+
+
+def generation(client_id):
+    ligne = db.session.get(GenerationFragment, ('risques', client_id))
+    return ligne.generation if ligne else None
+
+
+def test_generation_incrementee_dans_la_transaction(app, risques_surveilles):
+    db.session.add(Risque(reference='RIS-0001', intitule='Fraude', client_id=1))
+    db.session.commit()
+    avant = version()
+    assert generation(1) == 1
+
+    # Modification sans changement de nombre de lignes ni d'id : seule la génération la voit
+    Risque.query.filter_by(reference='RIS-0001').one().intitule = 'Fraude externe'
+    db.session.commit()
+    assert generation(1) == 2
+    assert version() != avant
+
+
+def test_generations_cloisonnees_par_client(app, risques_surveilles):
+    db.session.add(Risque(reference='RIS-0001', intitule='Sans client'))
+    db.session.commit()
+    avant = version(1)
+
+    db.session.add(Risque(reference='RIS-0002', intitule='Autre client', client_id=2))
+    db.session.commit()
+    assert generation(0) == 1
+    assert generation(2) == 1
+    assert version(1) == avant
+
+
+def test_generation_annulee_au_rollback(app, risques_surveilles):
+    db.session.add(Risque(reference='RIS-0001', intitule='Annulé', client_id=1))
+    db.session.flush()
+    db.session.rollback()
+    assert generation(1) is None
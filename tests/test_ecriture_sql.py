@@ -0,0 +1,62 @@
+# tests/test_ecriture_sql.py
+"""inserer_ou_mettre_a_jour : upsert des lignes de projection"""
+import pytest
+from sqlalchemy import Column, Integer, MetaData, String, Table, create_engine, select
+
+from services.ecriture_sql import inserer_ou_mettre_a_jour
+
+metadata = MetaData()
+T = Table(
+    'projection', metadata,
+    Column('niveau', String(20), primary_key=True),
+    Column('cle_id', Integer, primary_key=True),
+    Column('valeur', Integer),
+    Column('version', Integer),
+)
+
+
+@pytest.fixture
+def connection():
+    moteur = create_engine('sqlite://')
+    metadata.create_all(moteur)
+    with moteur.begin() as connexion:
+        yield connexion
+
+
+def _lignes(connection):
+    return {(l.niveau, l.cle_id): (l.valeur, l.version) for l in connection.execute(select(T))}
+
+
+def test_insertion_puis_mise_a_jour(connection):
+    inserer_ou_mettre_a_jour(connection, T, [{'niveau': 'a', 'cle_id': 1, 'valeur': 1, 'version': 1}],
+                             ['niveau', 'cle_id'])
+    inserer_ou_mettre_a_jour(connection, T, [
+        {'niveau': 'a', 'cle_id': 1, 'valeur': 5, 'version': 1},
+        {'niveau': 'a', 'cle_id': 2, 'valeur': 7, 'version': 1},
+    ], ['niveau', 'cle_id'])
+    assert _lignes(connection) == {('a', 1): (5, 1), ('a', 2): (7, 1)}
+
+
+def test_une_ligne_par_cle(connection):
+    inserer_ou_mettre_a_jour(connection, T, [
+        {'niveau': 'a', 'cle_id': 1, 'valeur': 1, 'version': 1},
+        {'niveau': 'a', 'cle_id': 1, 'valeur': 2, 'version': 1},
+    ], ['niveau', 'cle_id'])
+    assert _lignes(connection) == {('a', 1): (2, 1)}
+
+
+def test_compteur_incremente(connection):
+    for _ in range(3):
+        inserer_ou_mettre_a_jour(connection, T, [{'niveau': 'v', 'cle_id': 1, 'version': 1}],
+                                 ['niveau', 'cle_id'], maj={'version': T.c.version + 1})
+    assert _lignes(connection) == {('v', 1): (None, 3)}
+
+
+def test_autres_bases(connection, monkeypatch):
+    """UPDATE puis INSERT dans un point de sauvegarde"""
+    monkeypatch.setattr(connection.dialect, 'name', 'autre')
+    inserer_ou_mettre_a_jour(connection, T, [{'niveau': 'a', 'cle_id': 1, 'valeur': 1, 'version': 1}],
+                             ['niveau', 'cle_id'])
+    inserer_ou_mettre_a_jour(connection, T, [{'niveau': 'a', 'cle_id': 1, 'valeur': 4, 'version': 1}],
+                             ['niveau', 'cle_id'], maj={'version': T.c.version + 1})
+    assert _lignes(connection) == {('a', 1): (4, 2)}
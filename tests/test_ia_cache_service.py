@@ -0,0 +1,179 @@
+# tests/test_ia_cache_service.py
+"""Cache IA adressé par contenu, avec le fournisseur factice local (sans réseau)"""
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+from models import db, ReponseIACache, TacheIA
+from services.ia_cache_service import IACacheService, FournisseurIAFactice
+
+
+@pytest.fixture
+def fournisseur(monkeypatch):
+    """Fournisseur factice neuf, servi par get_client_openai (IA_FOURNISSEUR=factice)"""
+    monkeypatch.setenv('IA_FOURNISSEUR', 'factice')
+    factice = FournisseurIAFactice(latence=0.2)
+    monkeypatch.setattr(IACacheService, 'fournisseur_factice', factice)
+    return factice
+
+
+def appeler(prompt, client_id=None, ttl=None):
+    """Appel IA typique : le fournisseur n'est interrogé qu'en cas d'absence du cache"""
+    def appel():
+        client = IACacheService.get_client_openai('cle-de-test')
+        reponse = client.chat.completions.create(model='modele-test', messages=[{'role': 'user', 'content': prompt}])
+        return {'texte': reponse.choices[0].message.content}
+
+    return IACacheService.obtenir_ou_calculer(
+        'openai', 'modele-test', prompt, appel, parametres={'temperature': 0}, client_id=client_id, ttl=ttl
+    )
+
+
+def _ligne(client_id):
+    return ReponseIACache.query.filter_by(client_id=client_id).one()
+
+
+# ============================================
+# CACHE
+# ============================================
+
+def test_absence_puis_presence_en_cache(app, fournisseur):
+    premiere = appeler('Analyse du risque de fraude', client_id=1)
+    seconde = appeler('Analyse   du risque de fraude ', client_id=1)  # même prompt une fois normalisé
+
+    assert seconde == premiere
+    assert fournisseur.nb_appels == 1
+    assert _ligne(1).nb_hits == 1
+
+
+def test_parametres_differents_hors_cache(app, fournisseur):
+    IACacheService.obtenir_ou_calculer('openai', 'modele-test', 'prompt', lambda: {'r': 1},
+                                       parametres={'temperature': 0}, client_id=1)
+    resultat = IACacheService.obtenir_ou_calculer('openai', 'modele-test', 'prompt', lambda: {'r': 2},
+                                                  parametres={'temperature': 1}, client_id=1)
+    assert resultat == {'r': 2}
+
+
+def test_expiration_du_ttl(app, fournisseur):
+    appeler('Plan qualité', client_id=1, ttl=3600)
+    assert fournisseur.nb_appels == 1
+
+    # Réponse expirée : supprimée à la lecture, le fournisseur est rappelé
+    ReponseIACache.query.filter_by(client_id=1).update({'expires_at': datetime.utcnow() - timedelta(seconds=1)})
+    db.session.commit()
+    cle, _ = IACacheService.calculer_cle('openai', 'modele-test', 'Plan qualité', {'temperature': 0})
+    assert IACacheService.lire(cle, 1) is None
+    assert ReponseIACache.query.count() == 0
+
+    appeler('Plan qualité', client_id=1, ttl=3600)
+    assert fournisseur.nb_appels == 2
+
+
+def test_ttl_nul_sans_expiration(app, fournisseur):
+    appeler('Sans expiration', client_id=1, ttl=0)
+    assert _ligne(1).expires_at is None
+
+
+def test_purger_expires(app, fournisseur):
+    appeler('Expiré', client_id=1)
+    appeler('Valide', client_id=1)
+    ReponseIACache.query.filter_by(client_id=1).filter(ReponseIACache.id == 1).update(
+        {'expires_at': datetime.utcnow() - timedelta(seconds=1)})
+    db.session.commit()
+
+    assert IACacheService.purger_expires() == 1
+    assert ReponseIACache.query.count() == 1
+
+
+def test_cles_cloisonnees_par_client(app, fournisseur):
+    appeler('Cartographie des risques', client_id=1)
+    appeler('Cartographie des risques', client_id=2)
+    appeler('Cartographie des risques', client_id=None)
+    assert fournisseur.nb_appels == 3
+
+    appeler('Cartographie des risques', client_id=2)
+    assert fournisseur.nb_appels == 3
+    assert ReponseIACache.query.count() == 3
+
+    assert IACacheService.invalider(client_id=1) == 1
+    appeler('Cartographie des risques', client_id=1)
+    assert fournisseur.nb_appels == 4
+
+
+def test_deduplication_des_appels_en_cours(app, fournisseur):
+    resultats = []
+    depart = threading.Barrier(5)
+
+    def travailleur():
+        with app.app_context():
+            depart.wait()
+            resultats.append(appeler('Synthèse des constats', client_id=1))
+
+    threads = [threading.Thread(target=travailleur) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert fournisseur.nb_appels == 1
+    assert len(resultats) == 5
+    assert all(resultat == resultats[0] for resultat in resultats)
+
+
+def test_deduplication_cloisonnee_par_client(app, fournisseur):
+    depart = threading.Barrier(2)
+
+    def travailleur(client_id):
+        with app.app_context():
+            depart.wait()
+            appeler('Même prompt', client_id=client_id)
+
+    threads = [threading.Thread(target=travailleur, args=(client_id,)) for client_id in (1, 2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert fournisseur.nb_appels == 2
+
+
+def test_echec_du_fournisseur_non_mis_en_cache(app, fournisseur):
+    def appel_en_echec():
+        raise RuntimeError('fournisseur indisponible')
+
+    with pytest.raises(RuntimeError):
+        IACacheService.obtenir_ou_calculer('openai', 'modele-test', 'prompt', appel_en_echec, client_id=1)
+    assert ReponseIACache.query.count() == 0
+
+
+# ============================================
+# TÂCHES
+# ============================================
+
+def _tache(tache_id, client_id, created_by):
+    db.session.add(TacheIA(id=tache_id, operation='test', statut='termine', client_id=client_id,
+                           created_by=created_by))
+    db.session.commit()
+
+
+def test_statut_tache_du_client(app):
+    _tache('t-client', client_id=5, created_by=1)
+
+    assert IACacheService.statut_tache('t-client', client_id=5, user_id=2) is not None
+    assert IACacheService.statut_tache('t-client', client_id=6, user_id=1) is None
+    assert IACacheService.statut_tache('t-client', client_id=None, user_id=3) is None
+    assert IACacheService.statut_tache('t-client', super_admin=True) is not None
+
+
+def test_statut_tache_sans_client_reservee_au_createur(app):
+    _tache('t-sans-client', client_id=None, created_by=1)
+
+    assert IACacheService.statut_tache('t-sans-client', client_id=None, user_id=1) is not None
+    assert IACacheService.statut_tache('t-sans-client', client_id=5, user_id=2) is None
+    assert IACacheService.statut_tache('t-sans-client', client_id=None, user_id=2) is None
+    assert IACacheService.statut_tache('t-sans-client', client_id=5, user_id=9, super_admin=True) is not None
+
+
+def test_statut_tache_inconnue(app):
+    assert IACacheService.statut_tache('inexistante', client_id=5, user_id=1) is None
@@ -0,0 +1,102 @@
+# tests/test_kri_analytique_service.py
+"""Cache AnalytiqueKRI invalidé par la version partagée (écritures d'un autre worker)"""
+from datetime import datetime, timedelta
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from sqlalchemy import insert  # noqa: E402
+
+from models import db, KRI, MesureKRI, AgregatMesureKRI  # noqa: E402
+from services.kri_analytique_service import AnalytiqueKRI  # noqa: E402
+
+
+@pytest.fixture
+def kri(app):
+    AnalytiqueKRI._cache.clear()
+    indicateur = KRI(nom='Taux d\'incidents', client_id=1, seuil_alerte=10, seuil_critique=20,
+                     type_indicateur='kri', est_actif=True)
+    db.session.add(indicateur)
+    db.session.commit()
+    debut = datetime.now() - timedelta(days=3)
+    db.session.add_all([
+        MesureKRI(kri_id=indicateur.id, valeur=valeur, date_mesure=debut + timedelta(days=i), client_id=1)
+        for i, valeur in enumerate((4, 6))
+    ])
+    db.session.commit()
+    return indicateur
+
+
+def test_cache_servi_sans_ecriture(app, kri):
+    premier = AnalytiqueKRI.calculer(client_id=1)
+    assert AnalytiqueKRI.calculer(client_id=1) is premier
+    assert premier.get(kri.id)['derniere_valeur'] == 6
+
+
+def test_ecriture_orm_incremente_la_version(app, kri):
+    AnalytiqueKRI.calculer(client_id=1)
+    version = AnalytiqueKRI.version(1)
+
+    mesure = MesureKRI.query.filter_by(kri_id=kri.id).order_by(MesureKRI.date_mesure.desc()).first()
+    mesure.valeur = 25
+    db.session.commit()
+
+    assert AnalytiqueKRI.version(1) != version
+    resultats = AnalytiqueKRI.calculer(client_id=1)
+    assert resultats.get(kri.id)['derniere_valeur'] == 25
+    assert resultats.get(kri.id)['etat'] == 'critique'
+
+
+def test_mesure_sans_client_incremente_le_client_du_kri(app, kri):
+    version = AnalytiqueKRI.version(1)
+    db.session.add(MesureKRI(kri_id=kri.id, valeur=12, date_mesure=datetime.now()))
+    db.session.commit()
+    assert AnalytiqueKRI.version(1) != version
+
+
+def test_ecriture_dun_autre_worker(app, kri):
+    """Le cache local n'est pas touché : seule la version partagée change"""
+    premier = AnalytiqueKRI.calculer(client_id=1)
+
+    with db.engine.begin() as connection:
+        connection.execute(insert(MesureKRI).values(kri_id=kri.id, valeur=30, date_mesure=datetime.now(),
+                                                    client_id=1))
+        AnalytiqueKRI.incrementer(connection, [1])
+
+    resultats = AnalytiqueKRI.calculer(client_id=1)
+    assert resultats is not premier
+    assert resultats.get(kri.id)['derniere_valeur'] == 30
+
+
+def test_autre_client_non_invalide(app, kri):
+    premier = AnalytiqueKRI.calculer(client_id=1)
+    db.session.add(KRI(nom='Autre', client_id=2))
+    db.session.commit()
+    assert AnalytiqueKRI.calculer(client_id=1) is premier
+
+
+def test_invalidation_globale(app, kri):
+    premier = AnalytiqueKRI.calculer(client_id=1)
+    tous = AnalytiqueKRI.calculer()
+    AnalytiqueKRI.invalider()
+    assert AnalytiqueKRI.calculer(client_id=1) is not premier
+    assert AnalytiqueKRI.calculer() is not tous
+
+
+def test_mesures_purgees_comptees_par_leurs_agregats(app, kri):
+    """Journée résumée par la rétention (valeurs 1, 2, 3) : mêmes statistiques que les mesures brutes"""
+    jour = datetime.combine((datetime.now() - timedelta(days=200)).date(), datetime.min.time())
+    db.session.add(AgregatMesureKRI(kri_id=kri.id, granularite='jour', debut=jour, client_id=1, nb_mesures=3,
+                                    valeur_min=1, valeur_max=3, somme=6, somme_carres=14, derniere_valeur=3,
+                                    derniere_date=jour + timedelta(hours=20)))
+    db.session.commit()
+    AnalytiqueKRI.invalider()
+
+    stats = AnalytiqueKRI.calculer(client_id=1).get(kri.id)
+    attendu = np.array([1, 2, 3, 4, 6])
+    assert stats['nb_mesures'] == 5
+    assert stats['moyenne'] == round(attendu.mean(), 2)
+    assert stats['ecart_type'] == round(attendu.std(), 2)
+    assert (stats['min'], stats['max'], stats['derniere_valeur']) == (1, 6, 6)
+    assert stats['periode_couverte'] >= 197
@@ -0,0 +1,55 @@
+# tests/test_kri_series_service.py
+"""Séries KRI en cache et ETag sous la version partagée des données du client"""
+from datetime import datetime, timedelta
+
+import pytest
+
+pytest.importorskip('numpy')
+
+from sqlalchemy import insert  # noqa: E402
+
+from models import db, KRI, MesureKRI  # noqa: E402
+from services.kri_analytique_service import AnalytiqueKRI  # noqa: E402
+from services.kri_series_service import SeriesKRI  # noqa: E402
+
+
+@pytest.fixture
+def kri(app):
+    SeriesKRI._cache.clear()
+    indicateur = KRI(nom='Délai de traitement', client_id=1, seuil_alerte=10, seuil_critique=20)
+    db.session.add(indicateur)
+    db.session.commit()
+    debut = datetime.now() - timedelta(days=5)
+    db.session.add_all([
+        MesureKRI(kri_id=indicateur.id, valeur=valeur, date_mesure=debut + timedelta(days=i), client_id=1)
+        for i, valeur in enumerate((4, 6, 5))
+    ])
+    db.session.commit()
+    return indicateur
+
+
+def test_serie_servie_depuis_le_cache(app, kri):
+    donnees, etag = SeriesKRI.serie(kri, client_id=1)
+    assert donnees['valeurs'] == [4, 6, 5]
+    assert SeriesKRI.serie(kri, client_id=1) == (donnees, etag)
+    assert SeriesKRI.serie(kri, client_id=1)[0] is donnees
+
+
+def test_ecriture_dun_autre_worker(app, kri):
+    """Insertion hors ORM (planificateur de collectes) : seule la version partagée change"""
+    donnees, etag = SeriesKRI.serie(kri, client_id=1)
+
+    with db.engine.begin() as connection:
+        connection.execute(insert(MesureKRI).values(kri_id=kri.id, valeur=30, date_mesure=datetime.now(),
+                                                    client_id=1))
+        AnalytiqueKRI.incrementer(connection, [1])
+
+    nouvelles, nouvel_etag = SeriesKRI.serie(kri, client_id=1)
+    assert nouvel_etag != etag
+    assert nouvelles['valeurs'][-1] == 30
+
+
+def test_etag_identique_entre_workers(app, kri):
+    _, etag = SeriesKRI.serie(kri, client_id=1)
+    SeriesKRI._cache.clear()
+    assert SeriesKRI.serie(kri, client_id=1)[1] == etag
@@ -0,0 +1,69 @@
+# tests/test_risque_derniere_evaluation.py
+"""Risque.derniere_evaluation sans requête par risque sur les listes"""
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.orm import selectinload
+
+from models import db, Risque, EvaluationRisque, RisqueEtatCourant
+
+
+@contextmanager
+def compter_requetes():
+    requetes = []
+
+    def compter(*args):
+        requetes.append(args[2])
+
+    event.listen(db.engine, 'before_cursor_execute', compter)
+    try:
+        yield requetes
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', compter)
+
+
+@pytest.fixture
+def risque_ids(app):
+    ids = []
+    for i in range(3):
+        risque = Risque(reference=f'RIS-{i:04d}', intitule=f'Risque {i}')
+        db.session.add(risque)
+        db.session.flush()
+        evaluation = EvaluationRisque(risque_id=risque.id)
+        db.session.add(evaluation)
+        db.session.flush()
+        # Le premier risque n'a pas encore de dernière évaluation dans son état courant
+        db.session.add(RisqueEtatCourant(risque_id=risque.id, derniere_evaluation_id=evaluation.id if i else None))
+        ids.append(risque.id)
+    db.session.commit()
+    db.session.expunge_all()
+    return ids
+
+
+def test_etat_courant_charge_avec_la_liste(app, risque_ids):
+    risques = Risque.query.options(
+        selectinload(Risque.etat_courant).joinedload(RisqueEtatCourant.derniere_evaluation)
+    ).filter(Risque.id.in_(risque_ids)).all()
+
+    with compter_requetes() as requetes:
+        dernieres = [risque.derniere_evaluation for risque in risques]
+
+    assert requetes == []
+    assert dernieres[0] is None
+    assert [evaluation.risque_id for evaluation in dernieres[1:]] == risque_ids[1:]
+
+
+def test_sans_chargement(app, risque_ids):
+    risque = db.session.get(Risque, risque_ids[1])
+    assert risque.derniere_evaluation.risque_id == risque_ids[1]
+    assert db.session.get(Risque, risque_ids[0]).derniere_evaluation is None
+
+
+def test_evaluations_deja_chargees(app, risque_ids):
+    risque = Risque.query.options(selectinload(Risque.evaluations)).filter_by(id=risque_ids[2]).one()
+
+    with compter_requetes() as requetes:
+        assert risque.derniere_evaluation.risque_id == risque_ids[2]
+
+    assert requetes == []
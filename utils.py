@@ -1,11 +1,18 @@
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
-import numpy as np
+from chargement_differe import ModuleParesseux
+
+
+def _backend_agg():
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+# Bibliothèques lourdes chargées au premier usage (démarrage des workers)
+plt = ModuleParesseux('matplotlib.pyplot', avant=_backend_agg)
+patches = ModuleParesseux('matplotlib.patches', avant=_backend_agg)
+np = ModuleParesseux('numpy')
 from io import BytesIO
 import base64
-from datetime import datetime, timedelta
+from datetime import datetime
 
 def calculer_niveau_risque(impact, probabilite):
     """Calculer le niveau de risque basé sur la matrice des risques - VERSION SYNCHRONISÉE"""
@@ -544,169 +551,27 @@ def generer_matrice_risque_specifique(evaluations, risque_surbrillance=None):
 
 def generer_tableau_bordeaux(risques):
     """Générer le tableau de Bordeaux avec classement par niveau de risque"""
+    from services.historique_evaluations_service import tableau_bordeaux
 
-    tableau = {
-        'actions_prioritaires': [],    # Risques Critiques
-        'surveillance_renforcee': [],  # Risques Élevés
-        'surveillance_courante': [],   # Risques Moyens
-        'actions_limitees': []         # Risques Faibles
-    }
-
-    for risque in risques:
-        # Ignorer les risques archivés - VERSION ROBUSTE
-        if getattr(risque, 'is_archived', False):
-            continue
-
-        # Filtrer uniquement les évaluations confirmées
-        evaluations_confirmees = [
-            e for e in getattr(risque, 'evaluations', [])
-            if getattr(e, 'date_confirmation', None) is not None
-        ]
-
-        if not evaluations_confirmees:
-            continue
-
-        try:
-            # Récupérer la dernière évaluation confirmée
-            derniere_evaluation = max(evaluations_confirmees, key=lambda x: x.date_confirmation)
-            niveau_risque = getattr(derniere_evaluation, 'niveau_risque', None)
-            score = getattr(derniere_evaluation, 'score_risque', 0)
-
-            # Classer par niveau de risque exact
-            entry = {
-                'risque': risque,
-                'score': score,
-                'evaluation': derniere_evaluation,
-                'niveau': niveau_risque
-            }
-
-            if niveau_risque == 'Critique':
-                tableau['actions_prioritaires'].append(entry)
-            elif niveau_risque == 'Élevé':
-                tableau['surveillance_renforcee'].append(entry)
-            elif niveau_risque == 'Moyen':
-                tableau['surveillance_courante'].append(entry)
-            elif niveau_risque == 'Faible':
-                tableau['actions_limitees'].append(entry)
-
-        except Exception as e:
-            print(f"⚠️ Erreur traitement risque {getattr(risque, 'reference', 'N/A')}: {e}")
-            continue
-
-    # Trier chaque catégorie par score décroissant
-    for categorie in tableau:
-        tableau[categorie] = sorted(tableau[categorie], key=lambda x: x['score'], reverse=True)
-
-    print(f"📋 Tableau Bordeaux généré: {sum(len(v) for v in tableau.values())} risques")
-    return tableau
-
-def calculer_tendance_kri(mesures, periode_jours=30):
-    """Calculer la tendance des KRI sur une période donnée"""
-    if not mesures:
-        return 'stable'
-    
-    date_limite = datetime.now() - timedelta(days=periode_jours)
-    mesures_recentes = [m for m in mesures if m.date_mesure >= date_limite]
-    
-    if len(mesures_recentes) < 2:
-        return 'stable'
-    
-    mesures_recentes.sort(key=lambda x: x.date_mesure)
-    valeurs = [m.valeur for m in mesures_recentes]
-    
-    if len(valeurs) > 1:
-        pente = np.polyfit(range(len(valeurs)), valeurs, 1)[0]
-        
-        if pente > 0.1:
-            return 'hausse'
-        elif pente < -0.1:
-            return 'baisse'
-    
-    return 'stable'
-
-def generer_tableau_bordeaux(risques):
-    """Générer le tableau de Bordeaux avec classement par niveau de risque"""
-
-    tableau = {
-        'actions_prioritaires': [],    # Risques Critiques
-        'surveillance_renforcee': [],  # Risques Élevés
-        'surveillance_courante': [],   # Risques Moyens
-        'actions_limitees': []         # Risques Faibles
-    }
-
-    for risque in risques:
-        # Ignorer les risques archivés - VERSION ROBUSTE
-        if getattr(risque, 'is_archived', False):
-            continue
-
-        # Filtrer uniquement les évaluations confirmées
-        evaluations_confirmees = [
-            e for e in getattr(risque, 'evaluations', [])
-            if getattr(e, 'date_confirmation', None) is not None
-        ]
-
-        if not evaluations_confirmees:
-            continue
-
-        try:
-            # Récupérer la dernière évaluation confirmée
-            derniere_evaluation = max(evaluations_confirmees, key=lambda x: x.date_confirmation)
-            niveau_risque = getattr(derniere_evaluation, 'niveau_risque', None)
-            score = getattr(derniere_evaluation, 'score_risque', 0)
-
-            # Classer par niveau de risque exact
-            entry = {
-                'risque': risque,
-                'score': score,
-                'evaluation': derniere_evaluation,
-                'niveau': niveau_risque
-            }
-
-            if niveau_risque == 'Critique':
-                tableau['actions_prioritaires'].append(entry)
-            elif niveau_risque == 'Élevé':
-                tableau['surveillance_renforcee'].append(entry)
-            elif niveau_risque == 'Moyen':
-                tableau['surveillance_courante'].append(entry)
-            elif niveau_risque == 'Faible':
-                tableau['actions_limitees'].append(entry)
-
-        except Exception as e:
-            print(f"⚠️ Erreur traitement risque {getattr(risque, 'reference', 'N/A')}: {e}")
-            continue
-
-    # Trier chaque catégorie par score décroissant
-    for categorie in tableau:
-        tableau[categorie] = sorted(tableau[categorie], key=lambda x: x['score'], reverse=True)
+    tableau = tableau_bordeaux(risques)
 
     print(f"📋 Tableau Bordeaux généré: {sum(len(v) for v in tableau.values())} risques")
     return tableau
 
 
-
 def calculer_tendance_kri(mesures, periode_jours=30):
-    """Calculer la tendance des KRI sur une période donnée"""
+    """Calculer la tendance des KRI sur une période donnée (voir AnalytiqueKRI pour un lot)"""
     if not mesures:
         return 'stable'
     
-    date_limite = datetime.now() - timedelta(days=periode_jours)
-    mesures_recentes = [m for m in mesures if m.date_mesure >= date_limite]
-    
-    if len(mesures_recentes) < 2:
-        return 'stable'
-    
-    mesures_recentes.sort(key=lambda x: x.date_mesure)
-    valeurs = [m.valeur for m in mesures_recentes]
-    
-    if len(valeurs) > 1:
-        pente = np.polyfit(range(len(valeurs)), valeurs, 1)[0]
-        
-        if pente > 0.1:
-            return 'hausse'
-        elif pente < -0.1:
-            return 'baisse'
+    from services.kri_analytique_service import analyser_series
     
-    return 'stable'
+    mesures = sorted(mesures, key=lambda x: x.date_mesure)
+    resultat = analyser_series([0] * len(mesures),
+                               [m.date_mesure for m in mesures],
+                               [m.valeur for m in mesures],
+                               periode_jours=periode_jours)
+    return resultat['tendance'][0]
 
 def generer_rapport_conformite(actions):
     """Générer un rapport de conformité détaillé"""
@@ -802,8 +667,8 @@ def generer_organigramme_svg(processus):
 
 def mettre_a_jour_statistiques_cartographie(cartographie_id):
     """Mettre à jour les statistiques d'une cartographie - Version complète corrigée"""
-    from models import Cartographie, Risque, EvaluationRisque, db
-    from sqlalchemy import func, and_
+    from models import Cartographie, Risque, EvaluationRisque, RisqueEtatCourant, db
+    from sqlalchemy import func
     from datetime import datetime
     
     cartographie = Cartographie.query.get(cartographie_id)
@@ -820,49 +685,26 @@ def mettre_a_jour_statistiques_cartographie(cartographie_id):
             is_archived=False
         ).count()
         
-        # 2. Compter les risques évalués
-        risques_evalues = db.session.query(Risque)\
-            .join(EvaluationRisque)\
+        # Dernière évaluation de chaque risque : lue dans l'état courant (risque_etat_courant)
+        dernieres_evaluations = db.session.query(EvaluationRisque)\
+            .join(RisqueEtatCourant, RisqueEtatCourant.derniere_evaluation_id == EvaluationRisque.id)\
+            .join(Risque, Risque.id == RisqueEtatCourant.risque_id)\
             .filter(
                 Risque.cartographie_id == cartographie_id,
                 Risque.is_archived == False
-            )\
-            .distinct()\
-            .count()
+            )
         
-        # 3. Calculer le score moyen
-        # Sous-requête pour les dernières évaluations
-        derniere_eval_subquery = db.session.query(
-            EvaluationRisque.risque_id,
-            func.max(EvaluationRisque.created_at).label('max_date')
-        ).group_by(EvaluationRisque.risque_id).subquery()
+        # 2. Compter les risques évalués
+        risques_evalues = dernieres_evaluations.count()
         
-        score_moyen = db.session.query(func.avg(EvaluationRisque.score_risque))\
-            .join(derniere_eval_subquery, and_(
-                EvaluationRisque.risque_id == derniere_eval_subquery.c.risque_id,
-                EvaluationRisque.created_at == derniere_eval_subquery.c.max_date
-            ))\
-            .join(Risque, EvaluationRisque.risque_id == Risque.id)\
-            .filter(
-                Risque.cartographie_id == cartographie_id,
-                Risque.is_archived == False
-            )\
-            .scalar()
+        # 3. Calculer le score moyen
+        score_moyen = dernieres_evaluations.with_entities(func.avg(EvaluationRisque.score_risque)).scalar()
         
         # 4. Compter les risques par niveau
-        niveaux_risques = db.session.query(
+        niveaux_risques = dernieres_evaluations.with_entities(
             EvaluationRisque.niveau_risque,
             func.count(EvaluationRisque.id)
-        ).join(derniere_eval_subquery, and_(
-            EvaluationRisque.risque_id == derniere_eval_subquery.c.risque_id,
-            EvaluationRisque.created_at == derniere_eval_subquery.c.max_date
-        ))\
-         .join(Risque, EvaluationRisque.risque_id == Risque.id)\
-         .filter(
-             Risque.cartographie_id == cartographie_id,
-             Risque.is_archived == False
-         )\
-         .group_by(EvaluationRisque.niveau_risque).all()
+        ).group_by(EvaluationRisque.niveau_risque).all()
         
         # 5. Préparer les statistiques complètes
         statistiques = {
@@ -926,86 +768,37 @@ def calculer_score_risque_moyen(risques):
     if not risques:
         return 0
     
-    scores = []
-    for risque in risques:
-        # Ignorer les risques archivés
-        if hasattr(risque, 'is_archived') and risque.is_archived:
-            continue
-            
-        evaluations_validees = [e for e in risque.evaluations if e.statut == 'valide']
-        if evaluations_validees:
-            derniere_eval = max(evaluations_validees, key=lambda x: x.created_at)
-            scores.append(derniere_eval.score_risque)
-    
-    return sum(scores) / len(scores) if scores else 0
+    from services.historique_evaluations_service import HistoriqueEvaluations
+    return HistoriqueEvaluations.pour_risques(risques).score_moyen()
 
 def analyser_tendances_risques(risques, periode_jours=90):
     """Analyser les tendances des risques sur une période donnée"""
-    date_limite = datetime.now() - timedelta(days=periode_jours)
-    
-    tendances = {
-        'risques_critiques': 0,
-        'risques_en_hausse': 0,
-        'risques_en_baisse': 0,
-        'risques_stables': 0,
-        'nouveaux_risques': 0
-    }
-    
-    for risque in risques:
-        # Ignorer les risques archivés
-        if hasattr(risque, 'is_archived') and risque.is_archived:
-            continue
-            
-        # Évaluations récentes
-        evaluations_recentes = [e for e in risque.evaluations 
-                              if e.created_at >= date_limite and e.statut == 'valide']
-        
-        if not evaluations_recentes:
-            continue
-            
-        # Trier par date
-        evaluations_recentes.sort(key=lambda x: x.created_at)
-        
-        # Vérifier si c'est un nouveau risque
-        if len(evaluations_recentes) == 1 and (datetime.now() - evaluations_recentes[0].created_at).days <= 30:
-            tendances['nouveaux_risques'] += 1
-        
-        # Analyser la tendance
-        if len(evaluations_recentes) >= 2:
-            premier_score = evaluations_recentes[0].score_risque
-            dernier_score = evaluations_recentes[-1].score_risque
-            
-            if dernier_score > premier_score + 2:  # Hausse significative
-                tendances['risques_en_hausse'] += 1
-            elif dernier_score < premier_score - 2:  # Baisse significative
-                tendances['risques_en_baisse'] += 1
-            else:
-                tendances['risques_stables'] += 1
-        
-        # Vérifier risque critique
-        derniere_eval = evaluations_recentes[-1]
-        if derniere_eval.score_risque >= 16:
-            tendances['risques_critiques'] += 1
-    
-    return tendances
+    from services.historique_evaluations_service import HistoriqueEvaluations
+    return HistoriqueEvaluations.pour_risques(risques).tendances(periode_jours)
 
 def generer_heatmap_risques(cartographie):
     """Générer une heatmap des risques pour une cartographie"""
     fig, ax = plt.subplots(figsize=(10, 8))
     
-    # Préparer les données pour la heatmap
+    from models import db, Risque, RisqueEtatCourant
+    from sqlalchemy import func, or_
+    
+    # Préparer les données pour la heatmap : impact × probabilité de l'état courant
+    # (dernière évaluation confirmée ou validée), compté par cellule en une requête
     data = np.zeros((5, 5))
     
-    for risque in cartographie.risques:
-        if hasattr(risque, 'is_archived') and risque.is_archived:
-            continue
-            
-        if risque.evaluations:
-            derniere_eval = max(risque.evaluations, key=lambda x: x.created_at)
-            if derniere_eval.impact and derniere_eval.probabilite:
-                i = derniere_eval.impact - 1
-                j = derniere_eval.probabilite - 1
-                data[i, j] += 1
+    cellules = db.session.query(
+        RisqueEtatCourant.impact, RisqueEtatCourant.probabilite, func.count()
+    ).join(Risque, RisqueEtatCourant.risque_id == Risque.id).filter(
+        Risque.cartographie_id == cartographie.id,
+        # is_archived NULL : risque non archivé
+        or_(Risque.is_archived == False, Risque.is_archived.is_(None)),
+        RisqueEtatCourant.impact.between(1, 5),
+        RisqueEtatCourant.probabilite.between(1, 5)
+    ).group_by(RisqueEtatCourant.impact, RisqueEtatCourant.probabilite).all()
+    
+    for impact, probabilite, nb in cellules:
+        data[impact - 1, probabilite - 1] += nb
     
     # Créer la heatmap
     im = ax.imshow(data, cmap='YlOrRd', interpolation='nearest')
@@ -1047,18 +840,8 @@ def calculer_indice_severite(risques):
     if not risques:
         return 0
     
-    scores_severite = []
-    for risque in risques:
-        if hasattr(risque, 'is_archived') and risque.is_archived:
-            continue
-            
-        if risque.evaluations:
-            derniere_eval = max(risque.evaluations, key=lambda x: x.created_at)
-            # Indice de sévérité = impact * probabilité (score normalisé)
-            severite = (derniere_eval.impact * derniere_eval.probabilite) / 25.0
-            scores_severite.append(severite)
-    
-    return round(sum(scores_severite) / len(scores_severite) * 100, 2) if scores_severite else 0
+    from services.historique_evaluations_service import HistoriqueEvaluations
+    return HistoriqueEvaluations.pour_risques(risques).indice_severite()
 
 def generer_radar_chart_risques(cartographie):
     """Générer un radar chart des risques par catégorie"""
@@ -2358,8 +2141,19 @@ def get_niveau_risque_matrice(score):
         return {'nom': 'Critique', 'couleur': 'critique', 'classe': 'matrice-connectee-critique'}
 
 def calculer_statistiques_kri(kri):
-    """Calcule les statistiques détaillées d'un KRI"""
-    if not kri.mesures:
+    """Calcule les statistiques détaillées d'un KRI (mêmes règles que AnalytiqueKRI)"""
+    from models import AgregatMesureKRI
+    from services.kri_analytique_service import (analyser_series, agregats_journaliers,
+                                                 series_avec_agregats, ResultatsKRI)
+    
+    # Mesures purgées par la rétention : comptées par leurs agrégats journaliers
+    mesures_triees = sorted(kri.mesures, key=lambda x: x.date_mesure)
+    kri_ids, dates, valeurs, cumuls = series_avec_agregats(
+        [(kri.id, m.date_mesure, m.valeur) for m in mesures_triees],
+        agregats_journaliers(AgregatMesureKRI.kri_id == kri.id)
+    )
+    stats = ResultatsKRI(analyser_series(kri_ids, dates, valeurs, cumuls=cumuls)).get(kri.id)
+    if stats is None:
         return {
             'moyenne': 0,
             'min': 0,
@@ -2369,25 +2163,16 @@ def calculer_statistiques_kri(kri):
             'ecart_type': 0
         }
     
-    valeurs = [m.valeur for m in kri.mesures]
-    dates = [m.date_mesure for m in kri.mesures]
-    
-    # Trier par date
-    mesures_triees = sorted(zip(dates, valeurs), key=lambda x: x[0])
-    valeurs_triees = [v for d, v in mesures_triees]
-    
-    stats = {
-        'moyenne': round(np.mean(valeurs), 2),
-        'min': round(min(valeurs), 2),
-        'max': round(max(valeurs), 2),
-        'derniere_valeur': valeurs_triees[-1] if valeurs_triees else 0,
-        'ecart_type': round(np.std(valeurs), 2) if len(valeurs) > 1 else 0,
-        'tendance': calculer_tendance_kri_detaille(valeurs_triees),
-        'nb_mesures': len(valeurs),
-        'periode_couverte': (max(dates) - min(dates)).days if len(dates) > 1 else 0
+    return {
+        'moyenne': stats['moyenne'],
+        'min': stats['min'],
+        'max': stats['max'],
+        'derniere_valeur': stats['derniere_valeur'],
+        'ecart_type': stats['ecart_type'],
+        'tendance': stats['tendance_detaillee'],
+        'nb_mesures': stats['nb_mesures'],
+        'periode_couverte': stats['periode_couverte']
     }
-    
-    return stats
 
 def calculer_tendance_kri_detaille(valeurs):
     """Calcule la tendance détaillée d'un KRI"""
@@ -2412,54 +2197,10 @@ def calculer_tendance_kri_detaille(valeurs):
     else:
         return 'stable'
 
-def generer_graphique_kri(kri):
-    """Génère un graphique d'évolution du KRI"""
-    if not kri.mesures:
-        return None
-    
-    mesures_triees = sorted(kri.mesures, key=lambda x: x.date_mesure)
-    dates = [m.date_mesure.strftime('%d/%m/%Y') for m in mesures_triees]
-    valeurs = [m.valeur for m in mesures_triees]
-    
-    fig, ax = plt.subplots(figsize=(10, 6))
-    
-    # Courbe principale
-    ax.plot(dates, valeurs, 'b-', linewidth=2, marker='o', markersize=4, label='Valeur KRI')
-    
-    # Seuils d'alerte
-    if kri.seuil_alerte:
-        ax.axhline(y=kri.seuil_alerte, color='orange', linestyle='--', 
-                  label=f'Seuil alerte ({kri.seuil_alerte})')
-    
-    if kri.seuil_critique:
-        ax.axhline(y=kri.seuil_critique, color='red', linestyle='--', 
-                  label=f'Seuil critique ({kri.seuil_critique})')
-    
-    ax.set_xlabel('Date')
-    ax.set_ylabel(f'Valeur ({kri.unite_mesure})')
-    ax.set_title(f'Évolution du KRI - {kri.nom}')
-    ax.legend()
-    ax.grid(True, alpha=0.3)
-    
-    # Rotation des dates pour meilleure lisibilité
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-    
-    # Conversion en base64
-    buffer = BytesIO()
-    plt.savefig(buffer, format='png', dpi=100, bbox_inches='tight')
-    buffer.seek(0)
-    image_png = buffer.getvalue()
-    buffer.close()
-    
-    graphic = base64.b64encode(image_png).decode('utf-8')
-    plt.close()
-    
-    return graphic
 def synchroniser_kri_automatique():
-    """Synchronisation automatique des KRI"""
-    from models import KRI, MesureKRI, Risque, db
-    from datetime import datetime, timedelta
+    """Synchronisation automatique des KRI (statistiques calculées en lot)"""
+    from models import KRI, db
+    from services.kri_analytique_service import AnalytiqueKRI
     
     print("🔄 SYNCHRONISATION AUTOMATIQUE DES KRI...")
     
@@ -2467,21 +2208,23 @@ def synchroniser_kri_automatique():
         kris = KRI.query.filter_by(est_actif=True).all()
         kris_synchronises = 0
         
+        # Tendances et dernières valeurs de tous les KRI actifs en une passe
+        resultats = AnalytiqueKRI.calculer()
+        
         for kri in kris:
             # Vérifier si une synchronisation est nécessaire
+            derniere_sync = getattr(kri, 'derniere_sync', None)
             besoin_sync = (
-                kri.derniere_sync is None or 
-                (datetime.utcnow() - kri.derniere_sync).total_seconds() > 3600  # 1 heure
+                derniere_sync is None or 
+                (datetime.utcnow() - derniere_sync).total_seconds() > 3600  # 1 heure
             )
             
             if besoin_sync:
-                # Mettre à jour la tendance
-                kri.tendance = calculer_tendance_kri(kri.mesures)
+                # Mettre à jour la tendance (les franchissements de seuil sont détectés
+                # à l'arrivée de chaque mesure par EvaluateurSeuilsKRI)
+                kri.tendance = resultats.tendance(kri.id)
                 kri.derniere_sync = datetime.utcnow()
                 kris_synchronises += 1
-                
-                # Vérifier les alertes de seuil
-                verifier_alertes_kri(kri)
         
         db.session.commit()
         print(f"✅ {kris_synchronises}/{len(kris)} KRI synchronisés")
@@ -2493,43 +2236,10 @@ def synchroniser_kri_automatique():
         return False
 
 def verifier_alertes_kri(kri):
-    """Vérifier et créer des alertes pour les KRI dépassant les seuils"""
-    from models import Alerte, MesureKRI, db
+    """Réévaluer l'état de seuil d'un KRI (alerte créée seulement si l'état s'aggrave)"""
+    from services.kri_seuils_service import EvaluateurSeuilsKRI
     
-    if not kri.mesures:
-        return
-    
-    derniere_mesure = MesureKRI.query.filter_by(kri_id=kri.id).order_by(MesureKRI.date_mesure.desc()).first()
-    if not derniere_mesure:
-        return
-    
-    valeur = derniere_mesure.valeur
-    
-    # Vérifier le seuil critique
-    if kri.seuil_critique and valeur >= kri.seuil_critique:
-        alerte = Alerte(
-            type='kri_critique',
-            gravite='haute',
-            titre=f"KRI {kri.nom} - Seuil critique dépassé",
-            description=f"Le KRI {kri.nom} a atteint la valeur {valeur}, dépassant le seuil critique de {kri.seuil_critique}",
-            entite_type='kri',
-            entite_id=kri.id,
-            created_by=1  # Système
-        )
-        db.session.add(alerte)
-    
-    # Vérifier le seuil d'alerte
-    elif kri.seuil_alerte and valeur >= kri.seuil_alerte:
-        alerte = Alerte(
-            type='kri_alerte', 
-            gravite='moyenne',
-            titre=f"KRI {kri.nom} - Seuil d'alerte dépassé",
-            description=f"Le KRI {kri.nom} a atteint la valeur {valeur}, dépassant le seuil d'alerte de {kri.seuil_alerte}",
-            entite_type='kri',
-            entite_id=kri.id,
-            created_by=1  # Système
-        )
-        db.session.add(alerte)
+    EvaluateurSeuilsKRI.reevaluer([kri.id])
 
 def synchroniser_kri_risque(risque_id):
     """Synchroniser les KRI d'un risque spécifique"""
@@ -2708,20 +2418,15 @@ def create_notification(user_id, type, title, message, entity_type=None, entity_
 
 def track_user_session(user_id, session_id, ip_address=None, user_agent=None):
     """Suit une session utilisateur"""
+    from services.session_utilisateur_service import SessionUtilisateurService
     try:
-        # Désactiver les sessions précédentes
-        UserSession.query.filter_by(user_id=user_id, is_active=True).update({'is_active': False})
-        
-        # Créer la nouvelle session
-        session = UserSession(
+        SessionUtilisateurService.enregistrer_ouverture(
             user_id=user_id,
             session_id=session_id,
             ip_address=ip_address or (request.remote_addr if request else None),
             user_agent=user_agent or (request.user_agent.string if request else None)
         )
-        db.session.add(session)
-        db.session.commit()
-        return session
+        return True
     except Exception as e:
         log_system('error', 'session', f"Erreur suivi session: {e}")
         return None
@@ -2729,12 +2434,9 @@ def track_user_session(user_id, session_id, ip_address=None, user_agent=None):
 
 def end_user_session(session_id):
     """Termine une session utilisateur"""
+    from services.session_utilisateur_service import SessionUtilisateurService
     try:
-        session = UserSession.query.filter_by(session_id=session_id, is_active=True).first()
-        if session:
-            session.is_active = False
-            session.logout_time = datetime.utcnow()
-            db.session.commit()
+        SessionUtilisateurService.enregistrer_fermeture(session_id)
     except Exception as e:
         log_system('error', 'session', f"Erreur fin session: {e}")
 